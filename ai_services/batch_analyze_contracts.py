@@ -0,0 +1,366 @@
+"""
+Phân tích rủi ro hàng loạt (portfolio) bằng analyze_contract của Lambda callllm,
+thay cho việc gọi HTTP từng hợp đồng khi cần rà soát lại sau khi luật thay đổi.
+
+Manifest (JSONL hoặc JSON array), mỗi item là một hợp đồng:
+
+    {"id": "hd-0001", "contract_text": "HỢP ĐỒNG THUÊ NHÀ ..."}
+    {"id": "hd-0002", "s3_key": "contracts/2024/hd-0002.pdf", "bucket": "my-contracts"}
+    {"id": "hd-0003", "s3_uri": "s3://my-contracts/contracts/2024/hd-0003.txt", "language": "vi"}
+
+- Chạy trên thread pool (mặc định) hoặc process pool; số call Bedrock đồng thời
+  bị giới hạn theo từng modelId (--model-concurrency).
+- Kết quả rag_search được cache trong process (RAG_RESULT_CACHE_SIZE của callllm),
+  các bản sao của cùng một hợp đồng mẫu chỉ gọi RAG một lần.
+- Mỗi item xong được ghi ngay một dòng vào report JSONL; --resume bỏ qua các id
+  đã "ok" trong report nên chạy lại sau khi bị ngắt không phải làm lại từ đầu.
+
+Ví dụ:
+
+    # AWS thật (cần MODEL_ID, RAG_FUNCTION_NAME như Lambda callllm)
+    python batch_analyze_contracts.py manifest.jsonl --report portfolio_report.jsonl \\
+        --workers 16 --model-concurrency 4 --resume
+
+    # Chạy thử với stand-in local, không cần AWS
+    python batch_analyze_contracts.py --local-synthetic 200 --report /tmp/report.jsonl
+"""
+
+import argparse
+import base64
+import importlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+TEXT_FORMATS = {"txt", "md", "html"}
+
+# Module callllm của process hiện tại (thread pool dùng chung, process pool mỗi
+# worker một bản - xem _init_worker)
+_CALLLLM = None
+
+
+# -----------------------------------------------------------------------------
+# Giới hạn concurrency theo model
+# -----------------------------------------------------------------------------
+
+class ModelConcurrencyLimiter:
+    """
+    Bọc client bedrock-runtime: converse / invoke_model chờ semaphore của modelId
+    tương ứng. caps = {"model_id": n}; model không có trong caps dùng default_cap.
+    """
+
+    def __init__(self, client, default_cap: int, caps: Optional[Dict[str, int]] = None):
+        self._client = client
+        self._default_cap = max(1, default_cap)
+        self._caps = dict(caps or {})
+        self._semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, model_id: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            sem = self._semaphores.get(model_id)
+            if sem is None:
+                sem = threading.BoundedSemaphore(max(1, self._caps.get(model_id, self._default_cap)))
+                self._semaphores[model_id] = sem
+            return sem
+
+    def converse(self, **kwargs):
+        with self._semaphore(kwargs.get("modelId", "")):
+            return self._client.converse(**kwargs)
+
+    def invoke_model(self, **kwargs):
+        with self._semaphore(kwargs.get("modelId", "")):
+            return self._client.invoke_model(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def parse_model_caps(spec: str) -> Tuple[int, Dict[str, int]]:
+    """"4" -> (4, {}); "4,anthropic.claude-3-5-sonnet...=2" -> (4, {model: 2})"""
+    default_cap = 4
+    caps: Dict[str, int] = {}
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "=" in part:
+            model_id, _, value = part.rpartition("=")
+            caps[model_id.strip()] = int(value)
+        else:
+            default_cap = int(part)
+    return default_cap, caps
+
+
+# -----------------------------------------------------------------------------
+# Khởi tạo module callllm (AWS thật hoặc stand-in local)
+# -----------------------------------------------------------------------------
+
+def load_callllm(local_cfg: Optional[Dict[str, Any]], default_cap: int, caps: Dict[str, int], rag_cache_size: int):
+    if local_cfg:
+        import local_aws_stubs as stubs
+
+        stack = stubs.LocalAwsStack(
+            dim=local_cfg["dim"],
+            embed_latency_ms=local_cfg["embed_latency_ms"],
+            converse_latency_ms=local_cfg["converse_latency_ms"],
+        )
+        stack.seed_legal_index(stubs.make_synthetic_corpus(n_chunks=local_cfg["chunks"], dim=local_cfg["dim"]))
+        stack.load("ragsearch")
+        module = stack.load("callllm")
+    else:
+        module = importlib.import_module("lambda_function_callllm")
+
+    module.bedrock = ModelConcurrencyLimiter(module.bedrock, default_cap, caps)
+    module.RAG_RESULT_CACHE_SIZE = rag_cache_size
+    return module
+
+
+def _init_worker(local_cfg, default_cap, caps, rag_cache_size):
+    global _CALLLLM
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    _CALLLLM = load_callllm(local_cfg, default_cap, caps, rag_cache_size)
+
+
+# -----------------------------------------------------------------------------
+# Manifest
+# -----------------------------------------------------------------------------
+
+def load_manifest(path: str) -> List[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as f:
+        raw = f.read()
+    if raw.lstrip().startswith("["):
+        items = json.loads(raw)
+    else:
+        items = [json.loads(line) for line in raw.splitlines() if line.strip()]
+
+    for i, item in enumerate(items):
+        if not item.get("id"):
+            item["id"] = item.get("s3_uri") or item.get("s3_key") or f"item-{i:06d}"
+    return items
+
+
+def synthetic_manifest(n: int, n_distinct: int = 10) -> List[Dict[str, Any]]:
+    """Portfolio giả lập: n hợp đồng từ n_distinct mẫu (giống thực tế, nhiều bản sao cùng mẫu)."""
+    import local_aws_stubs as stubs
+
+    bases = [tpl["raw_text"] for tpl in stubs.make_synthetic_templates(max(1, n_distinct))]
+    return [
+        {"id": f"hd-{i:05d}", "contract_text": bases[i % len(bases)]}
+        for i in range(n)
+    ]
+
+
+def load_done_ids(report_path: str) -> Set[str]:
+    done: Set[str] = set()
+    if not os.path.exists(report_path):
+        return done
+    with open(report_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # dòng ghi dở khi bị ngắt
+            if rec.get("status") == "ok":
+                done.add(rec["id"])
+    return done
+
+
+def drop_partial_last_line(report_path: str) -> None:
+    """Cắt dòng cuối ghi dở (bị ngắt giữa chừng) trước khi ghi nối tiếp report."""
+    if not os.path.exists(report_path):
+        return
+    with open(report_path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+
+def _split_s3_uri(uri: str) -> Tuple[str, str]:
+    without_scheme = uri[len("s3://"):]
+    bucket, _, key = without_scheme.partition("/")
+    return bucket, key
+
+
+def build_request(item: Dict[str, Any], s3) -> Dict[str, Any]:
+    """Item manifest -> request body của callllm (text hoặc file)."""
+    data = {"language": item.get("language") or "vi"}
+    if item.get("contract_text"):
+        data["contract_text"] = item["contract_text"]
+        return data
+
+    if item.get("s3_uri"):
+        bucket, key = _split_s3_uri(item["s3_uri"])
+    else:
+        bucket, key = item.get("bucket") or os.getenv("CONTRACT_BUCKET"), item.get("s3_key")
+    if not bucket or not key:
+        raise ValueError("item needs contract_text, s3_uri or s3_key (+ bucket / CONTRACT_BUCKET)")
+
+    body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    file_format = (item.get("file_format") or key.rsplit(".", 1)[-1]).lower()
+    if file_format in TEXT_FORMATS:
+        # Text thuần đi nhánh TEXT để có context RAG
+        data["contract_text"] = body.decode("utf-8", errors="replace")
+    else:
+        data["file_bytes_base64"] = base64.b64encode(body).decode("ascii")
+        data["file_format"] = file_format
+        data["file_name"] = key.rsplit("/", 1)[-1]
+    return data
+
+
+# -----------------------------------------------------------------------------
+# Worker
+# -----------------------------------------------------------------------------
+
+def analyze_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    module = _CALLLLM
+    t0 = time.perf_counter()
+    row: Dict[str, Any] = {"id": item["id"]}
+    try:
+        data = build_request(item, module.s3)
+        contract_input = module.parse_contract_input(data)
+        debug: Dict[str, Any] = {}
+        analysis, _ = module.analyze_contract(contract_input, debug=debug)
+        row.update(
+            status="ok",
+            language=contract_input.language,
+            overall_risk_level=analysis.get("overall_risk_level"),
+            risk_items=len(analysis.get("risk_items") or []),
+            rag_context=debug.get("rag_context"),
+            analysis=analysis,
+        )
+    except Exception as e:
+        row.update(status="error", error={"type": type(e).__name__, "message": str(e)})
+    row["duration_ms"] = round((time.perf_counter() - t0) * 1000.0, 1)
+    return row
+
+
+def run_batch(
+    items: Iterable[Dict[str, Any]],
+    report_path: str,
+    workers: int,
+    executor_kind: str,
+    init_args: tuple,
+    append: bool,
+) -> Dict[str, Any]:
+    items = list(items)
+    counts: Counter = Counter()
+    risk_levels: Counter = Counter()
+    durations: List[float] = []
+
+    if executor_kind == "process":
+        # Mỗi process có semaphore riêng: chia đều cap cho các worker
+        local_cfg, default_cap, caps, rag_cache_size = init_args
+        per_proc = max(1, default_cap // workers)
+        per_proc_caps = {m: max(1, c // workers) for m, c in caps.items()}
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(local_cfg, per_proc, per_proc_caps, rag_cache_size),
+        )
+    else:
+        _init_worker(*init_args)
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+    t0 = time.perf_counter()
+    with executor, open(report_path, "a" if append else "w", encoding="utf-8") as report:
+        futures = [executor.submit(analyze_item, item) for item in items]
+        for n, fut in enumerate(as_completed(futures), 1):
+            row = fut.result()
+            # Checkpoint: ghi + flush từng item
+            report.write(json.dumps(row, ensure_ascii=False) + "\n")
+            report.flush()
+
+            counts[row["status"]] += 1
+            durations.append(row["duration_ms"])
+            if row["status"] == "ok":
+                risk_levels[row.get("overall_risk_level") or "UNKNOWN"] += 1
+            if n % 50 == 0 or n == len(futures):
+                elapsed = time.perf_counter() - t0
+                print(f"  {n}/{len(futures)} done, {n / elapsed * 60.0:.1f} contracts/min", flush=True)
+    elapsed = time.perf_counter() - t0
+
+    durations.sort()
+    summary = {
+        "items": len(items),
+        "ok": counts["ok"],
+        "failed": counts["error"],
+        "elapsed_s": round(elapsed, 2),
+        "contracts_per_minute": round(len(items) / elapsed * 60.0, 1) if elapsed > 0 else None,
+        "p50_item_ms": durations[len(durations) // 2] if durations else None,
+        "risk_levels": dict(risk_levels),
+    }
+    if executor_kind == "thread" and _CALLLLM is not None:
+        summary["rag_cache"] = dict(_CALLLLM.RAG_RESULT_CACHE_STATS)
+    return summary
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("manifest", nargs="?", help="file JSONL / JSON array các hợp đồng")
+    parser.add_argument("--report", required=True, help="report JSONL (đồng thời là checkpoint)")
+    parser.add_argument("--resume", action="store_true", help="bỏ qua id đã ok trong report, ghi nối tiếp")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--executor", choices=("thread", "process"), default="thread")
+    parser.add_argument("--model-concurrency", default="4",
+                        help='số call Bedrock đồng thời mỗi model, vd "4" hoặc "4,<model_id>=2"')
+    parser.add_argument("--rag-cache-size", type=int, default=1024)
+    parser.add_argument("--summary", help="ghi summary JSON")
+    local = parser.add_argument_group("local stand-in (không cần AWS)")
+    local.add_argument("--local-synthetic", type=int, metavar="N", help="portfolio giả lập N hợp đồng")
+    local.add_argument("--local", action="store_true", help="chạy manifest với stand-in local")
+    local.add_argument("--chunks", type=int, default=2000)
+    local.add_argument("--dim", type=int, default=256)
+    local.add_argument("--embed-latency-ms", type=float, default=20.0)
+    local.add_argument("--converse-latency-ms", type=float, default=400.0)
+    args = parser.parse_args(argv)
+
+    if args.local_synthetic:
+        items = synthetic_manifest(args.local_synthetic)
+    elif args.manifest:
+        items = load_manifest(args.manifest)
+    else:
+        parser.error("manifest is required (or --local-synthetic N)")
+
+    local_cfg = None
+    if args.local or args.local_synthetic:
+        local_cfg = {
+            "chunks": args.chunks,
+            "dim": args.dim,
+            "embed_latency_ms": args.embed_latency_ms,
+            "converse_latency_ms": args.converse_latency_ms,
+        }
+
+    done: Set[str] = set()
+    if args.resume:
+        drop_partial_last_line(args.report)
+        done = load_done_ids(args.report)
+    todo = [it for it in items if it["id"] not in done]
+    print(f"{len(items)} contracts in manifest, {len(done)} already done, {len(todo)} to analyze")
+
+    default_cap, caps = parse_model_caps(args.model_concurrency)
+    summary = run_batch(
+        todo,
+        args.report,
+        workers=args.workers,
+        executor_kind=args.executor,
+        init_args=(local_cfg, default_cap, caps, args.rag_cache_size),
+        append=args.resume,
+    )
+    summary["skipped_from_checkpoint"] = len(done)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.exit(main())
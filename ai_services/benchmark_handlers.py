@@ -0,0 +1,335 @@
+"""
+Benchmark các hàm nóng và Lambda handler trong ai_services với local stand-ins
+(xem local_aws_stubs.py) thay cho S3 / Bedrock / Lambda.
+
+Mỗi scenario chạy trong một process riêng (spawn) để peak RSS phản ánh đúng
+scenario đó. Kết quả: p50/p95/p99 latency (ms), throughput (ops/s), peak RSS (MB).
+
+Ví dụ:
+
+    python benchmark_handlers.py --chunks 5000 --iterations 50 --save-baseline bench_baseline.json
+    python benchmark_handlers.py --chunks 5000 --iterations 50 --compare bench_baseline.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
+
+import local_aws_stubs as stubs
+
+QUERIES = [
+    "quy định về đặt cọc mua bán nhà đất",
+    "mức phạt vi phạm hợp đồng tối đa",
+    "đơn phương chấm dứt hợp đồng thuê nhà",
+    "bồi thường thiệt hại do vi phạm nghĩa vụ",
+    "giải quyết tranh chấp hợp đồng tại tòa án",
+    "chuyển nhượng quyền sử dụng đất công chứng",
+    "lãi suất chậm thanh toán",
+    "bảo hành công trình xây dựng",
+]
+
+CONTRACT_TEXT = "\n\n".join([
+    "HỢP ĐỒNG THUÊ NHÀ Ở",
+    "Điều 1. Bên A đồng ý cho Bên B thuê căn hộ số 12, thời hạn 12 tháng.",
+    "Điều 2. Giá thuê 10.000.000 đồng/tháng. Bên B đặt cọc 2 tháng tiền nhà.",
+    "Điều 3. Bên vi phạm chịu phạt 20% giá trị hợp đồng.",
+    "Điều 4. Bên A có quyền đơn phương chấm dứt hợp đồng bất kỳ lúc nào.",
+])
+
+MODEL_OUTPUTS = [
+    json.dumps(stubs.CANNED_ANALYSIS, ensure_ascii=False),
+    "Đây là kết quả:\n```json\n" + json.dumps(stubs.CANNED_ANALYSIS, ensure_ascii=False) + "\n```",
+    '{"summary": "thiếu dấu đóng", "risk_items": [',
+]
+
+
+# -----------------------------------------------------------------------------
+# Scenarios
+# -----------------------------------------------------------------------------
+# Mỗi scenario nhận config, trả về op(i) để đo. Phần setup không được tính giờ.
+
+def _stack(cfg: Dict[str, Any]) -> stubs.LocalAwsStack:
+    stack = stubs.LocalAwsStack(
+        dim=cfg["dim"],
+        embed_latency_ms=cfg["embed_latency_ms"],
+        converse_latency_ms=cfg["converse_latency_ms"],
+        converse_ms_per_output_token=cfg["converse_ms_per_output_token"],
+        s3_latency_ms=cfg["s3_latency_ms"],
+    )
+    stack.seed_legal_index(stubs.make_synthetic_corpus(n_chunks=cfg["chunks"], dim=cfg["dim"], seed=cfg["seed"]))
+    stack.seed_templates()
+    return stack
+
+
+def scenario_load_index_cold(cfg: Dict[str, Any]) -> Callable[[int], Any]:
+    rag = _stack(cfg).load("ragsearch")
+
+    def op(i: int) -> None:
+        rag.INDEX_CACHE["loaded"] = False
+        rag.load_index_if_needed()
+
+    return op
+
+
+def scenario_search_index(cfg: Dict[str, Any]) -> Callable[[int], Any]:
+    rag = _stack(cfg).load("ragsearch")
+    rag.load_index_if_needed()
+
+    def op(i: int) -> Any:
+        return rag.search_index(query=QUERIES[i % len(QUERIES)], top_k=8, filters={"source_type": ["legal"]})
+
+    return op
+
+
+def scenario_parse_model_json(cfg: Dict[str, Any]) -> Callable[[int], Any]:
+    callllm = _stack(cfg).load("callllm")
+
+    def op(i: int) -> Any:
+        return callllm.parse_model_json(MODEL_OUTPUTS[i % len(MODEL_OUTPUTS)])
+
+    return op
+
+
+def scenario_ragsearch_handler(cfg: Dict[str, Any]) -> Callable[[int], Any]:
+    rag = _stack(cfg).load("ragsearch")
+
+    def op(i: int) -> Any:
+        return rag.lambda_handler(stubs.api_event({"query": QUERIES[i % len(QUERIES)], "top_k": 8}), None)
+
+    return op
+
+
+def scenario_callllm_handler(cfg: Dict[str, Any]) -> Callable[[int], Any]:
+    stack = _stack(cfg)
+    stack.load("ragsearch")
+    callllm = stack.load("callllm")
+
+    def op(i: int) -> Any:
+        return callllm.lambda_handler(stubs.api_event({"contract_text": CONTRACT_TEXT}), None)
+
+    return op
+
+
+def scenario_callllm_handler_no_prescreen(cfg: Dict[str, Any]) -> Callable[[int], Any]:
+    # So sánh với callllm_handler: gửi toàn văn hợp đồng, không pre-screen bằng rule
+    stack = _stack(cfg)
+    stack.load("ragsearch")
+    callllm = stack.load("callllm")
+
+    def op(i: int) -> Any:
+        return callllm.lambda_handler(stubs.api_event({"contract_text": CONTRACT_TEXT, "prescreen": False}), None)
+
+    return op
+
+
+def scenario_generate_handler(cfg: Dict[str, Any]) -> Callable[[int], Any]:
+    stack = _stack(cfg)
+    stack.load("ragsearch")
+    generator = stack.load("generate_contract")
+
+    def op(i: int) -> Any:
+        body = {
+            "template_id": "tpl-001",
+            "contract_info": {"ben_a": f"Nguyễn Văn A{i}", "ben_b": "Trần Thị B", "gia_thue": "10.000.000"},
+        }
+        return generator.lambda_handler(stubs.api_event(body), None)
+
+    return op
+
+
+SCENARIOS: Dict[str, Callable[[Dict[str, Any]], Callable[[int], Any]]] = {
+    "load_index_cold": scenario_load_index_cold,
+    "search_index": scenario_search_index,
+    "parse_model_json": scenario_parse_model_json,
+    "ragsearch_handler": scenario_ragsearch_handler,
+    "callllm_handler": scenario_callllm_handler,
+    "callllm_handler_no_prescreen": scenario_callllm_handler_no_prescreen,
+    "generate_handler": scenario_generate_handler,
+}
+
+
+# -----------------------------------------------------------------------------
+# Measurement
+# -----------------------------------------------------------------------------
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile trên list đã sort."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values) + 0.5 - 1e-9)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux trả KB, macOS trả bytes
+    return rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0
+
+
+def run_scenario(name: str, cfg: Dict[str, Any]) -> Dict[str, Any]:
+    op = SCENARIOS[name](cfg)
+
+    for i in range(cfg["warmup"]):
+        op(i)
+
+    latencies: List[float] = []
+    started = time.perf_counter()
+    for i in range(cfg["iterations"]):
+        t0 = time.perf_counter()
+        op(i)
+        latencies.append((time.perf_counter() - t0) * 1000.0)
+    wall_s = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "scenario": name,
+        "iterations": len(latencies),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "mean_ms": round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        "throughput_ops": round(len(latencies) / wall_s, 3) if wall_s > 0 else 0.0,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def run_all(names: List[str], cfg: Dict[str, Any], isolate: bool = True) -> List[Dict[str, Any]]:
+    results = []
+    for name in names:
+        if isolate:
+            ctx = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                res = pool.submit(run_scenario, name, cfg).result()
+        else:
+            res = run_scenario(name, cfg)
+        print(format_row(res), flush=True)
+        results.append(res)
+    return results
+
+
+# -----------------------------------------------------------------------------
+# Baselines
+# -----------------------------------------------------------------------------
+
+# (metric, True nếu lớn hơn là tệ hơn)
+COMPARED_METRICS: List[Tuple[str, bool]] = [
+    ("p50_ms", True),
+    ("p95_ms", True),
+    ("p99_ms", True),
+    ("throughput_ops", False),
+    ("peak_rss_mb", True),
+]
+
+
+def compare_to_baseline(
+    results: List[Dict[str, Any]],
+    baseline: Dict[str, Any],
+    tolerance: float,
+    cfg: Dict[str, Any],
+    metrics: List[Tuple[str, bool]] = None,
+) -> List[str]:
+    """Trả về danh sách regression (chuỗi mô tả); rỗng nếu không có."""
+    base_cfg = baseline.get("config") or {}
+    if any(base_cfg.get(k) != cfg.get(k) for k in ("chunks", "dim")):
+        print("[WARN] Baseline được chạy với config khác (chunks/dim), so sánh chỉ mang tính tham khảo")
+
+    base_by_name = {r["scenario"]: r for r in baseline.get("results", [])}
+    regressions: List[str] = []
+    for res in results:
+        base = base_by_name.get(res["scenario"])
+        if not base:
+            continue
+        for metric, higher_is_worse in metrics or COMPARED_METRICS:
+            old = base.get(metric)
+            new = res.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = change > tolerance if higher_is_worse else change < -tolerance
+            flag = "REGRESSION" if worse else "ok"
+            line = f"{res['scenario']:<20} {metric:<15} {old:>10} -> {new:>10} ({change:+.1%}) {flag}"
+            print(line)
+            if worse:
+                regressions.append(line)
+    return regressions
+
+
+def format_row(res: Dict[str, Any]) -> str:
+    return (
+        f"{res['scenario']:<20} n={res['iterations']:<5} "
+        f"p50={res['p50_ms']:>9.3f}ms p95={res['p95_ms']:>9.3f}ms p99={res['p99_ms']:>9.3f}ms "
+        f"thr={res['throughput_ops']:>9.2f}/s rss={res['peak_rss_mb']:>7.1f}MB"
+    )
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="danh sách scenario, cách nhau dấu phẩy")
+    parser.add_argument("--chunks", type=int, default=2000, help="số chunk trong corpus tổng hợp")
+    parser.add_argument("--dim", type=int, default=stubs.EMBED_DIM)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--iterations", type=int, default=30)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--embed-latency-ms", type=float, default=0.0)
+    parser.add_argument("--converse-latency-ms", type=float, default=0.0)
+    parser.add_argument("--converse-ms-per-output-token", type=float, default=0.0)
+    parser.add_argument("--s3-latency-ms", type=float, default=0.0)
+    parser.add_argument("--no-isolate", action="store_true", help="chạy mọi scenario trong cùng process")
+    parser.add_argument("--save-baseline", help="ghi kết quả ra file JSON để so sánh về sau")
+    parser.add_argument("--compare", help="file baseline JSON để so sánh")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="ngưỡng regression (0.10 = 10%%)")
+    args = parser.parse_args(argv)
+
+    names = [n.strip() for n in args.scenarios.split(",") if n.strip()]
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios {unknown}. Allowed: {sorted(SCENARIOS)}")
+
+    cfg = {
+        "chunks": args.chunks,
+        "dim": args.dim,
+        "seed": args.seed,
+        "iterations": args.iterations,
+        "warmup": args.warmup,
+        "embed_latency_ms": args.embed_latency_ms,
+        "converse_latency_ms": args.converse_latency_ms,
+        "converse_ms_per_output_token": args.converse_ms_per_output_token,
+        "s3_latency_ms": args.s3_latency_ms,
+    }
+
+    results = run_all(names, cfg, isolate=not args.no_isolate)
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "config": cfg,
+        "results": results,
+    }
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance, cfg)
+        if regressions:
+            print(f"{len(regressions)} regression(s) vượt ngưỡng {args.tolerance:.0%}")
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""
+Micro-benchmark cho lớp serialize JSON (fast_json.py): so sánh các backend đang cài
+(orjson / msgspec / stdlib) trên các đường nóng của Lambda:
+
+  - load_index_if_needed   parse JSONL index (cold load, S3 giả lập không có latency)
+  - make_response          serialize response ragsearch lớn (top_k kết quả đầy đủ)
+  - decode_rag_payload     parse lại response đó ở phía caller (callllm / generator)
+
+Ví dụ:
+
+    python benchmark_json.py --chunks 5000 --dim 1024 --iterations 20
+    python benchmark_json.py --backends orjson,stdlib --typed-index --output json_bench.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+import fast_json
+import local_aws_stubs as stubs
+from benchmark_handlers import QUERIES, percentile
+
+
+def _time_op(op: Callable[[], Any], iterations: int, warmup: int) -> Dict[str, float]:
+    for _ in range(warmup):
+        op()
+    samples = []
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        op()
+        samples.append((time.perf_counter() - t0) * 1000.0)
+    samples.sort()
+    return {
+        "p50_ms": round(percentile(samples, 50), 3),
+        "p95_ms": round(percentile(samples, 95), 3),
+        "mean_ms": round(sum(samples) / len(samples), 3),
+    }
+
+
+def bench_backend(stack: stubs.LocalAwsStack, backend: str, typed_index: bool, args) -> Dict[str, Any]:
+    fast_json.set_backend(backend, typed_index=typed_index)
+    rag = stack.load("ragsearch")
+
+    def load_index():
+        rag.INDEX_CACHE["loaded"] = False
+        rag.load_index_if_needed()
+
+    load_stats = _time_op(load_index, max(1, args.iterations // 4), 1)
+
+    # Response lớn: top_k kết quả đầy đủ metadata + text
+    results = rag.search_index(QUERIES[0], top_k=args.top_k, filters={})
+    resp = {"query": QUERIES[0], "language": "vi", "top_k": args.top_k, "results": results}
+    response_stats = _time_op(lambda: rag.make_response(200, resp), args.iterations, args.warmup)
+
+    body = rag.make_response(200, resp)["body"]
+    decode_stats = _time_op(lambda: fast_json.loads(body), args.iterations, args.warmup)
+
+    return {
+        "backend": backend,
+        "typed_index": typed_index,
+        "load_index_if_needed": load_stats,
+        "make_response": response_stats,
+        "decode_rag_payload": decode_stats,
+        "response_bytes": len(body.encode("utf-8")),
+    }
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", default=",".join(fast_json.AVAILABLE_BACKENDS))
+    parser.add_argument("--chunks", type=int, default=3000)
+    parser.add_argument("--dim", type=int, default=stubs.EMBED_DIM)
+    parser.add_argument("--top-k", type=int, default=50)
+    parser.add_argument("--iterations", type=int, default=40)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--typed-index", action="store_true", help="thêm lượt đo với JSON_TYPED_INDEX=1")
+    parser.add_argument("--output", help="ghi kết quả JSON")
+    args = parser.parse_args(argv)
+
+    backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+    unknown = [b for b in backends if b not in fast_json.AVAILABLE_BACKENDS]
+    if unknown:
+        parser.error(f"backends not installed: {unknown}. Available: {fast_json.AVAILABLE_BACKENDS}")
+
+    stack = stubs.LocalAwsStack(dim=args.dim)
+    stack.seed_legal_index(stubs.make_synthetic_corpus(n_chunks=args.chunks, dim=args.dim))
+
+    runs = [(b, False) for b in backends]
+    if args.typed_index:
+        runs += [(b, True) for b in backends]
+
+    rows = []
+    print(f"{'backend':<18}{'load_index p50':>16}{'make_response p50':>20}{'decode p50':>14}")
+    for backend, typed in runs:
+        row = bench_backend(stack, backend, typed, args)
+        rows.append(row)
+        name = backend + (" (typed)" if typed else "")
+        print(
+            f"{name:<18}{row['load_index_if_needed']['p50_ms']:>14.1f}ms"
+            f"{row['make_response']['p50_ms']:>18.3f}ms{row['decode_rag_payload']['p50_ms']:>12.3f}ms",
+            flush=True,
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"chunks": args.chunks, "dim": args.dim, "top_k": args.top_k, "runs": rows}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.exit(main())
@@ -0,0 +1,396 @@
+"""
+Tách hợp đồng thành điều khoản, phân loại điều khoản theo từ khoá và chạy các
+rule kiểm tra nhanh (không gọi model) cho các rủi ro có thể nhận ra bằng từ ngữ:
+thiếu điều khoản giải quyết tranh chấp, mức phạt / lãi chậm trả vượt trần, đặt
+cọc không rõ điều kiện hoàn trả, đơn phương chấm dứt không báo trước...
+
+Dùng bởi callllm (pre-screen trước khi gọi Bedrock); file này phải được đóng gói
+cùng Lambda callllm.
+
+    clauses = split_clauses(contract_text)
+    screen = prescreen(clauses)            # risk_items sơ bộ + điều khoản cần model đọc
+    prompt_text = compact_contract_text(clauses, screen)
+
+clause_hash / render_clauses / assign_items_to_clauses phục vụ phân tích lại
+từng phần (chỉ gửi điều khoản đã sửa) khi user chỉnh bản nháp.
+"""
+
+import hashlib
+import re
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+# -----------------------------------------------------------------------------
+# Tách điều khoản
+# -----------------------------------------------------------------------------
+
+# "Điều 5.", "ĐIỀU 5:", "Điều V -", "Article 5"
+_CLAUSE_HEADING_RE = re.compile(
+    r"^[ \t]*(?:Điều|ĐIỀU|Article|ARTICLE)[ \t]+(\d+|[IVXLC]+)\b.*$",
+    re.MULTILINE,
+)
+_PARAGRAPH_SPLIT_RE = re.compile(r"\n[ \t]*\n")
+# Khi không có tiêu đề "Điều": gộp đoạn văn ngắn tới khoảng này (ký tự)
+PARAGRAPH_CLAUSE_CHARS = 1200
+
+
+def split_clauses(text: str) -> List[Dict[str, Any]]:
+    """
+    Tách hợp đồng theo tiêu đề "Điều N"; phần trước điều đầu tiên là phần mở
+    đầu (article_no rỗng). Không có tiêu đề nào thì tách theo đoạn văn.
+    Mỗi clause: {"clause_id", "article_no", "heading", "text"}.
+    """
+    text = (text or "").strip()
+    if not text:
+        return []
+
+    pieces = []
+    matches = list(_CLAUSE_HEADING_RE.finditer(text))
+    if matches:
+        if matches[0].start() > 0:
+            pieces.append(("", text[:matches[0].start()]))
+        for i, m in enumerate(matches):
+            end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+            pieces.append((m.group(1), text[m.start():end]))
+    else:
+        buf = ""
+        for para in _PARAGRAPH_SPLIT_RE.split(text):
+            if buf and len(buf) + len(para) > PARAGRAPH_CLAUSE_CHARS:
+                pieces.append(("", buf))
+                buf = ""
+            buf = f"{buf}\n\n{para}" if buf else para
+        if buf:
+            pieces.append(("", buf))
+
+    clauses = []
+    for article_no, body in pieces:
+        body = body.strip()
+        if not body:
+            continue
+        clauses.append({
+            "clause_id": f"C{len(clauses) + 1}",
+            "article_no": article_no,
+            "heading": body.split("\n", 1)[0].strip(),
+            "text": body,
+        })
+    return clauses
+
+
+def clause_hash(clause: Dict[str, Any]) -> str:
+    """Hash nội dung điều khoản (bỏ qua khác biệt khoảng trắng), không phụ thuộc clause_id."""
+    normalized = " ".join(clause["text"].split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:32]
+
+
+# -----------------------------------------------------------------------------
+# Phân loại điều khoản theo từ khoá
+# -----------------------------------------------------------------------------
+
+# Thứ tự có ý nghĩa: khớp tiêu đề trước, rồi tới category đứng trước trong list
+CATEGORY_KEYWORDS = [
+    ("dispute", ["giải quyết tranh chấp", "tranh chấp", "trọng tài", "tòa án", "toà án"]),
+    ("penalty", ["phạt vi phạm", "bồi thường", "phạt"]),
+    ("deposit", ["đặt cọc", "tiền cọc", "ký quỹ", "ký cược"]),
+    ("termination", ["chấm dứt", "đơn phương", "hủy bỏ hợp đồng", "huỷ bỏ hợp đồng"]),
+    ("payment", ["thanh toán", "giá thuê", "giá trị hợp đồng", "giá bán", "lãi suất", "chậm trả"]),
+    ("force_majeure", ["bất khả kháng"]),
+    ("confidentiality", ["bảo mật"]),
+    ("obligations", ["quyền và nghĩa vụ", "nghĩa vụ", "trách nhiệm", "quyền của"]),
+    ("term", ["thời hạn", "hiệu lực"]),
+    ("object", ["đối tượng", "phạm vi", "nội dung công việc"]),
+    ("general", ["điều khoản chung", "điều khoản thi hành", "cam kết chung", "thỏa thuận khác", "thoả thuận khác"]),
+    ("parties", ["cộng hòa xã hội", "cộng hoà xã hội", "căn cứ", "bên a", "bên b", "bên cho thuê", "bên thuê"]),
+]
+
+# Điều khoản thuộc các loại này, nếu không bị rule nào flag, chỉ gửi tiêu đề cho
+# model (skeleton); các loại còn lại (và "other") luôn gửi nguyên văn.
+SKELETON_CATEGORIES = {"dispute", "force_majeure", "confidentiality", "term", "object", "general", "parties"}
+
+
+def classify_clause(clause: Dict[str, Any]) -> str:
+    heading = clause["heading"].lower()
+    for category, keywords in CATEGORY_KEYWORDS:
+        if any(k in heading for k in keywords):
+            return category
+    body = clause["text"].lower()
+    for category, keywords in CATEGORY_KEYWORDS:
+        if any(k in body for k in keywords):
+            return category
+    return "other"
+
+
+# -----------------------------------------------------------------------------
+# Rules
+# -----------------------------------------------------------------------------
+
+# Trần phạt vi phạm hợp đồng thương mại: 8% giá trị phần nghĩa vụ bị vi phạm
+PENALTY_CAP_PERCENT = 8.0
+# Trần lãi suất thoả thuận: 20%/năm
+INTEREST_CAP_PERCENT_PER_YEAR = 20.0
+
+_PERCENT_RE = re.compile(r"(\d+(?:[.,]\d+)?)\s*%")
+_MONTHLY_RE = re.compile(r"%\s*(?:/|một|mỗi|trên)\s*tháng", re.IGNORECASE)
+
+LAW_COMMERCIAL_301 = {"law_name": "Luật Thương mại 2005", "article": "Điều 301", "clause": "", "note": ""}
+LAW_CIVIL_468 = {"law_name": "Bộ luật Dân sự 2015", "article": "Điều 468", "clause": "", "note": ""}
+LAW_CIVIL_328 = {"law_name": "Bộ luật Dân sự 2015", "article": "Điều 328", "clause": "", "note": ""}
+LAW_CIVIL_428 = {"law_name": "Bộ luật Dân sự 2015", "article": "Điều 428", "clause": "", "note": ""}
+
+
+def _percents(text: str) -> List[float]:
+    return [float(v.replace(",", ".")) for v in _PERCENT_RE.findall(text)]
+
+
+def _excerpt(text: str, keyword: str, width: int = 240) -> str:
+    """Đoạn ngắn quanh keyword (hoặc đầu điều khoản) để làm clause_excerpt."""
+    flat = " ".join(text.split())
+    pos = flat.lower().find(keyword) if keyword else -1
+    start = max(0, pos - width // 3) if pos >= 0 else 0
+    out = flat[start:start + width]
+    return ("… " if start > 0 else "") + out + (" …" if start + width < len(flat) else "")
+
+
+def _finding(rule_id: str, clause: Optional[Dict[str, Any]], keyword: str, **item) -> Dict[str, Any]:
+    return {
+        "rule_id": rule_id,
+        "clause_id": clause["clause_id"] if clause else "",
+        "clause_excerpt": _excerpt(clause["text"], keyword) if clause else "",
+        **item,
+    }
+
+
+_DISPUTE_FORUMS = ("tòa án", "toà án", "trọng tài", "thương lượng", "hòa giải", "hoà giải")
+
+
+def rule_missing_dispute(clauses, categories) -> List[Dict[str, Any]]:
+    # Điều khoản tranh chấp có thể nằm trong "Điều khoản chung" -> xét cả nội dung
+    for c in clauses:
+        body = c["text"].lower()
+        if categories[c["clause_id"]] == "dispute" or (
+                "tranh chấp" in body and any(k in body for k in _DISPUTE_FORUMS)):
+            return []
+    return [_finding(
+        "missing_dispute_resolution", None, "",
+        title="Thiếu điều khoản giải quyết tranh chấp",
+        risk_types=["UnclearTerm", "LegalCompliance"],
+        severity="MEDIUM",
+        description="Hợp đồng không quy định cách thức và cơ quan giải quyết tranh chấp (thương lượng, hòa giải, trọng tài hay tòa án).",
+        recommendation="Bổ sung điều khoản giải quyết tranh chấp: thời hạn thương lượng, cơ quan giải quyết (trọng tài/tòa án) và luật áp dụng.",
+        law_references=[],
+    )]
+
+
+def rule_penalty_cap(clauses, categories) -> List[Dict[str, Any]]:
+    out = []
+    for c in clauses:
+        body = c["text"].lower()
+        if "phạt" not in body:
+            continue
+        rates = [p for p in _percents(body) if p > PENALTY_CAP_PERCENT]
+        if not rates:
+            continue
+        out.append(_finding(
+            "penalty_above_cap", c, "phạt",
+            title="Mức phạt vi phạm vượt giới hạn",
+            risk_types=["LegalCompliance", "Financial"],
+            severity="HIGH",
+            description=(
+                f"Điều khoản quy định mức phạt {max(rates):g}%, cao hơn mức tối đa "
+                f"{PENALTY_CAP_PERCENT:g}% giá trị phần nghĩa vụ bị vi phạm (áp dụng cho hợp đồng thương mại)."
+            ),
+            recommendation=f"Điều chỉnh mức phạt không vượt quá {PENALTY_CAP_PERCENT:g}% giá trị phần nghĩa vụ bị vi phạm.",
+            law_references=[dict(LAW_COMMERCIAL_301)],
+        ))
+    return out
+
+
+def rule_interest_cap(clauses, categories) -> List[Dict[str, Any]]:
+    out = []
+    for c in clauses:
+        body = c["text"].lower()
+        if "lãi" not in body:
+            continue
+        rates = _percents(body)
+        if not rates:
+            continue
+        per_year = max(rates) * (12 if _MONTHLY_RE.search(body) else 1)
+        if per_year <= INTEREST_CAP_PERCENT_PER_YEAR:
+            continue
+        out.append(_finding(
+            "interest_above_cap", c, "lãi",
+            title="Lãi suất vượt mức trần",
+            risk_types=["LegalCompliance", "Financial"],
+            severity="HIGH",
+            description=(
+                f"Lãi suất thỏa thuận tương đương khoảng {per_year:g}%/năm, vượt mức tối đa "
+                f"{INTEREST_CAP_PERCENT_PER_YEAR:g}%/năm; phần vượt không có hiệu lực."
+            ),
+            recommendation=f"Giảm lãi suất (kể cả lãi chậm trả) xuống không quá {INTEREST_CAP_PERCENT_PER_YEAR:g}%/năm.",
+            law_references=[dict(LAW_CIVIL_468)],
+        ))
+    return out
+
+
+def rule_deposit_terms(clauses, categories) -> List[Dict[str, Any]]:
+    out = []
+    for c in clauses:
+        body = c["text"].lower()
+        keyword = next((k for k in ("đặt cọc", "tiền cọc", "ký quỹ") if k in body), None)
+        if not keyword:
+            continue
+        if any(k in body for k in ("hoàn trả", "hoàn lại", "trả lại", "hoàn cọc")):
+            continue
+        out.append(_finding(
+            "deposit_refund_unclear", c, keyword,
+            title="Điều kiện hoàn trả tiền cọc không rõ ràng",
+            risk_types=["UnclearTerm", "Financial"],
+            severity="MEDIUM",
+            description="Hợp đồng có khoản đặt cọc nhưng không nêu thời hạn, điều kiện hoàn trả hoặc trường hợp mất cọc.",
+            recommendation="Ghi rõ thời điểm hoàn trả tiền cọc, các khoản được khấu trừ và trường hợp mất cọc / phạt cọc.",
+            law_references=[dict(LAW_CIVIL_328)],
+        ))
+    return out
+
+
+def rule_unilateral_termination(clauses, categories) -> List[Dict[str, Any]]:
+    out = []
+    for c in clauses:
+        body = c["text"].lower()
+        if "đơn phương" not in body or "chấm dứt" not in body:
+            continue
+        if "báo trước" in body or "thông báo" in body:
+            continue
+        out.append(_finding(
+            "unilateral_termination_no_notice", c, "đơn phương",
+            title="Đơn phương chấm dứt hợp đồng không cần báo trước",
+            risk_types=["ImbalancedObligation"],
+            severity="HIGH",
+            description="Điều khoản cho phép đơn phương chấm dứt hợp đồng mà không quy định thời hạn báo trước hay căn cứ chấm dứt.",
+            recommendation="Quy định rõ các căn cứ được đơn phương chấm dứt, thời hạn báo trước và nghĩa vụ bồi thường khi chấm dứt.",
+            law_references=[dict(LAW_CIVIL_428)],
+        ))
+    return out
+
+
+RULES = [
+    rule_missing_dispute,
+    rule_penalty_cap,
+    rule_interest_cap,
+    rule_deposit_terms,
+    rule_unilateral_termination,
+]
+
+SEVERITY_ORDER = ["LOW", "MEDIUM", "HIGH", "CRITICAL"]
+
+
+def max_severity(levels: List[str]) -> Optional[str]:
+    known = [lv for lv in levels if lv in SEVERITY_ORDER]
+    return max(known, key=SEVERITY_ORDER.index) if known else None
+
+
+def prescreen(clauses: List[Dict[str, Any]], skeleton_categories: Optional[Set[str]] = None) -> Dict[str, Any]:
+    """
+    Phân loại + chạy RULES. Trả về:
+      risk_items         rủi ro sơ bộ (cùng schema risk_items của model, thêm
+                         "source": "rule", "rule_id", "clause_id"; id P1, P2, ...)
+      categories         clause_id -> category
+      full_clause_ids    điều khoản cần gửi nguyên văn cho model (bị flag / không chắc)
+      elapsed_ms
+    """
+    t0 = time.perf_counter()
+    skeleton_categories = SKELETON_CATEGORIES if skeleton_categories is None else skeleton_categories
+    categories = {c["clause_id"]: classify_clause(c) for c in clauses}
+
+    findings = []
+    for rule in RULES:
+        findings.extend(rule(clauses, categories))
+    risk_items = []
+    for i, f in enumerate(findings, 1):
+        risk_items.append({"id": f"P{i}", "source": "rule", **f})
+
+    flagged = {f["clause_id"] for f in findings if f["clause_id"]}
+    full_ids = [
+        c["clause_id"] for c in clauses
+        if c["clause_id"] in flagged or categories[c["clause_id"]] not in skeleton_categories
+    ]
+    return {
+        "risk_items": risk_items,
+        "categories": categories,
+        "flagged_clause_ids": sorted(flagged, key=lambda cid: int(cid[1:])),
+        "full_clause_ids": full_ids,
+        "overall_risk_level": max_severity([r["severity"] for r in risk_items]) or "LOW",
+        "elapsed_ms": round((time.perf_counter() - t0) * 1000.0, 3),
+    }
+
+
+OMITTED_PRESCREENED = "đã kiểm tra tự động, lược bỏ nội dung"
+OMITTED_UNCHANGED = "không đổi so với lần phân tích trước, lược bỏ nội dung"
+
+
+def render_clauses(clauses: List[Dict[str, Any]], omitted: Dict[str, str], labels: bool = False) -> str:
+    """
+    Ghép lại hợp đồng: điều khoản có trong omitted (clause_id -> ghi chú) chỉ còn
+    tiêu đề, còn lại giữ nguyên văn. labels=True thêm mã "[C3]" trước mỗi điều khoản.
+    """
+    lines = []
+    for c in clauses:
+        prefix = f"[{c['clause_id']}] " if labels else ""
+        note = omitted.get(c["clause_id"])
+        lines.append(f"{prefix}{c['heading']} [{note}]" if note else prefix + c["text"])
+    return "\n\n".join(lines)
+
+
+def rule_findings_note(screen: Dict[str, Any]) -> str:
+    if not screen["risk_items"]:
+        return ""
+    found = "\n".join(f"- {r['id']} ({r['severity']}): {r['title']}" for r in screen["risk_items"])
+    return "\n\n=== RỦI RO ĐÃ PHÁT HIỆN BẰNG KIỂM TRA TỰ ĐỘNG (không cần liệt kê lại) ===\n" + found
+
+
+def compact_contract_text(clauses: List[Dict[str, Any]], screen: Dict[str, Any]) -> str:
+    """
+    Văn bản gửi model thay cho toàn bộ hợp đồng: các điều khoản đã kiểm tra tự
+    động chỉ còn tiêu đề (giữ bố cục), điều khoản bị flag / chưa chắc giữ nguyên
+    văn, kèm danh sách rủi ro rule đã phát hiện để model không phải lặp lại.
+    """
+    full = set(screen["full_clause_ids"])
+    omitted = {c["clause_id"]: OMITTED_PRESCREENED for c in clauses if c["clause_id"] not in full}
+    return render_clauses(clauses, omitted) + rule_findings_note(screen)
+
+
+def assign_items_to_clauses(
+    items: List[Dict[str, Any]],
+    clauses: List[Dict[str, Any]],
+) -> Tuple[Dict[str, List[Dict[str, Any]]], List[Dict[str, Any]]]:
+    """
+    Gán risk_items của model cho điều khoản: theo "clause_id" model trả về, nếu
+    không có thì theo clause_excerpt nằm trong điều khoản nào. Trả về
+    (clause_id -> items, items chung cho cả hợp đồng).
+    """
+    ids = {c["clause_id"] for c in clauses}
+    flat = {c["clause_id"]: " ".join(c["text"].split()).lower() for c in clauses}
+    by_clause: Dict[str, List[Dict[str, Any]]] = {}
+    document_items = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        cid = str(item.get("clause_id") or "").strip().strip("[]")
+        if cid not in ids:
+            excerpt = " ".join(str(item.get("clause_excerpt") or "").split()).lower().strip("… .")
+            cid = next((k for k, v in flat.items() if excerpt and excerpt in v), "")
+        if cid:
+            by_clause.setdefault(cid, []).append(item)
+        else:
+            document_items.append(item)
+    return by_clause, document_items
+
+
+def merge_prescreen(analysis: Dict[str, Any], screen: Dict[str, Any]) -> Dict[str, Any]:
+    """Gộp risk_items của rule vào kết quả model; overall_risk_level lấy mức cao hơn."""
+    merged = dict(analysis)
+    items = merged.get("risk_items")
+    merged["risk_items"] = list(screen["risk_items"]) + (items if isinstance(items, list) else [])
+    level = str(merged.get("overall_risk_level") or "").upper()
+    if level in SEVERITY_ORDER:
+        merged["overall_risk_level"] = max_severity([level, screen["overall_risk_level"]])
+    return merged
@@ -0,0 +1,302 @@
+"""
+Đánh giá chất lượng retrieval của ragsearch (recall@k, MRR, nDCG@k) song song với
+latency và bộ nhớ theo từng query, cho mọi search mode đã cấu hình.
+
+Bộ query có nhãn (JSONL), mỗi dòng:
+
+    {"query": "quy định về đặt cọc mua bán nhà đất",
+     "expected": [{"doc_id": "luat-00012", "article_no": "Điều 328"}],
+     "filters": {"source_type": ["legal"]}}
+
+Một kết quả được tính là đúng nếu trùng doc_id và (nếu nhãn có) article_no.
+
+Ví dụ:
+
+    # corpus + query tổng hợp, embedding giả lập
+    python eval_retrieval.py --synthetic-chunks 3000 --k 8 --quality-floor recall=0.8
+
+    # index thật + bộ query thật, embedding query gọi Bedrock thật
+    python eval_retrieval.py --index-file legal_chunks_with_emb.jsonl \\
+        --queries legal_queries.jsonl --live-embeddings --output eval_report.json
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional, Tuple
+
+import local_aws_stubs as stubs
+from benchmark_handlers import percentile
+
+# -----------------------------------------------------------------------------
+# Search modes
+# -----------------------------------------------------------------------------
+# Mỗi mode là các field ghi đè vào request body của ragsearch.lambda_handler.
+# Khi thêm tuỳ chọn mới cho scoring engine, thêm mode tương ứng vào đây.
+
+SEARCH_MODES: Dict[str, Dict[str, Any]] = {
+    "cosine": {},
+    "mmr": {"diversity": {"mmr_lambda": 0.7, "max_per_doc": 2}},
+    "rerank_model": {"rerank": {"method": "model", "fetch_k": 24}},
+    "rerank_llm": {"rerank": {"method": "llm", "fetch_k": 24}},
+}
+
+
+# -----------------------------------------------------------------------------
+# Labeled queries
+# -----------------------------------------------------------------------------
+
+def load_labeled_queries(path: str) -> List[Dict[str, Any]]:
+    queries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            rec = json.loads(line)
+            if not rec.get("query") or not rec.get("expected"):
+                continue
+            queries.append(rec)
+    return queries
+
+
+def make_labeled_queries(records: List[Dict[str, Any]], n_queries: int, seed: int = 7) -> List[Dict[str, Any]]:
+    """
+    Sinh query có nhãn từ corpus tổng hợp: chọn một điều khoản, ghép tiêu đề văn bản
+    + tiêu đề điều + vài từ trong nội dung. Nhãn là (doc_id, article_no) của điều đó.
+    """
+    rnd = random.Random(seed)
+    articles: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for rec in records:
+        articles.setdefault((rec["doc_id"], rec["article_no"]), rec)
+
+    keys = sorted(articles)
+    picked = rnd.sample(keys, min(n_queries, len(keys)))
+    queries = []
+    for doc_id, article_no in picked:
+        rec = articles[(doc_id, article_no)]
+        words = stubs.tokenize(rec["text"])
+        start = rnd.randint(0, max(0, len(words) - 6))
+        snippet = " ".join(words[start:start + 6])
+        queries.append({
+            "query": f"{rec['title']} quy định về {rec['article_title'].lower()} {snippet}",
+            "expected": [{"doc_id": doc_id, "article_no": article_no}],
+            "filters": {"source_type": ["legal"]},
+        })
+    return queries
+
+
+# -----------------------------------------------------------------------------
+# Metrics
+# -----------------------------------------------------------------------------
+
+def _matches(result: Dict[str, Any], expected: Dict[str, Any]) -> bool:
+    if expected.get("doc_id") and result.get("doc_id") != expected["doc_id"]:
+        return False
+    if expected.get("article_no") and result.get("article_no") != expected["article_no"]:
+        return False
+    return True
+
+
+def relevance_ranks(results: List[Dict[str, Any]], expected: List[Dict[str, Any]]) -> List[int]:
+    """
+    Với mỗi vị trí trong results: index của nhãn expected mà nó khớp lần đầu, hoặc -1.
+    Nhiều chunk của cùng một điều chỉ được tính một lần.
+    """
+    seen = set()
+    out = []
+    for res in results:
+        hit = -1
+        for j, exp in enumerate(expected):
+            if j not in seen and _matches(res, exp):
+                hit = j
+                seen.add(j)
+                break
+        out.append(hit)
+    return out
+
+
+def score_query(results: List[Dict[str, Any]], expected: List[Dict[str, Any]], k: int) -> Dict[str, float]:
+    hits = relevance_ranks(results[:k], expected)
+    n_rel = len(expected)
+
+    recall = sum(1 for h in hits if h >= 0) / n_rel if n_rel else 0.0
+
+    rr = 0.0
+    for rank, h in enumerate(hits, start=1):
+        if h >= 0:
+            rr = 1.0 / rank
+            break
+
+    dcg = sum(1.0 / math.log2(rank + 1) for rank, h in enumerate(hits, start=1) if h >= 0)
+    idcg = sum(1.0 / math.log2(rank + 1) for rank in range(1, min(n_rel, k) + 1))
+    ndcg = dcg / idcg if idcg else 0.0
+
+    return {"recall": recall, "rr": rr, "ndcg": ndcg}
+
+
+# -----------------------------------------------------------------------------
+# Evaluation
+# -----------------------------------------------------------------------------
+
+def _search(rag, query: Dict[str, Any], k: int, mode_body: Dict[str, Any]) -> List[Dict[str, Any]]:
+    body = {"query": query["query"], "top_k": k, "filters": query.get("filters") or {}}
+    body.update(mode_body)
+    resp = rag.lambda_handler(stubs.api_event(body), None)
+    if resp["statusCode"] != 200:
+        raise RuntimeError(f"ragsearch returned {resp['statusCode']}: {resp['body'][:300]}")
+    return json.loads(resp["body"]).get("results") or []
+
+
+def evaluate_mode(
+    stack: stubs.LocalAwsStack,
+    mode: str,
+    queries: List[Dict[str, Any]],
+    k: int,
+    memory_sample: int,
+    live_bedrock=None,
+) -> Dict[str, Any]:
+    rag = stack.load("ragsearch")
+    if live_bedrock is not None:
+        rag.bedrock = live_bedrock
+    mode_body = SEARCH_MODES[mode]
+
+    t0 = time.perf_counter()
+    rag.load_index_if_needed()
+    load_ms = (time.perf_counter() - t0) * 1000.0
+
+    # Warm-up một query để không tính chi phí lazy-init vào latency
+    _search(rag, queries[0], k, mode_body)
+
+    per_query = []
+    latencies = []
+    for q in queries:
+        t0 = time.perf_counter()
+        results = _search(rag, q, k, mode_body)
+        latency_ms = (time.perf_counter() - t0) * 1000.0
+        latencies.append(latency_ms)
+        scores = score_query(results, q["expected"], k)
+        per_query.append({"query": q["query"], "latency_ms": round(latency_ms, 3), **scores})
+
+    # Bộ nhớ đo ở pass riêng vì tracemalloc làm chậm đáng kể
+    for q, row in zip(queries[:memory_sample], per_query):
+        tracemalloc.start()
+        _search(rag, q, k, mode_body)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        row["peak_alloc_kb"] = round(peak / 1024.0, 1)
+
+    n = len(per_query)
+    mem = [r["peak_alloc_kb"] for r in per_query if "peak_alloc_kb" in r]
+    latencies.sort()
+    return {
+        "mode": mode,
+        "k": k,
+        "queries": n,
+        f"recall@{k}": round(sum(r["recall"] for r in per_query) / n, 4),
+        "mrr": round(sum(r["rr"] for r in per_query) / n, 4),
+        f"ndcg@{k}": round(sum(r["ndcg"] for r in per_query) / n, 4),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "mean_peak_alloc_kb": round(sum(mem) / len(mem), 1) if mem else None,
+        "index_load_ms": round(load_ms, 1),
+        "per_query": per_query,
+    }
+
+
+def parse_quality_floor(spec: Optional[str], k: int) -> Dict[str, float]:
+    """"recall=0.8,ndcg=0.6" -> {"recall@k": 0.8, "ndcg@k": 0.6}"""
+    floor: Dict[str, float] = {}
+    if not spec:
+        return floor
+    for part in spec.split(","):
+        name, _, value = part.partition("=")
+        name = name.strip().lower()
+        if name in ("recall", "ndcg"):
+            name = f"{name}@{k}"
+        floor[name] = float(value)
+    return floor
+
+
+def pick_fastest(summaries: List[Dict[str, Any]], floor: Dict[str, float]) -> Optional[Dict[str, Any]]:
+    ok = [s for s in summaries if all(s.get(m, 0.0) >= v for m, v in floor.items())]
+    return min(ok, key=lambda s: s["p50_ms"]) if ok else None
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default=",".join(SEARCH_MODES), help="search mode cần chạy, cách nhau dấu phẩy")
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--queries", help="file JSONL query có nhãn")
+    parser.add_argument("--index-file", help="file legal_chunks_with_emb.jsonl thật (mặc định: corpus tổng hợp)")
+    parser.add_argument("--synthetic-chunks", type=int, default=2000)
+    parser.add_argument("--synthetic-queries", type=int, default=100)
+    parser.add_argument("--dim", type=int, default=stubs.EMBED_DIM)
+    parser.add_argument("--live-embeddings", action="store_true", help="embedding query bằng Bedrock thật")
+    parser.add_argument("--memory-sample", type=int, default=20, help="số query đo peak alloc bằng tracemalloc")
+    parser.add_argument("--quality-floor", help='ví dụ "recall=0.8,mrr=0.6"')
+    parser.add_argument("--output", help="ghi báo cáo JSON (kèm số liệu từng query)")
+    args = parser.parse_args(argv)
+
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    unknown = [m for m in modes if m not in SEARCH_MODES]
+    if unknown:
+        parser.error(f"unknown modes {unknown}. Allowed: {sorted(SEARCH_MODES)}")
+
+    stack = stubs.LocalAwsStack(dim=args.dim)
+    if args.index_file:
+        with open(args.index_file, "rb") as f:
+            stack.s3.put_object(Bucket=stack.env["LEGAL_INDEX_BUCKET"], Key=stack.env["LEGAL_INDEX_KEY"], Body=f.read())
+        records = None
+    else:
+        records = stubs.make_synthetic_corpus(n_chunks=args.synthetic_chunks, dim=args.dim)
+        stack.seed_legal_index(records)
+
+    if args.queries:
+        queries = load_labeled_queries(args.queries)
+    elif records is not None:
+        queries = make_labeled_queries(records, args.synthetic_queries)
+    else:
+        parser.error("--queries is required with --index-file")
+    if not queries:
+        parser.error("no labeled queries")
+
+    live_bedrock = None
+    if args.live_embeddings:
+        import boto3
+        live_bedrock = boto3.client("bedrock-runtime", region_name=os.getenv("AWS_REGION", "ap-southeast-1"))
+
+    summaries = []
+    for mode in modes:
+        summary = evaluate_mode(stack, mode, queries, args.k, args.memory_sample, live_bedrock)
+        summaries.append(summary)
+        print(
+            f"{mode:<16} recall@{args.k}={summary[f'recall@{args.k}']:.4f} mrr={summary['mrr']:.4f} "
+            f"ndcg@{args.k}={summary[f'ndcg@{args.k}']:.4f} p50={summary['p50_ms']:.2f}ms "
+            f"p95={summary['p95_ms']:.2f}ms alloc={summary['mean_peak_alloc_kb']}KB",
+            flush=True,
+        )
+
+    floor = parse_quality_floor(args.quality_floor, args.k)
+    best = pick_fastest(summaries, floor) if floor else None
+    if floor:
+        print(f"Fastest mode meeting {floor}: {best['mode'] if best else 'NONE'}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(
+                {"k": args.k, "quality_floor": floor, "best_mode": best["mode"] if best else None, "modes": summaries},
+                f, ensure_ascii=False, indent=2,
+            )
+
+    return 0 if (not floor or best) else 1
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.exit(main())
@@ -0,0 +1,261 @@
+"""
+Capture event production (lấy mẫu, đã redact PII) để replay load test bằng
+replay_traffic.py.
+
+Bật qua ENV (mặc định tắt):
+  EVENT_CAPTURE_RATE      tỉ lệ lấy mẫu 0..1 (0 = tắt)
+  EVENT_CAPTURE_FILE      ghi JSONL vào file này (vd. search_server); để trống thì
+                          ghi log line "EVENT_CAPTURE {...}" (CloudWatch Logs: export
+                          log group rồi đưa file cho replay_traffic.py)
+  EVENT_CAPTURE_MAX_TEXT  chuỗi dài hơn ngưỡng (ký tự) chỉ giữ độ dài (mặc định 300)
+  EVENT_CAPTURE_INVOKE    1 = capture cả payload invoke trực tiếp (mặc định chỉ event
+                          API Gateway: invoke lồng nhau callllm / generator -> ragsearch
+                          sẽ được sinh lại khi replay request gốc)
+  EVENT_CAPTURE_SALT      khoá HMAC cho bí danh (đặt giống nhau cho mọi container để bí
+                          danh ổn định giữa các log stream; để trống = khoá ngẫu nhiên
+                          theo process)
+  TENANT_ID_CLAIM         claim tenant của authorizer (mặc định sub), giữ lại dưới dạng
+                          bí danh để replay vẫn đi nhánh tenant
+
+Mỗi bản ghi:
+  {"v": 1, "ts": <epoch ms>, "function": "ragsearch" | "callllm" | "generate_contract",
+   "source": "api" | "invoke", "event": {...}}
+  source "api": event API Gateway (chỉ giữ body / method / path / query string và
+  claim tenant của authorizer, bỏ header, phần còn lại của requestContext);
+  "invoke": payload invoke trực tiếp.
+
+Redact:
+  - chuỗi dài (nội dung hợp đồng, text tài liệu) -> "<<capture:text:N>>", field
+    *_base64 -> "<<capture:base64:N>>"; replay sinh lại nội dung giả cùng độ dài
+  - field định danh (tenant_id, user_id, document_id) -> bí danh HMAC (EVENT_CAPTURE_SALT)
+    để replay vẫn giữ hành vi cache / index theo tenant / bản nháp
+  - field có tên chứa thông tin cá nhân (họ tên, tên, bên A/B, party, địa chỉ, CCCD,
+    số tài khoản, email, điện thoại...) -> che toàn bộ, giữ độ dài; áp cho cả dict /
+    list lồng bên trong field đó
+  - contract_info: mọi chuỗi đều bị che, trừ field trong CONTRACT_INFO_SAFE_KEYS
+    (giá, thời hạn, tiền cọc...)
+  - chuỗi ngắn còn lại: che email, số điện thoại, dãy số 9-16 chữ số (CCCD / CMND /
+    tài khoản ngân hàng)
+Không capture event worker của job async và lời gọi nội bộ (shard_search).
+
+File này phải được đóng gói cùng cả ba Lambda.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import secrets
+import threading
+import time
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger()
+
+CAPTURE_RATE = float(os.getenv("EVENT_CAPTURE_RATE", "0"))
+CAPTURE_FILE = os.getenv("EVENT_CAPTURE_FILE", "")
+CAPTURE_MAX_TEXT = int(os.getenv("EVENT_CAPTURE_MAX_TEXT", "300"))
+CAPTURE_INVOKE = os.getenv("EVENT_CAPTURE_INVOKE", "0") == "1"
+CAPTURE_SALT = (os.getenv("EVENT_CAPTURE_SALT") or secrets.token_hex(16)).encode("utf-8")
+TENANT_ID_CLAIM = os.getenv("TENANT_ID_CLAIM", "sub")
+
+FORMAT_VERSION = 1
+LOG_MARKER = "EVENT_CAPTURE "
+INTERNAL_ACTIONS = ("shard_search",)
+
+PSEUDONYM_KEYS = ("tenant_id", "user_id", "document_id")
+PII_KEY_PARTS = (
+    "ho_ten", "name", "ben_a", "ben_b", "dai_dien", "nguoi", "dia_chi", "address",
+    "cccd", "cmnd", "ho_chieu", "passport", "tai_khoan", "account", "ma_so_thue", "mst",
+    "email", "phone", "sdt", "dien_thoai", "party", "parties",
+)
+# So khớp nguyên từ (tách theo "_"): "ten" không được khớp "content" / "tenant_id"
+PII_KEY_WORDS = ("ten", "ben")
+# contract_info là dữ liệu người dùng tự nhập: chỉ giữ các field không định danh
+CONTRACT_INFO_KEY = "contract_info"
+CONTRACT_INFO_SAFE_KEYS = (
+    "price", "total_price", "deposit", "deposit_amount", "duration", "template_id",
+    "gia", "gia_thue", "gia_ban", "tien_coc", "tien_dat_coc", "thoi_han", "ngay_bat_dau",
+    "ngay_ket_thuc", "start_date", "end_date", "currency", "language",
+)
+
+_EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+_PHONE_RE = re.compile(r"(?<!\d)(?:\+84|0)(?:[ .-]?\d){8,10}(?!\d)")
+_NUMBER_ID_RE = re.compile(r"(?<!\d)\d{9,16}(?!\d)")
+_PLACEHOLDER_RE = re.compile(r"^<<capture:(text|base64):(\d+)>>$")
+
+_LOCK = threading.Lock()
+
+
+# -----------------------------------------------------------------------------
+# Redact
+# -----------------------------------------------------------------------------
+
+def _mask(match: "re.Match") -> str:
+    return "#" * len(match.group(0))
+
+
+def _norm_key(key: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "_", str(key).lower())
+
+
+def pseudonym(value: Any) -> str:
+    # HMAC có khoá: id ngắn (user id, draft_<timestamp>) không dò ngược được bằng hash thử
+    digest = hmac.new(CAPTURE_SALT, str(value).encode("utf-8"), hashlib.sha256).hexdigest()
+    return "anon-" + digest[:12]
+
+
+def _is_pii_key(norm: str) -> bool:
+    words = norm.split("_")
+    return any(part in norm for part in PII_KEY_PARTS) or any(w in words for w in PII_KEY_WORDS)
+
+
+def redact(value: Any, key: str = "", pii: bool = False, contract_info: bool = False) -> Any:
+    """
+    Redact đệ quy theo tên field + nội dung (xem docstring module). pii: đang nằm
+    trong field thông tin cá nhân (che mọi chuỗi); contract_info: đang nằm trong
+    contract_info (che mọi chuỗi trừ CONTRACT_INFO_SAFE_KEYS).
+    """
+    norm = _norm_key(key)
+    pii = pii or _is_pii_key(norm)
+    contract_info = contract_info or norm == CONTRACT_INFO_KEY
+    if isinstance(value, dict):
+        return {k: redact(v, k, pii, contract_info) for k, v in value.items()}
+    if isinstance(value, list):
+        return [redact(v, key, pii, contract_info) for v in value]
+    if not isinstance(value, str):
+        return value
+    if norm.endswith("base64"):
+        return f"<<capture:base64:{len(value)}>>"
+    if norm in PSEUDONYM_KEYS:
+        return pseudonym(value)
+    if len(value) > CAPTURE_MAX_TEXT:
+        return f"<<capture:text:{len(value)}>>"
+    if pii or (contract_info and norm not in CONTRACT_INFO_SAFE_KEYS):
+        return "#" * len(value)
+    value = _EMAIL_RE.sub(_mask, value)
+    value = _PHONE_RE.sub(_mask, value)
+    return _NUMBER_ID_RE.sub(_mask, value)
+
+
+def _authorizer_tenant(authorizer: Dict[str, Any]) -> Optional[str]:
+    claims = (authorizer.get("jwt") or {}).get("claims") or authorizer.get("claims") or authorizer.get("lambda")
+    if not isinstance(claims, dict):
+        claims = authorizer
+    return claims.get(TENANT_ID_CLAIM)
+
+
+def build_record(function: str, event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Bản ghi capture (đã redact) cho event, None nếu event không cần capture."""
+    if not isinstance(event, dict) or event.get("job_action"):
+        return None  # worker job async: replay request gốc sẽ sinh lại
+
+    if "body" not in event:
+        if not CAPTURE_INVOKE or event.get("action") in INTERNAL_ACTIONS:
+            return None
+        return {"v": FORMAT_VERSION, "ts": int(time.time() * 1000), "function": function,
+                "source": "invoke", "event": redact(event)}
+
+    body = event.get("body")
+    if event.get("isBase64Encoded") and body:
+        body = base64.b64decode(body).decode("utf-8", "replace")
+    try:
+        data = json.loads(body) if body else None
+    except (TypeError, ValueError):
+        data = None
+    if isinstance(data, dict) and data.get("action") in INTERNAL_ACTIONS:
+        return None
+
+    request_context = event.get("requestContext") or {}
+    http = request_context.get("http") or {}
+    captured: Dict[str, Any] = {
+        "httpMethod": event.get("httpMethod") or http.get("method"),
+        "path": event.get("path") or event.get("rawPath"),
+        "queryStringParameters": redact(event.get("queryStringParameters")),
+        "isBase64Encoded": False,
+        "body": json.dumps(redact(data), ensure_ascii=False) if data is not None
+        else redact(body or "", "body"),
+    }
+    tenant = _authorizer_tenant(request_context.get("authorizer") or {})
+    if tenant:
+        captured["requestContext"] = {"authorizer": {"claims": {TENANT_ID_CLAIM: pseudonym(tenant)}}}
+    return {"v": FORMAT_VERSION, "ts": int(time.time() * 1000), "function": function,
+            "source": "api", "event": {k: v for k, v in captured.items() if v is not None}}
+
+
+def capture_event(function: str, event: Dict[str, Any]) -> None:
+    """Gọi đầu lambda_handler. Không bao giờ làm lỗi request."""
+    if CAPTURE_RATE <= 0 or random.random() >= CAPTURE_RATE:
+        return
+    try:
+        record = build_record(function, event)
+        if record is None:
+            return
+        line = json.dumps(record, ensure_ascii=False)
+        if CAPTURE_FILE:
+            with _LOCK, open(CAPTURE_FILE, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        else:
+            logger.info("%s%s", LOG_MARKER, line)
+    except Exception as e:
+        logger.warning("Event capture failed: %s", e)
+
+
+# -----------------------------------------------------------------------------
+# Đọc lại (replay_traffic.py)
+# -----------------------------------------------------------------------------
+
+def parse_capture_line(line: str) -> Optional[Dict[str, Any]]:
+    """Dòng JSONL capture, hoặc dòng log bất kỳ có chứa "EVENT_CAPTURE {...}"."""
+    pos = line.find(LOG_MARKER)
+    text = line[pos + len(LOG_MARKER):] if pos != -1 else line
+    text = text.strip()
+    if not text.startswith("{"):
+        return None
+    try:
+        record = json.loads(text)
+    except ValueError:
+        # log export có thể escape JSON trong một field "message"
+        return None
+    if not isinstance(record, dict) or "function" not in record or "event" not in record:
+        return None
+    return record
+
+
+def expand_placeholders(value: Any, filler: str) -> Any:
+    """<<capture:text:N>> -> N ký tự từ filler; <<capture:base64:N>> -> base64 hợp lệ dài N."""
+    if isinstance(value, dict):
+        return {k: expand_placeholders(v, filler) for k, v in value.items()}
+    if isinstance(value, list):
+        return [expand_placeholders(v, filler) for v in value]
+    if not isinstance(value, str):
+        return value
+    match = _PLACEHOLDER_RE.match(value)
+    if not match:
+        return value
+    kind, n = match.group(1), int(match.group(2))
+    if kind == "base64":
+        raw = (filler.encode("utf-8") * (n // max(1, len(filler)) + 1))[: n * 3 // 4]
+        return base64.b64encode(raw).decode("ascii")
+    return (filler * (n // max(1, len(filler)) + 1))[:n]
+
+
+def restore_event(record: Dict[str, Any], filler: str) -> Dict[str, Any]:
+    """Event để gọi lambda_handler từ bản ghi capture."""
+    event = dict(record["event"])
+    if record.get("source") != "api":
+        return expand_placeholders(event, filler)
+    body = event.get("body")
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        data = None
+    if data is not None:
+        event["body"] = json.dumps(expand_placeholders(data, filler), ensure_ascii=False)
+    else:
+        event["body"] = expand_placeholders(body or "", filler)
+    return event
@@ -0,0 +1,157 @@
+"""
+Lớp serialize JSON dùng chung cho các Lambda: dùng orjson hoặc msgspec nếu có trong
+deployment package / layer, ngược lại fallback về stdlib json.
+
+Backend chọn qua ENV:
+  JSON_BACKEND = auto | orjson | msgspec | stdlib   (auto: orjson > msgspec > stdlib)
+  JSON_TYPED_INDEX = 0 | 1
+      1: record index được decode theo schema IndexRecord (msgspec decode thẳng vào
+         struct; backend khác project sau khi parse). Field ngoài schema bị bỏ.
+      0 (mặc định): giữ nguyên mọi field metadata như trước.
+
+Mọi backend đều raise json.JSONDecodeError khi input không hợp lệ, nên code gọi
+giữ nguyên các except hiện có.
+
+File này phải được đóng gói cùng cả ba Lambda (ragsearch, callllm, generator).
+"""
+
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # không có trong package / layer
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+# Schema record trong legal_chunks_with_emb.jsonl (dùng khi JSON_TYPED_INDEX=1)
+INDEX_RECORD_FIELDS = (
+    "doc_id", "chunk_id", "source_type", "doc_category", "field",
+    "title", "article_no", "article_title", "text",
+    "op",  # "delete" = tombstone trong segment delta của index
+)
+
+if msgspec is not None:
+    class IndexRecord(msgspec.Struct, omit_defaults=True):
+        embedding: Optional[List[float]] = None
+        text: Optional[str] = None
+        # Metadata: không ép kiểu (article_no có thể là số ở một số nguồn)
+        doc_id: Any = None
+        chunk_id: Any = None
+        source_type: Any = None
+        doc_category: Any = None
+        field: Any = None
+        title: Any = None
+        article_no: Any = None
+        article_title: Any = None
+        op: Optional[str] = None
+
+
+def _available_backends() -> List[str]:
+    names = []
+    if orjson is not None:
+        names.append("orjson")
+    if msgspec is not None:
+        names.append("msgspec")
+    names.append("stdlib")
+    return names
+
+
+AVAILABLE_BACKENDS = _available_backends()
+
+# Trạng thái backend hiện tại (đổi bằng set_backend, vd. trong benchmark)
+_STATE: Dict[str, Any] = {}
+
+
+def set_backend(name: str = "auto", typed_index: Optional[bool] = None) -> str:
+    if name == "auto":
+        name = AVAILABLE_BACKENDS[0]
+    if name not in AVAILABLE_BACKENDS:
+        raise RuntimeError(f"JSON backend '{name}' is not installed. Available: {AVAILABLE_BACKENDS}")
+    if typed_index is None:
+        typed_index = os.getenv("JSON_TYPED_INDEX", "0") == "1"
+
+    _STATE["backend"] = name
+    _STATE["typed_index"] = typed_index
+    if name == "msgspec":
+        _STATE["encoder"] = msgspec.json.Encoder(enc_hook=_default)
+        _STATE["decoder"] = msgspec.json.Decoder()
+        _STATE["index_decoder"] = msgspec.json.Decoder(IndexRecord)
+    return name
+
+
+def backend() -> str:
+    return _STATE["backend"]
+
+
+# -----------------------------------------------------------------------------
+# Encode / decode
+# -----------------------------------------------------------------------------
+
+def _default(obj: Any) -> Any:
+    # numpy scalar / array (vd. score float32) -> kiểu Python
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps_bytes(obj: Any) -> bytes:
+    """JSON UTF-8 (không escape ký tự tiếng Việt, tương đương ensure_ascii=False)."""
+    name = _STATE["backend"]
+    if name == "orjson":
+        return orjson.dumps(obj, default=_default)
+    if name == "msgspec":
+        return _STATE["encoder"].encode(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+def dumps(obj: Any) -> str:
+    name = _STATE["backend"]
+    if name == "stdlib":
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_default)
+    return dumps_bytes(obj).decode("utf-8")
+
+
+def loads(data: Any) -> Any:
+    """str | bytes -> object. Input lỗi -> json.JSONDecodeError với mọi backend."""
+    name = _STATE["backend"]
+    if name == "orjson":
+        # orjson.JSONDecodeError là subclass của json.JSONDecodeError
+        return orjson.loads(data)
+    if name == "msgspec":
+        try:
+            return _STATE["decoder"].decode(data)
+        except msgspec.DecodeError as e:
+            raise json.JSONDecodeError(str(e), data if isinstance(data, str) else "", 0)
+    return json.loads(data)
+
+
+def decode_index_record(line: bytes) -> Tuple[Dict[str, Any], Optional[List[float]]]:
+    """
+    Một dòng JSONL của index -> (metadata không có embedding, embedding).
+    Với JSON_TYPED_INDEX=1, metadata chỉ gồm INDEX_RECORD_FIELDS.
+    """
+    if _STATE["typed_index"]:
+        if _STATE["backend"] == "msgspec":
+            try:
+                rec = _STATE["index_decoder"].decode(line)
+            except msgspec.DecodeError as e:
+                raise json.JSONDecodeError(str(e), "", 0)
+            meta = {f: getattr(rec, f) for f in INDEX_RECORD_FIELDS if getattr(rec, f) is not None}
+            return meta, rec.embedding
+        raw = loads(line)
+        meta = {f: raw[f] for f in INDEX_RECORD_FIELDS if raw.get(f) is not None}
+        return meta, raw.get("embedding")
+
+    rec = loads(line)
+    emb = rec.pop("embedding", None)
+    return rec, emb
+
+
+set_backend(os.getenv("JSON_BACKEND", "auto"))
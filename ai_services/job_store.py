@@ -0,0 +1,368 @@
+"""
+Job store + dispatch cho chế độ bất đồng bộ (async job) của callllm và generator.
+
+Luồng:
+  1. Client gửi request như cũ kèm "async": true
+     -> handler tạo job (status QUEUED), dispatch worker, trả 202 + job_id ngay.
+  2. Worker (chính Lambda đó, invoke kiểu Event; hoặc thread khi chạy local)
+     chạy pipeline, ghi progress / partial result vào store.
+  3. Client poll bằng {"job_id": "..."} (POST) hoặc ?job_id=... (GET); chỉ caller
+     đã submit (owner: claim của authorizer / tenant_id khi invoke trực tiếp)
+     mới thấy job, caller khác nhận 404.
+
+Backend của store chọn qua ENV:
+  JOB_STORE = dynamodb | sqlite | memory   (mặc định: dynamodb nếu có JOB_TABLE, ngược lại memory)
+  JOB_TABLE          bảng DynamoDB (partition key: job_id, kiểu S; TTL attribute: ttl)
+  JOB_SQLITE_PATH    file SQLite (mặc định /tmp/jobs.sqlite3)
+  JOB_BUCKET         (tuỳ chọn) bucket S3 để chứa request/result lớn
+  JOB_DISPATCH = lambda | thread   (mặc định: lambda khi chạy trên AWS Lambda)
+
+Dispatch lambda chạy worker ở container khác nên store phải dùng chung giữa các
+container (DynamoDB, hoặc SQLite trên EFS): submit_job từ chối store memory khi
+dispatch lambda.
+
+File này phải được đóng gói cùng lambda_function_callllm.py và
+lambda_function_generate_contract.py.py.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import logging
+from typing import Any, Callable, Dict, Optional
+
+import boto3
+
+logger = logging.getLogger()
+
+JOB_QUEUED = "QUEUED"
+JOB_RUNNING = "RUNNING"
+JOB_SUCCEEDED = "SUCCEEDED"
+JOB_FAILED = "FAILED"
+
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# Payload Event invoke bị giới hạn ~256 KB; request lớn hơn sẽ được đưa lên S3
+MAX_INLINE_REQUEST_BYTES = 200 * 1024
+# Item DynamoDB tối đa 400 KB
+MAX_INLINE_DOC_BYTES = 350 * 1024
+
+
+def new_job(kind: str, owner: Optional[str] = None) -> Dict[str, Any]:
+    now = time.time()
+    return {
+        "job_id": uuid.uuid4().hex,
+        "kind": kind,
+        "owner": owner,
+        "status": JOB_QUEUED,
+        "progress": {"stage": "queued", "percent": 0},
+        "partial": {},
+        "result": None,
+        "error": None,
+        "created_at": now,
+        "updated_at": now,
+        "ttl": int(now) + JOB_TTL_SECONDS,
+    }
+
+
+def public_view(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Các field trả về cho client khi poll."""
+    return {k: job.get(k) for k in ("job_id", "kind", "status", "progress", "partial", "result", "error",
+                                    "created_at", "updated_at")}
+
+
+def job_visible_to(job: Optional[Dict[str, Any]], owner: Optional[str]) -> bool:
+    """Job chỉ trả cho caller đã submit (job không có owner: chỉ caller không có owner)."""
+    return job is not None and job.get("owner") == owner
+
+
+# -----------------------------------------------------------------------------
+# Stores
+# -----------------------------------------------------------------------------
+
+class MemoryJobStore:
+    """Chỉ dùng cho test / chạy local: job nằm trong RAM của process."""
+
+    def __init__(self):
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def create(self, job: Dict[str, Any]) -> None:
+        with self._lock:
+            self._jobs[job["job_id"]] = json.loads(json.dumps(job))
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return json.loads(json.dumps(job)) if job else None
+
+    def update(self, job_id: str, **fields) -> None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                raise KeyError(job_id)
+            job.update(json.loads(json.dumps(fields)))
+            job["updated_at"] = time.time()
+
+
+class SqliteJobStore:
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " job_id TEXT PRIMARY KEY, status TEXT NOT NULL, doc TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+
+    def create(self, job: Dict[str, Any]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, status, doc, updated_at) VALUES (?, ?, ?, ?)",
+                (job["job_id"], job["status"], json.dumps(job, ensure_ascii=False), job["updated_at"]),
+            )
+            self._conn.commit()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT doc FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, job_id: str, **fields) -> None:
+        with self._lock:
+            row = self._conn.execute("SELECT doc FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                raise KeyError(job_id)
+            job = json.loads(row[0])
+            job.update(fields)
+            job["updated_at"] = time.time()
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, doc = ?, updated_at = ? WHERE job_id = ?",
+                (job["status"], json.dumps(job, ensure_ascii=False), job["updated_at"], job_id),
+            )
+            self._conn.commit()
+
+
+class DynamoJobStore:
+    """
+    Mỗi job là một item: job_id (S), status (S), doc (S, JSON), updated_at (N), ttl (N).
+    Nếu doc quá lớn cho một item và có JOB_BUCKET, field "result" được đưa lên S3.
+    """
+
+    def __init__(self, table_name: str, bucket: Optional[str] = None, dynamodb=None, s3=None):
+        self.table_name = table_name
+        self.bucket = bucket
+        self.dynamodb = dynamodb or boto3.client("dynamodb")
+        self.s3 = s3 or (boto3.client("s3") if bucket else None)
+
+    def _put(self, job: Dict[str, Any]) -> None:
+        doc = json.dumps(job, ensure_ascii=False)
+        if len(doc.encode("utf-8")) > MAX_INLINE_DOC_BYTES and self.bucket and job.get("result") is not None:
+            key = f"jobs/{job['job_id']}/result.json"
+            self.s3.put_object(
+                Bucket=self.bucket,
+                Key=key,
+                Body=json.dumps(job["result"], ensure_ascii=False).encode("utf-8"),
+                ContentType="application/json",
+            )
+            job = dict(job, result=None, result_s3_key=key)
+            doc = json.dumps(job, ensure_ascii=False)
+
+        self.dynamodb.put_item(
+            TableName=self.table_name,
+            Item={
+                "job_id": {"S": job["job_id"]},
+                "status": {"S": job["status"]},
+                "doc": {"S": doc},
+                "updated_at": {"N": str(job["updated_at"])},
+                "ttl": {"N": str(job["ttl"])},
+            },
+        )
+
+    def create(self, job: Dict[str, Any]) -> None:
+        self._put(job)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        resp = self.dynamodb.get_item(TableName=self.table_name, Key={"job_id": {"S": job_id}}, ConsistentRead=True)
+        item = resp.get("Item")
+        if not item:
+            return None
+        job = json.loads(item["doc"]["S"])
+        if job.get("result_s3_key") and job.get("result") is None:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=job["result_s3_key"])
+            job["result"] = json.loads(obj["Body"].read())
+        return job
+
+    def update(self, job_id: str, **fields) -> None:
+        # Sau khi tạo, chỉ worker của job ghi vào item -> read-modify-write là đủ
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        job.update(fields)
+        job["updated_at"] = time.time()
+        if job.get("result") is not None:
+            job.pop("result_s3_key", None)
+        self._put(job)
+
+
+_STORE = {"instance": None}
+
+
+def get_job_store():
+    """Store theo ENV, khởi tạo một lần cho mỗi container."""
+    if _STORE["instance"] is not None:
+        return _STORE["instance"]
+
+    table = os.getenv("JOB_TABLE")
+    backend = os.getenv("JOB_STORE") or ("dynamodb" if table else "memory")
+    if backend == "dynamodb":
+        if not table:
+            raise RuntimeError("JOB_TABLE env var is required for JOB_STORE=dynamodb")
+        store = DynamoJobStore(table, bucket=os.getenv("JOB_BUCKET"))
+    elif backend == "sqlite":
+        store = SqliteJobStore(os.getenv("JOB_SQLITE_PATH", "/tmp/jobs.sqlite3"))
+    elif backend == "memory":
+        store = MemoryJobStore()
+    else:
+        raise RuntimeError(f"Unknown JOB_STORE '{backend}'")
+
+    _STORE["instance"] = store
+    return store
+
+
+def set_job_store(store) -> None:
+    """Thay store (dùng khi test / chạy local)."""
+    _STORE["instance"] = store
+
+
+# -----------------------------------------------------------------------------
+# Dispatch & worker
+# -----------------------------------------------------------------------------
+
+def is_job_worker_event(event: Dict[str, Any]) -> bool:
+    return isinstance(event, dict) and event.get("job_action") == "run"
+
+
+def requested_job_id(event: Dict[str, Any], data: Dict[str, Any]) -> Optional[str]:
+    """job_id cần tra cứu: từ body, hoặc query string (?job_id=...) khi GET qua API Gateway."""
+    job_id = data.get("job_id") if isinstance(data, dict) else None
+    if not job_id:
+        job_id = (event.get("queryStringParameters") or {}).get("job_id")
+    return job_id or None
+
+
+def submit_job(
+    kind: str,
+    request: Dict[str, Any],
+    context: Any,
+    lambda_client: Any,
+    s3: Any = None,
+    run_inline: Optional[Callable[[Dict[str, Any]], None]] = None,
+    owner: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Tạo job và dispatch worker. Request lớn (file base64) được đưa lên JOB_BUCKET
+    vì payload Event invoke có giới hạn. owner: caller được phép poll job.
+    """
+    store = get_job_store()
+    dispatch = os.getenv("JOB_DISPATCH") or ("lambda" if os.getenv("AWS_LAMBDA_FUNCTION_NAME") else "thread")
+    if dispatch == "lambda" and isinstance(store, MemoryJobStore):
+        # Worker Event invoke chạy ở container khác, không thấy job trong memory
+        raise RuntimeError(
+            "JOB_DISPATCH=lambda needs a shared job store: set JOB_TABLE "
+            "(DynamoDB) or JOB_STORE=sqlite with JOB_SQLITE_PATH on EFS"
+        )
+    job = new_job(kind, owner=owner)
+    store.create(job)
+
+    request = dict(request)
+    request.pop("async", None)
+    worker_event: Dict[str, Any] = {"job_action": "run", "job_id": job["job_id"], "kind": kind}
+
+    raw = json.dumps(request, ensure_ascii=False).encode("utf-8")
+    bucket = os.getenv("JOB_BUCKET")
+    if len(raw) > MAX_INLINE_REQUEST_BYTES and bucket and s3 is not None:
+        key = f"jobs/{job['job_id']}/request.json"
+        s3.put_object(Bucket=bucket, Key=key, Body=raw, ContentType="application/json")
+        worker_event["request_s3_key"] = key
+    else:
+        worker_event["request"] = request
+
+    if dispatch == "lambda":
+        function_name = getattr(context, "function_name", None) or os.getenv("AWS_LAMBDA_FUNCTION_NAME")
+        lambda_client.invoke(
+            FunctionName=function_name,
+            InvocationType="Event",
+            Payload=json.dumps(worker_event, ensure_ascii=False).encode("utf-8"),
+        )
+    else:
+        threading.Thread(target=run_inline, args=(worker_event,), daemon=True).start()
+
+    return job
+
+
+def load_worker_request(worker_event: Dict[str, Any], s3: Any = None) -> Dict[str, Any]:
+    if "request" in worker_event:
+        return worker_event["request"]
+    obj = s3.get_object(Bucket=os.getenv("JOB_BUCKET"), Key=worker_event["request_s3_key"])
+    return json.loads(obj["Body"].read())
+
+
+def make_progress_reporter(job_id: str) -> Callable[..., None]:
+    """progress(stage, percent, **partial): ghi tiến độ + kết quả từng phần vào store."""
+    store = get_job_store()
+    partial: Dict[str, Any] = {}
+
+    def progress(stage: str, percent: int, **partial_fields) -> None:
+        partial.update(partial_fields)
+        try:
+            store.update(job_id, progress={"stage": stage, "percent": percent}, partial=dict(partial))
+        except Exception as e:  # progress không được làm hỏng job
+            logger.warning("Failed to record job progress %s: %s", job_id, e)
+
+    return progress
+
+
+def run_job(worker_event: Dict[str, Any], work: Callable[[Dict[str, Any], Callable[..., None]], Dict[str, Any]],
+            s3: Any = None) -> Dict[str, Any]:
+    """
+    Chạy `work(request, progress) -> result` cho job và ghi trạng thái cuối.
+    Lỗi được ghi vào job (FAILED), không raise để Lambda không retry Event invoke.
+    """
+    store = get_job_store()
+    job_id = worker_event["job_id"]
+    try:
+        store.update(job_id, status=JOB_RUNNING, progress={"stage": "started", "percent": 1})
+    except KeyError:
+        # Job không có trong store (vd. store memory ở container khác): retry cũng vô ích
+        logger.error("Job %s not found in job store, dropping worker event", job_id)
+        return {"job_id": job_id, "status": JOB_FAILED}
+
+    try:
+        request = load_worker_request(worker_event, s3=s3)
+        result = work(request, make_progress_reporter(job_id))
+    except ValueError as ve:
+        return _fail_job(store, job_id, {"type": "bad_request", "message": str(ve)})
+    except Exception as e:
+        logger.error("Job %s failed: %s", job_id, e)
+        return _fail_job(store, job_id, {"type": type(e).__name__, "message": str(e)})
+
+    try:
+        store.update(job_id, status=JOB_SUCCEEDED, result=result, progress={"stage": "done", "percent": 100})
+    except Exception as e:
+        # vd. result quá lớn cho item DynamoDB mà không có JOB_BUCKET: không để job RUNNING mãi
+        logger.error("Failed to store result of job %s: %s", job_id, e)
+        return _fail_job(store, job_id, {"type": "result_store_failed", "message": str(e)})
+    return {"job_id": job_id, "status": JOB_SUCCEEDED}
+
+
+def _fail_job(store: Any, job_id: str, error: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        store.update(job_id, status=JOB_FAILED, error=error)
+    except Exception as e:
+        logger.error("Failed to mark job %s as failed: %s", job_id, e)
+    return {"job_id": job_id, "status": JOB_FAILED}
@@ -1,13 +1,36 @@
 import json
 import os
+import re
+import gzip
 import base64
+import time
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Optional, Tuple, Dict, Any
+from typing import Optional, Tuple, Dict, Any, List
 
 import boto3
 from botocore.exceptions import ClientError
 
+import contract_clauses
+import event_capture
+import fast_json
+import model_router
+from legal_context import estimate_tokens, pack_legal_context
+
+from job_store import (
+    JOB_QUEUED,
+    get_job_store,
+    is_job_worker_event,
+    job_visible_to,
+    public_view,
+    requested_job_id,
+    run_job,
+    submit_job,
+)
+
 # ----------------------------------------------------------------------------- 
 # 1. Logging & Config
 # ----------------------------------------------------------------------------- 
@@ -17,10 +40,23 @@ logger.setLevel(logging.INFO)
 
 bedrock = boto3.client("bedrock-runtime")
 lambda_client = boto3.client("lambda")
+s3 = boto3.client("s3")  # chỉ dùng cho request lớn của job async (JOB_BUCKET)
 
 # ENV: tên Lambda RAG-search, ví dụ 'rag_search'
 RAG_FUNCTION_NAME = os.getenv("RAG_FUNCTION_NAME")
 
+# Đa dạng hoá kết quả RAG (MMR + tối đa N chunk / doc_id) để context không bị
+# lấp đầy bởi các chunk liền kề của cùng một điều luật
+RAG_DIVERSITY = {"mmr_lambda": 0.7, "max_per_doc": 2}
+RAG_RESULT_FIELDS = ["doc_id", "chunk_id", "title", "article_no", "article_title", "text", "score"]
+
+# Cache kết quả rag_search trong process (0 = tắt). Hữu ích khi batch / Lambda warm
+# phân tích nhiều bản của cùng một hợp đồng mẫu
+RAG_RESULT_CACHE_SIZE = int(os.getenv("RAG_RESULT_CACHE_SIZE", "0"))
+RAG_RESULT_CACHE: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+RAG_RESULT_CACHE_LOCK = threading.Lock()
+RAG_RESULT_CACHE_STATS = {"hits": 0, "misses": 0}
+
 class Config:
     MODEL_ID: str = os.getenv(
         "MODEL_ID",
@@ -28,6 +64,32 @@ class Config:
     )
     ALLOWED_FORMATS = {"pdf", "doc", "docx", "txt", "md", "html"}
     MAX_FILE_SIZE_BYTES: int = int(10 * 1024 * 1024)  # ~10MB
+    # Ngân sách token cho context RAG trong prompt (0 = không giới hạn)
+    RAG_CONTEXT_TOKEN_BUDGET: int = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "1500"))
+    # Pre-screen bằng rule (contract_clauses.py) trước khi gọi model, mode TEXT
+    PRESCREEN_ENABLED: bool = os.getenv("PRESCREEN_ENABLED", "1") == "1"
+    # Hợp đồng ngắn hơn ngưỡng này vẫn chạy rule nhưng gửi nguyên văn cho model
+    PRESCREEN_MIN_TOKENS: int = int(os.getenv("PRESCREEN_MIN_TOKENS", "600"))
+    # Kết quả phân tích theo điều khoản (phân tích lại từng phần theo document_id).
+    # Không đặt bucket -> giữ trong memory của process (chỉ hợp cho local / warm Lambda)
+    ANALYSIS_STORE_BUCKET: Optional[str] = os.getenv("ANALYSIS_STORE_BUCKET") or os.getenv("JOB_BUCKET")
+    ANALYSIS_STORE_PREFIX: str = os.getenv("ANALYSIS_STORE_PREFIX", "analysis-clauses/")
+    # Sửa quá tỉ lệ điều khoản này thì phân tích lại toàn bộ
+    INCREMENTAL_MAX_CHANGED_RATIO: float = float(os.getenv("INCREMENTAL_MAX_CHANGED_RATIO", "0.5"))
+    # Request qua API Gateway: caller lấy từ claim này của authorizer (requestContext.authorizer)
+    TENANT_ID_CLAIM: str = os.getenv("TENANT_ID_CLAIM", "sub")
+    # Bắt model trả kết quả qua tool (Converse toolConfig + JSON schema) thay vì text JSON
+    OUTPUT_TOOL_USE: bool = os.getenv("OUTPUT_TOOL_USE", "1") == "1"
+    # Output sai schema: sửa cục bộ, rồi gọi model rẻ sửa riêng phần lỗi (0 = tắt)
+    OUTPUT_REPAIR_MAX_CALLS: int = int(os.getenv("OUTPUT_REPAIR_MAX_CALLS", "1"))
+
+
+# Chọn model / maxTokens theo kích thước input + SLO, escalate khi kết quả kém
+# (MODEL_TIERS, LARGE_MODEL_ID, ROUTER_* - xem model_router.py)
+ROUTER = model_router.from_env(Config.MODEL_ID)
+
+VALID_RISK_LEVELS = {"LOW", "MEDIUM", "HIGH", "CRITICAL"}
+
 
 
 SYSTEM_PROMPT = """
@@ -95,6 +157,16 @@ class ContractInput:
     file_bytes: Optional[bytes] = None
     # context RAG do BE gửi lên (hoặc để None)
     rag_context: Optional[str] = None
+    # SLO latency cho lời gọi model (None = ROUTER_LATENCY_SLO_MS)
+    latency_slo_ms: Optional[int] = None
+    # Pre-screen bằng rule (chỉ mode TEXT); prescreen_only = không gọi model
+    prescreen: bool = True
+    prescreen_only: bool = False
+    # Id bản nháp phía client: có thì chỉ phân tích lại điều khoản đã sửa
+    document_id: Optional[str] = None
+    # Caller đã xác thực (claim authorizer / tenant_id của invoke trực tiếp), gộp vào key
+    # lưu kết quả để document_id trùng giữa các user không lẫn kết quả của nhau
+    tenant_id: Optional[str] = None
 
     @property
     def has_file(self) -> bool:
@@ -123,7 +195,7 @@ def parse_event_body(event: Dict[str, Any]) -> Dict[str, Any]:
         body = base64.b64decode(body).decode("utf-8")
 
     try:
-        data = json.loads(body)
+        data = fast_json.loads(body)
     except json.JSONDecodeError:
         logger.warning("Body is not valid JSON")
         raise ValueError("Request body must be valid JSON")
@@ -131,13 +203,48 @@ def parse_event_body(event: Dict[str, Any]) -> Dict[str, Any]:
     return data
 
 
+def request_tenant_id(event: Dict[str, Any], data: Dict[str, Any]) -> Optional[str]:
+    """
+    Caller của request. API Gateway: claim Config.TENANT_ID_CLAIM của authorizer
+    (HTTP API JWT / REST API Cognito / Lambda authorizer), bỏ qua tenant_id trong body.
+    Invoke trực tiếp (backend, worker job async): tenant_id trong payload.
+    """
+    if "body" not in event and "requestContext" not in event:
+        return data.get("tenant_id")
+    authorizer = (event.get("requestContext") or {}).get("authorizer") or {}
+    claims = (authorizer.get("jwt") or {}).get("claims") or authorizer.get("claims") or authorizer.get("lambda")
+    if not isinstance(claims, dict):
+        claims = authorizer
+    claimed = claims.get(Config.TENANT_ID_CLAIM)
+    return str(claimed) if claimed else None
+
+
 # ----------------------------------------------------------------------------- 
 # 4. Request -> ContractInput (validation)
 # ----------------------------------------------------------------------------- 
 
+def parse_flag(data: Dict[str, Any], name: str, default: bool) -> bool:
+    """Cờ boolean trong body: true / "true" / "1" và false / "false" / "0"; giá trị khác -> ValueError."""
+    value = data.get(name)
+    if value is None:
+        return default
+    if value in (True, 1, "true", "1"):
+        return True
+    if value in (False, 0, "false", "0"):
+        return False
+    raise ValueError(f"{name} must be true or false")
+
+
 def parse_contract_input(data: Dict[str, Any]) -> ContractInput:
     language = (data.get("language") or "vi").lower()
 
+    latency_slo_ms = data.get("latency_slo_ms")
+    if latency_slo_ms is not None:
+        try:
+            latency_slo_ms = int(latency_slo_ms)
+        except (TypeError, ValueError):
+            raise ValueError("latency_slo_ms must be an integer")
+
     # Lấy context_rag (nếu BE gửi lên)
     rag_context = (data.get("context_rag") or "").strip() or None
 
@@ -171,6 +278,7 @@ def parse_contract_input(data: Dict[str, Any]) -> ContractInput:
             file_format=file_format,
             file_bytes=file_bytes,
             rag_context=rag_context,
+            latency_slo_ms=latency_slo_ms,
         )
 
     # Text branch
@@ -180,10 +288,29 @@ def parse_contract_input(data: Dict[str, Any]) -> ContractInput:
             "Either contract_text or (file_bytes_base64 + file_format) is required"
         )
 
+    prescreen_only = parse_flag(data, "prescreen_only", False)
+    prescreen = prescreen_only or parse_flag(data, "prescreen", Config.PRESCREEN_ENABLED)
+
+    document_id = str(data.get("document_id") or "").strip() or None
+    if document_id and len(document_id) > 200:
+        raise ValueError("document_id must be at most 200 characters")
+    if not parse_flag(data, "incremental", True):
+        document_id = None
+    tenant_id = str(data.get("tenant_id") or "").strip() or None
+    if document_id and not tenant_id:
+        # Không biết caller: document_id (vd. draft_<timestamp>) có thể trùng giữa các user
+        logger.info("document_id without authenticated caller, incremental analysis disabled")
+        document_id = None
+
     return ContractInput(
         language=language,
         contract_text=contract_text,
         rag_context=rag_context,
+        latency_slo_ms=latency_slo_ms,
+        prescreen=prescreen,
+        prescreen_only=prescreen_only,
+        document_id=document_id,
+        tenant_id=tenant_id,
     )
 
 
@@ -191,87 +318,134 @@ def parse_contract_input(data: Dict[str, Any]) -> ContractInput:
 # 5. RAG hook: dùng Lambda invoke thay vì API Gateway
 # ----------------------------------------------------------------------------- 
 
-def retrieve_legal_context(contract_text: str, language: str) -> str:
-    """
-    Gọi trực tiếp Lambda rag_search (invokeFunction), trả về text context để nhét vào prompt LLM.
-    Nếu RAG lỗi hoặc chưa cấu hình, trả chuỗi rỗng để không chặn flow chính.
+def _rag_cache_key(payload: Dict[str, Any]) -> str:
+    # Chuẩn hoá khoảng trắng / hoa-thường để các bản copy của cùng một hợp đồng
+    # mẫu (khác format) dùng chung kết quả RAG
+    normalized = dict(payload)
+    normalized["query"] = " ".join((payload.get("query") or "").lower().split())
+    raw = json.dumps(normalized, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
-    Yêu cầu:
-    - ENV: RAG_FUNCTION_NAME = tên hàm Lambda rag_search
-    - IAM: lambda:InvokeFunction trên hàm đó
-    """
-    if not RAG_FUNCTION_NAME:
-        return ""
 
-    # Payload gửi sang rag_search
-    payload = {
-        "query": contract_text,
-        "language": language,
-        "top_k": 8,
-        "filters": {
-            "source_type": ["legal"],
-        }
-    }
+def decode_rag_payload(resp_payload: Any) -> Any:
+    """rag_search với compress: {"encoding": "gzip", "data": base64} -> dict."""
+    if isinstance(resp_payload, dict) and resp_payload.get("encoding") == "gzip":
+        return fast_json.loads(gzip.decompress(base64.b64decode(resp_payload["data"])))
+    return resp_payload
 
+
+def invoke_rag_search(payload: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """
+    Invoke Lambda rag_search, trả về list chunk (có thể rỗng) hoặc None nếu lỗi.
+    """
     try:
         response = lambda_client.invoke(
             FunctionName=RAG_FUNCTION_NAME,
             InvocationType="RequestResponse",
-            Payload=json.dumps(payload).encode("utf-8"),
+            Payload=fast_json.dumps_bytes(payload),
         )
     except Exception as e:
         print(f"[WARN] RAG Lambda invoke failed: {e}")
-        return ""
+        return None
 
     try:
         raw_payload = response["Payload"].read()
-        resp_payload = json.loads(raw_payload)
+        resp_payload = decode_rag_payload(fast_json.loads(raw_payload))
     except Exception as e:
         print(f"[WARN] Failed to parse RAG Lambda raw payload: {e}")
-        return ""
+        return None
 
     # Trường hợp rag_search đang trả theo format API (statusCode + body)
     if isinstance(resp_payload, dict) and "statusCode" in resp_payload:
         status = resp_payload.get("statusCode", 500)
         if status != 200:
             print(f"[WARN] RAG Lambda returned status {status}: {resp_payload.get('body')}")
-            return ""
+            return None
         body = resp_payload.get("body") or "{}"
         try:
-            result = json.loads(body)
+            result = fast_json.loads(body)
         except json.JSONDecodeError:
             print("[WARN] RAG Lambda body is not valid JSON")
-            return ""
+            return None
     else:
         # Nếu sau này rag_search trả raw dict, dùng luôn
         if isinstance(resp_payload, dict):
             result = resp_payload
         else:
-            return ""
+            return None
 
-    chunks = result.get("results") or []
+    return result.get("results") or []
+
+
+def fetch_rag_chunks(payload: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """
+    invoke_rag_search + LRU cache trong process (RAG_RESULT_CACHE_SIZE > 0).
+    Chỉ cache kết quả thành công; an toàn khi gọi từ nhiều thread (batch).
+    """
+    if RAG_RESULT_CACHE_SIZE <= 0:
+        return invoke_rag_search(payload)
+
+    key = _rag_cache_key(payload)
+    with RAG_RESULT_CACHE_LOCK:
+        if key in RAG_RESULT_CACHE:
+            RAG_RESULT_CACHE.move_to_end(key)
+            RAG_RESULT_CACHE_STATS["hits"] += 1
+            return RAG_RESULT_CACHE[key]
+        RAG_RESULT_CACHE_STATS["misses"] += 1
+
+    chunks = invoke_rag_search(payload)
+    if chunks is not None:
+        with RAG_RESULT_CACHE_LOCK:
+            RAG_RESULT_CACHE[key] = chunks
+            while len(RAG_RESULT_CACHE) > RAG_RESULT_CACHE_SIZE:
+                RAG_RESULT_CACHE.popitem(last=False)
+    return chunks
+
+
+def retrieve_legal_context(
+    contract_text: str,
+    language: str,
+    debug: Optional[Dict[str, Any]] = None,
+) -> str:
+    """
+    Gọi trực tiếp Lambda rag_search (invokeFunction), trả về text context để nhét vào prompt LLM.
+    Nếu RAG lỗi hoặc chưa cấu hình, trả chuỗi rỗng để không chặn flow chính.
+    Context được đóng gói trong Config.RAG_CONTEXT_TOKEN_BUDGET; thống kê phần bị
+    cắt/bỏ ghi vào debug["rag_context"] (nếu truyền debug).
+
+    Yêu cầu:
+    - ENV: RAG_FUNCTION_NAME = tên hàm Lambda rag_search
+    - IAM: lambda:InvokeFunction trên hàm đó
+    """
+    if not RAG_FUNCTION_NAME:
+        return ""
+
+    # Payload gửi sang rag_search
+    payload = {
+        "query": contract_text,
+        "language": language,
+        "top_k": 8,
+        "filters": {
+            "source_type": ["legal"],
+        },
+        "diversity": RAG_DIVERSITY,
+        # Chỉ lấy field cần cho prompt, trả dict trực tiếp (nén nếu lớn)
+        "fields": RAG_RESULT_FIELDS,
+        "response_format": "raw",
+        "compress": "auto",
+    }
+
+    chunks = fetch_rag_chunks(payload)
     if not chunks:
         return ""
 
-    lines = []
-    for i, c in enumerate(chunks, start=1):
-        title = c.get("title") or ""
-        article_no = c.get("article_no") or ""
-        article_title = c.get("article_title") or ""
-        text = c.get("text") or ""
-
-        header = f"[Trích dẫn {i} – {title}"
-        if article_no:
-            header += f", {article_no}"
-        if article_title:
-            header += f": {article_title}"
-        header += "]"
-
-        lines.append(header)
-        lines.append(text)
-        lines.append("")
-
-    context_str = "\n".join(lines)
+    budget = Config.RAG_CONTEXT_TOKEN_BUDGET
+    if budget <= 0:
+        budget = sum(estimate_tokens(c.get("text") or "") + 50 for c in chunks)
+
+    context_str, stats = pack_legal_context(chunks, query=contract_text, budget_tokens=budget, label="Trích dẫn")
+    if debug is not None:
+        debug["rag_context"] = stats
     return context_str
 
 
@@ -279,15 +453,23 @@ def retrieve_legal_context(contract_text: str, language: str) -> str:
 # 6. Prompt builder & Bedrock client
 # ----------------------------------------------------------------------------- 
 
-def build_user_prompt_text(contract_text: str, context: str | None = None) -> str:
+CLAUSE_LABEL_INSTRUCTION = (
+    "Mỗi điều khoản được đánh mã dạng [C1], [C2], ... Với mỗi phần tử risk_items, thêm trường "
+    "\"clause_id\" là mã điều khoản liên quan (chuỗi rỗng nếu rủi ro chung cho cả hợp đồng). "
+    "Chỉ phân tích các điều khoản có nội dung; điều khoản đã lược bỏ nội dung thì bỏ qua.\n\n"
+)
+
+
+def build_user_prompt_text(contract_text: str, context: str | None = None, labelled: bool = False) -> str:
     """
     Prompt dùng cho mode TEXT.
-    Có thêm context (RAG) nếu không rỗng.
+    Có thêm context (RAG) nếu không rỗng; labelled = điều khoản đã đánh mã [C1], ...
     """
     base = (
         "Dưới đây là nội dung hợp đồng cần phân tích rủi ro. "
         "Hãy đọc kỹ và TRẢ VỀ DUY NHẤT một JSON hợp lệ theo đúng cấu trúc đã được mô tả trong hướng dẫn hệ thống.\n\n"
-        "=== NỘI DUNG HỢP ĐỒNG ===\n"
+        + (CLAUSE_LABEL_INSTRUCTION if labelled else "")
+        + "=== NỘI DUNG HỢP ĐỒNG ===\n"
         f"{contract_text}\n"
         "=== HẾT NỘI DUNG HỢP ĐỒNG ==="
     )
@@ -303,19 +485,112 @@ def build_user_prompt_text(contract_text: str, context: str | None = None) -> st
     return base
 
 
-def call_bedrock_text(contract_text: str, language: str) -> str:
+ANALYSIS_TOOL_NAME = "report_contract_analysis"
+LEVEL_ENUM = ["LOW", "MEDIUM", "HIGH", "CRITICAL"]
+RISK_TYPE_ENUM = ["LegalCompliance", "Financial", "FraudScam", "UnclearTerm", "ImbalancedObligation"]
+
+RISK_ITEM_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "id": {"type": "string"},
+        "title": {"type": "string"},
+        "clause_id": {"type": "string"},
+        "clause_excerpt": {"type": "string"},
+        "risk_types": {"type": "array", "items": {"type": "string", "enum": RISK_TYPE_ENUM}},
+        "severity": {"type": "string", "enum": LEVEL_ENUM},
+        "description": {"type": "string"},
+        "recommendation": {"type": "string"},
+        "law_references": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "law_name": {"type": "string"},
+                    "article": {"type": "string"},
+                    "clause": {"type": "string"},
+                    "note": {"type": "string"},
+                },
+            },
+        },
+    },
+    "required": ["id", "title", "severity", "description", "recommendation"],
+}
+
+ANALYSIS_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "overall_risk_level": {"type": "string", "enum": LEVEL_ENUM},
+        "risk_items": {"type": "array", "items": RISK_ITEM_SCHEMA},
+        "disclaimer": {"type": "string"},
+    },
+    "required": ["summary", "overall_risk_level", "risk_items", "disclaimer"],
+}
+
+
+def analysis_tool_kwargs(schema: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """toolConfig bắt model trả kết quả đúng schema (rỗng nếu OUTPUT_TOOL_USE=0)."""
+    if not Config.OUTPUT_TOOL_USE:
+        return {}
+    return {
+        "toolConfig": {
+            "tools": [{
+                "toolSpec": {
+                    "name": ANALYSIS_TOOL_NAME,
+                    "description": "Trả kết quả phân tích rủi ro hợp đồng theo đúng cấu trúc JSON yêu cầu.",
+                    "inputSchema": {"json": schema or ANALYSIS_SCHEMA},
+                }
+            }],
+            "toolChoice": {"tool": {"name": ANALYSIS_TOOL_NAME}},
+        }
+    }
+
+
+def extract_model_output(response: Dict[str, Any], attempt: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Text output của Converse. Model trả qua tool -> JSON của toolUse.input
+    (attempt["tool_use"] = True); không thì ghép các block text.
+    """
+    content_list = response["output"]["message"].get("content", [])
+    if not content_list:
+        raise ValueError("Empty content from model")
+    for block in content_list:
+        tool_use = block.get("toolUse")
+        if tool_use and tool_use.get("name") == ANALYSIS_TOOL_NAME:
+            if attempt is not None:
+                attempt["tool_use"] = True
+            return fast_json.dumps(tool_use.get("input") or {})
+    return "".join(block.get("text", "") for block in content_list)
+
+
+def call_bedrock_text(
+    contract_text: str,
+    language: str,
+    debug: Optional[Dict[str, Any]] = None,
+    legal_context: Optional[str] = None,
+    route: Optional[Dict[str, Any]] = None,
+    attempts: Optional[List[Dict[str, Any]]] = None,
+    labelled: bool = False,
+) -> str:
     """
     Gọi Bedrock Converse API với TEXT và trả về raw text từ model.
-    Có sẵn hook context từ RAG.
+    Có sẵn hook context từ RAG (legal_context: context đã lấy sẵn, "" = không có).
+    route: decision của ROUTER (None = tự route); attempts nhận thông tin lời gọi.
+    labelled: contract_text đã đánh mã điều khoản (model trả thêm clause_id).
     """
-    context = retrieve_legal_context(contract_text, language=language)
-    user_prompt = build_user_prompt_text(contract_text, context=context)
+    context = legal_context
+    if context is None:
+        context = retrieve_legal_context(contract_text, language=language, debug=debug)
+    user_prompt = build_user_prompt_text(contract_text, context=context, labelled=labelled)
+    if route is None:
+        route = ROUTER.route("analysis", estimate_tokens(SYSTEM_PROMPT + user_prompt))
 
-    logger.info("Calling Bedrock model %s with TEXT ...", Config.MODEL_ID)
+    logger.info("Calling Bedrock model %s with TEXT (maxTokens=%d) ...", route["model_id"], route["max_tokens"])
 
     try:
-        response = bedrock.converse(
-            modelId=Config.MODEL_ID,
+        response, attempt = ROUTER.converse(
+            bedrock,
+            route,
             system=[{"text": SYSTEM_PROMPT}],
             messages=[
                 {
@@ -324,22 +599,20 @@ def call_bedrock_text(contract_text: str, language: str) -> str:
                 }
             ],
             inferenceConfig={
-                "maxTokens": 4096,
                 "temperature": 0.2,
                 "topP": 0.9,
             },
+            **analysis_tool_kwargs(),
         )
         logger.info("Received response from Bedrock (text mode)")
+        if attempts is not None:
+            attempts.append(attempt)
     except ClientError as e:
         logger.error("Bedrock invocation failed (text mode): %s", e)
         raise
 
     try:
-        output_message = response["output"]["message"]
-        content_list = output_message.get("content", [])
-        if not content_list:
-            raise ValueError("Empty content from model (text mode)")
-        model_text = content_list[0].get("text", "")
+        model_text = extract_model_output(response, attempt)
     except Exception as e:
         logger.error("Failed to extract text from Bedrock response (text mode): %s", e)
         raise
@@ -353,12 +626,15 @@ def call_bedrock_document(
     file_name: Optional[str],
     language: str,
     context: Optional[str] = None,
+    route: Optional[Dict[str, Any]] = None,
+    attempts: Optional[List[Dict[str, Any]]] = None,
 ) -> str:
     """
     Gọi Bedrock Converse API với DOCUMENT (pdf/docx/...) và trả về raw text từ model.
 
     file_format: pdf, doc, docx, txt, md, html
     context: chuỗi RAG (luật, mẫu hợp đồng) đã được build ở BE (context_rag)
+    route / attempts: như call_bedrock_text
     """
     if not file_name:
         file_name = f"uploaded_contract.{file_format}"
@@ -376,14 +652,21 @@ def call_bedrock_document(
             "=== HẾT THÔNG TIN THAM KHẢO ==="
         )
 
+    if route is None:
+        route = ROUTER.route(
+            "analysis",
+            estimate_document_tokens(file_bytes, file_format) + estimate_tokens(SYSTEM_PROMPT + user_text),
+        )
+
     logger.info(
         "Calling Bedrock model %s with DOCUMENT (format=%s, name=%s, size=%d bytes, has_context=%s) ...",
-        Config.MODEL_ID, file_format, file_name, len(file_bytes), bool(context)
+        route["model_id"], file_format, file_name, len(file_bytes), bool(context)
     )
 
     try:
-        response = bedrock.converse(
-            modelId=Config.MODEL_ID,
+        response, attempt = ROUTER.converse(
+            bedrock,
+            route,
             system=[{"text": SYSTEM_PROMPT}],
             messages=[
                 {
@@ -401,22 +684,20 @@ def call_bedrock_document(
                 }
             ],
             inferenceConfig={
-                "maxTokens": 4096,
                 "temperature": 0.2,
                 "topP": 0.9,
             },
+            **analysis_tool_kwargs(),
         )
         logger.info("Received response from Bedrock (document mode)")
+        if attempts is not None:
+            attempts.append(attempt)
     except ClientError as e:
         logger.error("Bedrock invocation failed (document mode): %s", e)
         raise
 
     try:
-        output_message = response["output"]["message"]
-        content_list = output_message.get("content", [])
-        if not content_list:
-            raise ValueError("Empty content from model (document mode)")
-        model_text = content_list[0].get("text", "")
+        model_text = extract_model_output(response, attempt)
     except Exception as e:
         logger.error(
             "Failed to extract text from Bedrock document response: %s", e
@@ -430,68 +711,641 @@ def call_bedrock_document(
 # 7. Model JSON parsing
 # ----------------------------------------------------------------------------- 
 
-def parse_model_json(model_output_text: str) -> Tuple[Dict[str, Any], Optional[str]]:
+_CODE_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.MULTILINE)
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+_SMART_QUOTES = str.maketrans({"“": '"', "”": '"'})
+
+
+def _close_truncated_json(text: str) -> str:
+    """Đóng chuỗi / ngoặc còn mở (output bị cắt giữa chừng)."""
+    stack, in_str, escaped = [], False, False
+    for ch in text:
+        if in_str:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]" and stack:
+            stack.pop()
+    out = text + ('"' if in_str else "")
+    out = re.sub(r",\s*$", "", out.rstrip())
+    return out + "".join(reversed(stack))
+
+
+def lenient_json_loads(text: str) -> Optional[Any]:
     """
-    Phiên bản robust: cố gắng trích JSON object đầu tiên trong output.
+    Parse JSON "gần đúng" của model: bỏ ```json, text thừa ngoài {...}, dấu phẩy
+    thừa, ngoặc kép kiểu “”, ngoặc chưa đóng. None nếu vẫn không parse được.
     """
-    try:
-        text = model_output_text.strip()
-        
-        # 1. Tìm vị trí dấu '{' đầu tiên
-        start_idx = text.find("{")
-        
-        # 2. Tìm vị trí dấu '}' cuối cùng
-        end_idx = text.rfind("}")
-        
-        if start_idx != -1 and end_idx != -1:
-            text = text[start_idx : end_idx + 1]
-        else:
-            raise ValueError("No JSON object found in output")
+    text = _CODE_FENCE_RE.sub("", (text or "").strip())
+    start = text.find("{")
+    if start == -1:
+        return None
+    end = text.rfind("}")
+    head = text[start:end + 1] if end > start else text[start:]
+    candidates = [head]
+    # “” trong nội dung tiếng Việt là hợp lệ -> chỉ thay khi cách khác không được
+    for src in (text[start:], text[start:].translate(_SMART_QUOTES)):
+        candidates.append(_TRAILING_COMMA_RE.sub(r"\1", src[:src.rfind("}") + 1] or src))
+        # bị cắt giữa chừng: đóng phần còn mở của toàn bộ phần sau "{"
+        candidates.append(_TRAILING_COMMA_RE.sub(r"\1", _close_truncated_json(src)))
+    for cand in candidates:
+        try:
+            return json.loads(cand)
+        except ValueError:
+            continue
+    return None
+
 
-        analysis = json.loads(text)
+def parse_model_json(model_output_text: str) -> Tuple[Dict[str, Any], Optional[str]]:
+    """
+    Phiên bản robust: cố gắng trích JSON object đầu tiên trong output
+    (lenient_json_loads). Trả về (analysis, raw); raw != None khi không parse được.
+    """
+    analysis = lenient_json_loads(model_output_text)
+    # "{" lạc trong câu trả lời text cũng parse thành {} -> không tính là kết quả
+    if isinstance(analysis, dict) and ("risk_items" in analysis or "overall_risk_level" in analysis):
         return analysis, None
 
+    logger.warning("Model output parsing failed: No JSON object found in output")
+    logger.info("Raw output causing error: %s", model_output_text)
+    analysis = {
+        "summary": "AI đã trả về kết quả nhưng không đúng định dạng JSON.",
+        "overall_risk_level": "UNKNOWN",
+        "risk_items": [],
+        "disclaimer": "Lỗi kỹ thuật từ phía AI Parser."
+    }
+    return analysis, model_output_text
+
+
+# ----------------------------------------------------------------------------- 
+# 7b. Kiểm tra schema + sửa output lỗi (cục bộ, rồi gọi model sửa riêng phần lỗi)
+# ----------------------------------------------------------------------------- 
+
+DEFAULT_DISCLAIMER = "Kết quả chỉ mang tính tham khảo, không thay thế tư vấn của luật sư."
+
+OUTPUT_REPAIR_STATS = {
+    "analyses": 0,          # số output model đã kiểm tra
+    "tool_use": 0,          # trả qua tool (schema ép từ phía model)
+    "valid": 0,             # đúng schema ngay
+    "local_fixed": 0,       # sửa được cục bộ, không gọi thêm
+    "repair_calls": 0,      # lời gọi sửa lỗi
+    "repaired": 0,          # hợp lệ sau khi gọi sửa
+    "unrepaired": 0,        # vẫn lỗi -> để analysis_confidence quyết định escalate
+}
+OUTPUT_REPAIR_LOCK = threading.Lock()
+
+
+def _bump_repair_stats(**counts) -> None:
+    with OUTPUT_REPAIR_LOCK:
+        for k, v in counts.items():
+            OUTPUT_REPAIR_STATS[k] += v
+
+
+def output_repair_stats() -> Dict[str, Any]:
+    with OUTPUT_REPAIR_LOCK:
+        stats = dict(OUTPUT_REPAIR_STATS)
+    checked = max(stats["analyses"], 1)
+    stats["repair_rate"] = round((stats["local_fixed"] + stats["repaired"]) / checked, 4)
+    stats["repair_call_rate"] = round(stats["repair_calls"] / checked, 4)
+    return stats
+
+
+def item_errors(item: Any) -> List[str]:
+    if not isinstance(item, dict):
+        return ["not_object"]
+    errors = [f for f in ("title", "description", "recommendation")
+              if not isinstance(item.get(f), str) or not item.get(f).strip()]
+    if item.get("severity") not in VALID_RISK_LEVELS:
+        errors.append("severity")
+    return errors
+
+
+def validate_analysis(analysis: Dict[str, Any]) -> List[str]:
+    """Lỗi schema dạng "overall_risk_level", "risk_items[2].severity"; [] nếu hợp lệ."""
+    errors = []
+    if not isinstance(analysis.get("summary"), str):
+        errors.append("summary")
+    if analysis.get("overall_risk_level") not in VALID_RISK_LEVELS:
+        errors.append("overall_risk_level")
+    if not isinstance(analysis.get("disclaimer"), str):
+        errors.append("disclaimer")
+    items = analysis.get("risk_items")
+    if not isinstance(items, list):
+        errors.append("risk_items")
+        return errors
+    for i, item in enumerate(items):
+        errors.extend(f"risk_items[{i}].{e}" for e in item_errors(item))
+    return errors
+
+
+def _as_level(value: Any) -> Any:
+    level = str(value or "").strip().upper()
+    return level if level in VALID_RISK_LEVELS else value
+
+
+def fix_analysis_locally(analysis: Dict[str, Any]) -> Dict[str, Any]:
+    """Sửa các lỗi không cần model: hoa/thường, kiểu list, field mặc định, id."""
+    fixed = dict(analysis)
+    items = fixed.get("risk_items")
+    if isinstance(items, dict):
+        items = [items]
+    if not isinstance(items, list):
+        items = []
+    out_items = []
+    for n, item in enumerate(items, 1):
+        if not isinstance(item, dict):
+            out_items.append(item)
+            continue
+        item = dict(item)
+        item["severity"] = _as_level(item.get("severity"))
+        item.setdefault("id", f"R{n}")
+        for f in ("clause_excerpt", "recommendation"):
+            if item.get(f) is None:
+                item[f] = ""
+        if isinstance(item.get("risk_types"), str):
+            item["risk_types"] = [t.strip() for t in item["risk_types"].split(",") if t.strip()]
+        item.setdefault("risk_types", [])
+        if not isinstance(item.get("law_references"), list):
+            item["law_references"] = []
+        out_items.append(item)
+    fixed["risk_items"] = out_items
+
+    fixed["overall_risk_level"] = _as_level(fixed.get("overall_risk_level"))
+    if fixed["overall_risk_level"] not in VALID_RISK_LEVELS:
+        severities = [i.get("severity") for i in out_items if isinstance(i, dict)]
+        fixed["overall_risk_level"] = contract_clauses.max_severity(severities) or "LOW"
+    if not isinstance(fixed.get("summary"), str):
+        fixed["summary"] = ""
+    if not isinstance(fixed.get("disclaimer"), str) or not fixed["disclaimer"].strip():
+        fixed["disclaimer"] = DEFAULT_DISCLAIMER
+    return fixed
+
+
+REPAIR_SYSTEM_PROMPT = (
+    "Bạn sửa dữ liệu JSON bị lỗi định dạng cho hệ thống phân tích rủi ro hợp đồng. "
+    "Giữ nguyên nội dung, chỉ sửa cấu trúc / giá trị không hợp lệ theo schema. "
+    "severity chỉ nhận LOW | MEDIUM | HIGH | CRITICAL. Không thêm giải thích."
+)
+
+
+def call_repair(prompt: str, schema: Dict[str, Any]) -> Optional[Any]:
+    """Một lời gọi sửa lỗi: input chỉ gồm phần bị lỗi, output qua tool theo schema."""
+    route = ROUTER.route("repair", estimate_tokens(REPAIR_SYSTEM_PROMPT + prompt))
+    _bump_repair_stats(repair_calls=1)
+    try:
+        response, _ = ROUTER.converse(
+            bedrock,
+            route,
+            system=[{"text": REPAIR_SYSTEM_PROMPT}],
+            messages=[{"role": "user", "content": [{"text": prompt}]}],
+            inferenceConfig={"temperature": 0.0},
+            **analysis_tool_kwargs(schema),
+        )
+        return lenient_json_loads(extract_model_output(response))
     except Exception as e:
-        logger.warning("Model output parsing failed: %s", e)
-        logger.info("Raw output causing error: %s", model_output_text) 
-        
-        analysis = {
-            "summary": f"AI đã trả về kết quả nhưng không đúng định dạng JSON. (Lỗi: {str(e)})",
-            "overall_risk_level": "UNKNOWN",
-            "risk_items": [],
-            "disclaimer": "Lỗi kỹ thuật từ phía AI Parser."
-        }
-        return analysis, model_output_text
+        logger.warning("Output repair call failed: %s", e)
+        return None
+
+
+def repair_model_output(
+    analysis: Dict[str, Any],
+    raw: Optional[str],
+    attempt: Dict[str, Any],
+) -> Tuple[Dict[str, Any], Optional[str], Dict[str, Any]]:
+    """
+    Output model -> (analysis, raw, info). Sửa cục bộ trước; còn lỗi thì gọi model
+    rẻ chỉ với phần lỗi: các risk_item sai schema, hoặc (khi không parse được)
+    chính output JSON hỏng - không gửi lại hợp đồng. Output bị cắt hoặc không có
+    nội dung phân tích không sửa ở đây (analysis_confidence sẽ escalate).
+    """
+    info: Dict[str, Any] = {"tool_use": bool(attempt.get("tool_use")), "errors": [], "repair_calls": 0}
+    _bump_repair_stats(analyses=1, tool_use=int(info["tool_use"]))
+    if attempt.get("stop_reason") == "max_tokens":
+        return analysis, raw, info
+
+    if raw is None:
+        info["errors"] = validate_analysis(analysis)
+        if not info["errors"]:
+            _bump_repair_stats(valid=1)
+            return analysis, raw, info
+        analysis = fix_analysis_locally(analysis)
+        remaining = validate_analysis(analysis)
+        if not remaining:
+            info["fixed"] = "local"
+            _bump_repair_stats(local_fixed=1)
+            return analysis, raw, info
+    else:
+        info["errors"] = ["invalid_json"]
+        if '"risk_items"' not in raw and '"overall_risk_level"' not in raw:
+            # không có nội dung phân tích để sửa -> cần chạy lại thật (escalate)
+            _bump_repair_stats(unrepaired=1)
+            return analysis, raw, info
+
+    if Config.OUTPUT_REPAIR_MAX_CALLS <= 0:
+        _bump_repair_stats(unrepaired=1)
+        return analysis, raw, info
+
+    info["repair_calls"] = 1
+    if raw is not None:
+        prompt = (
+            "Output JSON sau bị lỗi cú pháp. Trả lại đúng nội dung đó dưới dạng JSON hợp lệ theo schema:\n\n"
+            + raw[:20000]
+        )
+        repaired = call_repair(prompt, ANALYSIS_SCHEMA)
+        if isinstance(repaired, dict):
+            repaired = fix_analysis_locally(repaired)
+            if not validate_analysis(repaired):
+                info["fixed"] = "repair_call"
+                _bump_repair_stats(repaired=1)
+                return repaired, None, info
+        _bump_repair_stats(unrepaired=1)
+        return analysis, raw, info
+
+    broken = [i for i, item in enumerate(analysis["risk_items"]) if item_errors(item)]
+    fragment = [analysis["risk_items"][i] for i in broken]
+    prompt = (
+        "Các phần tử risk_items sau không đúng schema (lỗi: "
+        + ", ".join(e for e in remaining) + "). "
+        "Trả lại đúng số phần tử, cùng thứ tự, đã sửa:\n\n"
+        + json.dumps(fragment, ensure_ascii=False)
+    )
+    repaired = call_repair(prompt, {
+        "type": "object",
+        "properties": {"risk_items": {"type": "array", "items": RISK_ITEM_SCHEMA}},
+        "required": ["risk_items"],
+    })
+    items = repaired.get("risk_items") if isinstance(repaired, dict) else None
+    if isinstance(items, list) and len(items) == len(broken):
+        merged_items = list(analysis["risk_items"])
+        for i, item in zip(broken, items):
+            merged_items[i] = item
+        candidate = fix_analysis_locally({**analysis, "risk_items": merged_items})
+        if not validate_analysis(candidate):
+            info["fixed"] = "repair_call"
+            _bump_repair_stats(repaired=1)
+            return candidate, None, info
+    _bump_repair_stats(unrepaired=1)
+    return analysis, raw, info
 
 
 # ----------------------------------------------------------------------------- 
 # 8. Core use case: analyze_contract
 # ----------------------------------------------------------------------------- 
 
-def analyze_contract(contract_input: ContractInput) -> Tuple[Dict[str, Any], Optional[str]]:
+def estimate_document_tokens(file_bytes: bytes, file_format: str) -> int:
+    """Ước lượng token của file đính kèm (text: theo ký tự; pdf/doc/docx: theo dung lượng)."""
+    if file_format in ("txt", "md", "html"):
+        return estimate_tokens(file_bytes.decode("utf-8", errors="ignore"))
+    # pdf/docx nén + định dạng: ~8 byte / token là ước lượng thô đủ để chọn tier
+    return max(1, len(file_bytes) // 8)
+
+
+def analysis_confidence(analysis: Dict[str, Any], raw: Optional[str], attempt: Dict[str, Any]) -> Optional[str]:
+    """Lý do kết quả phân tích low-confidence (để escalate), None nếu dùng được."""
+    if attempt.get("stop_reason") == "max_tokens":
+        return "truncated"
+    if raw is not None:
+        return "invalid_json"
+    if str(analysis.get("overall_risk_level") or "").upper() not in VALID_RISK_LEVELS:
+        return "invalid_risk_level"
+    items = analysis.get("risk_items")
+    if not isinstance(items, list):
+        return "invalid_risk_items"
+    for item in items:
+        if not isinstance(item, dict) or not item.get("description") or \
+                str(item.get("severity") or "").upper() not in VALID_RISK_LEVELS:
+            return "incomplete_risk_item"
+    return None
+
+
+def run_prescreen(contract_text: str) -> Tuple[Dict[str, Any], str, Dict[str, Any]]:
+    """
+    Rule pre-screen (contract_clauses.py) cho mode TEXT.
+    Trả về (screen, text gửi model, stats). Text gửi model chỉ giữ nguyên văn các
+    điều khoản bị flag / chưa chắc, phần còn lại thay bằng tiêu đề.
+    """
+    clauses = contract_clauses.split_clauses(contract_text)
+    screen = contract_clauses.prescreen(clauses)
+
+    model_text = contract_text
+    trimmed = (
+        estimate_tokens(contract_text) >= Config.PRESCREEN_MIN_TOKENS
+        and len(screen["full_clause_ids"]) < len(clauses)
+    )
+    if trimmed:
+        model_text = contract_clauses.compact_contract_text(clauses, screen)
+
+    stats = {
+        "elapsed_ms": screen["elapsed_ms"],
+        "clauses": len(clauses),
+        "flagged_clauses": len(screen["flagged_clause_ids"]),
+        "full_clauses": len(screen["full_clause_ids"]) if trimmed else len(clauses),
+        "rule_findings": len(screen["risk_items"]),
+        "trimmed": trimmed,
+        "contract_tokens": estimate_tokens(contract_text),
+        "prompt_contract_tokens": estimate_tokens(model_text),
+    }
+    return screen, model_text, stats
+
+
+def prescreen_analysis(screen: Dict[str, Any]) -> Dict[str, Any]:
+    """Kết quả phân tích chỉ từ rule (prescreen_only), cùng schema với output model."""
+    return {
+        "summary": "Kết quả kiểm tra sơ bộ tự động theo các quy tắc phổ biến, chưa qua phân tích của AI.",
+        "overall_risk_level": screen["overall_risk_level"],
+        "risk_items": screen["risk_items"],
+        "disclaimer": "Kết quả chỉ mang tính tham khảo, không thay thế tư vấn của luật sư.",
+    }
+
+
+# ----------------------------------------------------------------------------- 
+# 8b. Phân tích lại từng phần: hash theo điều khoản, lưu kết quả theo document_id
+# ----------------------------------------------------------------------------- 
+
+# Đổi prompt -> kết quả cũ không còn dùng lại được
+CLAUSE_STORE_VERSION = hashlib.sha256((SYSTEM_PROMPT + CLAUSE_LABEL_INSTRUCTION).encode("utf-8")).hexdigest()[:12]
+CLAUSE_STORE_MEMORY: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+CLAUSE_STORE_MEMORY_SIZE = 200
+CLAUSE_STORE_LOCK = threading.Lock()
+
+
+def _clause_store_key(tenant_id: str, document_id: str, language: str) -> str:
+    digest = hashlib.sha256(f"{language}:{tenant_id}:{document_id}".encode("utf-8")).hexdigest()[:40]
+    return f"{Config.ANALYSIS_STORE_PREFIX}{digest}.json"
+
+
+def load_clause_analysis(tenant_id: str, document_id: str, language: str) -> Optional[Dict[str, Any]]:
+    key = _clause_store_key(tenant_id, document_id, language)
+    record = None
+    if Config.ANALYSIS_STORE_BUCKET:
+        try:
+            obj = s3.get_object(Bucket=Config.ANALYSIS_STORE_BUCKET, Key=key)
+            record = fast_json.loads(obj["Body"].read())
+        except Exception as e:
+            # NoSuchKey = lần phân tích đầu của bản nháp
+            logger.info("No stored clause analysis for %s: %s", key, e)
+    else:
+        with CLAUSE_STORE_LOCK:
+            record = CLAUSE_STORE_MEMORY.get(key)
+    if not record or record.get("version") != CLAUSE_STORE_VERSION:
+        return None
+    return record
+
+
+def save_clause_analysis(tenant_id: str, document_id: str, language: str, record: Dict[str, Any]) -> None:
+    key = _clause_store_key(tenant_id, document_id, language)
+    record = {**record, "version": CLAUSE_STORE_VERSION, "updated_at": int(time.time())}
+    if Config.ANALYSIS_STORE_BUCKET:
+        try:
+            s3.put_object(
+                Bucket=Config.ANALYSIS_STORE_BUCKET, Key=key,
+                Body=fast_json.dumps_bytes(record), ContentType="application/json",
+            )
+        except Exception as e:
+            # Không lưu được chỉ làm lần sau phân tích lại toàn bộ
+            logger.warning("Failed to store clause analysis %s: %s", key, e)
+        return
+    with CLAUSE_STORE_LOCK:
+        CLAUSE_STORE_MEMORY[key] = record
+        CLAUSE_STORE_MEMORY.move_to_end(key)
+        while len(CLAUSE_STORE_MEMORY) > CLAUSE_STORE_MEMORY_SIZE:
+            CLAUSE_STORE_MEMORY.popitem(last=False)
+
+
+def plan_incremental(
+    contract_input: ContractInput,
+    screen: Optional[Dict[str, Any]],
+    prescreen_stats: Optional[Dict[str, Any]],
+) -> Dict[str, Any]:
+    """
+    So hash từng điều khoản với lần phân tích trước của document_id.
+    mode: "unchanged" (không cần gọi model), "incremental" (chỉ gửi điều khoản đã
+    sửa, phần còn lại chỉ còn tiêu đề) hoặc "full" (chưa có kết quả cũ / sửa nhiều).
+    """
+    clauses = contract_clauses.split_clauses(contract_input.contract_text)
+    hashes = {c["clause_id"]: contract_clauses.clause_hash(c) for c in clauses}
+    previous = load_clause_analysis(
+        contract_input.tenant_id, contract_input.document_id, contract_input.language
+    )
+    stored = (previous or {}).get("clauses") or {}
+    changed = [c["clause_id"] for c in clauses if hashes[c["clause_id"]] not in stored]
+
+    if previous is None or len(changed) > Config.INCREMENTAL_MAX_CHANGED_RATIO * len(clauses):
+        mode, changed = "full", [c["clause_id"] for c in clauses]
+    elif not changed:
+        mode = "unchanged"
+    else:
+        mode = "incremental"
+
+    # Điều khoản pre-screen đã cho qua (không flag, loại ít rủi ro) vẫn chỉ gửi tiêu đề
+    prescreen_full = {c["clause_id"] for c in clauses}
+    if screen is not None and prescreen_stats and prescreen_stats["trimmed"]:
+        prescreen_full = set(screen["full_clause_ids"])
+    omitted = {}
+    for c in clauses:
+        cid = c["clause_id"]
+        if cid not in changed:
+            omitted[cid] = contract_clauses.OMITTED_UNCHANGED
+        elif cid not in prescreen_full:
+            omitted[cid] = contract_clauses.OMITTED_PRESCREENED
+
+    model_text = contract_clauses.render_clauses(clauses, omitted, labels=True)
+    if screen is not None:
+        model_text += contract_clauses.rule_findings_note(screen)
+    return {
+        "mode": mode,
+        "clauses": clauses,
+        "hashes": hashes,
+        "changed": set(changed),
+        "previous": previous,
+        "model_text": model_text,
+    }
+
+
+def merge_incremental(plan: Dict[str, Any], analysis: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Ghép risk_items mới (điều khoản đã sửa) với risk_items đã lưu (điều khoản
+    không đổi) theo thứ tự điều khoản hiện tại; id đánh lại R1, R2, ...
+    analysis = None khi không gọi model (mode "unchanged").
+    Trả về (analysis đã ghép, record để lưu).
+    """
+    previous = plan["previous"] or {}
+    stored = previous.get("clauses") or {}
+    by_clause, document_items = contract_clauses.assign_items_to_clauses(
+        (analysis or {}).get("risk_items") or [], plan["clauses"]
+    )
+    if plan["mode"] != "full":
+        seen = {str(i.get("title") or "") for i in document_items}
+        document_items = document_items + [
+            i for i in previous.get("document_items") or [] if str(i.get("title") or "") not in seen
+        ]
+
+    record_clauses: Dict[str, Any] = {}
+    risk_items: List[Dict[str, Any]] = []
+    reused_items = 0
+    for c in plan["clauses"]:
+        cid = c["clause_id"]
+        h = plan["hashes"][cid]
+        if cid in plan["changed"]:
+            items = [{k: v for k, v in i.items() if k not in ("id", "clause_id")} for i in by_clause.get(cid, [])]
+        else:
+            items = stored[h]["risk_items"]
+            reused_items += len(items)
+        record_clauses[h] = {"heading": c["heading"], "risk_items": items}
+        risk_items.extend({**i, "clause_id": cid} for i in items)
+    document_items = [{k: v for k, v in i.items() if k not in ("id", "clause_id")} for i in document_items]
+    risk_items.extend({**i, "clause_id": ""} for i in document_items)
+    for n, item in enumerate(risk_items, 1):
+        item["id"] = f"R{n}"
+
+    if plan["mode"] == "full":
+        base = analysis
+        level = str(analysis.get("overall_risk_level") or "").upper()
+    else:
+        # Tóm tắt của lần phân tích toàn bộ gần nhất vẫn mô tả đúng hợp đồng
+        base = {**(analysis or {}), **{k: previous[k] for k in ("summary", "disclaimer") if previous.get(k)}}
+        level = contract_clauses.max_severity([i.get("severity") for i in risk_items]) or "LOW"
+
+    merged = {**base, "overall_risk_level": level, "risk_items": risk_items}
+    record = {
+        "summary": merged.get("summary"),
+        "disclaimer": merged.get("disclaimer"),
+        "overall_risk_level": level,
+        "clauses": record_clauses,
+        "document_items": document_items,
+    }
+    stats = {
+        "clauses": len(plan["clauses"]),
+        "analyzed_clauses": len(plan["changed"]),
+        "reused_clauses": len(plan["clauses"]) - len(plan["changed"]),
+        "reused_risk_items": reused_items,
+    }
+    return merged, {"record": record, "stats": stats}
+
+
+def analyze_contract(
+    contract_input: ContractInput,
+    debug: Optional[Dict[str, Any]] = None,
+    progress=None,
+) -> Tuple[Dict[str, Any], Optional[str]]:
     """
     Core logic:
     - Chọn mode TEXT hoặc DOCUMENT.
-    - Gọi Bedrock tương ứng.
-    - Parse JSON từ output.
+    - Mode TEXT: pre-screen bằng rule, chỉ gửi điều khoản bị flag / chưa chắc
+      (kèm khung hợp đồng) cho model; rủi ro của rule được gộp vào kết quả.
+      Có document_id: chỉ gửi điều khoản đã sửa so với lần phân tích trước,
+      risk_items của điều khoản không đổi được dùng lại.
+    - ROUTER chọn model + maxTokens, gọi Bedrock tương ứng.
+    - Parse JSON từ output; kết quả low-confidence (JSON lỗi, bị cắt, thiếu field)
+      thì gọi lại với tier lớn hơn nếu còn trong SLO.
+    debug (optional): dict nhận thông tin phụ (vd. thống kê context RAG, "routing",
+    "prescreen", "incremental"). progress (optional): nhận risk_items sơ bộ ngay sau pre-screen.
     """
+    screen = None
+    plan = None
     if contract_input.has_file:
-        model_output_text = call_bedrock_document(
-            file_bytes=contract_input.file_bytes,
-            file_format=contract_input.file_format,
-            file_name=contract_input.file_name,
-            language=contract_input.language,
-            context=contract_input.rag_context,  # context RAG do BE truyền (nếu có)
-        )
+        input_tokens = estimate_document_tokens(contract_input.file_bytes, contract_input.file_format)
+        input_tokens += estimate_tokens(SYSTEM_PROMPT + (contract_input.rag_context or ""))
+
+        def call(route, attempts):
+            return call_bedrock_document(
+                file_bytes=contract_input.file_bytes,
+                file_format=contract_input.file_format,
+                file_name=contract_input.file_name,
+                language=contract_input.language,
+                context=contract_input.rag_context,  # context RAG do BE truyền (nếu có)
+                route=route,
+                attempts=attempts,
+            )
     elif contract_input.has_text:
-        model_output_text = call_bedrock_text(
-            contract_text=contract_input.contract_text,
-            language=contract_input.language,
-        )
+        model_text = contract_input.contract_text
+        stats = None
+        if contract_input.prescreen:
+            screen, model_text, stats = run_prescreen(contract_input.contract_text)
+            if debug is not None:
+                debug["prescreen"] = stats
+            if progress:
+                progress("prescreened", 20, risk_items=screen["risk_items"])
+            if contract_input.prescreen_only:
+                if debug is not None:
+                    debug["routing"] = {"final_model": "rules", "attempts": [], "escalated": False}
+                return prescreen_analysis(screen), None
+
+        if contract_input.document_id:
+            plan = plan_incremental(contract_input, screen, stats)
+            if plan["mode"] == "unchanged":
+                analysis, result = merge_incremental(plan, None)
+                if debug is not None:
+                    debug["incremental"] = {"document_id": contract_input.document_id, "mode": "unchanged", **result["stats"]}
+                    debug["routing"] = {"final_model": plan["previous"].get("model"), "attempts": [], "escalated": False}
+                if screen is not None:
+                    analysis = contract_clauses.merge_prescreen(analysis, screen)
+                return analysis, None
+            model_text = plan["model_text"]
+
+        # RAG chỉ gọi một lần (theo toàn văn hợp đồng), dùng lại nếu phải escalate
+        context = retrieve_legal_context(contract_input.contract_text, language=contract_input.language, debug=debug)
+        input_tokens = estimate_tokens(SYSTEM_PROMPT + build_user_prompt_text(model_text, context, labelled=plan is not None))
+
+        def call(route, attempts):
+            return call_bedrock_text(
+                contract_text=model_text,
+                language=contract_input.language,
+                debug=debug,
+                legal_context=context or "",
+                route=route,
+                attempts=attempts,
+                labelled=plan is not None,
+            )
     else:
         raise ValueError("No valid input provided")
 
-    analysis, raw = parse_model_json(model_output_text)
+    route = ROUTER.route("analysis", input_tokens, slo_ms=contract_input.latency_slo_ms)
+    routing: Dict[str, Any] = {"initial": route, "attempts": []}
+    started = time.perf_counter()
+    while True:
+        model_output_text = call(route, routing["attempts"])
+        analysis, raw = parse_model_json(model_output_text)
+        analysis, raw, repair = repair_model_output(analysis, raw, routing["attempts"][-1])
+        routing["attempts"][-1]["output_repair"] = repair
+        why = analysis_confidence(analysis, raw, routing["attempts"][-1])
+        if why is None:
+            break
+        elapsed_ms = (time.perf_counter() - started) * 1000.0
+        next_route = ROUTER.escalate(route, why, elapsed_ms)
+        if next_route is None:
+            routing["low_confidence"] = why
+            break
+        logger.info("Low-confidence analysis (%s) from %s, escalating to %s", why, route["model_id"], next_route["model_id"])
+        route = next_route
+
+    routing["final_model"] = route["model_id"]
+    routing["escalated"] = len(routing["attempts"]) > 1
+    if debug is not None:
+        debug["routing"] = routing
+    if plan is not None and raw is None:
+        analysis, result = merge_incremental(plan, analysis)
+        if "low_confidence" not in routing:
+            save_clause_analysis(
+                contract_input.tenant_id, contract_input.document_id, contract_input.language,
+                {**result["record"], "model": route["model_id"]},
+            )
+        if debug is not None:
+            debug["incremental"] = {
+                "document_id": contract_input.document_id,
+                "mode": plan["mode"],
+                **result["stats"],
+                "prompt_contract_tokens": estimate_tokens(model_text),
+            }
+    if screen is not None:
+        analysis = contract_clauses.merge_prescreen(analysis, screen)
     return analysis, raw
 
 
@@ -506,7 +1360,7 @@ def make_response(status_code: int, body: Dict[str, Any]) -> Dict[str, Any]:
             "Content-Type": "application/json",
             "Access-Control-Allow-Origin": "*",
         },
-        "body": json.dumps(body, ensure_ascii=False),
+        "body": fast_json.dumps(body),
     }
 
 
@@ -514,21 +1368,70 @@ def make_response(status_code: int, body: Dict[str, Any]) -> Dict[str, Any]:
 # 10. Lambda handler
 # ----------------------------------------------------------------------------- 
 
+def run_analysis(data: Dict[str, Any], progress=None) -> Dict[str, Any]:
+    """
+    Request body -> response body. Dùng chung cho request đồng bộ và job worker;
+    progress(stage, percent, **partial) được gọi khi chạy dưới dạng job.
+    """
+    contract_input = parse_contract_input(data)
+    if progress:
+        progress("analyzing", 10, mode="document" if contract_input.has_file else "text")
+
+    debug: Dict[str, Any] = {}
+    analysis, raw_model_output = analyze_contract(contract_input, debug=debug, progress=progress)
+
+    routing = debug.pop("routing", {})
+    return {
+        "analysis": analysis,
+        "model": routing.get("final_model", Config.MODEL_ID),
+        "routing": routing,
+        "raw_model_output": raw_model_output,
+        "language": contract_input.language,
+        "debug": debug,
+    }
+
+
+def run_analysis_job(worker_event: Dict[str, Any]) -> Dict[str, Any]:
+    return run_job(worker_event, run_analysis, s3=s3)
+
+
+def job_status_response(job_id: str, owner: Optional[str]) -> Dict[str, Any]:
+    job = get_job_store().get(job_id)
+    if not job_visible_to(job, owner):
+        return make_response(404, {"error": f"Job not found: {job_id}"})
+    return make_response(200, public_view(job))
+
+
 def lambda_handler(event, context):
     logger.info("Received event: %s", json.dumps(event)[:1000])
+    event_capture.capture_event("callllm", event)
+
+    # Worker của job async (được chính Lambda này invoke kiểu Event)
+    if is_job_worker_event(event):
+        return run_analysis_job(event)
 
     try:
         data = parse_event_body(event)
-        contract_input = parse_contract_input(data)
-
-        analysis, raw_model_output = analyze_contract(contract_input)
+        data = dict(data, tenant_id=request_tenant_id(event, data))
+
+        if data.get("action") == "output_repair_stats":
+            return make_response(200, output_repair_stats())
+
+        # Poll trạng thái job: {"job_id": "..."} hoặc GET ?job_id=...
+        job_id = requested_job_id(event, data)
+        if job_id and not data.get("contract_text") and not data.get("file_bytes_base64"):
+            return job_status_response(job_id, data.get("tenant_id"))
+
+        # Job async: validate ngay để lỗi input vẫn trả 400 đồng bộ
+        if data.get("async"):
+            parse_contract_input(data)
+            job = submit_job(
+                "analyze_contract", data, context, lambda_client, s3=s3, run_inline=run_analysis_job,
+                owner=data.get("tenant_id"),
+            )
+            return make_response(202, {"job_id": job["job_id"], "status": JOB_QUEUED})
 
-        response_body = {
-            "analysis": analysis,
-            "model": Config.MODEL_ID,
-            "raw_model_output": raw_model_output,
-            "language": contract_input.language,
-        }
+        response_body = run_analysis(data)
         return make_response(200, response_body)
 
     except ValueError as ve:
@@ -547,4 +1450,4 @@ def lambda_handler(event, context):
         return make_response(
             500,
             {"error": "Internal server error", "details": str(e)},
-        )
\ No newline at end of file
+        )
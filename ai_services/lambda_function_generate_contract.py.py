@@ -1,13 +1,34 @@
 import json
 import os
+import gzip
+import base64
 import uuid
+import time
 import datetime
 import logging
-from typing import Dict, Any, List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any, List, Optional, Tuple
 
 import boto3
 from botocore.exceptions import ClientError
 
+import event_capture
+import fast_json
+import model_router
+from legal_context import estimate_tokens, pack_legal_context
+import template_renderer
+
+from job_store import (
+    JOB_QUEUED,
+    get_job_store,
+    is_job_worker_event,
+    job_visible_to,
+    public_view,
+    requested_job_id,
+    run_job,
+    submit_job,
+)
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -22,9 +43,59 @@ TEMPLATE_METADATA_KEY = os.getenv("TEMPLATE_METADATA_KEY", "index/template_metad
 
 MODEL_ID = os.getenv("MODEL_ID", "anthropic.claude-3-haiku-20240307-v1:0")
 
+# Chọn model / maxTokens theo độ dài template + SLO (MODEL_TIERS, LARGE_MODEL_ID,
+# ROUTER_* - xem model_router.py). Bản sinh ra bị cắt / quá ngắn -> escalate.
+ROUTER = model_router.from_env(MODEL_ID)
+# Bản nháp ngắn hơn tỉ lệ này so với template -> coi là chưa đầy đủ
+MIN_DRAFT_TEMPLATE_RATIO = float(os.getenv("MIN_DRAFT_TEMPLATE_RATIO", "0.3"))
+
+# Template có cấu trúc ("Điều N", slot {{...}}, chỗ trống "....") được render tại
+# chỗ, model chỉ viết điều khoản còn trống (template_renderer.py).
+# auto = dùng khi template parse được, llm = luôn để model viết toàn bộ.
+TEMPLATE_RENDER_MODE = os.getenv("TEMPLATE_RENDER_MODE", "auto")
+
 # Lambda RAG-search (đã triển khai ở giai đoạn 2.3)
 RAG_FUNCTION_NAME = os.getenv("RAG_FUNCTION_NAME", "ragsearch")
 
+# Đa dạng hoá kết quả RAG (MMR + tối đa N chunk / doc_id)
+RAG_DIVERSITY = {"mmr_lambda": 0.7, "max_per_doc": 2}
+RAG_RESULT_FIELDS = ["doc_id", "chunk_id", "title", "article_no", "article_title", "text", "score"]
+
+# Ngân sách token cho context pháp luật trong prompt (0 = không giới hạn)
+RAG_CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "1500"))
+
+# Cache context pháp luật theo template (không phụ thuộc contract_info).
+# Entry được invalidate khi version index pháp luật do ragsearch báo đổi.
+LEGAL_CONTEXT_CACHE_ENABLED = os.getenv("LEGAL_CONTEXT_CACHE_ENABLED", "1") == "1"
+LEGAL_CONTEXT_CACHE_PREFIX = os.getenv("LEGAL_CONTEXT_CACHE_PREFIX", "index/legal_context_cache")
+LEGAL_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("LEGAL_CONTEXT_CACHE_TTL_SECONDS", str(24 * 3600)))
+INDEX_VERSION_CHECK_SECONDS = int(os.getenv("INDEX_VERSION_CHECK_SECONDS", "60"))
+# Field contract_info ảnh hưởng tới luật áp dụng -> delta query nhỏ (có thể ghi đè
+# theo template bằng metadata["rag_delta_fields"])
+RAG_DELTA_FIELDS = [
+    f.strip() for f in os.getenv(
+        "RAG_DELTA_FIELDS",
+        "muc_dich_su_dung,loai_tai_san,hinh_thuc_thanh_toan,dieu_khoan_dac_biet,notes_for_lawyer_ai",
+    ).split(",") if f.strip()
+]
+RAG_DELTA_TOP_K = int(os.getenv("RAG_DELTA_TOP_K", "3"))
+RAG_DELTA_MAX_CHARS = 300
+
+# Batch nhiều bản nháp từ một template (request có "drafts")
+MAX_BATCH_DRAFTS = int(os.getenv("MAX_BATCH_DRAFTS", "50"))
+GENERATE_BATCH_CONCURRENCY = int(os.getenv("GENERATE_BATCH_CONCURRENCY", "4"))  # số call Converse đồng thời
+S3_WRITE_CONCURRENCY = int(os.getenv("S3_WRITE_CONCURRENCY", "8"))
+
+# Artifact hợp đồng sinh ra trên S3
+ARTIFACT_FORMAT = os.getenv("ARTIFACT_FORMAT", "separate")          # separate | bundle
+ARTIFACT_COMPRESSION = os.getenv("ARTIFACT_COMPRESSION", "none")    # none | gzip
+PRESIGNED_URL_TTL_SECONDS = int(os.getenv("PRESIGNED_URL_TTL_SECONDS", "3600"))
+# Lambda giới hạn response 6 MB; vượt ngưỡng này thì chỉ trả reference + URL
+MAX_INLINE_RESPONSE_BYTES = int(os.getenv("MAX_INLINE_RESPONSE_BYTES", str(5 * 1024 * 1024)))
+
+# Claim của authorizer (API Gateway) xác định caller -> chỉ caller đã submit job mới poll được
+TENANT_ID_CLAIM = os.getenv("TENANT_ID_CLAIM", "sub")
+
 if not TEMPLATE_BUCKET:
     raise RuntimeError("TEMPLATE_BUCKET env var is required")
 
@@ -32,13 +103,21 @@ s3 = boto3.client("s3", region_name=AWS_REGION)
 bedrock = boto3.client("bedrock-runtime", region_name=AWS_REGION)
 lambda_client = boto3.client("lambda", region_name=AWS_REGION)
 
+# (template_id, language) -> {"index_version", "built_at", "query", "results"}
+LEGAL_CONTEXT_CACHE: Dict[Tuple[str, str], Dict[str, Any]] = {}
+INDEX_VERSION_STATE = {"version": None, "checked_at": 0.0}
+
+# PUT các artifact của một hợp đồng song song
+S3_UPLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=S3_WRITE_CONCURRENCY)
+
 # -------------------------------------------------------------------
 # Global cache template metadata
 # -------------------------------------------------------------------
 
 TEMPLATE_CACHE = {
     "loaded": False,
-    "by_id": {}  # dict[doc_id] = metadata dict
+    "by_id": {},  # dict[doc_id] = metadata dict
+    "parsed": {},  # dict[doc_id] = template đã parse (template_renderer), theo version raw text
 }
 
 
@@ -60,7 +139,7 @@ def load_template_metadata_if_needed():
         if not line:
             continue
         try:
-            rec = json.loads(line.decode("utf-8"))
+            rec = fast_json.loads(line)
         except json.JSONDecodeError:
             logger.warning("Invalid JSON line in template metadata, skipped")
             continue
@@ -71,6 +150,7 @@ def load_template_metadata_if_needed():
         by_id[doc_id] = rec
 
     TEMPLATE_CACHE["by_id"] = by_id
+    TEMPLATE_CACHE["parsed"] = {}
     TEMPLATE_CACHE["loaded"] = True
 
     logger.info("Loaded %d template metadata records", len(by_id))
@@ -81,15 +161,29 @@ def parse_event_body(event: Dict[str, Any]) -> Dict[str, Any]:
         return event
     body = event["body"]
     if event.get("isBase64Encoded"):
-        import base64
         body = base64.b64decode(body).decode("utf-8")
     try:
-        data = json.loads(body)
+        data = fast_json.loads(body)
     except json.JSONDecodeError:
         raise ValueError("Request body must be valid JSON")
     return data
 
 
+def request_owner(event: Dict[str, Any], data: Dict[str, Any]) -> Optional[str]:
+    """
+    Caller của request (owner của job async). API Gateway: claim TENANT_ID_CLAIM
+    của authorizer. Invoke trực tiếp (backend): tenant_id trong payload.
+    """
+    if "body" not in event and "requestContext" not in event:
+        return data.get("tenant_id")
+    authorizer = (event.get("requestContext") or {}).get("authorizer") or {}
+    claims = (authorizer.get("jwt") or {}).get("claims") or authorizer.get("claims") or authorizer.get("lambda")
+    if not isinstance(claims, dict):
+        claims = authorizer
+    claimed = claims.get(TENANT_ID_CLAIM)
+    return str(claimed) if claimed else None
+
+
 def load_template_raw_text(metadata: Dict[str, Any]) -> str:
     """
     MVP: thử đọc nội dung file template từ S3 như text (nhiều file .doc/.docx sẽ không đọc được,
@@ -142,7 +236,14 @@ def build_rag_query(template_metadata: Dict[str, Any], contract_info: Dict[str,
     return query
 
 
-def call_rag_lambda(query: str, language: str = "vi") -> Dict[str, Any]:
+def decode_rag_payload(resp_payload: Any) -> Any:
+    """rag_search với compress: {"encoding": "gzip", "data": base64} -> dict."""
+    if isinstance(resp_payload, dict) and resp_payload.get("encoding") == "gzip":
+        return fast_json.loads(gzip.decompress(base64.b64decode(resp_payload["data"])))
+    return resp_payload
+
+
+def call_rag_lambda(query: str, language: str = "vi", top_k: int = 6) -> Dict[str, Any]:
     """
     Gọi trực tiếp Lambda rag_search (invokeFunction).
     Lambda rag_search hiện tại trả về dạng:
@@ -154,18 +255,23 @@ def call_rag_lambda(query: str, language: str = "vi") -> Dict[str, Any]:
     payload = {
         "query": query,
         "language": language,
-        "top_k": 6,
+        "top_k": top_k,
         "filters": {
             "source_type": ["legal"]
             # Có thể thêm "field": ["Xây dựng - Đô thị"] nếu muốn tập trung BĐS
-        }
+        },
+        "diversity": RAG_DIVERSITY,
+        # Chỉ lấy field cần cho prompt / cache, trả dict trực tiếp (nén nếu lớn)
+        "fields": RAG_RESULT_FIELDS,
+        "response_format": "raw",
+        "compress": "auto",
     }
 
     try:
         response = lambda_client.invoke(
             FunctionName=RAG_FUNCTION_NAME,
             InvocationType="RequestResponse",
-            Payload=json.dumps(payload).encode("utf-8"),
+            Payload=fast_json.dumps_bytes(payload),
         )
     except Exception as e:
         logger.warning("RAG Lambda invoke failed: %s", e)
@@ -173,7 +279,7 @@ def call_rag_lambda(query: str, language: str = "vi") -> Dict[str, Any]:
 
     try:
         raw_payload = response["Payload"].read()
-        resp_payload = json.loads(raw_payload)
+        resp_payload = decode_rag_payload(fast_json.loads(raw_payload))
     except Exception as e:
         logger.warning("Failed to parse RAG Lambda raw payload: %s", e)
         return {}
@@ -186,7 +292,7 @@ def call_rag_lambda(query: str, language: str = "vi") -> Dict[str, Any]:
             return {}
         body = resp_payload.get("body") or "{}"
         try:
-            return json.loads(body)
+            return fast_json.loads(body)
         except json.JSONDecodeError:
             logger.warning("RAG Lambda body is not valid JSON")
             return {}
@@ -198,49 +304,219 @@ def call_rag_lambda(query: str, language: str = "vi") -> Dict[str, Any]:
     return {}
 
 
-def build_legal_context_text(rag_result: Dict[str, Any]) -> str:
+def build_legal_context_text(
+    rag_result: Dict[str, Any],
+    query: str = "",
+    debug: Optional[Dict[str, Any]] = None,
+) -> str:
     """
-    Nhận kết quả từ RAG (rag_search) và build thành một block text để nhét vào prompt.
+    Nhận kết quả từ RAG (rag_search) và build thành một block text để nhét vào prompt,
+    giới hạn trong RAG_CONTEXT_TOKEN_BUDGET. Thống kê ghi vào debug["rag_context"].
     """
     chunks = rag_result.get("results") or []
     if not chunks:
         return ""
 
-    lines: List[str] = []
-    for i, c in enumerate(chunks, start=1):
-        title = c.get("title") or ""
-        article_no = c.get("article_no") or ""
-        article_title = c.get("article_title") or ""
-        text = c.get("text") or ""
+    budget = RAG_CONTEXT_TOKEN_BUDGET
+    if budget <= 0:
+        budget = sum(estimate_tokens(c.get("text") or "") + 50 for c in chunks)
+
+    context_text, stats = pack_legal_context(chunks, query=query, budget_tokens=budget, label="Trích dẫn pháp luật")
+    if debug is not None:
+        debug["rag_context"] = stats
+    return context_text
+
+
+def build_template_rag_query(template_metadata: Dict[str, Any]) -> str:
+    """
+    Query RAG chỉ phụ thuộc template (không có contract_info) -> cache được theo template.
+    """
+    template_type = template_metadata.get("template_type") or ""
+    title = template_metadata.get("title") or ""
+    return (
+        f"Loại hợp đồng: {template_type}. Tiêu đề: {title}.\n\n"
+        "Hãy tìm các văn bản pháp luật Việt Nam liên quan trực tiếp tới loại hợp đồng này, "
+        "đặc biệt là về: thời hạn thuê/mua, nghĩa vụ các bên, chấm dứt hợp đồng, phạt vi phạm, "
+        "bồi thường thiệt hại, quyền sử dụng tài sản."
+    )
+
+
+def build_delta_rag_query(template_metadata: Dict[str, Any], contract_info: Dict[str, Any]) -> str:
+    """
+    Query bổ sung chỉ gồm các field contract_info có ảnh hưởng tới luật áp dụng
+    (RAG_DELTA_FIELDS hoặc metadata["rag_delta_fields"]). Rỗng nếu không có field nào.
+    """
+    fields = template_metadata.get("rag_delta_fields") or RAG_DELTA_FIELDS
+    parts = []
+    for key in fields:
+        value = contract_info.get(key)
+        if value in (None, "", [], {}):
+            continue
+        if not isinstance(value, str):
+            value = json.dumps(value, ensure_ascii=False)
+        parts.append(f"{key}: {value[:RAG_DELTA_MAX_CHARS]}")
+    if not parts:
+        return ""
+    template_type = template_metadata.get("template_type") or ""
+    return f"Loại hợp đồng: {template_type}. " + "; ".join(parts)
+
 
-        header = f"[Trích dẫn pháp luật {i} – {title}"
-        if article_no:
-            header += f", {article_no}"
-        if article_title:
-            header += f": {article_title}"
-        header += "]"
+def current_index_version() -> Optional[str]:
+    """
+    Version index pháp luật do ragsearch báo (action "index_version", cùng giá trị
+    với "index_version" trong kết quả search, kể cả khi có segment delta / shard),
+    kiểm tra lại tối đa mỗi INDEX_VERSION_CHECK_SECONDS. None nếu chưa lấy được.
+    """
+    if not RAG_FUNCTION_NAME:
+        return None
+    now = time.time()
+    if now - INDEX_VERSION_STATE["checked_at"] < INDEX_VERSION_CHECK_SECONDS:
+        return INDEX_VERSION_STATE["version"]
+    try:
+        response = lambda_client.invoke(
+            FunctionName=RAG_FUNCTION_NAME,
+            InvocationType="RequestResponse",
+            Payload=fast_json.dumps_bytes({"action": "index_version"}),
+        )
+        resp_payload = fast_json.loads(response["Payload"].read())
+        if resp_payload.get("statusCode") != 200:
+            raise RuntimeError("status %s: %s" % (resp_payload.get("statusCode"), resp_payload.get("body")))
+        INDEX_VERSION_STATE["version"] = fast_json.loads(resp_payload["body"]).get("index_version")
+    except Exception as e:
+        # Giữ version cũ (hoặc None -> fallback theo TTL)
+        logger.warning("Failed to read legal index version from ragsearch: %s", e)
+    INDEX_VERSION_STATE["checked_at"] = now
+    return INDEX_VERSION_STATE["version"]
 
-        lines.append(header)
-        lines.append(text)
-        lines.append("")
 
-    return "\n".join(lines)
+def _legal_context_cache_key(template_id: str, language: str) -> str:
+    return f"{LEGAL_CONTEXT_CACHE_PREFIX}/{template_id}.{language}.json"
+
+
+def _legal_context_entry_valid(entry: Optional[Dict[str, Any]], index_version: Optional[str]) -> bool:
+    if not entry:
+        return False
+    if index_version is not None:
+        return entry.get("index_version") == index_version
+    # Không biết version index hiện tại: fallback theo TTL
+    return time.time() - entry.get("built_at", 0) < LEGAL_CONTEXT_CACHE_TTL_SECONDS
+
+
+def get_template_legal_results(
+    template_metadata: Dict[str, Any],
+    language: str,
+    rebuild: bool = False,
+) -> Tuple[List[Dict[str, Any]], str]:
+    """
+    Kết quả RAG theo template (không phụ thuộc contract_info).
+    Thứ tự: cache trong memory -> object S3 (build offline / lần chạy trước) -> gọi RAG.
+    Entry bị coi là cũ khi index_version khác version hiện tại của index (current_index_version).
+    Trả về (results, source) với source = memory | s3 | built | none.
+    """
+    template_id = template_metadata.get("doc_id") or ""
+    index_version = current_index_version()
+    cache_key = (template_id, language)
+
+    if not rebuild:
+        entry = LEGAL_CONTEXT_CACHE.get(cache_key)
+        if _legal_context_entry_valid(entry, index_version):
+            return entry["results"], "memory"
+
+        try:
+            obj = s3.get_object(Bucket=TEMPLATE_BUCKET, Key=_legal_context_cache_key(template_id, language))
+            entry = fast_json.loads(obj["Body"].read())
+        except ClientError:
+            entry = None
+        except (ValueError, KeyError) as e:
+            logger.warning("Invalid legal context cache object for %s: %s", template_id, e)
+            entry = None
+        if _legal_context_entry_valid(entry, index_version):
+            LEGAL_CONTEXT_CACHE[cache_key] = entry
+            return entry["results"], "s3"
+
+    query = build_template_rag_query(template_metadata)
+    rag_result = call_rag_lambda(query=query, language=language)
+    results = rag_result.get("results") or []
+    if not results:
+        return [], "none"
+
+    entry = {
+        "template_id": template_id,
+        "language": language,
+        "index_version": rag_result.get("index_version") or index_version,
+        "built_at": time.time(),
+        "query": query,
+        "results": results,
+    }
+    LEGAL_CONTEXT_CACHE[cache_key] = entry
+    try:
+        s3.put_object(
+            Bucket=TEMPLATE_BUCKET,
+            Key=_legal_context_cache_key(template_id, language),
+            Body=fast_json.dumps_bytes(entry),
+            ContentType="application/json; charset=utf-8",
+        )
+    except ClientError as e:
+        logger.warning("Failed to persist legal context cache for %s: %s", template_id, e)
+    return results, "built"
+
+
+def merge_rag_results(*result_lists: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Gộp nhiều list kết quả RAG, bỏ chunk trùng, sort theo score giảm dần."""
+    merged: Dict[Any, Dict[str, Any]] = {}
+    for results in result_lists:
+        for r in results:
+            key = r.get("chunk_id") or (r.get("doc_id"), r.get("article_no"), (r.get("text") or "")[:80])
+            if key not in merged or r.get("score", 0.0) > merged[key].get("score", 0.0):
+                merged[key] = r
+    return sorted(merged.values(), key=lambda r: r.get("score", 0.0), reverse=True)
+
+
+def warm_legal_context_cache(template_ids: Optional[List[str]], language: str) -> Dict[str, Any]:
+    """Build lại cache context pháp luật cho các template (mặc định: tất cả), vd. sau khi index đổi."""
+    load_template_metadata_if_needed()
+    ids = template_ids or list(TEMPLATE_CACHE["by_id"])
+    report = {}
+    for template_id in ids:
+        metadata = TEMPLATE_CACHE["by_id"].get(template_id)
+        if not metadata:
+            report[template_id] = "template_not_found"
+            continue
+        results, source = get_template_legal_results(metadata, language, rebuild=True)
+        report[template_id] = {"source": source, "results": len(results)}
+    return {"language": language, "index_version": current_index_version(), "templates": report}
 
 
 def retrieve_legal_context_for_template(
     template_metadata: Dict[str, Any],
     contract_info: Dict[str, Any],
-    language: str
+    language: str,
+    debug: Optional[Dict[str, Any]] = None,
 ) -> str:
     """
     Hàm tổng: build query -> call RAG -> build text.
+    Với LEGAL_CONTEXT_CACHE_ENABLED, phần luật theo template lấy từ cache và chỉ
+    gọi RAG thêm cho delta query (các field contract_info quan trọng).
     Nếu có lỗi hoặc không có kết quả, trả về "" để không chặn flow chính.
     """
     try:
-        query = build_rag_query(template_metadata, contract_info)
-        rag_result = call_rag_lambda(query=query, language=language)
-        context_text = build_legal_context_text(rag_result)
-        return context_text
+        if not LEGAL_CONTEXT_CACHE_ENABLED:
+            query = build_rag_query(template_metadata, contract_info)
+            rag_result = call_rag_lambda(query=query, language=language)
+            return build_legal_context_text(rag_result, query=query, debug=debug)
+
+        base_results, source = get_template_legal_results(template_metadata, language)
+        query = build_template_rag_query(template_metadata)
+        delta_results: List[Dict[str, Any]] = []
+        delta_query = build_delta_rag_query(template_metadata, contract_info)
+        if delta_query:
+            delta_results = call_rag_lambda(query=delta_query, language=language, top_k=RAG_DELTA_TOP_K).get("results") or []
+            query = f"{query}\n{delta_query}"
+
+        if debug is not None:
+            debug["legal_context_cache"] = {"source": source, "delta_results": len(delta_results)}
+        rag_result = {"results": merge_rag_results(base_results, delta_results)}
+        return build_legal_context_text(rag_result, query=query, debug=debug)
     except Exception as e:
         logger.warning("retrieve_legal_context_for_template failed: %s", e)
         return ""
@@ -316,15 +592,25 @@ def build_user_prompt(
     return "\n".join(user_parts)
 
 
-def call_bedrock_generate_contract(system_prompt: str, user_prompt: str) -> str:
+def call_bedrock_generate_contract(
+    system_prompt: str,
+    user_prompt: str,
+    route: Optional[Dict[str, Any]] = None,
+    attempts: Optional[List[Dict[str, Any]]] = None,
+) -> str:
     """
     Gọi Bedrock (Claude Haiku) để sinh hợp đồng, trả về text thuần.
+    route: decision của ROUTER (None = tự route); attempts nhận thông tin lời gọi.
     """
-    logger.info("Calling Bedrock model %s for contract generation ...", MODEL_ID)
+    if route is None:
+        route = ROUTER.route("drafting", estimate_tokens(system_prompt + user_prompt))
+    logger.info("Calling Bedrock model %s for contract generation (maxTokens=%d) ...",
+                route["model_id"], route["max_tokens"])
 
     try:
-        response = bedrock.converse(
-            modelId=MODEL_ID,
+        response, attempt = ROUTER.converse(
+            bedrock,
+            route,
             system=[{"text": system_prompt}],
             messages=[
                 {
@@ -333,7 +619,6 @@ def call_bedrock_generate_contract(system_prompt: str, user_prompt: str) -> str:
                 }
             ],
             inferenceConfig={
-                "maxTokens": 4096,
                 "temperature": 0.2,
                 "topP": 0.9,
             },
@@ -341,6 +626,8 @@ def call_bedrock_generate_contract(system_prompt: str, user_prompt: str) -> str:
     except ClientError as e:
         logger.error("Bedrock invocation failed: %s", e)
         raise
+    if attempts is not None:
+        attempts.append(attempt)
 
     try:
         output_message = response["output"]["message"]
@@ -355,6 +642,180 @@ def call_bedrock_generate_contract(system_prompt: str, user_prompt: str) -> str:
     return model_text
 
 
+def draft_confidence(contract_text: str, template_raw_text: str, attempt: Dict[str, Any]) -> Optional[str]:
+    """Lý do bản nháp low-confidence (để escalate), None nếu dùng được."""
+    if attempt.get("stop_reason") == "max_tokens":
+        return "truncated"
+    if not contract_text.strip():
+        return "empty"
+    if template_raw_text and len(contract_text) < MIN_DRAFT_TEMPLATE_RATIO * len(template_raw_text):
+        return "too_short"
+    return None
+
+
+def generate_contract_text(
+    system_prompt: str,
+    user_prompt: str,
+    template_raw_text: str,
+    slo_ms: Optional[int] = None,
+    mode: str = "drafting",
+    confidence=None,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Sinh hợp đồng qua ROUTER: chọn tier theo số token input, gọi lại với tier lớn
+    hơn khi bản nháp bị cắt / rỗng / quá ngắn và còn trong SLO.
+    confidence(text, attempt) -> lý do low-confidence hoặc None (mặc định draft_confidence).
+    Trả về (contract_text, routing).
+    """
+    if confidence is None:
+        def confidence(text, attempt):
+            return draft_confidence(text, template_raw_text, attempt)
+
+    route = ROUTER.route(mode, estimate_tokens(system_prompt + user_prompt), slo_ms=slo_ms)
+    routing: Dict[str, Any] = {"initial": route, "attempts": []}
+    started = time.perf_counter()
+    while True:
+        contract_text = call_bedrock_generate_contract(system_prompt, user_prompt, route, routing["attempts"])
+        why = confidence(contract_text, routing["attempts"][-1])
+        if why is None:
+            break
+        next_route = ROUTER.escalate(route, why, (time.perf_counter() - started) * 1000.0)
+        if next_route is None:
+            routing["low_confidence"] = why
+            break
+        logger.info("Low-confidence draft (%s) from %s, escalating to %s", why, route["model_id"], next_route["model_id"])
+        route = next_route
+
+    routing["final_model"] = route["model_id"]
+    routing["escalated"] = len(routing["attempts"]) > 1
+    return contract_text, routing
+
+
+# -------------------------------------------------------------------
+# Render template + model chỉ viết phần còn trống
+# -------------------------------------------------------------------
+
+def get_parsed_template(template_id: str, template_raw_text: str) -> Optional[Dict[str, Any]]:
+    """Template đã parse (cache theo template_id + version nội dung), None nếu không có cấu trúc."""
+    if not template_raw_text:
+        return None
+    version = template_renderer.template_version(template_raw_text)
+    parsed = TEMPLATE_CACHE["parsed"].get(template_id)
+    if parsed is None or parsed["version"] != version:
+        parsed = template_renderer.parse_template(template_raw_text)
+        TEMPLATE_CACHE["parsed"][template_id] = parsed
+    return parsed if parsed["structured"] else None
+
+
+def build_gap_system_prompt() -> str:
+    return (
+        build_system_prompt().replace(
+            "- Output CHỈ là nội dung hợp đồng hoàn chỉnh dạng text thuần, không thêm giải thích.\n", ""
+        )
+        + "- Phần còn lại của hợp đồng đã được soạn sẵn từ mẫu; bạn CHỈ viết nội dung cho các phần được yêu cầu.\n"
+        "- Output: với mỗi phần, một dòng mã phần (ví dụ [B5]) rồi nội dung phần đó dạng text thuần, "
+        "không lặp lại tiêu đề điều khoản, không thêm giải thích.\n"
+    )
+
+
+def build_gap_user_prompt(
+    template_metadata: Dict[str, Any],
+    contract_info: Dict[str, Any],
+    rendered: Dict[str, Any],
+    legal_context: str,
+) -> str:
+    """Prompt cho model: khung hợp đồng (tiêu đề các block) + danh sách phần cần viết."""
+    title = template_metadata.get("title") or ""
+    template_type = template_metadata.get("template_type") or ""
+    parts = [f"Loại hợp đồng: {template_type}. Tiêu đề mẫu: {title}."]
+
+    if legal_context:
+        parts.append(
+            "\nDưới đây là một số trích dẫn pháp luật và điều khoản liên quan do hệ thống truy xuất được "
+            "(hãy dùng làm căn cứ khi soạn thảo, nhưng không cần trích nguyên văn toàn bộ):\n"
+        )
+        parts.append(legal_context)
+
+    parts.append("\nDưới đây là thông tin đầu vào (contract_info) ở dạng JSON:\n")
+    parts.append(json.dumps(contract_info, ensure_ascii=False, indent=2))
+
+    gaps = set(rendered["gaps"])
+    outline = []
+    for b in rendered["blocks"]:
+        first_line = b["heading"] or b["text"].split("\n", 1)[0][:120]
+        outline.append(f"[{b['block_id']}] {first_line}" + ("  <- CẦN VIẾT" if b["block_id"] in gaps else ""))
+    parts.append("\nBố cục hợp đồng (các phần không đánh dấu đã có sẵn nội dung):\n")
+    parts.append("\n".join(outline))
+
+    requests = []
+    for b in rendered["blocks"]:
+        if b["block_id"] in gaps:
+            hint = f" — yêu cầu: {b['instruction']}" if b["instruction"] else ""
+            requests.append(f"- [{b['block_id']}] {b['heading'] or 'Nội dung bổ sung'}{hint}")
+    parts.append(
+        "\nYÊU CẦU:\n"
+        "- Viết nội dung cho các phần sau, dùng thông tin trong contract_info; "
+        "thông tin chưa có thì viết theo thông lệ phổ biến, không bịa số liệu quá cụ thể:\n"
+        + "\n".join(requests)
+        + "\n- Trả về đúng định dạng: dòng [mã phần] rồi nội dung, các phần cách nhau một dòng trống."
+    )
+    return "\n".join(parts)
+
+
+def draft_contract(
+    metadata: Dict[str, Any],
+    contract_info: Dict[str, Any],
+    template_raw_text: str,
+    legal_context: str,
+    slo_ms: Optional[int] = None,
+    render_mode: str = TEMPLATE_RENDER_MODE,
+) -> Tuple[str, Dict[str, Any], Dict[str, Any]]:
+    """
+    Một bản hợp đồng. Template có cấu trúc: phần cố định render tại chỗ (giống hệt
+    giữa các bản nháp), model chỉ viết các block còn trống; không thì model viết
+    toàn bộ như trước. Trả về (contract_text, routing, render_stats).
+    """
+    parsed = get_parsed_template(metadata.get("doc_id") or "", template_raw_text) if render_mode != "llm" else None
+    if parsed is None:
+        system_prompt = build_system_prompt()
+        user_prompt = build_user_prompt(metadata, contract_info, template_raw_text, legal_context)
+        contract_text, routing = generate_contract_text(system_prompt, user_prompt, template_raw_text, slo_ms=slo_ms)
+        return contract_text, routing, {"mode": "llm"}
+
+    rendered = template_renderer.render_template(parsed, contract_info)
+    generated: Dict[str, str] = {}
+    routing: Dict[str, Any] = {"final_model": "template", "attempts": [], "escalated": False}
+    if rendered["gaps"]:
+        def confidence(text, attempt):
+            if attempt.get("stop_reason") == "max_tokens":
+                return "truncated"
+            if len(template_renderer.parse_gap_output(text, rendered["gaps"])) < len(rendered["gaps"]):
+                return "missing_sections"
+            return None
+
+        gap_text, routing = generate_contract_text(
+            build_gap_system_prompt(),
+            build_gap_user_prompt(metadata, contract_info, rendered, legal_context),
+            template_raw_text,
+            slo_ms=slo_ms,
+            mode="gap_fill",
+            confidence=confidence,
+        )
+        generated = template_renderer.parse_gap_output(gap_text, rendered["gaps"])
+
+    stats = {
+        "mode": "template",
+        "template_version": parsed["version"],
+        "blocks": len(rendered["blocks"]),
+        "rendered_blocks": len(rendered["blocks"]) - len(rendered["gaps"]),
+        "generated_blocks": len(generated),
+        "missing_blocks": [b for b in rendered["gaps"] if b not in generated],
+        "unfilled_slots": rendered["unfilled_slots"],
+        "unused_fields": rendered["unused_fields"],
+    }
+    return template_renderer.assemble(rendered, generated), routing, stats
+
+
 def to_html_from_text(contract_text: str) -> str:
     """
     Đơn giản: mỗi dòng -> <p>, dòng trống -> <br>.
@@ -377,39 +838,100 @@ def to_html_from_text(contract_text: str) -> str:
     return "\n".join(html_lines)
 
 
-def save_generated_to_s3(contract_text: str, contract_html: str) -> Dict[str, str]:
+def _put_artifact(key: str, body: bytes, content_type: str, compress: bool) -> None:
+    extra = {}
+    if compress:
+        body = gzip.compress(body, compresslevel=6)
+        # S3 trả lại Content-Encoding: gzip -> browser / HTTP client tự giải nén
+        extra["ContentEncoding"] = "gzip"
+    s3.put_object(Bucket=TEMPLATE_BUCKET, Key=key, Body=body, ContentType=content_type, **extra)
+
+
+def save_generated_to_s3(
+    contract_text: str,
+    contract_html: str,
+    artifact_format: Optional[str] = None,
+    compress: Optional[bool] = None,
+) -> Dict[str, str]:
     """
-    Lưu contract_text và contract_html lên S3, trả về paths.
+    Lưu hợp đồng lên S3, trả về paths.
+    artifact_format:
+      - "separate": contract .txt + .html (mặc định, như cũ); 2 object được PUT song song.
+      - "bundle":   một object .json chứa cả text và html.
+    compress: gzip body (Content-Encoding: gzip), mặc định theo ARTIFACT_COMPRESSION.
     """
+    artifact_format = artifact_format or ARTIFACT_FORMAT
+    if compress is None:
+        compress = ARTIFACT_COMPRESSION == "gzip"
+
     now = datetime.datetime.utcnow()
     y = now.year
     m = now.month
     contract_id = str(uuid.uuid4())
-
     base_prefix = f"generated/contracts/{y}/{m:02d}/{contract_id}"
-    text_key = f"{base_prefix}.txt"
-    html_key = f"{base_prefix}.html"
 
+    if artifact_format == "bundle":
+        bundle_key = f"{base_prefix}.json"
+        bundle = {
+            "contract_id": contract_id,
+            "created_at": now.isoformat() + "Z",
+            "contract_text": contract_text,
+            "contract_html": contract_html,
+        }
+        uploads = {
+            "bundle_path": (bundle_key, json.dumps(bundle, ensure_ascii=False), "application/json; charset=utf-8"),
+        }
+    else:
+        uploads = {
+            "contract_text_path": (f"{base_prefix}.txt", contract_text, "text/plain; charset=utf-8"),
+            "contract_html_path": (f"{base_prefix}.html", contract_html, "text/html; charset=utf-8"),
+        }
+
+    futures = [
+        S3_UPLOAD_EXECUTOR.submit(_put_artifact, key, body.encode("utf-8"), content_type, compress)
+        for key, body, content_type in uploads.values()
+    ]
     try:
-        s3.put_object(
-            Bucket=TEMPLATE_BUCKET,
-            Key=text_key,
-            Body=contract_text.encode("utf-8"),
-            ContentType="text/plain; charset=utf-8",
-        )
-        s3.put_object(
-            Bucket=TEMPLATE_BUCKET,
-            Key=html_key,
-            Body=contract_html.encode("utf-8"),
-            ContentType="text/html; charset=utf-8",
-        )
+        for fut in futures:
+            fut.result()
     except ClientError as e:
         logger.warning("Failed to upload generated contract to S3: %s", e)
         return {}
 
+    return {name: key for name, (key, _, _) in uploads.items()}
+
+
+def presign_artifacts(s3_paths: Dict[str, str]) -> Dict[str, str]:
+    """Pre-signed GET URL cho từng artifact (client tải thẳng từ S3)."""
+    urls = {}
+    for name, key in s3_paths.items():
+        try:
+            urls[name.replace("_path", "_url")] = s3.generate_presigned_url(
+                "get_object",
+                Params={"Bucket": TEMPLATE_BUCKET, "Key": key},
+                ExpiresIn=PRESIGNED_URL_TTL_SECONDS,
+            )
+        except ClientError as e:
+            logger.warning("Failed to presign %s: %s", key, e)
+    return urls
+
+
+def parse_artifact_options(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    response_mode: "inline" (trả text + html trong body) | "reference" (chỉ s3_paths +
+    download_urls). include_content=false (cũ) tương đương "reference".
+    """
+    response_mode = data.get("response_mode") or ("inline" if data.get("include_content", True) else "reference")
+    if response_mode not in ("inline", "reference"):
+        raise ValueError("response_mode must be 'inline' or 'reference'")
+    artifact_format = data.get("artifact_format") or ARTIFACT_FORMAT
+    if artifact_format not in ("separate", "bundle"):
+        raise ValueError("artifact_format must be 'separate' or 'bundle'")
+    compress = data.get("compress_artifacts")
     return {
-        "contract_text_path": text_key,
-        "contract_html_path": html_key,
+        "response_mode": response_mode,
+        "artifact_format": artifact_format,
+        "compress": None if compress is None else bool(compress),
     }
 
 
@@ -420,7 +942,7 @@ def make_response(status_code: int, body: Dict[str, Any]) -> Dict[str, Any]:
             "Content-Type": "application/json",
             "Access-Control-Allow-Origin": "*",  # demo
         },
-        "body": json.dumps(body, ensure_ascii=False),
+        "body": fast_json.dumps(body),
     }
 
 
@@ -428,64 +950,302 @@ def make_response(status_code: int, body: Dict[str, Any]) -> Dict[str, Any]:
 # Lambda handler
 # -------------------------------------------------------------------
 
-def lambda_handler(event, context):
-    logger.info("Received event: %s", json.dumps(event)[:1000])
+def run_generation(data: Dict[str, Any], progress=None) -> Tuple[int, Dict[str, Any]]:
+    """
+    Request body -> (status_code, response body). Dùng chung cho request đồng bộ
+    và job worker; progress(stage, percent, **partial) báo tiến độ khi chạy async.
+    """
+    template_id = (data.get("template_id") or "").strip()
+    if not template_id:
+        return 400, {"error": "template_id is required"}
 
-    try:
-        data = parse_event_body(event)
+    contract_info = data.get("contract_info") or {}
+    if not isinstance(contract_info, dict):
+        return 400, {"error": "contract_info must be an object"}
 
-        template_id = (data.get("template_id") or "").strip()
-        if not template_id:
-            return make_response(400, {"error": "template_id is required"})
+    language = (data.get("language") or "vi").lower()
 
-        contract_info = data.get("contract_info") or {}
-        if not isinstance(contract_info, dict):
-            return make_response(400, {"error": "contract_info must be an object"})
+    slo_ms = data.get("latency_slo_ms")
+    if slo_ms is not None:
+        try:
+            slo_ms = int(slo_ms)
+        except (TypeError, ValueError):
+            return 400, {"error": "latency_slo_ms must be an integer"}
+
+    render_mode = (data.get("render_mode") or TEMPLATE_RENDER_MODE).lower()
+    if render_mode not in ("auto", "llm"):
+        return 400, {"error": "render_mode must be 'auto' or 'llm'"}
+
+    drafts = data.get("drafts")
+    if drafts is not None:
+        drafts = parse_drafts(drafts, contract_info)
+    artifact_opts = parse_artifact_options(data)
+
+    # 1. Load template metadata
+    load_template_metadata_if_needed()
+    metadata = TEMPLATE_CACHE["by_id"].get(template_id)
+    if not metadata:
+        return 404, {"error": f"Template not found for template_id={template_id}"}
+
+    # 2. (Optional) load raw text của file template từ S3
+    template_raw_text = load_template_raw_text(metadata)
+    if progress:
+        progress("template_loaded", 10, template_title=metadata.get("title"))
+
+    if drafts is not None:
+        return 200, run_batch_generation(
+            metadata, template_raw_text, contract_info, drafts, language,
+            artifact_opts=artifact_opts,
+            progress=progress,
+            slo_ms=slo_ms,
+            render_mode=render_mode,
+        )
 
-        language = (data.get("language") or "vi").lower()
+    # 3. Lấy context pháp luật từ RAG
+    rag_debug: Dict[str, Any] = {}
+    legal_context = retrieve_legal_context_for_template(metadata, contract_info, language, debug=rag_debug)
+    if progress:
+        progress("legal_context_ready", 30, rag_context=rag_debug.get("rag_context"))
 
-        # 1. Load template metadata
-        load_template_metadata_if_needed()
-        metadata = TEMPLATE_CACHE["by_id"].get(template_id)
-        if not metadata:
-            return make_response(404, {"error": f"Template not found for template_id={template_id}"})
+    # 4-5. Render template + gọi Bedrock cho phần còn trống (hoặc sinh toàn bộ)
+    contract_text, routing, render_stats = draft_contract(
+        metadata, contract_info, template_raw_text, legal_context, slo_ms=slo_ms, render_mode=render_mode,
+    )
+    if progress:
+        # Trả bản text sớm, client có thể hiển thị trước khi HTML/S3 xong
+        progress("contract_generated", 80, contract_text=contract_text)
 
-        # 2. (Optional) load raw text của file template từ S3
-        template_raw_text = load_template_raw_text(metadata)
+    # 6. Convert sang HTML
+    contract_html = to_html_from_text(contract_text)
 
-        # 3. Lấy context pháp luật từ RAG
-        legal_context = retrieve_legal_context_for_template(metadata, contract_info, language)
+    # 7. Lưu lên S3
+    s3_paths = save_generated_to_s3(
+        contract_text, contract_html,
+        artifact_format=artifact_opts["artifact_format"], compress=artifact_opts["compress"],
+    )
 
-        # 4. Build prompts
-        system_prompt = build_system_prompt()
-        user_prompt = build_user_prompt(metadata, contract_info, template_raw_text, legal_context)
+    # 8. Build response
+    resp_body = {
+        "template_id": template_id,
+        "template_title": metadata.get("title"),
+        "template_type": metadata.get("template_type"),
+        "language": language,
+        "s3_paths": s3_paths,
+        "model": routing["final_model"],
+        "routing": routing,
+        "debug": {
+            "used_template_file": metadata.get("source_raw_path"),
+            "source_type": metadata.get("source_type"),
+            "rag_used": bool(legal_context),
+            "rag_context": rag_debug.get("rag_context"),
+            "template_render": render_stats,
+        },
+    }
 
-        # 5. Gọi Bedrock để sinh hợp đồng
-        contract_text = call_bedrock_generate_contract(system_prompt, user_prompt)
+    # Body quá lớn so với giới hạn response của Lambda -> chỉ trả reference
+    inline_bytes = len(contract_text.encode("utf-8")) + len(contract_html.encode("utf-8"))
+    response_mode = artifact_opts["response_mode"]
+    if response_mode == "inline" and inline_bytes > MAX_INLINE_RESPONSE_BYTES and s3_paths:
+        response_mode = "reference"
+    if response_mode == "inline":
+        resp_body["contract_text"] = contract_text
+        resp_body["contract_html"] = contract_html
+    else:
+        resp_body["download_urls"] = presign_artifacts(s3_paths)
+    resp_body["response_mode"] = response_mode
+    return 200, resp_body
 
-        # 6. Convert sang HTML
-        contract_html = to_html_from_text(contract_text)
 
-        # 7. Lưu lên S3
-        s3_paths = save_generated_to_s3(contract_text, contract_html)
+# -------------------------------------------------------------------
+# Batch: nhiều bản nháp từ cùng một template
+# -------------------------------------------------------------------
 
-        # 8. Build response
-        resp_body = {
-            "template_id": template_id,
-            "template_title": metadata.get("title"),
-            "template_type": metadata.get("template_type"),
-            "language": language,
-            "contract_text": contract_text,
-            "contract_html": contract_html,
-            "s3_paths": s3_paths,
-            "debug": {
-                "used_template_file": metadata.get("source_raw_path"),
-                "source_type": metadata.get("source_type"),
-                "rag_used": bool(legal_context),
-            },
-        }
+def parse_drafts(raw: Any, shared_info: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    drafts = [{"draft_id": "...", "contract_info": {...}}, ...]
+    contract_info của từng draft được merge đè lên contract_info chung của request.
+    Raise ValueError nếu không hợp lệ.
+    """
+    if not isinstance(raw, list) or not raw:
+        raise ValueError("drafts must be a non-empty list")
+    if len(raw) > MAX_BATCH_DRAFTS:
+        raise ValueError(f"drafts supports at most {MAX_BATCH_DRAFTS} items per request")
+
+    drafts = []
+    for i, item in enumerate(raw):
+        if not isinstance(item, dict):
+            raise ValueError(f"drafts[{i}] must be an object")
+        info = item.get("contract_info") or {}
+        if not isinstance(info, dict):
+            raise ValueError(f"drafts[{i}].contract_info must be an object")
+        drafts.append({
+            "draft_id": str(item.get("draft_id") or i),
+            "contract_info": {**shared_info, **info},
+        })
+    return drafts
+
+
+def common_contract_info(drafts: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Các field có cùng giá trị ở mọi draft -> dùng làm query RAG chung."""
+    first = drafts[0]["contract_info"]
+    return {
+        k: v for k, v in first.items()
+        if all(d["contract_info"].get(k) == v for d in drafts[1:])
+    }
+
+
+def run_batch_generation(
+    metadata: Dict[str, Any],
+    template_raw_text: str,
+    shared_info: Dict[str, Any],
+    drafts: List[Dict[str, Any]],
+    language: str,
+    artifact_opts: Optional[Dict[str, Any]] = None,
+    progress=None,
+    slo_ms: Optional[int] = None,
+    render_mode: str = TEMPLATE_RENDER_MODE,
+) -> Dict[str, Any]:
+    """
+    Template metadata/text và context pháp luật chỉ load một lần cho cả batch.
+    Converse chạy song song tối đa GENERATE_BATCH_CONCURRENCY call; bản nào xong
+    thì được đẩy sang pool ghi S3 ngay (các draft ghi song song với nhau).
+    Lỗi của một draft không làm hỏng cả batch.
+    """
+    rag_debug: Dict[str, Any] = {}
+    rag_info = {**common_contract_info(drafts), **shared_info}
+    legal_context = retrieve_legal_context_for_template(metadata, rag_info, language, debug=rag_debug)
+    if progress:
+        progress("legal_context_ready", 20, rag_context=rag_debug.get("rag_context"))
+
+    results: Dict[str, Dict[str, Any]] = {
+        d["draft_id"]: {"draft_id": d["draft_id"], "status": "pending"} for d in drafts
+    }
+
+    def generate(draft: Dict[str, Any]) -> Tuple[str, str, Dict[str, Any]]:
+        contract_text, routing, _ = draft_contract(
+            metadata, draft["contract_info"], template_raw_text, legal_context,
+            slo_ms=slo_ms, render_mode=render_mode,
+        )
+        return contract_text, to_html_from_text(contract_text), routing
+
+    artifact_opts = artifact_opts or parse_artifact_options({})
+    include_content = artifact_opts["response_mode"] == "inline"
+
+    t0 = time.perf_counter()
+    gen_workers = max(1, min(GENERATE_BATCH_CONCURRENCY, len(drafts)))
+    with ThreadPoolExecutor(max_workers=gen_workers) as gen_pool, \
+            ThreadPoolExecutor(max_workers=S3_WRITE_CONCURRENCY) as io_pool:
+        gen_futures = {gen_pool.submit(generate, d): d["draft_id"] for d in drafts}
+        save_futures = {}
+        for done_count, fut in enumerate(as_completed(gen_futures), 1):
+            draft_id = gen_futures[fut]
+            row = results[draft_id]
+            try:
+                contract_text, contract_html, routing = fut.result()
+            except Exception as e:
+                logger.warning("Draft %s failed: %s", draft_id, e)
+                row.update(status="error", error=str(e))
+                continue
+
+            row["status"] = "ok"
+            row["model"] = routing["final_model"]
+            row["escalated"] = routing["escalated"]
+            if include_content:
+                row["contract_text"] = contract_text
+                row["contract_html"] = contract_html
+            save_futures[io_pool.submit(
+                save_generated_to_s3, contract_text, contract_html,
+                artifact_opts["artifact_format"], artifact_opts["compress"],
+            )] = draft_id
+            if progress:
+                progress("drafts_generated", 20 + int(70 * done_count / len(drafts)), drafts_done=done_count)
+
+        for fut in as_completed(save_futures):
+            draft_id = save_futures[fut]
+            row = results[draft_id]
+            try:
+                row["s3_paths"] = fut.result()
+                if not include_content:
+                    row["download_urls"] = presign_artifacts(row["s3_paths"])
+            except Exception as e:
+                # Sinh xong nhưng không lưu được -> chỉ draft này lỗi, các draft khác vẫn trả về
+                logger.warning("Saving draft %s failed: %s", draft_id, e)
+                row.update(status="error", error=f"save failed: {e}")
+
+    rows = [results[d["draft_id"]] for d in drafts]
+    ok = sum(1 for r in rows if r["status"] == "ok")
+    return {
+        "template_id": metadata.get("doc_id"),
+        "template_title": metadata.get("title"),
+        "template_type": metadata.get("template_type"),
+        "language": language,
+        "response_mode": artifact_opts["response_mode"],
+        "drafts": rows,
+        "debug": {
+            "used_template_file": metadata.get("source_raw_path"),
+            "source_type": metadata.get("source_type"),
+            "rag_used": bool(legal_context),
+            "rag_context": rag_debug.get("rag_context"),
+            "drafts_ok": ok,
+            "drafts_failed": len(rows) - ok,
+            "generation_concurrency": gen_workers,
+            "elapsed_ms": round((time.perf_counter() - t0) * 1000.0, 1),
+        },
+    }
+
+
+def _generation_work(request: Dict[str, Any], progress) -> Dict[str, Any]:
+    status, body = run_generation(request, progress)
+    if status != 200:
+        # run_job ghi lỗi input thành job FAILED (bad_request)
+        raise ValueError(body.get("error") or f"Generation failed with status {status}")
+    return body
+
+
+def run_generation_job(worker_event: Dict[str, Any]) -> Dict[str, Any]:
+    return run_job(worker_event, _generation_work, s3=s3)
+
+
+def job_status_response(job_id: str, owner: Optional[str]) -> Dict[str, Any]:
+    job = get_job_store().get(job_id)
+    if not job_visible_to(job, owner):
+        return make_response(404, {"error": f"Job not found: {job_id}"})
+    return make_response(200, public_view(job))
+
+
+def lambda_handler(event, context):
+    logger.info("Received event: %s", json.dumps(event)[:1000])
+    event_capture.capture_event("generate_contract", event)
+
+    # Worker của job async (được chính Lambda này invoke kiểu Event)
+    if is_job_worker_event(event):
+        return run_generation_job(event)
+
+    try:
+        data = parse_event_body(event)
+        owner = request_owner(event, data)
+
+        # Poll trạng thái job: {"job_id": "..."} hoặc GET ?job_id=...
+        job_id = requested_job_id(event, data)
+        if job_id and not data.get("template_id"):
+            return job_status_response(job_id, owner)
+
+        # Build lại cache context pháp luật (vd. gọi sau khi rebuild index)
+        if data.get("action") == "warm_legal_context_cache":
+            language = (data.get("language") or "vi").lower()
+            return make_response(200, warm_legal_context_cache(data.get("template_ids"), language))
+
+        if data.get("async"):
+            if not (data.get("template_id") or "").strip():
+                return make_response(400, {"error": "template_id is required"})
+            job = submit_job(
+                "generate_contract", data, context, lambda_client, s3=s3, run_inline=run_generation_job,
+                owner=owner,
+            )
+            return make_response(202, {"job_id": job["job_id"], "status": JOB_QUEUED})
 
-        return make_response(200, resp_body)
+        status, resp_body = run_generation(data)
+        return make_response(status, resp_body)
 
     except ValueError as ve:
         logger.warning("Bad request: %s", ve)
@@ -1,12 +1,30 @@
 import json
 import os
+import re
+import gzip
 import math
+import base64
+import threading
+import time
+import uuid
+import tempfile
+import hashlib
+import heapq
+import itertools
 import logging
-from typing import List, Dict, Any, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from array import array
+from bisect import bisect_right
+from typing import List, Dict, Any, Optional, Tuple
 
 import boto3
 from botocore.exceptions import ClientError
 
+import event_capture
+import fast_json
+from vector_matrix import PRECISIONS, VectorMatrix, VectorStore
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -20,11 +38,323 @@ EMBED_MODEL_ID = os.getenv("EMBED_MODEL_ID", "cohere.embed-multilingual-v3")
 LEGAL_INDEX_BUCKET = os.getenv("LEGAL_INDEX_BUCKET")  # tên của bucket S3
 LEGAL_INDEX_KEY = os.getenv("LEGAL_INDEX_KEY", "index/legal_chunks_with_emb.jsonl")
 
+# Cập nhật index pháp luật không cần build lại: LEGAL_INDEX_KEY là base, các thay đổi
+# (văn bản mới / sửa / xoá) là segment delta seg-<seq>.jsonl dưới prefix này.
+# Để trống để tắt. Container warm kiểm tra segment mới mỗi LEGAL_SEGMENT_REFRESH_SECONDS.
+LEGAL_SEGMENT_PREFIX = os.getenv("LEGAL_SEGMENT_PREFIX", "index/legal_segments/")
+LEGAL_SEGMENT_REFRESH_SECONDS = int(os.getenv("LEGAL_SEGMENT_REFRESH_SECONDS", "60"))
+# Compaction bỏ qua segment mới hơn ngưỡng này (có thể còn đang được ghi)
+SEGMENT_COMPACT_GRACE_SECONDS = int(os.getenv("SEGMENT_COMPACT_GRACE_SECONDS", "60"))
+
+# Ngân sách bộ nhớ cho index pháp luật (vector + metadata chunk) trong một container.
+# Mặc định INDEX_MEMORY_FRACTION x bộ nhớ Lambda (AWS_LAMBDA_FUNCTION_MEMORY_SIZE),
+# chạy ngoài Lambda thì không giới hạn. Khi load, vector được giữ ở float32, hoặc
+# tự hạ xuống float16 -> int8 -> file mmap (INDEX_MMAP_DIR, mặc định /tmp) cho vừa
+# ngân sách; ép một mức cố định bằng INDEX_VECTOR_PRECISION.
+MB = 1024 * 1024
+INDEX_MEMORY_BUDGET_MB = float(os.getenv("INDEX_MEMORY_BUDGET_MB", "0"))
+INDEX_MEMORY_FRACTION = float(os.getenv("INDEX_MEMORY_FRACTION", "0.5"))
+INDEX_VECTOR_PRECISION = os.getenv("INDEX_VECTOR_PRECISION", "auto")  # auto | float32 | float16 | int8 | mmap
+INDEX_MMAP_DIR = os.getenv("INDEX_MMAP_DIR") or None
+INDEX_PLAN_AFTER_RECORDS = 1000  # ước tính tổng số chunk (theo ContentLength) sau ngần này record
+
+# Mặc định cho bước đa dạng hoá kết quả (MMR) khi request bật "diversity"
+DIVERSITY_DEFAULTS = {
+    "mmr_lambda": float(os.getenv("MMR_LAMBDA", "0.7")),
+    "max_per_doc": int(os.getenv("MMR_MAX_PER_DOC", "2")),
+    "dup_threshold": float(os.getenv("MMR_DUP_THRESHOLD", "0.95")),
+    "fetch_k": int(os.getenv("MMR_FETCH_K", "40")),
+}
+
+# Re-rank (tuỳ chọn): over-fetch ứng viên cosine rồi chấm lại bằng Bedrock rerank
+# model ("model") hoặc một prompt chấm điểm theo lô ("llm")
+RERANK_DEFAULTS = {
+    "method": os.getenv("RERANK_METHOD", "model"),
+    "fetch_k": int(os.getenv("RERANK_FETCH_K", "24")),
+    "budget_ms": int(os.getenv("RERANK_BUDGET_MS", "1500")),
+}
+RERANK_MODEL_ID = os.getenv("RERANK_MODEL_ID", "cohere.rerank-v3-5:0")
+RERANK_LLM_MODEL_ID = os.getenv("RERANK_LLM_MODEL_ID", "anthropic.claude-3-haiku-20240307-v1:0")
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "256"))
+RERANK_MAX_DOC_CHARS = 1500
+
+# Cache câu trả lời theo ngữ nghĩa: query mới có cosine >= ANSWER_CACHE_THRESHOLD với
+# một query đã lưu (cùng namespace, cùng version index) -> trả lại câu trả lời đó
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "500"))  # 0 = tắt
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "86400"))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.93"))
+
+# Response: nén gzip khi body JSON lớn hơn ngưỡng này (compress = "auto")
+GZIP_MIN_BYTES = int(os.getenv("GZIP_MIN_BYTES", "8192"))
+
+# Index tài liệu riêng của từng tenant (user): segment JSONL append-only trên S3
+#   {TENANT_INDEX_PREFIX}/{tenant_id}/seg-<seq>.jsonl    (mỗi lần index_document)
+#   {TENANT_INDEX_PREFIX}/{tenant_id}/base-<seq>.jsonl   (kết quả compaction, gộp mọi seg <= seq)
+TENANT_INDEX_BUCKET = os.getenv("TENANT_INDEX_BUCKET") or LEGAL_INDEX_BUCKET
+TENANT_INDEX_PREFIX = os.getenv("TENANT_INDEX_PREFIX", "tenant-index").strip("/")
+TENANT_INDEX_MEMORY_MB = int(os.getenv("TENANT_INDEX_MEMORY_MB", "512"))  # tổng cho LRU index tenant
+TENANT_REFRESH_SECONDS = int(os.getenv("TENANT_REFRESH_SECONDS", "30"))   # chu kỳ list segment mới
+TENANT_COMPACT_SEGMENTS = int(os.getenv("TENANT_COMPACT_SEGMENTS", "16"))  # quá số seg này -> compact
+TENANT_CHUNK_CHARS = int(os.getenv("TENANT_CHUNK_CHARS", "1200"))
+TENANT_CHUNK_OVERLAP = int(os.getenv("TENANT_CHUNK_OVERLAP", "200"))
+TENANT_MAX_CHUNKS_PER_DOC = int(os.getenv("TENANT_MAX_CHUNKS_PER_DOC", "500"))
+# Request qua API Gateway: tenant lấy từ claim của authorizer (Cognito / JWT / Lambda
+# authorizer), không tin tenant_id trong body. Invoke trực tiếp (backend, Lambda khác
+# đã có IAM) vẫn truyền tenant_id trong payload.
+TENANT_ID_CLAIM = os.getenv("TENANT_ID_CLAIM", "sub")
+
+# Action bảo trì / ghi cache dùng chung: chỉ nhận từ invoke trực tiếp (EventBridge, CLI,
+# backend có IAM), không qua API Gateway
+DIRECT_INVOKE_ACTIONS = ("compact_legal_index", "answer_cache_store", "build_legal_shards", "shard_search")
+EMBED_BATCH_SIZE = 96  # Cohere Embed v3: tối đa 96 texts / request
+
+# Chia index pháp luật thành shard (xem build_legal_shards): manifest JSON liệt kê
+# shard + cách chia ("doc_category" | "hash"). Để trống = một index như cũ.
+#   LEGAL_SHARD_NAME trống: container là coordinator, scatter query tới mọi shard
+#     (shard có trong LEGAL_SHARD_FUNCTIONS {"tên shard": "tên Lambda"} được invoke,
+#     shard còn lại load ngay trong process - dùng để chạy local / index nhỏ)
+#   LEGAL_SHARD_NAME = tên shard: container chỉ load + phục vụ shard đó ("shard_search")
+LEGAL_SHARD_MANIFEST_KEY = os.getenv("LEGAL_SHARD_MANIFEST_KEY", "")
+LEGAL_SHARD_NAME = os.getenv("LEGAL_SHARD_NAME", "")
+LEGAL_SHARD_FUNCTIONS: Dict[str, str] = json.loads(os.getenv("LEGAL_SHARD_FUNCTIONS") or "{}")
+SHARD_FANOUT_WORKERS = int(os.getenv("SHARD_FANOUT_WORKERS", "8"))
+
 if not LEGAL_INDEX_BUCKET:
     raise RuntimeError("LEGAL_INDEX_BUCKET env var is required")
 
 s3 = boto3.client("s3", region_name=AWS_REGION)
 bedrock = boto3.client("bedrock-runtime", region_name=AWS_REGION)
+lambda_client = boto3.client("lambda", region_name=AWS_REGION)  # chỉ dùng cho shard ở Lambda khác
+
+
+# -----------------------------------------------------------------------------
+# Columnar chunk store
+# -----------------------------------------------------------------------------
+
+class ChunkStore:
+    """
+    Metadata của chunk lưu theo cột thay vì một dict / chunk:
+    - Field scalar (source_type, doc_category, field, title, doc_id, article_no, ...
+      và mọi field scalar khác gặp trong index): mảng mã int + bảng giá trị đã
+      intern (mã 0 = không có).
+    - text, chunk_id: nối vào một buffer UTF-8 liên tục + mảng offset.
+    - Giá trị không phải scalar (list / dict, hiếm): dict thưa idx -> {field: value}.
+    Dict kết quả chỉ được tạo cho top-k cuối cùng (materialize).
+    """
+
+    CATEGORICAL_FIELDS = (
+        "source_type", "doc_category", "field", "title", "doc_id", "article_no", "article_title",
+    )
+    BUFFER_FIELDS = ("chunk_id", "text")
+    _SCALAR_TYPES = (str, int, float, bool)
+
+    def __init__(self):
+        self._codes: Dict[str, array] = {}
+        self._values: Dict[str, List[Any]] = {}
+        self._lookup: Dict[str, Dict[Any, int]] = {}
+        for f in self.CATEGORICAL_FIELDS:
+            self._add_column(f)
+        self._buffers = {f: bytearray() for f in self.BUFFER_FIELDS}
+        self._offsets = {f: array("Q", [0]) for f in self.BUFFER_FIELDS}
+        self._has_value = {f: bytearray() for f in self.BUFFER_FIELDS}
+        self._extras: Dict[int, Dict[str, Any]] = {}
+        self._postings: Dict[int, List[int]] = {}  # mã doc_id -> idx, build khi find() lần đầu
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _add_column(self, field: str) -> None:
+        # Cột mới gặp giữa chừng: các chunk trước đó nhận mã 0 (không có)
+        self._codes[field] = array("I", bytes(4 * getattr(self, "_size", 0)))
+        self._values[field] = [None]
+        self._lookup[field] = {}
+
+    def append(self, rec: Dict[str, Any]) -> int:
+        if isinstance(self._buffers["text"], bytes):
+            self._thaw()
+        idx = self._size
+        extra = None
+        for f, value in rec.items():
+            if f in self._buffers:
+                continue
+            if value is not None and not isinstance(value, self._SCALAR_TYPES):
+                extra = extra or {}
+                extra[f] = value
+                continue
+            if f not in self._codes:
+                self._add_column(f)
+
+        for f, codes in self._codes.items():
+            value = rec.get(f)
+            code = 0
+            if value is not None and (extra is None or f not in extra):
+                lookup = self._lookup[f]
+                # True == 1 trong dict key: tách theo kiểu cho giá trị không phải str
+                key = value if type(value) is str else (type(value), value)
+                code = lookup.get(key)
+                if code is None:
+                    code = len(self._values[f])
+                    lookup[key] = code
+                    self._values[f].append(value)
+            codes.append(code)
+            if f == "doc_id" and self._postings and code:
+                self._postings.setdefault(code, []).append(idx)
+
+        for f in self.BUFFER_FIELDS:
+            value = rec.get(f)
+            if value is not None:
+                self._buffers[f] += str(value).encode("utf-8")
+            self._offsets[f].append(len(self._buffers[f]))
+            self._has_value[f].append(value is not None)
+
+        if extra:
+            self._extras[idx] = extra
+        self._size += 1
+        return idx
+
+    def finalize(self) -> None:
+        # bytearray -> bytes: không còn over-allocation của buffer đang grow
+        self._buffers = {f: bytes(buf) for f, buf in self._buffers.items()}
+        self._has_value = {f: bytes(flags) for f, flags in self._has_value.items()}
+
+    def _thaw(self) -> None:
+        # Append sau finalize (vd. segment mới của index tenant)
+        self._buffers = {f: bytearray(buf) for f, buf in self._buffers.items()}
+        self._has_value = {f: bytearray(flags) for f, flags in self._has_value.items()}
+
+    def _buffer_value(self, field: str, idx: int) -> Optional[str]:
+        if not self._has_value[field][idx]:
+            return None
+        off = self._offsets[field]
+        return self._buffers[field][off[idx]:off[idx + 1]].decode("utf-8")
+
+    def get(self, idx: int, field: str) -> Any:
+        if field in self._codes:
+            return self._values[field][self._codes[field][idx]]
+        if field in self._buffers:
+            return self._buffer_value(field, idx)
+        return self._extras.get(idx, {}).get(field)
+
+    def text(self, idx: int) -> str:
+        return self._buffer_value("text", idx) or ""
+
+    def find(self, field: str, value: Any, stop: Optional[int] = None) -> List[int]:
+        """Các idx < stop có field == value (dùng khi áp tombstone / thay thế doc)."""
+        stop = self._size if stop is None else stop
+        if field == "doc_id":
+            code = self._lookup["doc_id"].get(value if type(value) is str else (type(value), value))
+            if not code:
+                return []
+            if not self._postings:
+                for i, c in enumerate(self._codes["doc_id"]):
+                    if c:
+                        self._postings.setdefault(c, []).append(i)
+            return [i for i in self._postings.get(code, []) if i < stop]
+        return [i for i in range(stop) if self.get(i, field) == value]
+
+    def materialize(self, idx: int, fields: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Dict metadata của chunk idx (chỉ các field trong `fields` nếu có)."""
+        rec: Dict[str, Any] = {}
+        for f in self._codes:
+            if fields is None or f in fields:
+                value = self._values[f][self._codes[f][idx]]
+                if value is not None:
+                    rec[f] = value
+        for f in self.BUFFER_FIELDS:
+            if fields is None or f in fields:
+                value = self._buffer_value(f, idx)
+                if value is not None:
+                    rec[f] = value
+        for k, v in self._extras.get(idx, {}).items():
+            if fields is None or k in fields:
+                rec[k] = v
+        return rec
+
+    def compile_filters(self, filters: Dict[str, Any]) -> List[Tuple[array, set]]:
+        """
+        filters dạng:
+        {
+          "source_type": ["legal", "template"],
+          "doc_category": ["luat", "nghi_dinh"],
+          "field": ["Xây dựng - Đô thị"]
+        }
+        -> list (mảng mã, tập mã được phép). Chunk PASS nếu thoả mọi điều kiện.
+        Giá trị không có trong index -> tập rỗng -> không chunk nào PASS.
+        """
+        compiled = []
+        for f in ("source_type", "doc_category", "field"):
+            allowed = (filters or {}).get(f)
+            if not allowed:
+                continue
+            if f not in self._lookup:
+                compiled.append((array("I", bytes(4 * self._size)), set()))
+                continue
+            lookup = self._lookup[f]
+            keys = [v if type(v) is str else (type(v), v) for v in allowed]
+            codes = {lookup[k] for k in keys if k in lookup}
+            compiled.append((self._codes[f], codes))
+        return compiled
+
+    @staticmethod
+    def matches(idx: int, compiled: List[Tuple[array, set]]) -> bool:
+        for codes, allowed in compiled:
+            if codes[idx] not in allowed:
+                return False
+        return True
+
+    def memory_bytes(self) -> int:
+        """Ước lượng bộ nhớ của các cột (không tính bảng giá trị intern / extras)."""
+        total = sum(c.itemsize * len(c) for c in self._codes.values())
+        total += sum(len(b) for b in self._buffers.values())
+        total += sum(o.itemsize * len(o) for o in self._offsets.values())
+        total += sum(len(h) for h in self._has_value.values())
+        return total
+
+
+class IndexView:
+    """
+    Gộp một hoặc nhiều index (dict cùng dạng INDEX_CACHE: chunks + vectors) thành
+    một dải idx liên tục để pipeline search (cosine, rerank, MMR) không cần biết
+    chunk thuộc index nào. Với nhiều index, kết quả có thêm field "index".
+    """
+
+    def __init__(self, parts: List[Tuple[str, Dict[str, Any]]]):
+        self.parts = parts
+        self.offsets: List[int] = []
+        total = 0
+        for _, index in parts:
+            self.offsets.append(total)
+            total += len(index["vectors"])
+        self.size = total
+
+    def locate(self, idx: int) -> Tuple[int, int]:
+        part = bisect_right(self.offsets, idx) - 1
+        return part, idx - self.offsets[part]
+
+    def vector(self, idx: int) -> List[float]:
+        part, local = self.locate(idx)
+        return self.parts[part][1]["vectors"][local]
+
+    def get(self, idx: int, field: str) -> Any:
+        part, local = self.locate(idx)
+        return self.parts[part][1]["chunks"].get(local, field)
+
+    def text(self, idx: int) -> str:
+        part, local = self.locate(idx)
+        return self.parts[part][1]["chunks"].text(local)
+
+    def materialize(self, idx: int, fields: Optional[List[str]] = None) -> Dict[str, Any]:
+        part, local = self.locate(idx)
+        name, index = self.parts[part]
+        rec = index["chunks"].materialize(local, fields)
+        if len(self.parts) > 1 and (fields is None or "index" in fields):
+            rec["index"] = name
+        return rec
+
+    def cache_key(self) -> str:
+        """Định danh nội dung view (cho cache theo idx, vd. RERANK_CACHE)."""
+        return ",".join(f"{name}@{index.get('version')}:{len(index['vectors'])}" for name, index in self.parts)
 
 
 # -----------------------------------------------------------------------------
@@ -33,10 +363,35 @@ bedrock = boto3.client("bedrock-runtime", region_name=AWS_REGION)
 
 INDEX_CACHE = {
     "loaded": False,
-    "chunks": [],   # list of dict (metadata + text, no embedding)
-    "vectors": []   # list of list[float]
+    "version": None,  # ETag base (+ seq segment cuối) trên S3 (client dùng để invalidate cache)
+    "chunks": ChunkStore(),   # metadata + text theo cột (không có embedding)
+    "vectors": [],   # VectorStore sau khi load (precision theo ngân sách bộ nhớ)
+    "deleted": set(),   # idx bị tombstone / thay thế bởi segment delta
+    "key": None,        # object base trên S3 (None = LEGAL_INDEX_KEY, hoặc key của shard)
+    "keep": None,       # shard: keep(rec) -> record thuộc shard
 }
 
+# LRU: tenant_id -> index đã load (cùng dạng INDEX_CACHE + thông tin segment),
+# giới hạn tổng bộ nhớ TENANT_INDEX_MEMORY_MB
+TENANT_INDEXES: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+# LRU: hash(namespace, language, query) -> câu trả lời + embedding (đã chuẩn hoá) của query
+ANSWER_CACHE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+ANSWER_CACHE_STATS = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+
+# LRU: hash(query, candidate set) -> {idx: rerank score}
+RERANK_CACHE: "OrderedDict[str, Dict[int, float]]" = OrderedDict()
+
+# Thread riêng cho lời gọi rerank để áp timeout cứng; nếu quá budget thì bỏ kết quả
+RERANK_EXECUTOR_WORKERS = 2
+RERANK_EXECUTOR = ThreadPoolExecutor(max_workers=RERANK_EXECUTOR_WORKERS)
+
+# Coordinator: manifest shard hiện tại + index của các shard load trong process
+SHARD_STATE: Dict[str, Any] = {
+    "manifest": None, "etag": None, "checked_at": 0.0, "local": {}, "version": None, "version_checked_at": 0.0,
+}
+SHARD_EXECUTOR = ThreadPoolExecutor(max_workers=SHARD_FANOUT_WORKERS)
+
 
 # -----------------------------------------------------------------------------
 # Helpers
@@ -56,104 +411,1127 @@ def cosine_similarity(a: List[float], b: List[float]) -> float:
         return 0.0
     return dot / math.sqrt(na * nb)
 
+def get_embeddings(texts: List[str], input_type: str = "search_query") -> List[List[float]]:
+    """
+    Embed nhiều đoạn văn. Cohere: gộp tối đa EMBED_BATCH_SIZE texts mỗi request
+    (input_type "search_query" cho câu hỏi, "search_document" cho tài liệu được index);
+    Titan không hỗ trợ batch nên gọi lần lượt.
+    """
+    model_id = EMBED_MODEL_ID
+    is_cohere = model_id.startswith("cohere.embed-")
+
+    if is_cohere:
+        batches = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+    else:
+        batches = [[t] for t in texts]
+
+    out: List[List[float]] = []
+    for batch in batches:
+        if is_cohere:
+            body_dict: Dict[str, Any] = {
+                "texts": batch,
+                "input_type": input_type,
+            }
+            if input_type == "search_document":
+                body_dict["truncate"] = "END"
+        else:
+            # Mặc định: Titan embeddings
+            body_dict = {
+                "inputText": batch[0]
+            }
+
+        try:
+            response = bedrock.invoke_model(
+                modelId=model_id,
+                body=json.dumps(body_dict),
+                contentType="application/json",
+                accept="application/json",
+            )
+        except ClientError as e:
+            logger.error("Bedrock invoke_model failed: %s", e)
+            raise
+
+        response_body = json.loads(response["body"].read())
+
+        # Parse output tùy model
+        if is_cohere:
+            # "embeddings": [ [1024 floats], ... ]
+            embeddings = response_body.get("embeddings")
+            if not embeddings or not isinstance(embeddings, list) or len(embeddings) != len(batch):
+                raise ValueError("No embeddings found in Cohere response")
+            out.extend(embeddings)
+        else:
+            # Titan: {"embedding": [..]}
+            embedding = response_body.get("embedding")
+            if not embedding:
+                raise ValueError("No embedding found in Titan response")
+            out.append(embedding)
+
+    return out
+
+
 def get_embedding(text: str) -> List[float]:
     if not text or not text.strip():
         raise ValueError("Query text is empty")
+    return get_embeddings([text], input_type="search_query")[0]
 
-    model_id = EMBED_MODEL_ID
 
-    # Nếu là Cohere Embed v3 (english/multilingual)
-    if model_id.startswith("cohere.embed-"):
-        # Query → dùng search_query
-        body_dict = {
-            "texts": [text],
-            "input_type": "search_query"
-            # Có thể thêm "truncate": "END" nếu cần
-        }
-    else:
-        # Mặc định: Titan embeddings
-        body_dict = {
-            "inputText": text
-        }
+def read_index_records(body: Any, index: Dict[str, Any], delta: bool = False, size_hint: Optional[int] = None) -> int:
+    """
+    Đọc JSONL index (StreamingBody) vào index["chunks"] + index["vectors"], trả về
+    số record hợp lệ. size_hint (ContentLength): sau INDEX_PLAN_AFTER_RECORDS record,
+    VectorStore được báo trước tổng số chunk ước tính để chọn precision một lần.
+    Với segment delta (delta=True):
+      - {"op": "delete", "doc_id": ...} / {"op": "delete", "chunk_id": ...} là tombstone
+        cho các chunk đã đọc trước đó;
+      - record của một doc_id thay thế toàn bộ chunk cũ của doc_id đó.
+    Chunk bị xoá / thay chỉ được đánh dấu trong index["deleted"] (giải phóng khi compaction).
+    index["keep"] (shard): record không thuộc shard vẫn xoá bản cũ nhưng không được thêm.
+    """
+    chunks: ChunkStore = index["chunks"]
+    vectors = index["vectors"]  # list[list[float]] hoặc VectorStore (index pháp luật)
+    deleted: set = index.setdefault("deleted", set())
+    keep = index.get("keep")  # shard: chỉ giữ record thuộc shard này
+    start = len(vectors)
+    replaced: set = set()
+    count = 0
+    read_bytes = 0
+    plan = getattr(vectors, "plan", None) if size_hint else None
+    for line in body.iter_lines():
+        if not line:
+            continue
+        read_bytes += len(line) + 1
+        if plan is not None and count >= INDEX_PLAN_AFTER_RECORDS:
+            plan(len(vectors) + int(count * (size_hint - read_bytes) / read_bytes))
+            plan = None
+        try:
+            # Tách embedding ra khỏi metadata (orjson / msgspec nếu có)
+            rec_no_emb, emb = fast_json.decode_index_record(line)
+        except json.JSONDecodeError:
+            logger.warning("Invalid JSON line in index, skipped")
+            continue
 
-    body = json.dumps(body_dict)
+        if delta and rec_no_emb.get("op") == "delete":
+            if rec_no_emb.get("chunk_id") is not None:
+                deleted.update(chunks.find("chunk_id", str(rec_no_emb["chunk_id"])))
+            elif rec_no_emb.get("doc_id") is not None:
+                deleted.update(chunks.find("doc_id", rec_no_emb["doc_id"]))
+            continue
 
-    try:
-        response = bedrock.invoke_model(
-            modelId=model_id,
-            body=body,
-            contentType="application/json",
-            accept="application/json",
+        text = (rec_no_emb.get("text") or "").strip()
+        if not emb or not text:
+            # Bỏ qua record thiếu embedding / text
+            continue
+
+        doc_id = rec_no_emb.get("doc_id")
+        if delta and doc_id is not None and doc_id not in replaced:
+            replaced.add(doc_id)
+            deleted.update(chunks.find("doc_id", doc_id, stop=start))
+
+        if keep is not None and not keep(rec_no_emb):
+            continue
+        vectors.append(emb)
+        chunks.append(rec_no_emb)
+        count += 1
+    return count
+
+
+# -----------------------------------------------------------------------------
+# Index segments (base bất biến + segment delta + tombstone)
+# -----------------------------------------------------------------------------
+
+SEGMENT_KEY_RE = re.compile(r"(seg|base)-(\d{13}-[0-9a-f]{8})\.jsonl$")
+SEGMENT_SEQ_METADATA = "segment-seq"  # metadata S3 của base: seq segment cuối cùng đã gộp
+
+
+SEGMENT_SEQ_STATE = {"last_ms": 0}
+SEGMENT_SEQ_LOCK = threading.Lock()
+
+
+def new_segment_seq() -> str:
+    # sort theo chuỗi == sort theo thời gian ghi (ms), uuid tránh trùng giữa các container.
+    # Trong một process ms tăng ngặt: hai segment ghi cùng ms (vd. index rồi xoá ngay
+    # cùng doc) không bị uuid đảo thứ tự
+    with SEGMENT_SEQ_LOCK:
+        ms = max(int(time.time() * 1000), SEGMENT_SEQ_STATE["last_ms"] + 1)
+        SEGMENT_SEQ_STATE["last_ms"] = ms
+    return "%013d-%s" % (ms, uuid.uuid4().hex[:8])
+
+
+def list_segment_layout(bucket: str, prefix: str) -> Dict[str, Any]:
+    """
+    Liệt kê object dưới prefix -> {"base": (seq, key) | None, "segments": [(seq, key)],
+    "stale": [key]}. Base mới nhất phủ mọi segment có seq <= seq của base; các
+    segment / base cũ đó là "stale" (compaction bị ngắt giữa chừng) và bị bỏ qua.
+    """
+    bases: List[Tuple[str, str]] = []
+    segments: List[Tuple[str, str]] = []
+    kwargs: Dict[str, Any] = {"Bucket": bucket, "Prefix": prefix}
+    while True:
+        resp = s3.list_objects_v2(**kwargs)
+        for item in resp.get("Contents") or []:
+            match = SEGMENT_KEY_RE.search(item["Key"])
+            if not match:
+                continue
+            kind, seq = match.groups()
+            (bases if kind == "base" else segments).append((seq, item["Key"]))
+        if not resp.get("IsTruncated"):
+            break
+        kwargs["ContinuationToken"] = resp["NextContinuationToken"]
+
+    bases.sort()
+    segments.sort()
+    base = bases[-1] if bases else None
+    base_seq = base[0] if base else ""
+    live = [(seq, key) for seq, key in segments if seq > base_seq]
+    stale = [key for _, key in bases[:-1]] + [key for seq, key in segments if seq <= base_seq]
+    return {"base": base, "segments": live, "stale": stale}
+
+
+def write_segment(bucket: str, prefix: str, records: List[Dict[str, Any]], kind: str = "seg", seq: str = None) -> str:
+    key = f"{prefix}{kind}-{seq or new_segment_seq()}.jsonl"
+    body = b"".join(fast_json.dumps_bytes(rec) + b"\n" for rec in records)
+    s3.put_object(Bucket=bucket, Key=key, Body=body, ContentType="application/x-ndjson")
+    return key
+
+
+def read_segment_into(bucket: str, key: str, index: Dict[str, Any], delta: bool = True) -> int:
+    obj = s3.get_object(Bucket=bucket, Key=key)
+    return read_index_records(obj["Body"], index, delta=delta)
+
+
+def compactable_segments(segments: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """Segment đủ cũ để gộp (quá SEGMENT_COMPACT_GRACE_SECONDS, tránh bỏ sót segment đang ghi dở)."""
+    cutoff = "%013d" % int((time.time() - SEGMENT_COMPACT_GRACE_SECONDS) * 1000)
+    return [(seq, key) for seq, key in segments if seq[:13] < cutoff]
+
+
+def compact_segments(
+    bucket: str,
+    base_key: Optional[str],
+    segment_keys: List[str],
+    out_key: str,
+    metadata: Optional[Dict[str, str]] = None,
+) -> Dict[str, int]:
+    """
+    Gộp base + các segment (theo thứ tự) thành một object JSONL, cùng ngữ nghĩa với
+    read_index_records(delta=True): tombstone xoá chunk trước nó, record của doc_id
+    trong segment sau thay thế bản cũ. Segment được giữ trong bộ nhớ (nhỏ), base
+    được stream từng dòng qua file tạm nên không cần load cả index.
+    Chỉ nên chạy một job compaction cho mỗi index tại một thời điểm.
+    """
+    removed_docs: set = set()
+    removed_chunks: set = set()
+    docs: "OrderedDict[Any, List[Tuple[str, bytes]]]" = OrderedDict()
+    for key in segment_keys:
+        replaced: set = set()
+        for line in s3.get_object(Bucket=bucket, Key=key)["Body"].iter_lines():
+            if not line:
+                continue
+            try:
+                rec = fast_json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning("Invalid JSON line in %s, skipped", key)
+                continue
+            doc_id = rec.get("doc_id")
+            if rec.get("op") == "delete":
+                if rec.get("chunk_id") is not None:
+                    chunk_id = str(rec["chunk_id"])
+                    removed_chunks.add(chunk_id)
+                    for d in list(docs):
+                        docs[d] = [item for item in docs[d] if item[0] != chunk_id]
+                elif doc_id is not None:
+                    removed_docs.add(doc_id)
+                    docs.pop(doc_id, None)
+                continue
+            if doc_id is not None and doc_id not in replaced:
+                replaced.add(doc_id)
+                removed_docs.add(doc_id)
+                docs.pop(doc_id, None)
+            docs.setdefault(doc_id, []).append((str(rec.get("chunk_id")), line))
+
+    kept = dropped = 0
+    with tempfile.TemporaryFile() as out:
+        if base_key:
+            for line in s3.get_object(Bucket=bucket, Key=base_key)["Body"].iter_lines():
+                if not line:
+                    continue
+                if removed_docs or removed_chunks:
+                    try:
+                        rec = fast_json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning("Invalid JSON line in %s, skipped", base_key)
+                        continue
+                    if rec.get("doc_id") in removed_docs or str(rec.get("chunk_id")) in removed_chunks:
+                        dropped += 1
+                        continue
+                out.write(line + b"\n")
+                kept += 1
+        for items in docs.values():
+            for _, line in items:
+                out.write(line + b"\n")
+                kept += 1
+
+        out.seek(0)
+        s3.put_object(
+            Bucket=bucket,
+            Key=out_key,
+            Body=out,
+            ContentType="application/x-ndjson",
+            Metadata=metadata or {},
         )
+    return {"chunks": kept, "dropped_chunks": dropped}
+
+
+def load_legal_index(key: Optional[str] = None, keep: Any = None, budget_share: int = 1) -> Dict[str, Any]:
+    """
+    Load base (LEGAL_INDEX_KEY, hoặc key của một shard) + mọi segment delta chưa
+    được gộp vào base. keep(rec) -> bool: chỉ giữ record thuộc shard.
+    budget_share: số index pháp luật chia nhau ngân sách bộ nhớ (shard load local).
+    """
+    key = key or LEGAL_INDEX_KEY
+    logger.info(
+        "Loading legal index from s3://%s/%s ...",
+        LEGAL_INDEX_BUCKET, key
+    )
+
+    started = time.perf_counter()
+    try:
+        obj = s3.get_object(Bucket=LEGAL_INDEX_BUCKET, Key=key)
     except ClientError as e:
-        logger.error("Bedrock invoke_model failed: %s", e)
+        logger.error("Failed to get index object from S3: %s", e)
         raise
 
-    response_body = json.loads(response["body"].read())
+    chunks = ChunkStore()
+    budget, budget_source = legal_index_budget()
+    if budget is not None and budget_share > 1:
+        budget //= budget_share
+    index: Dict[str, Any] = {
+        "chunks": chunks,
+        "vectors": VectorStore(
+            precision=INDEX_VECTOR_PRECISION if INDEX_VECTOR_PRECISION in PRECISIONS else "auto",
+            budget_bytes=budget,
+            reserved=chunks.memory_bytes,
+            directory=INDEX_MMAP_DIR,
+        ),
+        "budget_source": budget_source,
+        "deleted": set(),
+        "base_etag": (obj.get("ETag") or "").strip('"') or None,
+        # seq của segment cuối cùng đã được compaction gộp vào base
+        "base_seq": (obj.get("Metadata") or {}).get(SEGMENT_SEQ_METADATA) or "",
+        "segments": set(),
+        "seq": None,
+        "key": key,
+        "keep": keep,
+    }
+    read_index_records(obj["Body"], index, size_hint=obj.get("ContentLength"))
+    apply_legal_segments(index)
+    index["load_ms"] = round((time.perf_counter() - started) * 1000.0, 1)
 
-    # Parse output tùy model
-    if model_id.startswith("cohere.embed-"):
-        # "embeddings": [ [1024 floats] ]
-        embeddings = response_body.get("embeddings")
-        if not embeddings or not isinstance(embeddings, list):
-            raise ValueError("No embeddings found in Cohere response")
-        return embeddings[0]
+    vectors = index["vectors"].describe()
+    logger.info(
+        "Loaded %d chunks with embeddings into cache (vectors %s: %.1f MB memory, %.1f MB disk; "
+        "metadata %.1f MB; budget %s)",
+        len(index["chunks"]), vectors["precision"], vectors["memory_bytes"] / MB,
+        vectors["disk_bytes"] / MB, index["chunks"].memory_bytes() / MB,
+        "%.1f MB" % (budget / MB) if budget is not None else "unlimited",
+    )
+    if budget is not None and index_memory_bytes(index) > budget:
+        logger.warning(
+            "Legal index uses %.1f MB, over the %.1f MB budget (%s)",
+            index_memory_bytes(index) / MB, budget / MB, budget_source
+        )
+    return index
+
+
+def legal_index_budget() -> Tuple[Optional[int], str]:
+    """(ngân sách bytes cho index pháp luật, nguồn cấu hình); None = không giới hạn."""
+    if INDEX_MEMORY_BUDGET_MB > 0:
+        return int(INDEX_MEMORY_BUDGET_MB * MB), "INDEX_MEMORY_BUDGET_MB"
+    lambda_mb = os.getenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE")
+    if lambda_mb:
+        return int(float(lambda_mb) * MB * INDEX_MEMORY_FRACTION), "AWS_LAMBDA_FUNCTION_MEMORY_SIZE"
+    return None, "unlimited"
+
+
+def describe_legal_index(index: Dict[str, Any]) -> Dict[str, Any]:
+    vectors = index["vectors"]
+    metadata_bytes = index["chunks"].memory_bytes()
+    return {
+        "version": index.get("version"),
+        "chunks": len(index["chunks"]),
+        "deleted": len(index.get("deleted") or ()),
+        "vectors": vectors.describe() if hasattr(vectors, "describe") else {"precision": "list", "rows": len(vectors)},
+        "metadata_bytes": metadata_bytes,
+        "memory_bytes": index_memory_bytes(index),
+        "budget_source": index.get("budget_source"),
+        "load_ms": index.get("load_ms"),
+    }
+
+
+def index_memory_stats() -> Dict[str, Any]:
+    """
+    action "index_stats": precision đã chọn + footprint của index pháp luật (load nếu
+    chưa có; coordinator shard chỉ báo các shard đã load local) và LRU index tenant.
+    """
+    budget, source = legal_index_budget()
+    stats: Dict[str, Any] = {
+        "budget_bytes": budget,
+        "budget_source": source,
+        "lambda_memory_mb": os.getenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE"),
+        "configured_precision": INDEX_VECTOR_PRECISION,
+    }
+    if is_shard_coordinator():
+        stats["local_shards"] = {
+            name: describe_legal_index(index) for name, index in SHARD_STATE["local"].items() if index.get("loaded")
+        }
     else:
-        # Titan: {"embedding": [..]}
-        embedding = response_body.get("embedding")
-        if not embedding:
-            raise ValueError("No embedding found in Titan response")
-        return embedding
+        load_index_if_needed()
+        stats["legal"] = describe_legal_index(INDEX_CACHE)
+    stats["tenants"] = {
+        "loaded": len(TENANT_INDEXES),
+        "memory_bytes": sum(t["bytes"] for t in TENANT_INDEXES.values()),
+        "budget_bytes": TENANT_INDEX_MEMORY_MB * MB,
+    }
+    return stats
+
+
+def apply_legal_segments(index: Dict[str, Any]) -> int:
+    """Đọc các segment delta mới (seq > base_seq, chưa áp dụng) vào index."""
+    applied = 0
+    if LEGAL_SEGMENT_PREFIX:
+        layout = list_segment_layout(LEGAL_INDEX_BUCKET, LEGAL_SEGMENT_PREFIX)
+        for seq, key in layout["segments"]:
+            if seq <= index["base_seq"] or key in index["segments"]:
+                continue
+            read_segment_into(LEGAL_INDEX_BUCKET, key, index)
+            index["segments"].add(key)
+            index["seq"] = seq
+            applied += 1
+
+    index["chunks"].finalize()
+    seq = index.get("seq")
+    index["version"] = f"{index['base_etag']}+{seq}" if seq else index["base_etag"]
+    index["checked_at"] = time.time()
+    if applied:
+        logger.info(
+            "Applied %d legal index segments (%d chunks, %d deleted)",
+            applied, len(index["chunks"]), len(index["deleted"])
+        )
+    return applied
 
 
-def load_index_if_needed():
-    if INDEX_CACHE["loaded"]:
+def load_index_if_needed(index: Optional[Dict[str, Any]] = None):
+    """index: INDEX_CACHE (mặc định) hoặc một shard ({"loaded", "key", "keep"})."""
+    index = INDEX_CACHE if index is None else index
+    if not index["loaded"]:
+        if index is INDEX_CACHE and LEGAL_SHARD_NAME:
+            configure_shard_cache()
+        index.update(load_legal_index(index.get("key"), index.get("keep"), index.get("budget_share", 1)))
+        index["loaded"] = True
         return
 
-    logger.info(
-        "Loading legal index from s3://%s/%s ...",
-        LEGAL_INDEX_BUCKET, LEGAL_INDEX_KEY
-    )
+    if time.time() - index["checked_at"] < LEGAL_SEGMENT_REFRESH_SECONDS:
+        return
 
+    # Container warm: base đổi (compaction / build lại) -> load lại toàn bộ,
+    # ngược lại chỉ đọc segment mới. Lỗi S3 -> tiếp tục phục vụ bản đang có.
     try:
-        obj = s3.get_object(Bucket=LEGAL_INDEX_BUCKET, Key=LEGAL_INDEX_KEY)
+        head = s3.head_object(Bucket=LEGAL_INDEX_BUCKET, Key=index["key"])
+        if (head.get("ETag") or "").strip('"') != index["base_etag"]:
+            if index is INDEX_CACHE and LEGAL_SHARD_NAME:
+                configure_shard_cache()  # shard được build lại: cách chia có thể đã đổi
+            index.update(load_legal_index(index["key"], index["keep"], index.get("budget_share", 1)))
+        else:
+            apply_legal_segments(index)
     except ClientError as e:
-        logger.error("Failed to get index object from S3: %s", e)
+        logger.warning("Legal index refresh failed, serving cached version: %s", e)
+        index["checked_at"] = time.time()
+
+
+def compact_legal_index() -> Dict[str, Any]:
+    """
+    Gộp các segment delta đủ cũ vào base LEGAL_INDEX_KEY (ghi đè, metadata
+    segment-seq = seq cuối cùng đã gộp) rồi xoá các segment đó. Container đang
+    chạy thấy ETag base đổi và load lại.
+    """
+    if not LEGAL_SEGMENT_PREFIX:
+        raise ValueError("LEGAL_SEGMENT_PREFIX is not configured")
+
+    head = s3.head_object(Bucket=LEGAL_INDEX_BUCKET, Key=LEGAL_INDEX_KEY)
+    base_seq = (head.get("Metadata") or {}).get(SEGMENT_SEQ_METADATA) or ""
+    layout = list_segment_layout(LEGAL_INDEX_BUCKET, LEGAL_SEGMENT_PREFIX)
+    stale = [key for seq, key in layout["segments"] if seq <= base_seq]
+    segments = compactable_segments([(seq, key) for seq, key in layout["segments"] if seq > base_seq])
+
+    stats: Dict[str, Any] = {"compacted_segments": len(segments), "stale_deleted": len(stale)}
+    if segments:
+        stats.update(compact_segments(
+            LEGAL_INDEX_BUCKET,
+            LEGAL_INDEX_KEY,
+            [key for _, key in segments],
+            LEGAL_INDEX_KEY,
+            metadata={SEGMENT_SEQ_METADATA: segments[-1][0]},
+        ))
+        logger.info("Compacted %d legal index segments into %s", len(segments), LEGAL_INDEX_KEY)
+        # Shard đọc segment từ cùng prefix: chia lại base mới trước khi xoá segment
+        current = read_shard_manifest() if LEGAL_SHARD_MANIFEST_KEY else None
+        if current is not None:
+            manifest, _ = current
+            stats["shards"] = build_legal_shards(manifest["by"], len(manifest["shards"]))
+
+    for key in stale + [key for _, key in segments]:
+        s3.delete_object(Bucket=LEGAL_INDEX_BUCKET, Key=key)
+    return stats
+
+
+# -----------------------------------------------------------------------------
+# Shard index pháp luật (scatter-gather)
+# -----------------------------------------------------------------------------
+# Manifest (LEGAL_SHARD_MANIFEST_KEY):
+#   {"by": "doc_category" | "hash", "base_etag", "base_seq",
+#    "shards": [{"name", "key", "chunks", "doc_categories": [...], "catch_all": bool}]}
+# Mỗi shard là một base JSONL riêng; segment delta dưới LEGAL_SEGMENT_PREFIX được
+# áp cho mọi shard, mỗi shard chỉ giữ record thuộc về nó (shard_router).
+
+def shard_router(manifest: Dict[str, Any]):
+    """rec -> tên shard chứa rec. hash theo doc_id để mọi chunk của một văn bản cùng shard."""
+    shards = manifest["shards"]
+    if manifest["by"] == "hash":
+        names = [sh["name"] for sh in shards]
+
+        def route(rec: Dict[str, Any]) -> str:
+            ident = rec.get("doc_id") if rec.get("doc_id") is not None else rec.get("chunk_id")
+            digest = hashlib.md5(str(ident).encode("utf-8")).hexdigest()
+            return names[int(digest[:8], 16) % len(names)]
+        return route
+
+    by_category = {cat: sh["name"] for sh in shards for cat in sh.get("doc_categories") or []}
+    catch_all = next((sh["name"] for sh in shards if sh.get("catch_all")), shards[-1]["name"])
+    return lambda rec: by_category.get(rec.get("doc_category"), catch_all)
+
+
+def read_shard_manifest() -> Optional[Tuple[Dict[str, Any], str]]:
+    try:
+        obj = s3.get_object(Bucket=LEGAL_INDEX_BUCKET, Key=LEGAL_SHARD_MANIFEST_KEY)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return None
         raise
+    return fast_json.loads(obj["Body"].read()), (obj.get("ETag") or "").strip('"')
 
-    chunks: List[Dict[str, Any]] = []
-    vectors: List[List[float]] = []
 
-    for line in obj["Body"].iter_lines():
-        if not line:
-            continue
+def load_shard_manifest(force: bool = False) -> Dict[str, Any]:
+    """Manifest hiện tại (kiểm tra lại mỗi LEGAL_SEGMENT_REFRESH_SECONDS). Manifest đổi -> bỏ shard đã load."""
+    now = time.time()
+    if not force and SHARD_STATE["manifest"] is not None \
+            and now - SHARD_STATE["checked_at"] < LEGAL_SEGMENT_REFRESH_SECONDS:
+        return SHARD_STATE["manifest"]
+    try:
+        head = s3.head_object(Bucket=LEGAL_INDEX_BUCKET, Key=LEGAL_SHARD_MANIFEST_KEY)
+        if (head.get("ETag") or "").strip('"') != SHARD_STATE["etag"]:
+            loaded = read_shard_manifest()
+            if loaded is None:
+                raise ValueError("Shard manifest %s not found" % LEGAL_SHARD_MANIFEST_KEY)
+            manifest, etag = loaded
+            SHARD_STATE.update(manifest=manifest, etag=etag, local={})
+            logger.info("Loaded shard manifest: %d shards by %s", len(manifest["shards"]), manifest["by"])
+    except ClientError as e:
+        if SHARD_STATE["manifest"] is None:
+            raise
+        logger.warning("Shard manifest refresh failed, using cached manifest: %s", e)
+    SHARD_STATE["checked_at"] = now
+    return SHARD_STATE["manifest"]
+
+
+def shard_keep(manifest: Dict[str, Any], name: str):
+    route = shard_router(manifest)
+    return lambda rec: route(rec) == name
+
+
+def configure_shard_cache() -> None:
+    """Container shard (LEGAL_SHARD_NAME): INDEX_CACHE load base của shard đó."""
+    manifest = load_shard_manifest(force=True)
+    shard = next((sh for sh in manifest["shards"] if sh["name"] == LEGAL_SHARD_NAME), None)
+    if shard is None:
+        raise ValueError("Shard '%s' is not in the shard manifest" % LEGAL_SHARD_NAME)
+    INDEX_CACHE["key"] = shard["key"]
+    INDEX_CACHE["keep"] = shard_keep(manifest, LEGAL_SHARD_NAME)
+
+
+def shards_for_filters(manifest: Dict[str, Any], filters: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """(shard cần query, tên shard bỏ qua). Chỉ chia theo doc_category mới loại được shard."""
+    shards = manifest["shards"]
+    allowed = (filters or {}).get("doc_category")
+    if manifest["by"] != "doc_category" or not allowed:
+        return shards, []
+    allowed = set(allowed)
+    known = {cat for sh in shards for cat in sh.get("doc_categories") or []}
+    selected = [
+        sh for sh in shards
+        if allowed & set(sh.get("doc_categories") or []) or (sh.get("catch_all") and allowed - known)
+    ]
+    names = {sh["name"] for sh in selected}
+    return selected, [sh["name"] for sh in shards if sh["name"] not in names]
+
+
+def shard_candidates(index: Dict[str, Any], q_emb: List[float], filters: Dict[str, Any], limit: int) -> Dict[str, Any]:
+    """Top-limit của một shard, kèm metadata + embedding để coordinator rerank / MMR."""
+    ranked = rank_candidates(q_emb, filters, limit, IndexView([("legal", index)]))
+    return {
+        "index_version": index.get("version"),
+        "candidates": [
+            {"score": score, "chunk": index["chunks"].materialize(idx), "embedding": list(index["vectors"][idx])}
+            for score, idx in ranked
+        ],
+    }
+
+
+def search_local_shard(shard: Dict[str, Any], manifest: Dict[str, Any], q_emb: List[float],
+                       filters: Dict[str, Any], limit: int) -> Dict[str, Any]:
+    index = SHARD_STATE["local"].setdefault(
+        shard["name"],
+        {"loaded": False, "key": shard["key"], "keep": shard_keep(manifest, shard["name"]),
+         "budget_share": len(manifest["shards"])},
+    )
+    load_index_if_needed(index)
+    return shard_candidates(index, q_emb, filters, limit)
+
+
+def search_remote_shard(function_name: str, q_emb: List[float], filters: Dict[str, Any], limit: int) -> Dict[str, Any]:
+    payload = {"action": "shard_search", "q_emb": q_emb, "filters": filters, "limit": limit}
+    response = lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType="RequestResponse",
+        Payload=fast_json.dumps_bytes(payload),
+    )
+    result = fast_json.loads(response["Payload"].read())
+    if "statusCode" in result:  # lỗi từ handler của shard (400 / 500)
+        raise RuntimeError("Shard %s returned %s: %s" % (function_name, result["statusCode"], result.get("body")))
+    return result
+
+
+def gather_legal_shards(
+    q_emb: List[float],
+    filters: Dict[str, Any],
+    limit: int,
+    debug: Dict[str, Any] = None,
+) -> Dict[str, Any]:
+    """
+    Scatter query tới các shard (song song), gộp top-limit của từng shard bằng
+    heap. Trả về index nhỏ (cùng dạng INDEX_CACHE) chỉ gồm các ứng viên đã gộp,
+    để rerank / MMR / materialize chạy như với một index.
+    Shard lỗi bị bỏ qua (ghi trong debug["shards"]["failed"]); mọi shard lỗi -> raise.
+    """
+    manifest = load_shard_manifest()
+    selected, skipped = shards_for_filters(manifest, filters)
+    futures = {}
+    for shard in selected:
+        function_name = LEGAL_SHARD_FUNCTIONS.get(shard["name"])
+        if function_name:
+            futures[shard["name"]] = SHARD_EXECUTOR.submit(search_remote_shard, function_name, q_emb, filters, limit)
+        else:
+            futures[shard["name"]] = SHARD_EXECUTOR.submit(search_local_shard, shard, manifest, q_emb, filters, limit)
+
+    info: Dict[str, Any] = {"by": manifest["by"], "queried": list(futures), "skipped": skipped, "failed": []}
+    per_shard: List[List[Tuple[float, str, Dict[str, Any]]]] = []
+    for name, future in futures.items():
         try:
-            rec = json.loads(line.decode("utf-8"))
-        except json.JSONDecodeError:
-            logger.warning("Invalid JSON line in index, skipped")
+            result = future.result()
+        except Exception as e:
+            logger.warning("Shard %s search failed: %s", name, e)
+            info["failed"].append(name)
             continue
+        per_shard.append([(c["score"], name, c) for c in result["candidates"]])
+    if futures and len(info["failed"]) == len(futures):
+        raise RuntimeError("All legal index shards failed")
 
-        emb = rec.get("embedding")
-        text = (rec.get("text") or "").strip()
-        if not emb or not text:
-            # Bỏ qua record thiếu embedding / text
-            continue
+    index: Dict[str, Any] = {"chunks": ChunkStore(), "vectors": [], "deleted": set()}
+    merged = heapq.merge(*per_shard, key=lambda item: -item[0])
+    for _, _, cand in itertools.islice(merged, limit):
+        index["vectors"].append(cand["embedding"])
+        index["chunks"].append(cand["chunk"])
+    index["chunks"].finalize()
 
-        # Tách embedding ra khỏi metadata
-        rec_no_emb = dict(rec)
-        rec_no_emb.pop("embedding", None)
+    # Cùng version với answer cache / action index_version (không ghi vào INDEX_CACHE)
+    index["version"] = legal_index_version()
+    if debug is not None:
+        debug["shards"] = info
+        debug["index_version"] = index["version"]
+    return index
 
-        vectors.append(emb)
-        chunks.append(rec_no_emb)
 
-    INDEX_CACHE["chunks"] = chunks
-    INDEX_CACHE["vectors"] = vectors
-    INDEX_CACHE["loaded"] = True
+def is_shard_coordinator() -> bool:
+    return bool(LEGAL_SHARD_MANIFEST_KEY) and not LEGAL_SHARD_NAME
 
-    logger.info(
-        "Loaded %d chunks with embeddings into cache",
-        len(chunks)
+
+def legal_index_version() -> str:
+    """
+    Version index pháp luật, nguồn duy nhất cho "index_version" của response search,
+    key answer cache và action "index_version" (cache context theo template của generator).
+    Không chia shard: ETag base + seq segment cuối đã áp dụng (INDEX_CACHE["version"]).
+    Coordinator không load base: ETag manifest shard + seq segment delta mới nhất,
+    đọc lại mỗi LEGAL_SEGMENT_REFRESH_SECONDS.
+    """
+    if not is_shard_coordinator():
+        load_index_if_needed()
+        return str(INDEX_CACHE["version"])
+    load_shard_manifest()
+    now = time.time()
+    if SHARD_STATE["version"] is None or now - SHARD_STATE["version_checked_at"] >= LEGAL_SEGMENT_REFRESH_SECONDS:
+        seq = ""
+        if LEGAL_SEGMENT_PREFIX:
+            segments = list_segment_layout(LEGAL_INDEX_BUCKET, LEGAL_SEGMENT_PREFIX)["segments"]
+            seq = segments[-1][0] if segments else ""
+        digest = hashlib.sha1(f"{SHARD_STATE['etag']}|{seq}".encode("utf-8")).hexdigest()[:16]
+        SHARD_STATE.update(version="shards-" + digest, version_checked_at=now)
+    return SHARD_STATE["version"]
+
+
+def shard_search(body: Dict[str, Any]) -> Dict[str, Any]:
+    """action "shard_search" (coordinator -> container shard): top-limit theo q_emb."""
+    q_emb = body.get("q_emb")
+    if not isinstance(q_emb, list) or not q_emb:
+        raise ValueError("q_emb is required")
+    load_index_if_needed()
+    result = shard_candidates(INDEX_CACHE, q_emb, body.get("filters") or {}, int(body.get("limit") or 10))
+    result["shard"] = LEGAL_SHARD_NAME or None
+    return result
+
+
+def build_legal_shards(by: str = "doc_category", count: int = 4) -> Dict[str, Any]:
+    """
+    Chia base LEGAL_INDEX_KEY thành `count` shard (cạnh manifest) rồi ghi manifest.
+    by="doc_category": mỗi doc_category nằm trọn một shard (cân theo số chunk), shard
+    nhỏ nhất nhận cả category mới xuất hiện sau này (catch_all); query có filter
+    doc_category bỏ qua được shard. by="hash": chia đều theo doc_id.
+    Base được stream (2 lượt với doc_category) qua file tạm, không load cả index.
+    """
+    if not LEGAL_SHARD_MANIFEST_KEY:
+        raise ValueError("LEGAL_SHARD_MANIFEST_KEY is not configured")
+    if by not in ("doc_category", "hash"):
+        raise ValueError("shard by must be 'doc_category' or 'hash'")
+    if count < 1:
+        raise ValueError("shard count must be >= 1")
+
+    head = s3.head_object(Bucket=LEGAL_INDEX_BUCKET, Key=LEGAL_INDEX_KEY)
+    base_seq = (head.get("Metadata") or {}).get(SEGMENT_SEQ_METADATA) or ""
+    prefix = LEGAL_SHARD_MANIFEST_KEY.rsplit("/", 1)[0] + "/" if "/" in LEGAL_SHARD_MANIFEST_KEY else ""
+
+    def base_records():
+        for line in s3.get_object(Bucket=LEGAL_INDEX_BUCKET, Key=LEGAL_INDEX_KEY)["Body"].iter_lines():
+            if not line:
+                continue
+            try:
+                rec, _ = fast_json.decode_index_record(line)
+            except json.JSONDecodeError:
+                logger.warning("Invalid JSON line in index, skipped")
+                continue
+            yield line, rec
+
+    shards = [{"name": "shard-%02d" % i, "key": "%sshard-%02d.jsonl" % (prefix, i), "chunks": 0} for i in range(count)]
+    if by == "doc_category":
+        sizes: Dict[Any, int] = {}
+        for _, rec in base_records():
+            sizes[rec.get("doc_category")] = sizes.get(rec.get("doc_category"), 0) + 1
+        loads = [0] * count
+        for shard in shards:
+            shard["doc_categories"] = []
+        for category, n in sorted(sizes.items(), key=lambda kv: (-kv[1], str(kv[0]))):
+            i = loads.index(min(loads))
+            shards[i]["doc_categories"].append(category)
+            loads[i] += n
+        shards[loads.index(min(loads))]["catch_all"] = True
+
+    manifest = {
+        "by": by,
+        "base_etag": (head.get("ETag") or "").strip('"'),
+        "base_seq": base_seq,
+        "shards": shards,
+    }
+    route = shard_router(manifest)
+    files = {shard["name"]: tempfile.TemporaryFile() for shard in shards}
+    try:
+        counts = dict.fromkeys(files, 0)
+        for line, rec in base_records():
+            name = route(rec)
+            files[name].write(line + b"\n")
+            counts[name] += 1
+        for shard in shards:
+            shard["chunks"] = counts[shard["name"]]
+            out = files[shard["name"]]
+            out.seek(0)
+            s3.put_object(
+                Bucket=LEGAL_INDEX_BUCKET,
+                Key=shard["key"],
+                Body=out,
+                ContentType="application/x-ndjson",
+                # segment đã gộp vào base cũng đã có trong shard
+                Metadata={SEGMENT_SEQ_METADATA: base_seq} if base_seq else {},
+            )
+    finally:
+        for f in files.values():
+            f.close()
+
+    # Manifest ghi sau cùng: reader chỉ thấy manifest mới khi mọi shard đã sẵn sàng
+    s3.put_object(
+        Bucket=LEGAL_INDEX_BUCKET,
+        Key=LEGAL_SHARD_MANIFEST_KEY,
+        Body=fast_json.dumps_bytes(manifest),
+        ContentType="application/json",
     )
+    logger.info("Built %d legal index shards by %s", count, by)
+    return {"by": by, "shards": [{k: v for k, v in sh.items() if k != "key"} for sh in shards]}
+
+
+# -----------------------------------------------------------------------------
+# Tenant indexes (tài liệu riêng của user, segment append-only + compaction)
+# -----------------------------------------------------------------------------
+
+TENANT_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,128}$")
+
+
+def validate_tenant_id(tenant_id: Any) -> str:
+    # tenant_id phải đến từ caller đã xác thực (xem request_tenant_id), không từ input của user
+    tenant_id = str(tenant_id or "").strip()
+    if not TENANT_ID_RE.match(tenant_id):
+        raise ValueError("tenant_id must match [A-Za-z0-9_-]{1,128}")
+    return tenant_id
+
+
+def tenant_prefix(tenant_id: str) -> str:
+    return f"{TENANT_INDEX_PREFIX}/{tenant_id}/"
+
+
+def index_memory_bytes(index: Dict[str, Any]) -> int:
+    """
+    Ước lượng: VectorStore tự tính (block đã cấp, không tính file mmap); list[float]
+    Python ~32 byte / chiều (float object + con trỏ). Cộng metadata cột.
+    """
+    vectors = index["vectors"]
+    if hasattr(vectors, "memory_bytes"):
+        return vectors.memory_bytes() + index["chunks"].memory_bytes()
+    dim = len(vectors[0]) if vectors else 0
+    return len(vectors) * (dim * 32 + 64) + index["chunks"].memory_bytes()
+
+
+def load_tenant_index(tenant_id: str, index: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Load (index=None) hoặc refresh index của tenant: container warm chỉ đọc các
+    segment mới; nếu base đổi (đã compaction) thì load lại từ base.
+    """
+    layout = list_segment_layout(TENANT_INDEX_BUCKET, tenant_prefix(tenant_id))
+    base_key = layout["base"][1] if layout["base"] else None
+
+    if index is None or index["base"] != base_key:
+        index = {
+            "tenant_id": tenant_id,
+            "chunks": ChunkStore(),
+            "vectors": [],
+            "deleted": set(),
+            "base": base_key,
+            "segments": set(),
+            "version": None,
+        }
+        if base_key:
+            read_segment_into(TENANT_INDEX_BUCKET, base_key, index, delta=False)
+
+    new_segments = [(seq, key) for seq, key in layout["segments"] if key not in index["segments"]]
+    for _, key in new_segments:
+        read_segment_into(TENANT_INDEX_BUCKET, key, index)
+        index["segments"].add(key)
+
+    index["chunks"].finalize()
+    last_seq = layout["segments"][-1][0] if layout["segments"] else (layout["base"] or ("",))[0]
+    index["version"] = last_seq or None
+    index["checked_at"] = time.time()
+    index["bytes"] = index_memory_bytes(index)
+    if new_segments:
+        logger.info(
+            "Tenant %s index: +%d segments, %d chunks total",
+            tenant_id, len(new_segments), len(index["vectors"])
+        )
+    return index
+
+
+def get_tenant_index(tenant_id: str) -> Dict[str, Any]:
+    tenant_id = validate_tenant_id(tenant_id)
+    index = TENANT_INDEXES.get(tenant_id)
+    if index is None or time.time() - index["checked_at"] >= TENANT_REFRESH_SECONDS:
+        index = load_tenant_index(tenant_id, index)
+    TENANT_INDEXES[tenant_id] = index
+    TENANT_INDEXES.move_to_end(tenant_id)
+
+    # Evict tenant ít dùng nhất cho tới khi về dưới ngân sách (luôn giữ tenant hiện tại)
+    budget = TENANT_INDEX_MEMORY_MB * 1024 * 1024
+    while len(TENANT_INDEXES) > 1 and sum(t["bytes"] for t in TENANT_INDEXES.values()) > budget:
+        evicted, _ = TENANT_INDEXES.popitem(last=False)
+        logger.info("Evicted tenant index %s from memory", evicted)
+    return index
+
+
+def split_document(text: str) -> List[str]:
+    """Chia văn bản thành chunk ~TENANT_CHUNK_CHARS ký tự, ưu tiên cắt ở xuống dòng / hết câu."""
+    text = re.sub(r"[ \t]+", " ", text).strip()
+    pieces: List[str] = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + TENANT_CHUNK_CHARS)
+        if end < len(text):
+            floor = start + TENANT_CHUNK_CHARS // 2
+            cut = max(text.rfind("\n", floor, end), text.rfind(". ", floor, end))
+            if cut > start:
+                end = cut + 1
+        piece = text[start:end].strip()
+        if piece:
+            pieces.append(piece)
+        if end >= len(text):
+            break
+        start = max(end - TENANT_CHUNK_OVERLAP, start + 1)
+    return pieces
+
+
+def index_document(body: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    action "index_document": chunk + embed một tài liệu của tenant rồi ghi thành
+    một segment mới (không sửa object cũ). Index lại cùng doc_id: bản mới thay
+    bản cũ (ngay khi load segment, xoá hẳn khi compaction).
+    """
+    tenant_id = validate_tenant_id(body.get("tenant_id"))
+    doc_id = str(body.get("doc_id") or "").strip()
+    text = (body.get("text") or "").strip()
+    if not doc_id or not text:
+        raise ValueError("doc_id and text are required")
+    metadata = body.get("metadata") or {}
+    if not isinstance(metadata, dict):
+        raise ValueError("metadata must be an object")
+
+    pieces = split_document(text)
+    if len(pieces) > TENANT_MAX_CHUNKS_PER_DOC:
+        raise ValueError("document too large: %d chunks (max %d)" % (len(pieces), TENANT_MAX_CHUNKS_PER_DOC))
+    embeddings = get_embeddings(pieces, input_type="search_document")
+
+    title = body.get("title") or metadata.get("title") or doc_id
+    records = []
+    for i, (piece, emb) in enumerate(zip(pieces, embeddings)):
+        rec = {k: v for k, v in metadata.items() if k != "embedding"}
+        rec.update({
+            "doc_id": doc_id,
+            "chunk_id": f"{doc_id}#{i}",
+            "source_type": "user",
+            "title": title,
+            "text": piece,
+            "embedding": emb,
+        })
+        records.append(rec)
+
+    prefix = tenant_prefix(tenant_id)
+    key = write_segment(TENANT_INDEX_BUCKET, prefix, records)
+    result: Dict[str, Any] = {"tenant_id": tenant_id, "doc_id": doc_id, "chunks": len(records), "segment": key}
+
+    # Compaction "nền" theo kiểu amortized: Lambda đóng băng thread khi trả response,
+    # nên chạy ngay trong request vượt ngưỡng; job định kỳ gọi compact_tenant_index.
+    if len(list_segment_layout(TENANT_INDEX_BUCKET, prefix)["segments"]) > TENANT_COMPACT_SEGMENTS:
+        result["compaction"] = compact_tenant_index(tenant_id)
+
+    # Container này thấy ngay tài liệu vừa index
+    cached = TENANT_INDEXES.get(tenant_id)
+    if cached is not None:
+        cached["checked_at"] = 0.0
+    return result
+
+
+def delete_document(body: Dict[str, Any]) -> Dict[str, Any]:
+    """action "delete_document": ghi segment tombstone cho doc_id (xoá hẳn khi compaction)."""
+    tenant_id = validate_tenant_id(body.get("tenant_id"))
+    doc_id = str(body.get("doc_id") or "").strip()
+    if not doc_id:
+        raise ValueError("doc_id is required")
+
+    key = write_segment(TENANT_INDEX_BUCKET, tenant_prefix(tenant_id), [{"op": "delete", "doc_id": doc_id}])
+    cached = TENANT_INDEXES.get(tenant_id)
+    if cached is not None:
+        cached["checked_at"] = 0.0
+    return {"tenant_id": tenant_id, "doc_id": doc_id, "deleted": True, "segment": key}
+
+
+def compact_tenant_index(tenant_id: str) -> Dict[str, Any]:
+    """
+    Gộp base + các segment đủ cũ thành base-<seq> mới rồi xoá object cũ; đọc đồng
+    thời vẫn an toàn vì list_segment_layout bỏ qua object bị base mới phủ.
+    """
+    tenant_id = validate_tenant_id(tenant_id)
+    prefix = tenant_prefix(tenant_id)
+    layout = list_segment_layout(TENANT_INDEX_BUCKET, prefix)
+
+    segments = compactable_segments(layout["segments"])
+    if not segments:
+        return {"tenant_id": tenant_id, "compacted_segments": 0, "stale_deleted": 0}
+
+    base_key = layout["base"][1] if layout["base"] else None
+    new_base = f"{prefix}base-{segments[-1][0]}.jsonl"
+    stats = compact_segments(TENANT_INDEX_BUCKET, base_key, [key for _, key in segments], new_base)
+
+    obsolete = ([base_key] if base_key else []) + [key for _, key in segments] + layout["stale"]
+    for key in obsolete:
+        if key != new_base:
+            s3.delete_object(Bucket=TENANT_INDEX_BUCKET, Key=key)
+
+    logger.info("Compacted tenant %s: %d segments -> %s", tenant_id, len(segments), new_base)
+    return {
+        "tenant_id": tenant_id,
+        "compacted_segments": len(segments),
+        "stale_deleted": len(layout["stale"]),
+        "base": new_base,
+        **stats,
+    }
+
+
+# -----------------------------------------------------------------------------
+# Semantic answer cache (Q&A pháp lý)
+# -----------------------------------------------------------------------------
+
+def unit_vector(v: List[float]) -> List[float]:
+    norm = math.sqrt(sum(x * x for x in v))
+    return [x / norm for x in v] if norm else list(v)
+
+
+def parse_answer_cache_options(body: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    body["answer_cache"]: true hoặc {"namespace": "legal_qa", "threshold": 0.93}.
+    namespace tách các loại câu trả lời (vd. Q&A chung vs. theo từng hợp đồng);
+    tenant_id (nếu có) luôn được gộp vào namespace. Trả về {} nếu không bật.
+    """
+    raw = body.get("answer_cache")
+    if not raw or ANSWER_CACHE_SIZE <= 0:
+        return {}
+    if raw is True:
+        raw = {}
+    if not isinstance(raw, dict):
+        raise ValueError("answer_cache must be true or an object")
+
+    threshold = float(raw.get("threshold") or ANSWER_CACHE_THRESHOLD)
+    if not 0.5 <= threshold <= 1.0:
+        raise ValueError("answer_cache.threshold must be between 0.5 and 1.0")
+    namespace = str(raw.get("namespace") or "default")
+    if body.get("tenant_id"):
+        namespace = f"{validate_tenant_id(body['tenant_id'])}/{namespace}"
+    scope = body.get("scope") or "legal"
+    if scope not in ("legal", "tenant", "all"):
+        raise ValueError("scope must be one of: legal, tenant, all")
+    if scope != "legal":
+        # câu trả lời có dùng tài liệu tenant -> tách khỏi câu trả lời chỉ từ luật
+        namespace = f"{namespace}@{scope}"
+    return {
+        "namespace": namespace,
+        "language": (body.get("language") or "vi").lower(),
+        "threshold": threshold,
+        "tenant_id": body.get("tenant_id"),
+        "scope": scope,
+    }
+
+
+def answer_cache_version(opts: Dict[str, Any]) -> str:
+    """
+    Câu trả lời chỉ dùng lại khi các index đã tìm (theo scope) chưa đổi: scope
+    "legal" chỉ cần version index pháp luật, không load index tenant.
+    """
+    version = legal_index_version() if opts["scope"] != "tenant" else ""
+    if opts["scope"] != "legal":
+        version += "|" + str(get_tenant_index(validate_tenant_id(opts["tenant_id"]))["version"])
+    return version
+
+
+def answer_cache_lookup(q_emb: List[float], opts: Dict[str, Any]) -> Optional[Tuple[Dict[str, Any], float]]:
+    """
+    Entry cùng namespace / language / version có cosine(query) cao nhất và
+    >= threshold. Entry hết TTL, hoặc cùng namespace nhưng khác version index,
+    bị xoá khi quét qua.
+    """
+    now = time.time()
+    version = answer_cache_version(opts)
+
+    candidates: List[str] = []
+    for key, entry in list(ANSWER_CACHE.items()):
+        if now - entry["created_at"] > ANSWER_CACHE_TTL_SECONDS:
+            del ANSWER_CACHE[key]
+            ANSWER_CACHE_STATS["expired"] += 1
+            continue
+        if entry["namespace"] != opts["namespace"] or entry["language"] != opts["language"]:
+            continue
+        if entry["version"] != version:
+            del ANSWER_CACHE[key]
+            ANSWER_CACHE_STATS["expired"] += 1
+            continue
+        if len(entry["embedding"]) == len(q_emb) * 4:
+            candidates.append(key)
+
+    best: Optional[Tuple[str, float]] = None
+    if candidates:
+        # embedding entry là float32 đã chuẩn hoá -> cosine = dot, một phép nhân ma trận
+        matrix = VectorMatrix(b"".join(ANSWER_CACHE[k]["embedding"] for k in candidates), len(q_emb))
+        for key, sim in zip(candidates, matrix.scores(q_emb)):
+            if sim >= opts["threshold"] and (best is None or sim > best[1]):
+                best = (key, sim)
+
+    if best is None:
+        ANSWER_CACHE_STATS["misses"] += 1
+        return None
+    ANSWER_CACHE.move_to_end(best[0])
+    ANSWER_CACHE_STATS["hits"] += 1
+    entry = ANSWER_CACHE[best[0]]
+    entry["hits"] += 1
+    return entry, best[1]
+
+
+def answer_cache_store(body: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    action "answer_cache_store": lưu câu trả lời LLM cho query (gọi sau khi caller
+    sinh xong câu trả lời cho một lần miss). Body: query, answer, sources (tuỳ chọn),
+    answer_cache / tenant_id / scope / language như request search.
+    """
+    query = (body.get("query") or "").strip()
+    answer = body.get("answer")
+    if not query or not isinstance(answer, str) or not answer.strip():
+        raise ValueError("query and answer are required")
+    opts = parse_answer_cache_options({**body, "answer_cache": body.get("answer_cache") or True})
+    if not opts:
+        return {"stored": False, "reason": "answer cache disabled"}
+
+    sources = body.get("sources") or []
+    if not isinstance(sources, list):
+        raise ValueError("sources must be a list")
+
+    key = hashlib.sha1(f"{opts['namespace']}|{opts['language']}|{query}".encode("utf-8")).hexdigest()
+    ANSWER_CACHE.pop(key, None)
+    ANSWER_CACHE[key] = {
+        "namespace": opts["namespace"],
+        "language": opts["language"],
+        "version": answer_cache_version(opts),
+        "query": query,
+        "embedding": array("f", unit_vector(get_embedding(query))).tobytes(),
+        "answer": answer,
+        "sources": sources,
+        "created_at": time.time(),
+        "hits": 0,
+    }
+    ANSWER_CACHE_STATS["stores"] += 1
+    while len(ANSWER_CACHE) > ANSWER_CACHE_SIZE:
+        ANSWER_CACHE.popitem(last=False)
+        ANSWER_CACHE_STATS["evictions"] += 1
+    return {"stored": True, "size": len(ANSWER_CACHE)}
+
+
+def answer_cache_stats() -> Dict[str, Any]:
+    lookups = ANSWER_CACHE_STATS["hits"] + ANSWER_CACHE_STATS["misses"]
+    return {
+        **ANSWER_CACHE_STATS,
+        "hit_rate": round(ANSWER_CACHE_STATS["hits"] / lookups, 4) if lookups else 0.0,
+        "size": len(ANSWER_CACHE),
+        "capacity": ANSWER_CACHE_SIZE,
+        "threshold": ANSWER_CACHE_THRESHOLD,
+        "ttl_seconds": ANSWER_CACHE_TTL_SECONDS,
+    }
 
 
 def parse_event_body(event: Dict[str, Any]) -> Dict[str, Any]:
@@ -161,82 +1539,393 @@ def parse_event_body(event: Dict[str, Any]) -> Dict[str, Any]:
         return event
     body = event["body"]
     if event.get("isBase64Encoded"):
-        body = base64.b64decode(body).decode("utf-8")  # cần import base64 nếu dùng
+        body = base64.b64decode(body).decode("utf-8")
     try:
-        data = json.loads(body)
+        data = fast_json.loads(body)
     except json.JSONDecodeError:
         raise ValueError("Request body must be valid JSON")
     return data
 
 
-def apply_filters(rec: Dict[str, Any], filters: Dict[str, Any]) -> bool:
+def is_api_event(event: Dict[str, Any]) -> bool:
+    """Event từ API Gateway / search_server (public), khác payload invoke trực tiếp."""
+    return "body" in event or "requestContext" in event or "httpMethod" in event
+
+
+def authorizer_claims(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Claim của authorizer: HTTP API JWT, REST API Cognito, hoặc context Lambda authorizer."""
+    authorizer = (event.get("requestContext") or {}).get("authorizer") or {}
+    claims = (authorizer.get("jwt") or {}).get("claims") or authorizer.get("claims") or authorizer.get("lambda")
+    return claims if isinstance(claims, dict) else authorizer
+
+
+def request_tenant_id(event: Dict[str, Any], body: Dict[str, Any]) -> Optional[str]:
     """
-    filters dạng:
+    tenant của request. Invoke trực tiếp: tenant_id trong payload. API Gateway: claim
+    TENANT_ID_CLAIM của authorizer; body có tenant_id khác claim (hoặc không có claim)
+    -> PermissionError (403).
+    """
+    if not is_api_event(event):
+        return body.get("tenant_id")
+    claimed = authorizer_claims(event).get(TENANT_ID_CLAIM)
+    claimed = str(claimed) if claimed else None
+    requested = body.get("tenant_id")
+    if requested and str(requested) != claimed:
+        raise PermissionError("tenant_id must match the authenticated caller")
+    return claimed
+
+
+def rank_candidates(
+    q_emb: List[float],
+    filters: Dict[str, Any],
+    limit: int,
+    view: IndexView,
+) -> List[Tuple[float, int]]:
+    """
+    Chấm cosine cho toàn bộ các index trong view, trả về tối đa `limit` cặp
+    (score, idx) đã qua filter, sort từ cao xuống thấp. Các index dùng chung
+    model embedding nên score cosine so sánh trực tiếp được khi gộp.
+    """
+    ranked: List[Tuple[float, int]] = []
+
+    for (_, index), offset in zip(view.parts, view.offsets):
+        chunks: ChunkStore = index["chunks"]
+        compiled = chunks.compile_filters(filters)
+        if any(not allowed for _, allowed in compiled):
+            continue  # giá trị filter không có trong index này: không cần chấm cosine
+        deleted = index.get("deleted")
+        vectors = index["vectors"]
+        scores: List[Tuple[float, int]] = []
+
+        if hasattr(vectors, "scores"):
+            # VectorMatrix (vector_matrix.py, vd. search_server): một phép nhân ma trận
+            scores = list(zip(vectors.scores(q_emb), range(len(vectors))))
+        else:
+            for i, vec in enumerate(vectors):
+                s = cosine_similarity(q_emb, vec)
+                scores.append((s, i))
+
+        # sort từ cao xuống thấp
+        scores.sort(key=lambda x: x[0], reverse=True)
+
+        taken = 0
+        for score, idx in scores:
+            if score <= 0:
+                break
+            if compiled and not chunks.matches(idx, compiled):
+                continue
+            if deleted and idx in deleted:
+                continue
+            ranked.append((score, offset + idx))
+            taken += 1
+            if taken >= limit:
+                break
+
+    if len(view.parts) > 1:
+        ranked.sort(key=lambda x: x[0], reverse=True)
+        del ranked[limit:]
+    return ranked
+
+
+def parse_diversity_options(raw: Any) -> Dict[str, Any]:
+    """
+    body["diversity"] có thể là true (dùng mặc định) hoặc object:
     {
-      "source_type": ["legal", "template"],
-      "doc_category": ["luat", "nghi_dinh"],
-      "field": ["Xây dựng - Đô thị"]
+      "mmr_lambda": 0.7,      # 1.0 = chỉ relevance, 0.0 = chỉ đa dạng
+      "max_per_doc": 2,       # tối đa bao nhiêu chunk cho mỗi doc_id
+      "dup_threshold": 0.95,  # cosine giữa 2 chunk >= ngưỡng -> coi là trùng, bỏ
+      "fetch_k": 40           # số ứng viên lấy ra trước khi chọn lại
     }
-    Trả về True nếu record PASS filter.
+    Trả về {} nếu không bật.
     """
-    if not filters:
-        return True
-
-    # source_type
-    st_list = filters.get("source_type")
-    if st_list:
-        st_val = rec.get("source_type")
-        if st_val not in st_list:
-            return False
+    if not raw:
+        return {}
+    if raw is True:
+        raw = {}
+    if not isinstance(raw, dict):
+        raise ValueError("diversity must be true or an object")
+
+    opts = dict(DIVERSITY_DEFAULTS)
+    for key in ("mmr_lambda", "dup_threshold"):
+        if raw.get(key) is not None:
+            opts[key] = float(raw[key])
+    for key in ("max_per_doc", "fetch_k"):
+        if raw.get(key) is not None:
+            opts[key] = int(raw[key])
+
+    if not 0.0 <= opts["mmr_lambda"] <= 1.0:
+        raise ValueError("diversity.mmr_lambda must be between 0 and 1")
+    return opts
+
+
+def diversify_results(
+    q_emb: List[float],
+    candidates: List[Tuple[float, int]],
+    top_k: int,
+    mmr_lambda: float,
+    max_per_doc: int,
+    dup_threshold: float,
+    view: IndexView,
+) -> List[Tuple[float, int]]:
+    """
+    Maximal Marginal Relevance trên tập ứng viên, dùng chính vector trong index:
+      mmr(d) = λ * sim(q, d) - (1 - λ) * max_{s ∈ selected} sim(d, s)
+    Kèm giới hạn số chunk mỗi doc_id và loại chunk gần trùng (sim >= dup_threshold).
+    Trả về (relevance, idx) theo thứ tự được chọn (relevance = score của candidates).
+    """
+    vectors = {idx: view.vector(idx) for _, idx in candidates}
+
+    remaining = list(candidates)
+    selected: List[Tuple[float, int]] = []
+    per_doc: Dict[Any, int] = {}
+    # max sim tới tập đã chọn, cập nhật dần thay vì tính lại cả ma trận
+    max_sim = {idx: 0.0 for _, idx in remaining}
+
+    while remaining and len(selected) < top_k:
+        best_pos = -1
+        best_mmr = float("-inf")
+        for pos, (score, idx) in enumerate(remaining):
+            mmr = mmr_lambda * score - (1.0 - mmr_lambda) * max_sim[idx]
+            if mmr > best_mmr:
+                best_mmr = mmr
+                best_pos = pos
+
+        score, idx = remaining.pop(best_pos)
+        doc_id = view.get(idx, "doc_id")
+        if max_per_doc > 0 and doc_id is not None and per_doc.get(doc_id, 0) >= max_per_doc:
+            continue
+        if selected and max_sim[idx] >= dup_threshold:
+            continue
 
-    # doc_category
-    cat_list = filters.get("doc_category")
-    if cat_list:
-        cat_val = rec.get("doc_category")
-        if cat_val not in cat_list:
-            return False
+        selected.append((score, idx))
+        if doc_id is not None:
+            per_doc[doc_id] = per_doc.get(doc_id, 0) + 1
 
-    # field
-    field_list = filters.get("field")
-    if field_list:
-        field_val = rec.get("field")
-        if field_val not in field_list:
-            return False
+        for _, other in remaining:
+            sim = cosine_similarity(vectors[idx], vectors[other])
+            if sim > max_sim[other]:
+                max_sim[other] = sim
 
-    return True
+    return selected
 
 
-def search_index(query: str, top_k: int, filters: Dict[str, Any]) -> List[Dict[str, Any]]:
-    load_index_if_needed()
+def parse_rerank_options(raw: Any) -> Dict[str, Any]:
+    """
+    body["rerank"] có thể là true (dùng mặc định) hoặc object:
+    {
+      "method": "model" | "llm",  # Bedrock rerank model hoặc prompt chấm điểm theo lô
+      "fetch_k": 24,              # số ứng viên cosine đưa vào rerank
+      "budget_ms": 1500           # quá thời gian này -> giữ thứ tự cosine
+    }
+    Trả về {} nếu không bật.
+    """
+    if not raw:
+        return {}
+    if raw is True:
+        raw = {}
+    if not isinstance(raw, dict):
+        raise ValueError("rerank must be true or an object")
+
+    opts = dict(RERANK_DEFAULTS)
+    if raw.get("method") is not None:
+        opts["method"] = str(raw["method"])
+    for key in ("fetch_k", "budget_ms"):
+        if raw.get(key) is not None:
+            opts[key] = int(raw[key])
+
+    if opts["method"] not in ("model", "llm"):
+        raise ValueError("rerank.method must be 'model' or 'llm'")
+    return opts
+
+
+def rerank_with_model(query: str, docs: List[str]) -> List[float]:
+    """Bedrock rerank model (Cohere Rerank / Amazon Rerank) qua invoke_model."""
+    body_dict: Dict[str, Any] = {
+        "query": query,
+        "documents": docs,
+        "top_n": len(docs),
+    }
+    if RERANK_MODEL_ID.startswith("cohere."):
+        body_dict["api_version"] = 2
+
+    response = bedrock.invoke_model(
+        modelId=RERANK_MODEL_ID,
+        body=json.dumps(body_dict),
+        contentType="application/json",
+        accept="application/json",
+    )
+    response_body = json.loads(response["body"].read())
 
-    q_emb = get_embedding(query)
+    scores = [0.0] * len(docs)
+    for item in response_body.get("results") or []:
+        i = item.get("index")
+        if isinstance(i, int) and 0 <= i < len(docs):
+            scores[i] = float(item.get("relevance_score") or 0.0)
+    return scores
 
-    scores: List[Tuple[float, int]] = []
 
-    for i, vec in enumerate(INDEX_CACHE["vectors"]):
-        s = cosine_similarity(q_emb, vec)
-        scores.append((s, i))
+def rerank_with_llm(query: str, docs: List[str]) -> List[float]:
+    """
+    Chấm điểm liên quan cho cả lô đoạn văn trong MỘT lời gọi Converse.
+    Model trả {"relevance_scores": [0..10, ...]} theo đúng thứ tự đoạn.
+    """
+    passages = "\n\n".join(f"[{i}] {d}" for i, d in enumerate(docs))
+    user_text = (
+        f"Câu hỏi / ngữ cảnh tra cứu:\n{query}\n\n"
+        f"Các đoạn văn bản pháp luật:\n{passages}\n\n"
+        f"Chấm điểm mức độ liên quan của từng đoạn (0-10). "
+        f'CHỈ trả về JSON dạng {{"relevance_scores": [...]}} gồm đúng {len(docs)} số, theo thứ tự đoạn.'
+    )
+    response = bedrock.converse(
+        modelId=RERANK_LLM_MODEL_ID,
+        system=[{"text": "Bạn là bộ chấm điểm mức độ liên quan (relevance) giữa câu hỏi và văn bản pháp luật Việt Nam."}],
+        messages=[{"role": "user", "content": [{"text": user_text}]}],
+        inferenceConfig={"maxTokens": 16 + 6 * len(docs), "temperature": 0.0},
+    )
+    text = response["output"]["message"]["content"][0].get("text", "")
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    if not match:
+        raise ValueError("Rerank LLM output has no JSON object")
+    raw_scores = json.loads(match.group(0)).get("relevance_scores") or []
+    if len(raw_scores) != len(docs):
+        raise ValueError("Rerank LLM returned %d scores for %d passages" % (len(raw_scores), len(docs)))
+    return [max(0.0, min(10.0, float(x))) / 10.0 for x in raw_scores]
+
+
+def rerank_candidates(
+    query: str,
+    candidates: List[Tuple[float, int]],
+    opts: Dict[str, Any],
+    view: IndexView,
+    debug: Dict[str, Any] = None,
+) -> Tuple[List[Tuple[float, int]], Dict[int, float]]:
+    """
+    Chấm lại ứng viên trong giới hạn opts["budget_ms"]. Trả về (candidates sắp
+    theo rerank score, {idx: rerank score}); nếu timeout/lỗi thì giữ nguyên thứ tự cosine.
+    Kết quả được cache theo (method, query, view, tập ứng viên).
+    """
+    info: Dict[str, Any] = {"method": opts["method"], "candidates": len(candidates)}
+    if debug is not None:
+        debug["rerank"] = info
 
-    # sort từ cao xuống thấp
-    scores.sort(key=lambda x: x[0], reverse=True)
+    key_src = "%s|%s|%s|%s" % (
+        opts["method"], query, view.cache_key(), ",".join(str(idx) for _, idx in candidates)
+    )
+    cache_key = hashlib.sha1(key_src.encode("utf-8")).hexdigest()
 
-    results: List[Dict[str, Any]] = []
-    for score, idx in scores:
-        if score <= 0:
-            break
-        rec = INDEX_CACHE["chunks"][idx]
+    scores = RERANK_CACHE.get(cache_key)
+    if scores is not None:
+        RERANK_CACHE.move_to_end(cache_key)
+        info["status"] = "cached"
+    else:
+        docs = [view.text(idx)[:RERANK_MAX_DOC_CHARS] for _, idx in candidates]
+        scorer = rerank_with_llm if opts["method"] == "llm" else rerank_with_model
 
-        if not apply_filters(rec, filters):
-            continue
+        started = time.perf_counter()
+        future = RERANK_EXECUTOR.submit(scorer, query, docs)
+        try:
+            values = future.result(timeout=opts["budget_ms"] / 1000.0)
+        except FutureTimeoutError:
+            future.cancel()
+            logger.warning("Rerank exceeded %d ms budget, keeping cosine order", opts["budget_ms"])
+            info["status"] = "timeout"
+            return candidates, {}
+        except Exception as e:
+            logger.warning("Rerank failed, keeping cosine order: %s", e)
+            info["status"] = "error"
+            return candidates, {}
+        finally:
+            info["latency_ms"] = round((time.perf_counter() - started) * 1000.0, 1)
+
+        scores = {idx: values[i] for i, (_, idx) in enumerate(candidates)}
+        RERANK_CACHE[cache_key] = scores
+        while len(RERANK_CACHE) > RERANK_CACHE_SIZE:
+            RERANK_CACHE.popitem(last=False)
+        info["status"] = "ok"
+
+    reranked = sorted(((scores.get(idx, 0.0), idx) for _, idx in candidates), key=lambda x: x[0], reverse=True)
+    return reranked, scores
+
+
+def search_index(
+    query: str,
+    top_k: int,
+    filters: Dict[str, Any],
+    diversity: Dict[str, Any] = None,
+    rerank: Dict[str, Any] = None,
+    debug: Dict[str, Any] = None,
+    fields: Optional[List[str]] = None,
+    tenant_id: Optional[str] = None,
+    scope: str = "legal",
+    q_emb: Optional[List[float]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Pipeline: cosine top-fetch_k -> (rerank) -> (MMR / per-doc cap) -> top_k.
+    "score" luôn là cosine; khi có rerank, thêm "rerank_score".
+    fields: chỉ materialize các field này (None = tất cả).
+    scope: "legal" (index pháp luật chung), "tenant" (chỉ tài liệu của tenant_id)
+    hoặc "all" (gộp cả hai, kết quả có thêm field "index").
+    q_emb: embedding của query nếu caller đã tính (vd. khi tra answer cache).
+    """
+    fetch_k = top_k
+    if diversity:
+        fetch_k = max(fetch_k, diversity.get("fetch_k") or 0)
+    if rerank:
+        fetch_k = max(fetch_k, rerank["fetch_k"])
+
+    parts: List[Tuple[str, Dict[str, Any]]] = []
+    if scope in ("legal", "all"):
+        if is_shard_coordinator():
+            # Coordinator: index pháp luật chia shard -> scatter-gather top-fetch_k
+            if q_emb is None:
+                q_emb = get_embedding(query)
+            parts.append(("legal", gather_legal_shards(q_emb, filters, fetch_k, debug)))
+        else:
+            load_index_if_needed()
+            parts.append(("legal", INDEX_CACHE))
+            if debug is not None:
+                debug["index_version"] = INDEX_CACHE["version"]
+    if scope in ("tenant", "all") and tenant_id:
+        tenant_index = get_tenant_index(tenant_id)
+        if tenant_index["vectors"]:
+            parts.append(("tenant", tenant_index))
+    view = IndexView(parts)
+    if not view.size:
+        return []
+
+    if q_emb is None:
+        q_emb = get_embedding(query)
+
+    candidates = rank_candidates(q_emb, filters, limit=fetch_k, view=view)
+    cosine_by_idx = {idx: score for score, idx in candidates}
+
+    rerank_scores: Dict[int, float] = {}
+    if rerank and candidates:
+        candidates, rerank_scores = rerank_candidates(query, candidates, rerank, view, debug=debug)
+
+    if diversity:
+        ranked = diversify_results(
+            q_emb,
+            candidates,
+            top_k=top_k,
+            mmr_lambda=diversity["mmr_lambda"],
+            max_per_doc=diversity["max_per_doc"],
+            dup_threshold=diversity["dup_threshold"],
+            view=view,
+        )
+    else:
+        ranked = candidates[:top_k]
 
-        # copy metadata + thêm score
-        res = dict(rec)
-        res["score"] = score
+    results: List[Dict[str, Any]] = []
+    for _, idx in ranked:
+        # chỉ materialize dict cho top-k cuối cùng + thêm score
+        res = view.materialize(idx, fields)
+        if fields is None or "score" in fields:
+            res["score"] = cosine_by_idx[idx]
+        if idx in rerank_scores and (fields is None or "rerank_score" in fields):
+            res["rerank_score"] = rerank_scores[idx]
         results.append(res)
 
-        if len(results) >= top_k:
-            break
-
     return results
 
 
@@ -247,7 +1936,108 @@ def make_response(status_code: int, body: Dict[str, Any]) -> Dict[str, Any]:
             "Content-Type": "application/json",
             "Access-Control-Allow-Origin": "*",  # cho demo
         },
-        "body": json.dumps(body, ensure_ascii=False),
+        "body": fast_json.dumps(body),
+    }
+
+
+# -----------------------------------------------------------------------------
+# Response shaping: projection, cắt text, nén
+# -----------------------------------------------------------------------------
+
+def parse_response_options(body: Dict[str, Any], api_event: bool = False) -> Dict[str, Any]:
+    """
+    Tuỳ chọn định dạng kết quả (đều không bắt buộc):
+      "fields": ["title", "article_no", "article_title", "text", "score"]  -> chỉ trả các field này
+      "max_text_chars": 800       -> cắt text (thêm "text_truncated": true)
+      "compress": "gzip" | "auto" -> gzip + base64 (auto: chỉ khi body > GZIP_MIN_BYTES)
+      "response_format": "api" | "raw"
+          api: {statusCode, headers, body: "<json string>"} như cũ (API Gateway)
+          raw: trả thẳng dict cho caller invoke trực tiếp (không JSON lồng trong JSON);
+               không dùng được qua API Gateway (dict trần -> 502)
+    Raise ValueError nếu không hợp lệ.
+    """
+    fields = body.get("fields")
+    if fields is not None:
+        if not isinstance(fields, list) or not all(isinstance(f, str) for f in fields):
+            raise ValueError("fields must be a list of strings")
+
+    max_text_chars = body.get("max_text_chars")
+    if max_text_chars is not None:
+        try:
+            max_text_chars = int(max_text_chars)
+        except (TypeError, ValueError):
+            raise ValueError("max_text_chars must be an integer")
+        if max_text_chars <= 0:
+            raise ValueError("max_text_chars must be > 0")
+
+    compress = body.get("compress") or "none"
+    if compress not in ("none", "gzip", "auto"):
+        raise ValueError("compress must be one of: none, gzip, auto")
+
+    response_format = body.get("response_format") or "api"
+    if response_format not in ("api", "raw"):
+        raise ValueError("response_format must be 'api' or 'raw'")
+    if response_format == "raw" and api_event:
+        raise ValueError("response_format 'raw' is only available for direct invocation")
+
+    return {
+        "fields": fields,
+        "max_text_chars": max_text_chars,
+        "compress": compress,
+        "response_format": response_format,
+    }
+
+
+def project_results(
+    results: List[Dict[str, Any]],
+    fields: List[str] = None,
+    max_text_chars: int = None,
+) -> List[Dict[str, Any]]:
+    if not fields and not max_text_chars:
+        return results
+
+    out = []
+    for r in results:
+        item = {f: r[f] for f in fields if f in r} if fields else dict(r)
+        text = item.get("text")
+        if max_text_chars and text and len(text) > max_text_chars:
+            cut = text[:max_text_chars].rsplit(" ", 1)[0]
+            item["text"] = cut + " …"
+            item["text_truncated"] = True
+        out.append(item)
+    return out
+
+
+def encode_response(resp: Dict[str, Any], opts: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Serialize kết quả search theo opts (xem parse_response_options).
+    Nén: api -> body base64 + isBase64Encoded + Content-Encoding: gzip (API Gateway
+    trả nhị phân cho client); raw -> {"encoding": "gzip", "data": "<base64>"}.
+    """
+    compress = opts["compress"]
+    if compress == "none" and opts["response_format"] == "api":
+        return make_response(200, resp)
+    if compress == "none":
+        return resp
+
+    raw = fast_json.dumps_bytes(resp)
+    if compress == "auto" and len(raw) < GZIP_MIN_BYTES:
+        if opts["response_format"] == "raw":
+            return resp
+        return make_response(200, resp)
+
+    data = base64.b64encode(gzip.compress(raw, compresslevel=6)).decode("ascii")
+    if opts["response_format"] == "raw":
+        return {"encoding": "gzip", "data": data}
+    return {
+        "statusCode": 200,
+        "headers": {
+            "Content-Type": "application/json",
+            "Content-Encoding": "gzip",
+            "Access-Control-Allow-Origin": "*",  # cho demo
+        },
+        "isBase64Encoded": True,
+        "body": data,
     }
 
 
@@ -257,9 +2047,38 @@ def make_response(status_code: int, body: Dict[str, Any]) -> Dict[str, Any]:
 
 def lambda_handler(event, context):
     logger.info("Received event: %s", json.dumps(event)[:1000])
+    event_capture.capture_event("ragsearch", event)
 
     try:
         body = parse_event_body(event)
+        body = dict(body, tenant_id=request_tenant_id(event, body))
+
+        # Index tài liệu của tenant (gọi từ backend sau khi user upload)
+        action = body.get("action")
+        if action in DIRECT_INVOKE_ACTIONS and is_api_event(event):
+            raise PermissionError(f"action {action} is only available to direct invokes")
+        if action == "index_document":
+            return make_response(200, index_document(body))
+        if action == "delete_document":
+            return make_response(200, delete_document(body))
+        if action == "compact_tenant_index":
+            return make_response(200, compact_tenant_index(body.get("tenant_id")))
+        # Job định kỳ (vd. EventBridge): gộp segment delta vào base index pháp luật
+        if action == "compact_legal_index":
+            return make_response(200, compact_legal_index())
+        if action == "answer_cache_store":
+            return make_response(200, answer_cache_store(body))
+        if action == "answer_cache_stats":
+            return make_response(200, answer_cache_stats())
+        if action == "index_stats":
+            return make_response(200, index_memory_stats())
+        if action == "index_version":
+            return make_response(200, {"index_version": legal_index_version()})
+        # Coordinator -> container shard: trả thẳng dict (không bọc statusCode / body)
+        if action == "shard_search":
+            return shard_search(body)
+        if action == "build_legal_shards":
+            return make_response(200, build_legal_shards(body.get("by") or "doc_category", int(body.get("shards") or 4)))
 
         query = (body.get("query") or "").strip()
         if not query:
@@ -275,20 +2094,86 @@ def lambda_handler(event, context):
             top_k = 10
 
         filters = body.get("filters") or {}
-
-        results = search_index(query=query, top_k=top_k, filters=filters)
+        diversity = parse_diversity_options(body.get("diversity"))
+        rerank = parse_rerank_options(body.get("rerank"))
+        response_opts = parse_response_options(body, api_event=is_api_event(event))
+
+        # scope "tenant" / "all": tìm thêm trong tài liệu riêng của tenant. Mặc định chỉ
+        # index pháp luật, kể cả khi request đã xác thực (tenant_id lấy từ claim)
+        tenant_id = body.get("tenant_id")
+        scope = body.get("scope") or "legal"
+        if scope not in ("legal", "tenant", "all"):
+            raise ValueError("scope must be one of: legal, tenant, all")
+        if scope != "legal":
+            tenant_id = validate_tenant_id(tenant_id)
+
+        # Answer cache: hit -> trả câu trả lời đã lưu (kèm sources), bỏ qua search
+        answer_cache = parse_answer_cache_options(body)
+        q_emb = None
+        cached = None
+        if answer_cache:
+            q_emb = get_embedding(query)
+            cached = answer_cache_lookup(q_emb, answer_cache)
+        if cached:
+            entry, similarity = cached
+            logger.info("Answer cache hit (sim=%.4f, hit_rate=%.3f)", similarity, answer_cache_stats()["hit_rate"])
+            resp = {
+                "query": query,
+                "language": language,
+                "top_k": top_k,
+                "index_version": legal_index_version(),
+                "results": project_results(entry["sources"], response_opts["fields"], response_opts["max_text_chars"]),
+                "answer_cache": {
+                    "hit": True,
+                    "similarity": round(similarity, 4),
+                    "cached_query": entry["query"],
+                    "answer": entry["answer"],
+                    "age_seconds": round(time.time() - entry["created_at"], 1),
+                },
+            }
+            return encode_response(resp, response_opts)
+
+        debug: Dict[str, Any] = {}
+        results = search_index(
+            query=query,
+            top_k=top_k,
+            filters=filters,
+            diversity=diversity,
+            rerank=rerank,
+            debug=debug,
+            fields=response_opts["fields"],
+            tenant_id=tenant_id,
+            scope=scope,
+            q_emb=q_emb,
+        )
 
         resp = {
             "query": query,
             "language": language,
             "top_k": top_k,
-            "results": results,
+            "index_version": debug.get("index_version"),
+            "results": project_results(results, response_opts["fields"], response_opts["max_text_chars"]),
         }
-        return make_response(200, resp)
+        if scope != "legal":
+            resp["scope"] = scope
+            resp["tenant_index_version"] = (TENANT_INDEXES.get(tenant_id) or {}).get("version")
+        if diversity:
+            resp["diversity"] = diversity
+        if rerank:
+            resp["rerank"] = debug.get("rerank")
+        if "shards" in debug:
+            resp["shards"] = debug["shards"]
+        if answer_cache:
+            resp["answer_cache"] = {"hit": False}
+        return encode_response(resp, response_opts)
 
     except ValueError as ve:
         return make_response(400, {"error": str(ve)})
 
+    except PermissionError as pe:
+        logger.warning("Forbidden: %s", pe)
+        return make_response(403, {"error": str(pe)})
+
     except ClientError as ce:
         logger.error("AWS client error: %s", ce)
         return make_response(
@@ -0,0 +1,144 @@
+"""
+Ghép context pháp luật (chunk RAG) vào prompt trong giới hạn token: giữ nguyên
+chunk vừa budget, cắt theo câu quanh đoạn khớp query, bỏ phần còn lại.
+Dùng chung cho callllm và generator; file này phải được đóng gói cùng cả hai Lambda.
+"""
+
+import math
+import re
+from typing import Any, Dict, List, Tuple
+
+CHARS_PER_TOKEN = 3.0
+MIN_TRIMMED_CHUNK_TOKENS = 60
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.;:!?…])\s+|\n+")
+_STOPWORDS = {
+    "và", "của", "các", "có", "được", "cho", "trong", "theo", "là", "với",
+    "một", "những", "này", "khi", "thì", "không", "về", "tại", "hoặc", "bên",
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """Ước lượng số token (tiếng Việt có dấu ~ CHARS_PER_TOKEN ký tự / token)."""
+    if not text:
+        return 0
+    return int(math.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+def query_terms(query: str) -> set:
+    return {w for w in _WORD_RE.findall((query or "").lower()) if w not in _STOPWORDS}
+
+
+def split_sentences(text: str) -> List[str]:
+    return [s.strip() for s in _SENTENCE_SPLIT_RE.split(text or "") if s and s.strip()]
+
+
+def trim_to_relevant_span(text: str, terms: set, max_tokens: int) -> str:
+    """
+    Cắt chunk theo ranh giới câu quanh câu khớp query nhiều nhất, mở rộng dần
+    sang câu lân cận (ưu tiên câu khớp hơn) cho tới khi hết max_tokens.
+    """
+    sentences = split_sentences(text)
+    if not sentences or max_tokens <= 0:
+        return ""
+
+    scores = [len(terms & set(_WORD_RE.findall(s.lower()))) for s in sentences]
+    anchor = max(range(len(sentences)), key=lambda i: (scores[i], -i))
+
+    used = estimate_tokens(sentences[anchor])
+    if used > max_tokens:
+        # Một câu cũng quá dài: cắt cứng theo ranh giới từ
+        max_chars = int(max_tokens * CHARS_PER_TOKEN)
+        return sentences[anchor][:max_chars].rsplit(" ", 1)[0] + " …"
+
+    lo = hi = anchor
+    while True:
+        options = []
+        if lo > 0:
+            options.append((scores[lo - 1], 0, lo - 1))
+        if hi < len(sentences) - 1:
+            options.append((scores[hi + 1], 1, hi + 1))
+        if not options:
+            break
+        _, _, j = max(options)
+        cost = estimate_tokens(sentences[j]) + 1
+        if used + cost > max_tokens:
+            break
+        used += cost
+        lo, hi = min(lo, j), max(hi, j)
+
+    out = " ".join(sentences[lo:hi + 1])
+    if lo > 0:
+        out = "… " + out
+    if hi < len(sentences) - 1:
+        out += " …"
+    return out
+
+
+def pack_legal_context(
+    chunks: List[Dict[str, Any]],
+    query: str,
+    budget_tokens: int,
+    label: str,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Ghép các chunk RAG (đã sort theo score) thành block text trong giới hạn
+    budget_tokens. Chunk vừa budget thì giữ nguyên; nếu còn đủ chỗ thì cắt theo câu
+    quanh đoạn khớp query; không thì bỏ. Trả về (context, stats).
+    """
+    terms = query_terms(query)
+    lines: List[str] = []
+    used = 0
+    stats = {
+        "budget_tokens": budget_tokens,
+        "chunks_in": len(chunks),
+        "chunks_used": 0,
+        "chunks_trimmed": 0,
+        "chunks_dropped": 0,
+        "tokens_in": 0,
+        "tokens_used": 0,
+        "tokens_dropped": 0,
+    }
+
+    for c in chunks:
+        title = c.get("title") or ""
+        article_no = c.get("article_no") or ""
+        article_title = c.get("article_title") or ""
+        text = c.get("text") or ""
+
+        header = f"[{label} {stats['chunks_used'] + 1} – {title}"
+        if article_no:
+            header += f", {article_no}"
+        if article_title:
+            header += f": {article_title}"
+        header += "]"
+
+        text_tokens = estimate_tokens(text)
+        header_tokens = estimate_tokens(header) + 1
+        stats["tokens_in"] += text_tokens
+        remaining = budget_tokens - used - header_tokens
+
+        if text_tokens <= remaining:
+            body = text
+        elif remaining >= MIN_TRIMMED_CHUNK_TOKENS:
+            body = trim_to_relevant_span(text, terms, remaining)
+            stats["chunks_trimmed"] += 1
+        else:
+            body = ""
+
+        if not body:
+            stats["chunks_dropped"] += 1
+            continue
+
+        body_tokens = estimate_tokens(body)
+        used += header_tokens + body_tokens
+        stats["chunks_used"] += 1
+        stats["tokens_used"] += body_tokens
+
+        lines.append(header)
+        lines.append(body)
+        lines.append("")
+
+    stats["tokens_dropped"] = stats["tokens_in"] - stats["tokens_used"]
+    return "\n".join(lines), stats
@@ -0,0 +1,104 @@
+"""
+Cập nhật index pháp luật theo segment thay vì build lại toàn bộ
+legal_chunks_with_emb.jsonl. Dùng chung code với Lambda ragsearch (cùng ENV:
+LEGAL_INDEX_BUCKET, LEGAL_INDEX_KEY, LEGAL_SEGMENT_PREFIX, EMBED_MODEL_ID).
+
+    append FILE    thêm / thay văn bản: JSONL cùng schema index (có "embedding").
+                   Record của một doc_id thay thế toàn bộ chunk cũ của doc_id đó.
+    delete         tombstone theo --doc-id / --chunk-id
+    compact        gộp segment vào base (tương đương action "compact_legal_index")
+    status         base hiện tại + các segment chưa gộp
+    shard          chia base thành N shard + manifest (LEGAL_SHARD_MANIFEST_KEY),
+                   theo --by doc_category | hash. compact tự chia lại khi đã có manifest.
+
+Ví dụ:
+
+    python legal_index_segments.py append nghi_dinh_2025_moi.jsonl
+    python legal_index_segments.py delete --doc-id nghi_dinh-00012
+    python legal_index_segments.py compact
+    LEGAL_SHARD_MANIFEST_KEY=index/shards/manifest.json python legal_index_segments.py shard --by doc_category --shards 4
+"""
+
+import argparse
+import importlib
+import json
+import os
+import sys
+from typing import Any, Dict, List
+
+
+def load_records(path: str) -> List[Dict[str, Any]]:
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            rec = json.loads(line)
+            if rec.get("op") != "delete" and (not rec.get("embedding") or not (rec.get("text") or "").strip()):
+                raise ValueError(f"{path}:{n}: record needs 'embedding' and 'text'")
+            records.append(rec)
+    return records
+
+
+def status(rag) -> Dict[str, Any]:
+    head = rag.s3.head_object(Bucket=rag.LEGAL_INDEX_BUCKET, Key=rag.LEGAL_INDEX_KEY)
+    base_seq = (head.get("Metadata") or {}).get(rag.SEGMENT_SEQ_METADATA) or ""
+    layout = rag.list_segment_layout(rag.LEGAL_INDEX_BUCKET, rag.LEGAL_SEGMENT_PREFIX)
+    return {
+        "base": rag.LEGAL_INDEX_KEY,
+        "base_etag": (head.get("ETag") or "").strip('"'),
+        "base_seq": base_seq or None,
+        "pending_segments": [key for seq, key in layout["segments"] if seq > base_seq],
+    }
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_append = sub.add_parser("append", help="ghi segment từ file JSONL")
+    p_append.add_argument("file")
+    p_delete = sub.add_parser("delete", help="ghi segment tombstone")
+    p_delete.add_argument("--doc-id", nargs="*", default=[])
+    p_delete.add_argument("--chunk-id", nargs="*", default=[])
+    sub.add_parser("compact", help="gộp segment vào base")
+    sub.add_parser("status", help="base + segment chưa gộp")
+    p_shard = sub.add_parser("shard", help="chia base thành shard + manifest")
+    p_shard.add_argument("--by", choices=("doc_category", "hash"), default="doc_category")
+    p_shard.add_argument("--shards", type=int, default=4)
+    args = parser.parse_args(argv)
+
+    rag = importlib.import_module("lambda_function_ragsearch")
+    if args.command == "shard":
+        if not rag.LEGAL_SHARD_MANIFEST_KEY:
+            parser.error("LEGAL_SHARD_MANIFEST_KEY is empty")
+        print(json.dumps(rag.build_legal_shards(args.by, args.shards), ensure_ascii=False, indent=2))
+        return 0
+    if not rag.LEGAL_SEGMENT_PREFIX:
+        parser.error("LEGAL_SEGMENT_PREFIX is empty (segments disabled)")
+
+    if args.command == "append":
+        records = load_records(args.file)
+        if not records:
+            parser.error(f"{args.file} has no records")
+        key = rag.write_segment(rag.LEGAL_INDEX_BUCKET, rag.LEGAL_SEGMENT_PREFIX, records)
+        result: Dict[str, Any] = {"segment": key, "records": len(records)}
+    elif args.command == "delete":
+        tombstones = [{"op": "delete", "doc_id": d} for d in args.doc_id]
+        tombstones += [{"op": "delete", "chunk_id": c} for c in args.chunk_id]
+        if not tombstones:
+            parser.error("give at least one --doc-id or --chunk-id")
+        key = rag.write_segment(rag.LEGAL_INDEX_BUCKET, rag.LEGAL_SEGMENT_PREFIX, tombstones)
+        result = {"segment": key, "tombstones": len(tombstones)}
+    elif args.command == "compact":
+        result = rag.compact_legal_index()
+    else:
+        result = status(rag)
+
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.exit(main())
@@ -0,0 +1,697 @@
+"""
+Local stand-ins cho S3, Bedrock Runtime và Lambda để chạy các Lambda trong
+ai_services mà không cần AWS thật (benchmark, đánh giá retrieval, replay...).
+
+Cách dùng nhanh:
+
+    stack = LocalAwsStack(converse_latency_ms=50)
+    stack.seed_legal_index(make_synthetic_corpus(n_chunks=2000))
+    stack.seed_templates()
+    rag = stack.load("ragsearch")
+    callllm = stack.load("callllm")
+
+`stack.load(...)` import lại file Lambda thành một module mới (cache rỗng),
+rồi thay các client boto3 ở cấp module (s3, bedrock, lambda_client) bằng fake.
+Các Lambda được load sẽ tự đăng ký vào FakeLambda theo tên, nên callllm /
+generator gọi RAG qua lambda_client.invoke vẫn chạy in-process.
+"""
+
+import importlib.util
+import io
+import itertools
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from botocore.exceptions import ClientError
+
+AI_SERVICES_DIR = os.path.dirname(os.path.abspath(__file__))
+
+LAMBDA_FILES = {
+    "ragsearch": "lambda_function_ragsearch.py",
+    "callllm": "lambda_function_callllm.py",
+    "generate_contract": "lambda_function_generate_contract.py.py",
+}
+
+DEFAULT_ENV = {
+    "AWS_REGION": "ap-southeast-1",
+    "AWS_DEFAULT_REGION": "ap-southeast-1",
+    "LEGAL_INDEX_BUCKET": "local-legal-index",
+    "LEGAL_INDEX_KEY": "index/legal_chunks_with_emb.jsonl",
+    "TEMPLATE_BUCKET": "local-contract-templates",
+    "TEMPLATE_METADATA_KEY": "index/template_metadata.jsonl",
+    "RAG_FUNCTION_NAME": "ragsearch",
+}
+
+EMBED_DIM = 1024
+
+
+# -----------------------------------------------------------------------------
+# Deterministic embeddings
+# -----------------------------------------------------------------------------
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_TOKEN_VECTORS: Dict[tuple, List[float]] = {}
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall((text or "").lower())
+
+
+def _token_vector(token: str, dim: int) -> List[float]:
+    key = (token, dim)
+    vec = _TOKEN_VECTORS.get(key)
+    if vec is None:
+        rnd = random.Random(zlib.crc32(token.encode("utf-8")))
+        vec = [rnd.gauss(0.0, 1.0) for _ in range(dim)]
+        _TOKEN_VECTORS[key] = vec
+    return vec
+
+
+def text_embedding(text: str, dim: int = EMBED_DIM) -> List[float]:
+    """
+    Embedding giả lập nhưng có "ngữ nghĩa": tổng các vector ngẫu nhiên (seed theo
+    token) rồi chuẩn hoá L2. Hai đoạn văn dùng chung nhiều từ sẽ có cosine cao,
+    nên top-k trên corpus tổng hợp vẫn có ý nghĩa để đo recall.
+    """
+    acc = [0.0] * dim
+    counts = Counter(tokenize(text)) or Counter(["<empty>"])
+    for tok, n in counts.items():
+        tv = _token_vector(tok, dim)
+        acc = [a + n * b for a, b in zip(acc, tv)]
+    norm = math.sqrt(sum(x * x for x in acc)) or 1.0
+    return [x / norm for x in acc]
+
+
+# -----------------------------------------------------------------------------
+# Synthetic legal corpus
+# -----------------------------------------------------------------------------
+
+DOC_CATEGORIES = ["luat", "nghi_dinh", "thong_tu"]
+FIELDS = ["Bất động sản", "Xây dựng - Đô thị", "Dân sự", "Thương mại", "Lao động"]
+
+TOPICS = {
+    "dat_coc": {
+        "article_title": "Đặt cọc",
+        "phrases": [
+            "đặt cọc là việc một bên giao cho bên kia một khoản tiền hoặc tài sản có giá trị",
+            "tài sản đặt cọc được trả lại hoặc trừ vào nghĩa vụ trả tiền khi hợp đồng được giao kết",
+            "bên nhận đặt cọc từ chối giao kết hợp đồng thì phải trả lại tài sản đặt cọc và một khoản tiền tương đương",
+            "mua bán nhà đất thường kèm theo thỏa thuận đặt cọc để bảo đảm giao kết",
+        ],
+    },
+    "thue_nha": {
+        "article_title": "Hợp đồng thuê nhà ở",
+        "phrases": [
+            "bên cho thuê có nghĩa vụ giao nhà ở cho bên thuê đúng thời hạn đã thỏa thuận",
+            "bên thuê có nghĩa vụ trả tiền thuê nhà đầy đủ và đúng hạn",
+            "thời hạn thuê nhà ở do các bên thỏa thuận và ghi trong hợp đồng",
+            "bên thuê không được cho thuê lại nhà ở nếu không có sự đồng ý của bên cho thuê",
+        ],
+    },
+    "phat_vi_pham": {
+        "article_title": "Phạt vi phạm",
+        "phrases": [
+            "mức phạt vi phạm nghĩa vụ hợp đồng do các bên thỏa thuận",
+            "mức phạt không vượt quá tám phần trăm giá trị phần nghĩa vụ hợp đồng bị vi phạm",
+            "các bên có thể thỏa thuận vừa phạt vi phạm vừa bồi thường thiệt hại",
+        ],
+    },
+    "boi_thuong": {
+        "article_title": "Bồi thường thiệt hại",
+        "phrases": [
+            "bên vi phạm nghĩa vụ phải bồi thường toàn bộ thiệt hại thực tế phát sinh",
+            "thiệt hại được bồi thường bao gồm tổn thất về tài sản và chi phí hợp lý",
+            "bên có quyền lợi bị vi phạm phải áp dụng biện pháp hạn chế thiệt hại",
+        ],
+    },
+    "cham_dut": {
+        "article_title": "Đơn phương chấm dứt hợp đồng",
+        "phrases": [
+            "một bên có quyền đơn phương chấm dứt thực hiện hợp đồng khi bên kia vi phạm nghiêm trọng",
+            "bên đơn phương chấm dứt hợp đồng phải thông báo ngay cho bên kia",
+            "khi hợp đồng bị chấm dứt các bên phải hoàn trả cho nhau những gì đã nhận",
+        ],
+    },
+    "tranh_chap": {
+        "article_title": "Giải quyết tranh chấp",
+        "phrases": [
+            "tranh chấp hợp đồng được giải quyết thông qua thương lượng hòa giải",
+            "trường hợp không thương lượng được các bên có quyền khởi kiện tại tòa án có thẩm quyền",
+            "các bên có thể thỏa thuận giải quyết tranh chấp bằng trọng tài thương mại",
+        ],
+    },
+    "quyen_su_dung_dat": {
+        "article_title": "Chuyển nhượng quyền sử dụng đất",
+        "phrases": [
+            "người sử dụng đất được chuyển nhượng quyền sử dụng đất khi có giấy chứng nhận",
+            "hợp đồng chuyển nhượng quyền sử dụng đất phải được công chứng hoặc chứng thực",
+            "đất không có tranh chấp và không bị kê biên để bảo đảm thi hành án",
+        ],
+    },
+    "lai_suat": {
+        "article_title": "Lãi suất chậm thanh toán",
+        "phrases": [
+            "lãi suất theo thỏa thuận không được vượt quá hai mươi phần trăm một năm",
+            "bên chậm trả tiền phải trả lãi trên số tiền chậm trả tương ứng với thời gian chậm trả",
+        ],
+    },
+    "xay_dung": {
+        "article_title": "Hợp đồng thi công xây dựng",
+        "phrases": [
+            "nhà thầu thi công xây dựng phải bảo đảm chất lượng công trình theo thiết kế",
+            "bảo hành công trình xây dựng được thực hiện theo thời hạn quy định",
+            "chủ đầu tư có trách nhiệm thanh toán theo tiến độ đã thỏa thuận",
+        ],
+    },
+    "lao_dong": {
+        "article_title": "Hợp đồng lao động",
+        "phrases": [
+            "người lao động và người sử dụng lao động giao kết hợp đồng lao động bằng văn bản",
+            "thời giờ làm việc bình thường không quá tám giờ trong một ngày",
+            "người sử dụng lao động phải trả lương đầy đủ và đúng hạn",
+        ],
+    },
+}
+
+_FILLER = [
+    "trừ trường hợp pháp luật có quy định khác",
+    "theo quy định của Bộ luật Dân sự",
+    "trong thời hạn ba mươi ngày kể từ ngày nhận được thông báo",
+    "và phải được lập thành văn bản",
+    "nếu các bên không có thỏa thuận khác",
+]
+
+
+def make_synthetic_corpus(
+    n_chunks: int = 2000,
+    dim: int = EMBED_DIM,
+    seed: int = 42,
+    chunks_per_article: int = 3,
+    articles_per_doc: int = 12,
+) -> List[Dict[str, Any]]:
+    """
+    Sinh corpus pháp lý tổng hợp theo đúng schema của legal_chunks_with_emb.jsonl:
+    mỗi record có doc_id, chunk_id, source_type, doc_category, field, title,
+    article_no, article_title, text, embedding (dim chiều).
+
+    Các chunk liền kề của cùng một điều khoản chia sẻ phần lớn từ vựng, giống
+    corpus thật (điều luật dài được cắt thành nhiều chunk).
+    """
+    rnd = random.Random(seed)
+    topic_keys = sorted(TOPICS)
+    records: List[Dict[str, Any]] = []
+
+    for doc_no in itertools.count(1):
+        if len(records) >= n_chunks:
+            break
+        category = DOC_CATEGORIES[doc_no % len(DOC_CATEGORIES)]
+        field = FIELDS[doc_no % len(FIELDS)]
+        doc_id = f"{category}-{doc_no:05d}"
+        title = {
+            "luat": f"Luật số {doc_no}/2023/QH15",
+            "nghi_dinh": f"Nghị định số {doc_no}/2024/NĐ-CP",
+            "thong_tu": f"Thông tư số {doc_no}/2024/TT-BXD",
+        }[category]
+
+        for article in range(1, articles_per_doc + 1):
+            if len(records) >= n_chunks:
+                break
+            topic = rnd.choice(topic_keys)
+            spec = TOPICS[topic]
+            article_no = f"Điều {article}"
+            for part in range(chunks_per_article):
+                if len(records) >= n_chunks:
+                    break
+                sentences = []
+                for _ in range(rnd.randint(2, 4)):
+                    sentence = rnd.choice(spec["phrases"])
+                    if rnd.random() < 0.5:
+                        sentence += " " + rnd.choice(_FILLER)
+                    sentences.append(sentence[0].upper() + sentence[1:] + ".")
+                text = " ".join(sentences)
+                records.append({
+                    "doc_id": doc_id,
+                    "chunk_id": f"{doc_id}-a{article:03d}-c{part}",
+                    "source_type": "legal",
+                    "doc_category": category,
+                    "field": field,
+                    "title": title,
+                    "article_no": article_no,
+                    "article_title": spec["article_title"],
+                    "topic": topic,
+                    "text": text,
+                    "embedding": [
+                        round(x, 6) for x in text_embedding(f"{title} {spec['article_title']} {text}", dim)
+                    ],
+                })
+
+    return records
+
+
+def make_synthetic_templates(n_templates: int = 3) -> List[Dict[str, Any]]:
+    """
+    Template metadata (schema của template_metadata.jsonl) + nội dung text mẫu.
+    Key "raw_text" chỉ dùng để seed S3, không được ghi vào metadata.
+    """
+    kinds = [
+        ("hop_dong_thue_nha", "Hợp đồng thuê nhà ở"),
+        ("hop_dong_mua_ban_nha_dat", "Hợp đồng mua bán nhà đất"),
+        ("hop_dong_dat_coc", "Hợp đồng đặt cọc"),
+        ("hop_dong_thi_cong", "Hợp đồng thi công xây dựng"),
+    ]
+    templates = []
+    for i in range(n_templates):
+        template_type, title = kinds[i % len(kinds)]
+        doc_id = f"tpl-{i + 1:03d}"
+        raw_text = "\n\n".join([
+            "CỘNG HÒA XÃ HỘI CHỦ NGHĨA VIỆT NAM\nĐộc lập - Tự do - Hạnh phúc",
+            title.upper(),
+            "BÊN A: ..................................................",
+            "BÊN B: ..................................................",
+            "Điều 1. Đối tượng của hợp đồng\n..........................",
+            "Điều 2. Giá và phương thức thanh toán\n..........................",
+            "Điều 3. Quyền và nghĩa vụ của các bên\n..........................",
+            "Điều 4. Giải quyết tranh chấp\n..........................",
+            "ĐẠI DIỆN BÊN A                    ĐẠI DIỆN BÊN B",
+        ])
+        templates.append({
+            "doc_id": doc_id,
+            "source_type": "template",
+            "template_type": template_type,
+            "title": title,
+            "source_raw_path": f"templates/raw/{doc_id}.txt",
+            "raw_text": raw_text,
+        })
+    return templates
+
+
+def records_to_jsonl(records: List[Dict[str, Any]]) -> bytes:
+    return "\n".join(json.dumps(r, ensure_ascii=False) for r in records).encode("utf-8") + b"\n"
+
+
+# -----------------------------------------------------------------------------
+# Fake S3
+# -----------------------------------------------------------------------------
+
+def _client_error(code: str, message: str, operation: str) -> ClientError:
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+class FakeStreamingBody:
+    """Giống botocore StreamingBody ở các method mà Lambda dùng."""
+
+    def __init__(self, data: bytes):
+        self._stream = io.BytesIO(data)
+
+    def read(self, amt: Optional[int] = None) -> bytes:
+        return self._stream.read() if amt is None else self._stream.read(amt)
+
+    def iter_lines(self, chunk_size: int = 1024, keepends: bool = False) -> Iterator[bytes]:
+        for line in self._stream.read().splitlines(keepends):
+            yield line
+
+    def iter_chunks(self, chunk_size: int = 1024) -> Iterator[bytes]:
+        while True:
+            chunk = self._stream.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self) -> None:
+        self._stream.close()
+
+
+class FakeS3:
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        self.objects: Dict[tuple, Dict[str, Any]] = {}
+        self.calls: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _tick(self, op: str) -> None:
+        with self._lock:
+            self.calls[op] = self.calls.get(op, 0) + 1
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000.0)
+
+    def put_object(self, Bucket: str, Key: str, Body: Any = b"", **kwargs) -> Dict[str, Any]:
+        self._tick("put_object")
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        elif hasattr(Body, "read"):
+            Body = Body.read()
+        etag = '"%08x"' % zlib.crc32(Body)
+        with self._lock:
+            self.objects[(Bucket, Key)] = {
+                "Body": bytes(Body),
+                "ContentType": kwargs.get("ContentType"),
+                "ContentEncoding": kwargs.get("ContentEncoding"),
+                "Metadata": kwargs.get("Metadata") or {},
+                "ETag": etag,
+                "LastModified": time.time(),
+            }
+        return {"ETag": etag}
+
+    def get_object(self, Bucket: str, Key: str, **kwargs) -> Dict[str, Any]:
+        self._tick("get_object")
+        obj = self.objects.get((Bucket, Key))
+        if obj is None:
+            raise _client_error("NoSuchKey", f"s3://{Bucket}/{Key} not found", "GetObject")
+        return {
+            "Body": FakeStreamingBody(obj["Body"]),
+            "ContentLength": len(obj["Body"]),
+            "ContentType": obj["ContentType"],
+            "ContentEncoding": obj["ContentEncoding"],
+            "Metadata": dict(obj["Metadata"]),
+            "ETag": obj["ETag"],
+        }
+
+    def head_object(self, Bucket: str, Key: str, **kwargs) -> Dict[str, Any]:
+        self._tick("head_object")
+        obj = self.objects.get((Bucket, Key))
+        if obj is None:
+            raise _client_error("404", "Not Found", "HeadObject")
+        return {"ContentLength": len(obj["Body"]), "ETag": obj["ETag"], "Metadata": dict(obj["Metadata"])}
+
+    def delete_object(self, Bucket: str, Key: str, **kwargs) -> Dict[str, Any]:
+        self._tick("delete_object")
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = "", **kwargs) -> Dict[str, Any]:
+        self._tick("list_objects_v2")
+        keys = sorted(k for (b, k) in self.objects if b == Bucket and k.startswith(Prefix))
+        contents = [
+            {"Key": k, "Size": len(self.objects[(Bucket, k)]["Body"]), "ETag": self.objects[(Bucket, k)]["ETag"]}
+            for k in keys
+        ]
+        return {"Contents": contents, "KeyCount": len(contents), "IsTruncated": False}
+
+    def generate_presigned_url(self, ClientMethod: str, Params: Dict[str, Any], ExpiresIn: int = 3600, **kwargs) -> str:
+        return (
+            f"https://{Params['Bucket']}.s3.local/{Params['Key']}"
+            f"?X-Amz-Expires={ExpiresIn}&X-Amz-Signature=local"
+        )
+
+
+# -----------------------------------------------------------------------------
+# Fake Bedrock Runtime
+# -----------------------------------------------------------------------------
+
+CANNED_ANALYSIS = {
+    "summary": "Hợp đồng thuê nhà giữa Bên A và Bên B, thời hạn 12 tháng.",
+    "overall_risk_level": "MEDIUM",
+    "risk_items": [
+        {
+            "id": "R1",
+            "title": "Mức phạt vi phạm vượt giới hạn",
+            "clause_excerpt": "Bên vi phạm chịu phạt 20% giá trị hợp đồng.",
+            "risk_types": ["LegalCompliance", "Financial"],
+            "severity": "HIGH",
+            "description": "Mức phạt vượt quá mức tối đa theo quy định.",
+            "recommendation": "Điều chỉnh mức phạt không vượt quá 8% giá trị nghĩa vụ bị vi phạm.",
+            "law_references": [
+                {"law_name": "Luật Thương mại 2005", "article": "Điều 301", "clause": "", "note": ""}
+            ],
+        }
+    ],
+    "disclaimer": "Kết quả chỉ mang tính tham khảo, không thay thế tư vấn của luật sư.",
+}
+
+CANNED_CONTRACT = "\n\n".join([
+    "CỘNG HÒA XÃ HỘI CHỦ NGHĨA VIỆT NAM\nĐộc lập - Tự do - Hạnh phúc",
+    "HỢP ĐỒNG THUÊ NHÀ Ở",
+    "Điều 1. Đối tượng của hợp đồng\nBên A đồng ý cho Bên B thuê căn hộ theo thông tin tại hợp đồng này.",
+    "Điều 2. Giá thuê và phương thức thanh toán\nGiá thuê được thanh toán hằng tháng bằng chuyển khoản.",
+    "Điều 3. Quyền và nghĩa vụ của các bên\nCác bên thực hiện đúng các cam kết đã thỏa thuận.",
+    "Điều 4. Giải quyết tranh chấp\nTranh chấp được giải quyết bằng thương lượng, nếu không thành thì khởi kiện tại tòa án.",
+])
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 ký tự / token, đủ dùng cho số liệu usage giả lập
+    return max(1, len(text or "") // 4)
+
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    return sum(x * y for x, y in zip(a, b))
+
+
+def rerank_scores(query: str, docs: List[str], dim: int = EMBED_DIM) -> List[float]:
+    """Điểm rerank giả lập: cosine của embedding giả lập, kẹp về [0, 1]."""
+    q = text_embedding(query, dim)
+    return [max(0.0, _cosine(q, text_embedding(d, dim))) for d in docs]
+
+
+def default_converse_responder(request: Dict[str, Any]) -> str:
+    system_text = " ".join(s.get("text", "") for s in request.get("system") or [])
+    user_text = " ".join(
+        c.get("text", "") for m in request.get("messages") or [] for c in m.get("content", []) if isinstance(c, dict)
+    )
+    if "relevance_scores" in user_text:
+        # prompt rerank theo lô của ragsearch: "[i] passage" ... ; query ở dòng thứ 2
+        query = user_text.split("\n", 2)[1] if "\n" in user_text else user_text
+        passages = re.findall(r"^\[(\d+)\] (.*)$", user_text, re.MULTILINE)
+        scores = rerank_scores(query, [p for _, p in passages])
+        return json.dumps({"relevance_scores": [round(10 * s, 2) for s in scores]})
+    if "JSON" in system_text:
+        return json.dumps(CANNED_ANALYSIS, ensure_ascii=False)
+    return CANNED_CONTRACT
+
+
+class FakeBedrockRuntime:
+    """
+    invoke_model: trả embedding deterministic (định dạng Cohere hoặc Titan).
+    converse: trả response dựng sẵn qua `converse_responder(request) -> str`,
+    có độ trễ cấu hình được (cố định + theo số token output).
+    """
+
+    def __init__(
+        self,
+        dim: int = EMBED_DIM,
+        embed_latency_ms: float = 0.0,
+        converse_latency_ms: float = 0.0,
+        converse_ms_per_output_token: float = 0.0,
+        converse_responder: Optional[Callable[[Dict[str, Any]], str]] = None,
+    ):
+        self.dim = dim
+        self.embed_latency_ms = embed_latency_ms
+        self.converse_latency_ms = converse_latency_ms
+        self.converse_ms_per_output_token = converse_ms_per_output_token
+        self.converse_responder = converse_responder or default_converse_responder
+        self.calls: Dict[str, int] = {}
+        self.requests: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def _tick(self, op: str, request: Dict[str, Any]) -> None:
+        with self._lock:
+            self.calls[op] = self.calls.get(op, 0) + 1
+            self.requests.append({"op": op, **request})
+            del self.requests[:-100]
+
+    def invoke_model(self, modelId: str, body: Any, **kwargs) -> Dict[str, Any]:
+        payload = json.loads(body)
+        self._tick("invoke_model", {"modelId": modelId, "body": payload})
+        if self.embed_latency_ms:
+            time.sleep(self.embed_latency_ms / 1000.0)
+
+        if "rerank" in modelId:
+            docs = payload.get("documents") or []
+            scores = rerank_scores(payload.get("query") or "", docs, self.dim)
+            order = sorted(range(len(docs)), key=lambda i: scores[i], reverse=True)[: payload.get("top_n") or len(docs)]
+            out = {"results": [{"index": i, "relevance_score": scores[i]} for i in order]}
+        elif modelId.startswith("cohere.embed-"):
+            out = {"embeddings": [text_embedding(t, self.dim) for t in payload.get("texts") or []]}
+        elif "embed" in modelId:
+            out = {"embedding": text_embedding(payload.get("inputText") or "", self.dim)}
+        else:
+            raise _client_error("ValidationException", f"Unsupported local model {modelId}", "InvokeModel")
+
+        return {"body": FakeStreamingBody(json.dumps(out).encode("utf-8")), "contentType": "application/json"}
+
+    def converse(self, modelId: str, messages: List[Dict[str, Any]], **kwargs) -> Dict[str, Any]:
+        request = {"modelId": modelId, "messages": messages, **kwargs}
+        self._tick("converse", request)
+
+        text = self.converse_responder(request)
+        input_text = " ".join(
+            c.get("text", "") for m in messages for c in m.get("content", []) if isinstance(c, dict)
+        ) + " ".join(s.get("text", "") for s in kwargs.get("system") or [])
+        in_tokens = estimate_tokens(input_text)
+        out_tokens = estimate_tokens(text)
+
+        latency_ms = self.converse_latency_ms + self.converse_ms_per_output_token * out_tokens
+        if latency_ms:
+            time.sleep(latency_ms / 1000.0)
+
+        # toolConfig: responder trả JSON object -> block toolUse như Bedrock thật
+        content, stop_reason = [{"text": text}], "end_turn"
+        tools = (kwargs.get("toolConfig") or {}).get("tools") or []
+        if tools:
+            try:
+                tool_input = json.loads(text)
+            except ValueError:
+                tool_input = None
+            if isinstance(tool_input, dict):
+                content = [{"toolUse": {
+                    "toolUseId": uuid.uuid4().hex[:12],
+                    "name": tools[0]["toolSpec"]["name"],
+                    "input": tool_input,
+                }}]
+                stop_reason = "tool_use"
+
+        return {
+            "output": {"message": {"role": "assistant", "content": content}},
+            "stopReason": stop_reason,
+            "usage": {"inputTokens": in_tokens, "outputTokens": out_tokens, "totalTokens": in_tokens + out_tokens},
+            "metrics": {"latencyMs": int(latency_ms)},
+        }
+
+
+# -----------------------------------------------------------------------------
+# Fake Lambda
+# -----------------------------------------------------------------------------
+
+class FakeLambdaContext:
+    def __init__(self, function_name: str = "local", memory_limit_in_mb: int = 1024, timeout_s: float = 29.0):
+        self.function_name = function_name
+        self.memory_limit_in_mb = memory_limit_in_mb
+        self.aws_request_id = str(uuid.uuid4())
+        self.invoked_function_arn = f"arn:aws:lambda:local:000000000000:function:{function_name}"
+        self._deadline = time.monotonic() + timeout_s
+
+    def get_remaining_time_in_millis(self) -> int:
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+
+class FakeLambdaClient:
+    """lambda_client.invoke chạy handler đã đăng ký ngay trong process."""
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        self.handlers: Dict[str, Callable[[Dict[str, Any], Any], Any]] = {}
+        self.calls: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def register(self, function_name: str, handler: Callable[[Dict[str, Any], Any], Any]) -> None:
+        self.handlers[function_name] = handler
+
+    def invoke(self, FunctionName: str, InvocationType: str = "RequestResponse", Payload: Any = b"{}", **kwargs):
+        with self._lock:
+            self.calls[FunctionName] = self.calls.get(FunctionName, 0) + 1
+        handler = self.handlers.get(FunctionName)
+        if handler is None:
+            raise _client_error("ResourceNotFoundException", f"Function not found: {FunctionName}", "Invoke")
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000.0)
+
+        if isinstance(Payload, (bytes, bytearray)):
+            Payload = Payload.decode("utf-8")
+        event = json.loads(Payload or "{}")
+
+        if InvocationType == "Event":
+            threading.Thread(
+                target=handler, args=(event, FakeLambdaContext(FunctionName)), daemon=True
+            ).start()
+            return {"StatusCode": 202, "Payload": FakeStreamingBody(b"")}
+
+        try:
+            result = handler(event, FakeLambdaContext(FunctionName))
+        except Exception as e:  # giống Lambda: lỗi không bắt được -> FunctionError
+            err = {"errorMessage": str(e), "errorType": type(e).__name__}
+            return {
+                "StatusCode": 200,
+                "FunctionError": "Unhandled",
+                "Payload": FakeStreamingBody(json.dumps(err).encode("utf-8")),
+            }
+        return {"StatusCode": 200, "Payload": FakeStreamingBody(json.dumps(result, ensure_ascii=False).encode("utf-8"))}
+
+
+# -----------------------------------------------------------------------------
+# Stack: env + import Lambda modules với client giả
+# -----------------------------------------------------------------------------
+
+_load_counter = itertools.count(1)
+
+
+class LocalAwsStack:
+    def __init__(
+        self,
+        dim: int = EMBED_DIM,
+        embed_latency_ms: float = 0.0,
+        converse_latency_ms: float = 0.0,
+        converse_ms_per_output_token: float = 0.0,
+        s3_latency_ms: float = 0.0,
+        lambda_latency_ms: float = 0.0,
+        converse_responder: Optional[Callable[[Dict[str, Any]], str]] = None,
+        env: Optional[Dict[str, str]] = None,
+    ):
+        self.env = dict(DEFAULT_ENV)
+        self.env.update(env or {})
+        self.s3 = FakeS3(latency_ms=s3_latency_ms)
+        self.bedrock = FakeBedrockRuntime(
+            dim=dim,
+            embed_latency_ms=embed_latency_ms,
+            converse_latency_ms=converse_latency_ms,
+            converse_ms_per_output_token=converse_ms_per_output_token,
+            converse_responder=converse_responder,
+        )
+        self.lambda_client = FakeLambdaClient(latency_ms=lambda_latency_ms)
+
+    def seed_legal_index(self, records: List[Dict[str, Any]], key: Optional[str] = None) -> str:
+        key = key or self.env["LEGAL_INDEX_KEY"]
+        self.s3.put_object(Bucket=self.env["LEGAL_INDEX_BUCKET"], Key=key, Body=records_to_jsonl(records))
+        return key
+
+    def seed_templates(self, templates: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+        templates = templates if templates is not None else make_synthetic_templates()
+        bucket = self.env["TEMPLATE_BUCKET"]
+        metadata = []
+        for tpl in templates:
+            tpl = dict(tpl)
+            raw_text = tpl.pop("raw_text", "")
+            if raw_text and tpl.get("source_raw_path"):
+                self.s3.put_object(Bucket=bucket, Key=tpl["source_raw_path"], Body=raw_text.encode("utf-8"))
+            metadata.append(tpl)
+        self.s3.put_object(Bucket=bucket, Key=self.env["TEMPLATE_METADATA_KEY"], Body=records_to_jsonl(metadata))
+        return metadata
+
+    def load(self, kind: str, env: Optional[Dict[str, str]] = None, register_as: Optional[str] = None):
+        """
+        Import một bản mới của Lambda `kind` (ragsearch | callllm | generate_contract)
+        với env của stack và client giả. Mỗi lần gọi là một "cold start" mới.
+        """
+        if kind not in LAMBDA_FILES:
+            raise ValueError(f"Unknown lambda kind '{kind}'. Allowed: {sorted(LAMBDA_FILES)}")
+
+        os.environ.update(self.env)
+        os.environ.update(env or {})
+
+        path = os.path.join(AI_SERVICES_DIR, LAMBDA_FILES[kind])
+        module_name = f"local_{kind}_{next(_load_counter)}"
+        spec = importlib.util.spec_from_file_location(module_name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+
+        for attr, fake in (("s3", self.s3), ("bedrock", self.bedrock), ("lambda_client", self.lambda_client)):
+            if hasattr(module, attr):
+                setattr(module, attr, fake)
+
+        name = register_as or (self.env["RAG_FUNCTION_NAME"] if kind == "ragsearch" else kind)
+        self.lambda_client.register(name, module.lambda_handler)
+        return module
+
+
+def api_event(body: Dict[str, Any]) -> Dict[str, Any]:
+    """Event dạng API Gateway HTTP API (body là string JSON)."""
+    return {"body": json.dumps(body, ensure_ascii=False), "isBase64Encoded": False}
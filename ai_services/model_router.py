@@ -0,0 +1,269 @@
+"""
+Chọn model (tier) và maxTokens cho mỗi lời gọi Converse theo kích thước input,
+loại tác vụ (mode) và SLO latency, dựa trên thống kê latency / token mà process
+tự đo được. Dùng chung cho callllm (phân tích) và generator (soạn thảo); file này
+phải được đóng gói cùng cả hai Lambda.
+
+ENV:
+  MODEL_TIERS   JSON list các tier từ nhỏ -> lớn, ví dụ
+      [{"name": "fast", "model_id": "anthropic.claude-3-haiku-20240307-v1:0",
+        "max_output_tokens": 4096, "input_price": 0.00025, "output_price": 0.00125},
+       {"name": "strong", "model_id": "anthropic.claude-3-5-sonnet-20240620-v1:0",
+        "max_output_tokens": 8192, "input_price": 0.003, "output_price": 0.015,
+        "base_latency_ms": 1500, "ms_per_output_token": 35}]
+      (price: USD / 1K token). Mặc định: tier "default" = MODEL_ID của Lambda,
+      thêm tier "large" nếu có LARGE_MODEL_ID.
+  ROUTER_LARGE_INPUT_TOKENS  input từ ngưỡng này đi thẳng tier lớn nhất (mặc định 12000)
+  ROUTER_LATENCY_SLO_MS      SLO mặc định cho một request (0 = không giới hạn)
+  ROUTER_ESCALATION          1 (mặc định) / 0: gọi lại tier lớn hơn khi kết quả low-confidence
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+# Ước lượng output khi chưa có số liệu đo: output ~ ratio * input
+DEFAULT_OUTPUT_RATIO = {"analysis": 0.35, "drafting": 1.2, "gap_fill": 0.5, "repair": 1.0}
+DEFAULT_BASE_LATENCY_MS = 800.0
+DEFAULT_MS_PER_OUTPUT_TOKEN = 15.0
+MIN_MAX_TOKENS = 2048
+STATS_WINDOW = 100
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    pos = min(len(ordered) - 1, max(0, int(math.ceil(pct / 100.0 * len(ordered))) - 1))
+    return ordered[pos]
+
+
+class ModelStats:
+    """
+    Cửa sổ trượt các lời gọi gần nhất:
+      - theo model: (output tokens, latency ms) -> fit latency = base + k * output_tokens
+      - theo mode: (input tokens, output tokens) -> dự đoán độ dài output
+    """
+
+    def __init__(self, window: int = STATS_WINDOW):
+        self._lock = threading.Lock()
+        self._latency: Dict[str, deque] = {}
+        self._tokens: Dict[str, deque] = {}
+        self._window = window
+
+    def observe(self, model_id: str, mode: str, input_tokens: int, output_tokens: int, latency_ms: float) -> None:
+        with self._lock:
+            self._latency.setdefault(model_id, deque(maxlen=self._window)).append((output_tokens, latency_ms))
+            if input_tokens > 0:
+                self._tokens.setdefault(mode, deque(maxlen=self._window)).append((input_tokens, output_tokens))
+
+    def latency_model(self, model_id: str) -> Optional[Tuple[float, float]]:
+        """(base_ms, ms_per_output_token) theo least squares, None nếu chưa đủ mẫu."""
+        with self._lock:
+            samples = list(self._latency.get(model_id) or [])
+        if len(samples) < 3:
+            return None
+        n = float(len(samples))
+        mean_x = sum(x for x, _ in samples) / n
+        mean_y = sum(y for _, y in samples) / n
+        var_x = sum((x - mean_x) ** 2 for x, _ in samples)
+        if var_x <= 0:
+            return 0.0, mean_y / max(mean_x, 1.0)
+        slope = max(0.0, sum((x - mean_x) * (y - mean_y) for x, y in samples) / var_x)
+        return max(0.0, mean_y - slope * mean_x), slope
+
+    def predict_output_tokens(self, mode: str, input_tokens: int) -> int:
+        with self._lock:
+            samples = list(self._tokens.get(mode) or [])
+        if len(samples) < 3:
+            return max(256, int(input_tokens * DEFAULT_OUTPUT_RATIO.get(mode, 0.5)))
+        # p90 của tỉ lệ output/input, không thấp hơn median output đã gặp
+        ratio = _percentile([o / float(i) for i, o in samples], 90)
+        floor = _percentile([o for _, o in samples], 50)
+        return int(max(floor, ratio * input_tokens))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            models = list(self._latency)
+            counts = {m: len(v) for m, v in self._latency.items()}
+        out = {}
+        for m in models:
+            fit = self.latency_model(m)
+            out[m] = {"samples": counts[m]}
+            if fit:
+                out[m].update(base_latency_ms=round(fit[0], 1), ms_per_output_token=round(fit[1], 2))
+        return out
+
+
+class ModelRouter:
+    def __init__(
+        self,
+        tiers: List[Dict[str, Any]],
+        large_input_tokens: int = 12000,
+        default_slo_ms: int = 0,
+        escalation: bool = True,
+        stats: Optional[ModelStats] = None,
+    ):
+        if not tiers:
+            raise RuntimeError("ModelRouter needs at least one tier")
+        self.tiers = tiers
+        self.large_input_tokens = large_input_tokens
+        self.default_slo_ms = default_slo_ms
+        self.escalation = escalation
+        self.stats = stats or ModelStats()
+
+    # --------------------------------------------------------------
+    # Dự đoán
+    # --------------------------------------------------------------
+
+    def predict_latency_ms(self, tier_idx: int, output_tokens: int) -> float:
+        tier = self.tiers[tier_idx]
+        fit = self.stats.latency_model(tier["model_id"])
+        if fit is None:
+            fit = (
+                float(tier.get("base_latency_ms", DEFAULT_BASE_LATENCY_MS)),
+                float(tier.get("ms_per_output_token", DEFAULT_MS_PER_OUTPUT_TOKEN)),
+            )
+        return fit[0] + fit[1] * output_tokens
+
+    def estimate_cost(self, tier_idx: int, input_tokens: int, output_tokens: int) -> Optional[float]:
+        tier = self.tiers[tier_idx]
+        if tier.get("input_price") is None or tier.get("output_price") is None:
+            return None
+        return round(
+            input_tokens / 1000.0 * float(tier["input_price"]) + output_tokens / 1000.0 * float(tier["output_price"]),
+            6,
+        )
+
+    def _decision(self, tier_idx: int, mode: str, input_tokens: int, out_tokens: int,
+                  reason: str, slo_ms: int, max_tokens: Optional[int] = None) -> Dict[str, Any]:
+        tier = self.tiers[tier_idx]
+        cap = int(tier.get("max_output_tokens", 4096))
+        if max_tokens is None:
+            # dư 30% + 256 so với dự đoán; bị cắt (stopReason=max_tokens) thì escalate
+            max_tokens = int(out_tokens * 1.3) + 256
+        return {
+            "tier": tier.get("name", str(tier_idx)),
+            "tier_index": tier_idx,
+            "model_id": tier["model_id"],
+            "mode": mode,
+            "max_tokens": max(MIN_MAX_TOKENS, min(cap, max_tokens)),
+            "reason": reason,
+            "input_tokens": input_tokens,
+            "predicted_output_tokens": out_tokens,
+            "predicted_latency_ms": round(self.predict_latency_ms(tier_idx, out_tokens), 1),
+            "estimated_cost_usd": self.estimate_cost(tier_idx, input_tokens, out_tokens),
+            "slo_ms": slo_ms or None,
+        }
+
+    # --------------------------------------------------------------
+    # Routing
+    # --------------------------------------------------------------
+
+    def route(self, mode: str, input_tokens: int, slo_ms: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Tier mặc định là tier nhỏ nhất; input lớn (>= large_input_tokens) đi thẳng
+        tier lớn nhất. Nếu tier đó dự đoán vượt SLO thì lùi về tier lớn nhất còn
+        trong SLO (hoặc tier nhanh nhất nếu không tier nào đạt).
+        """
+        slo = self.default_slo_ms if slo_ms is None else int(slo_ms)
+        out_tokens = self.stats.predict_output_tokens(mode, input_tokens)
+
+        idx, reason = 0, "default"
+        if len(self.tiers) > 1 and input_tokens >= self.large_input_tokens:
+            idx, reason = len(self.tiers) - 1, "input_size"
+
+        if slo and self.predict_latency_ms(idx, out_tokens) > slo:
+            within = [i for i in range(idx + 1) if self.predict_latency_ms(i, out_tokens) <= slo]
+            if within:
+                idx = within[-1]
+            else:
+                idx = min(range(len(self.tiers)), key=lambda i: self.predict_latency_ms(i, out_tokens))
+            reason = "latency_slo"
+
+        return self._decision(idx, mode, input_tokens, out_tokens, reason, slo)
+
+    def escalate(self, decision: Dict[str, Any], why: str, elapsed_ms: float) -> Optional[Dict[str, Any]]:
+        """
+        Decision cho lần gọi lại khi kết quả low-confidence (why): tier lớn hơn kế
+        tiếp; nếu đã là tier lớn nhất và output bị cắt thì thử lại với maxTokens tối đa.
+        None nếu tắt escalation, hết lựa chọn hoặc lần gọi lại sẽ vượt SLO.
+        """
+        if not self.escalation:
+            return None
+        idx = decision["tier_index"]
+        out_tokens = decision["predicted_output_tokens"]
+        if why == "truncated":
+            out_tokens = max(out_tokens, decision["max_tokens"])
+
+        if idx + 1 < len(self.tiers):
+            nxt = self._decision(idx + 1, decision["mode"], decision["input_tokens"], out_tokens,
+                                 f"escalated:{why}", decision["slo_ms"])
+        elif why == "truncated" and decision["max_tokens"] < int(self.tiers[idx].get("max_output_tokens", 4096)):
+            nxt = self._decision(idx, decision["mode"], decision["input_tokens"], out_tokens,
+                                 f"retry:{why}", decision["slo_ms"],
+                                 max_tokens=int(self.tiers[idx].get("max_output_tokens", 4096)))
+        else:
+            return None
+
+        if decision["slo_ms"] and elapsed_ms + nxt["predicted_latency_ms"] > decision["slo_ms"]:
+            return None
+        return nxt
+
+    # --------------------------------------------------------------
+    # Gọi model + đo
+    # --------------------------------------------------------------
+
+    def converse(self, client, decision: Dict[str, Any], **kwargs) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        client.converse với modelId / maxTokens của decision; ghi nhận latency +
+        usage vào thống kê. Trả về (response, attempt).
+        """
+        kwargs["inferenceConfig"] = {**(kwargs.get("inferenceConfig") or {}), "maxTokens": decision["max_tokens"]}
+        started = time.perf_counter()
+        response = client.converse(modelId=decision["model_id"], **kwargs)
+        latency_ms = (time.perf_counter() - started) * 1000.0
+
+        usage = response.get("usage") or {}
+        in_tokens = int(usage.get("inputTokens") or decision["input_tokens"])
+        out_tokens = int(usage.get("outputTokens") or 0)
+        self.stats.observe(decision["model_id"], decision["mode"], in_tokens, out_tokens, latency_ms)
+        attempt = {
+            "tier": decision["tier"],
+            "model_id": decision["model_id"],
+            "max_tokens": decision["max_tokens"],
+            "reason": decision["reason"],
+            "latency_ms": round(latency_ms, 1),
+            "input_tokens": in_tokens,
+            "output_tokens": out_tokens,
+            "stop_reason": response.get("stopReason"),
+        }
+        return response, attempt
+
+
+def tiers_from_env(default_model_id: str) -> List[Dict[str, Any]]:
+    raw = os.getenv("MODEL_TIERS")
+    if raw:
+        tiers = json.loads(raw)
+        if not isinstance(tiers, list) or not all(isinstance(t, dict) and t.get("model_id") for t in tiers):
+            raise RuntimeError("MODEL_TIERS must be a JSON list of objects with model_id")
+        return tiers
+    tiers = [{"name": "default", "model_id": default_model_id, "max_output_tokens": 4096}]
+    if os.getenv("LARGE_MODEL_ID"):
+        tiers.append({
+            "name": "large",
+            "model_id": os.getenv("LARGE_MODEL_ID"),
+            "max_output_tokens": int(os.getenv("LARGE_MODEL_MAX_OUTPUT_TOKENS", "8192")),
+        })
+    return tiers
+
+
+def from_env(default_model_id: str) -> ModelRouter:
+    return ModelRouter(
+        tiers_from_env(default_model_id),
+        large_input_tokens=int(os.getenv("ROUTER_LARGE_INPUT_TOKENS", "12000")),
+        default_slo_ms=int(os.getenv("ROUTER_LATENCY_SLO_MS", "0")),
+        escalation=os.getenv("ROUTER_ESCALATION", "1") == "1",
+    )
@@ -0,0 +1,364 @@
+"""
+Replay event đã capture (xem event_capture.py) vào ba lambda_handler chạy với
+local stand-ins (local_aws_stubs.py), để thử tải một build mới theo đúng nhịp
+traffic production.
+
+  - Giữ khoảng cách thời gian giữa các event (chia cho --speedup; 0 = bắn liên tục).
+  - Mỗi function có một pool "container": container rảnh được dùng lại, không có
+    thì cold start (import lại file Lambda, cache rỗng). Container rảnh quá
+    --idle-timeout-s (tính theo thời gian của trace) bị thu hồi như Lambda thật.
+    lambda_client.invoke lồng nhau (callllm / generator -> ragsearch, worker
+    job async) cũng đi qua pool.
+  - Báo cáo theo function và tổng: throughput, p50/p95/p99/max latency, tỉ lệ
+    lỗi (5xx / exception), tỉ lệ 4xx, số cold start; --save / --compare như
+    benchmark_handlers.py (exit 1 nếu có regression).
+
+Ví dụ:
+
+    # Export log group (CloudWatch) hoặc file EVENT_CAPTURE_FILE
+    python replay_traffic.py captured.jsonl --concurrency 16 --speedup 10 --save replay_base.json
+    python replay_traffic.py captured.jsonl --concurrency 16 --speedup 10 --compare replay_base.json
+
+    # Không có capture: traffic tổng hợp (Poisson, trộn ba function)
+    python replay_traffic.py --synthetic 300 --rate 20 --speedup 0
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+import benchmark_handlers as bench
+import event_capture
+import local_aws_stubs as stubs
+
+FUNCTIONS = list(stubs.LAMBDA_FILES)
+
+# (metric, True nếu lớn hơn là tệ hơn); error_rate so sánh tuyệt đối (--error-tolerance)
+COMPARED_METRICS: List[Tuple[str, bool]] = [
+    ("p50_ms", True),
+    ("p95_ms", True),
+    ("p99_ms", True),
+    ("throughput_rps", False),
+    ("cold_starts", True),
+]
+
+
+# -----------------------------------------------------------------------------
+# Nguồn event
+# -----------------------------------------------------------------------------
+
+def read_capture(paths: List[str]) -> List[Dict[str, Any]]:
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                record = event_capture.parse_capture_line(line)
+                if record is not None:
+                    records.append(record)
+    records.sort(key=lambda r: r.get("ts", 0))
+    return records
+
+
+def synthetic_records(n: int, rate: float, seed: int) -> List[Dict[str, Any]]:
+    """Trộn ~60% tìm kiếm, ~30% phân tích hợp đồng, ~10% sinh hợp đồng; arrival Poisson."""
+    rnd = random.Random(seed)
+    ts = 0.0
+    records = []
+    for i in range(n):
+        ts += rnd.expovariate(rate) * 1000.0 if rate > 0 else 0.0
+        roll = rnd.random()
+        if roll < 0.6:
+            function = "ragsearch"
+            body = {"query": bench.QUERIES[i % len(bench.QUERIES)], "top_k": 8}
+        elif roll < 0.9:
+            function = "callllm"
+            body = {"contract_text": bench.CONTRACT_TEXT}
+        else:
+            function = "generate_contract"
+            body = {"template_id": "tpl-001", "contract_info": {"ben_a": "#" * 14, "gia_thue": "10.000.000"}}
+        records.append({"v": event_capture.FORMAT_VERSION, "ts": int(ts), "function": function,
+                        "source": "api", "event": stubs.api_event(body)})
+    return records
+
+
+# -----------------------------------------------------------------------------
+# Container pool
+# -----------------------------------------------------------------------------
+
+class ContainerPool:
+    """Các module Lambda đã load của một function; một container xử lý một request tại một thời điểm."""
+
+    def __init__(self, stack: stubs.LocalAwsStack, kind: str, load_lock: threading.Lock,
+                 idle_timeout_s: float = 0.0, speedup: float = 1.0):
+        self.stack = stack
+        self.kind = kind
+        self.load_lock = load_lock
+        self.idle_timeout_s = idle_timeout_s
+        self.speedup = speedup
+        self.cold_starts = 0
+        self.expired = 0
+        self.load_ms: List[float] = []
+        self._idle: List[Tuple[Any, float]] = []  # (module, lúc rảnh)
+        self._lock = threading.Lock()
+
+    def _expired(self, idle_since: float) -> bool:
+        if self.idle_timeout_s <= 0 or self.speedup <= 0:
+            return False
+        return (time.monotonic() - idle_since) * self.speedup > self.idle_timeout_s
+
+    def acquire(self) -> Tuple[Any, bool]:
+        with self._lock:
+            while self._idle:
+                module, idle_since = self._idle.pop()
+                if not self._expired(idle_since):
+                    return module, False
+                self.expired += 1
+        # Cold start: load tuần tự (stack.load sửa os.environ); đăng ký dưới tên tạm
+        # để không ghi đè dispatch của pool trong lambda_client
+        t0 = time.perf_counter()
+        with self.load_lock:
+            module = self.stack.load(self.kind, register_as=f"replay-cold-{self.kind}")
+        with self._lock:
+            self.cold_starts += 1
+            self.load_ms.append((time.perf_counter() - t0) * 1000.0)
+        return module, True
+
+    def release(self, module: Any) -> None:
+        with self._lock:
+            self._idle.append((module, time.monotonic()))
+
+    def dispatch(self, event: Dict[str, Any], context: Any) -> Any:
+        module, _ = self.acquire()
+        try:
+            return module.lambda_handler(event, context)
+        finally:
+            self.release(module)
+
+
+# -----------------------------------------------------------------------------
+# Replay
+# -----------------------------------------------------------------------------
+
+def status_of(result: Any) -> int:
+    if isinstance(result, dict) and isinstance(result.get("statusCode"), int):
+        return result["statusCode"]
+    return 200  # invoke trực tiếp trả dict thô
+
+
+def replay(records: List[Dict[str, Any]], pools: Dict[str, ContainerPool],
+           concurrency: int, speedup: float) -> Tuple[List[Dict[str, Any]], float]:
+    filler = stubs.CANNED_CONTRACT
+    samples: List[Dict[str, Any]] = []
+    samples_lock = threading.Lock()
+
+    def run_one(record: Dict[str, Any], due: float) -> None:
+        function = record["function"]
+        pool = pools[function]
+        event = event_capture.restore_event(record, filler)
+        started = time.perf_counter()
+        module, cold = pool.acquire()
+        status, error = 0, None
+        try:
+            result = module.lambda_handler(event, stubs.FakeLambdaContext(function))
+            status = status_of(result)
+        except Exception as e:  # Lambda thật: lỗi không bắt -> 502 ở API Gateway
+            status, error = 502, f"{type(e).__name__}: {e}"
+        finally:
+            pool.release(module)
+        done = time.perf_counter()
+        with samples_lock:
+            samples.append({
+                "function": function,
+                "latency_ms": (done - started) * 1000.0,
+                "queue_ms": max(0.0, (started - due) * 1000.0),
+                "status": status,
+                "cold": cold,
+                "error": error,
+            })
+
+    ts0 = records[0].get("ts", 0) if records else 0
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="replay") as executor:
+        for record in records:
+            offset = (record.get("ts", 0) - ts0) / 1000.0 / speedup if speedup > 0 else 0.0
+            due = wall_start + offset
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(run_one, record, due)
+    return samples, time.perf_counter() - wall_start
+
+
+def summarize(name: str, samples: List[Dict[str, Any]], wall_s: float, cold_starts: int) -> Dict[str, Any]:
+    latencies = sorted(s["latency_ms"] for s in samples)
+    queued = sorted(s["queue_ms"] for s in samples)
+    cold = sorted(s["latency_ms"] for s in samples if s["cold"])
+    n = len(samples)
+    errors = sum(1 for s in samples if s["status"] >= 500)
+    client_errors = sum(1 for s in samples if 400 <= s["status"] < 500)
+    return {
+        "scenario": name,
+        "requests": n,
+        "throughput_rps": round(n / wall_s, 3) if wall_s > 0 else 0.0,
+        "p50_ms": round(bench.percentile(latencies, 50), 3),
+        "p95_ms": round(bench.percentile(latencies, 95), 3),
+        "p99_ms": round(bench.percentile(latencies, 99), 3),
+        "max_ms": round(latencies[-1], 3) if latencies else 0.0,
+        "queue_p95_ms": round(bench.percentile(queued, 95), 3),
+        "error_rate": round(errors / n, 4) if n else 0.0,
+        "client_error_rate": round(client_errors / n, 4) if n else 0.0,
+        "cold_starts": cold_starts,
+        "cold_p50_ms": round(bench.percentile(cold, 50), 3),
+    }
+
+
+def build_results(samples: List[Dict[str, Any]], wall_s: float, pools: Dict[str, ContainerPool]) -> List[Dict[str, Any]]:
+    results = []
+    for function in FUNCTIONS:
+        mine = [s for s in samples if s["function"] == function]
+        if mine or pools[function].cold_starts:
+            results.append(summarize(function, mine, wall_s, pools[function].cold_starts))
+    results.append(summarize("all", samples, wall_s, sum(p.cold_starts for p in pools.values())))
+    return results
+
+
+def format_row(res: Dict[str, Any]) -> str:
+    return (
+        f"{res['scenario']:<18} n={res['requests']:<6} thr={res['throughput_rps']:>8.2f}/s "
+        f"p50={res['p50_ms']:>9.2f}ms p95={res['p95_ms']:>9.2f}ms p99={res['p99_ms']:>9.2f}ms "
+        f"max={res['max_ms']:>9.2f}ms err={res['error_rate']:>6.2%} 4xx={res['client_error_rate']:>6.2%} "
+        f"cold={res['cold_starts']}"
+    )
+
+
+def compare_error_rates(results: List[Dict[str, Any]], baseline: Dict[str, Any], error_tolerance: float) -> List[str]:
+    base_by_name = {r["scenario"]: r for r in baseline.get("results", [])}
+    regressions = []
+    for res in results:
+        base = base_by_name.get(res["scenario"])
+        if not base:
+            continue
+        old, new = base.get("error_rate", 0.0), res["error_rate"]
+        worse = new - old > error_tolerance
+        line = f"{res['scenario']:<20} {'error_rate':<15} {old:>10} -> {new:>10} ({new - old:+.2%}) {'REGRESSION' if worse else 'ok'}"
+        print(line)
+        if worse:
+            regressions.append(line)
+    return regressions
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("captures", nargs="*", help="file JSONL capture hoặc log export chứa dòng EVENT_CAPTURE")
+    parser.add_argument("--synthetic", type=int, default=0, help="không có capture: sinh N event tổng hợp")
+    parser.add_argument("--rate", type=float, default=10.0, help="req/s của traffic tổng hợp (thời gian trace)")
+    parser.add_argument("--functions", default=",".join(FUNCTIONS), help="chỉ replay các function này")
+    parser.add_argument("--limit", type=int, default=0, help="chỉ replay N event đầu")
+    parser.add_argument("--concurrency", type=int, default=8, help="số request chạy đồng thời tối đa")
+    parser.add_argument("--speedup", type=float, default=1.0, help="nén thời gian trace (10 = nhanh gấp 10); 0 = không chờ")
+    parser.add_argument("--idle-timeout-s", type=float, default=0.0,
+                        help="thu hồi container rảnh quá N giây (thời gian trace); 0 = giữ mãi")
+    parser.add_argument("--save", help="ghi báo cáo JSON để so sánh về sau")
+    parser.add_argument("--compare", help="báo cáo JSON của lần chạy trước để so sánh")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="ngưỡng regression latency / throughput / cold start")
+    parser.add_argument("--error-tolerance", type=float, default=0.01, help="ngưỡng tăng tuyệt đối của error_rate")
+
+    local = parser.add_argument_group("local stand-in (không cần AWS)")
+    local.add_argument("--chunks", type=int, default=2000, help="số chunk trong corpus tổng hợp")
+    local.add_argument("--dim", type=int, default=stubs.EMBED_DIM)
+    local.add_argument("--seed", type=int, default=42)
+    local.add_argument("--embed-latency-ms", type=float, default=0.0)
+    local.add_argument("--converse-latency-ms", type=float, default=0.0)
+    local.add_argument("--converse-ms-per-output-token", type=float, default=0.0)
+    local.add_argument("--s3-latency-ms", type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    if not args.captures and not args.synthetic:
+        parser.error("cần file capture hoặc --synthetic N")
+    functions = [f.strip() for f in args.functions.split(",") if f.strip()]
+    unknown = [f for f in functions if f not in FUNCTIONS]
+    if unknown:
+        parser.error(f"unknown functions {unknown}. Allowed: {FUNCTIONS}")
+
+    event_capture.CAPTURE_RATE = 0.0  # không capture lại chính traffic replay
+    records = read_capture(args.captures) if args.captures else synthetic_records(args.synthetic, args.rate, args.seed)
+    records = [r for r in records if r["function"] in functions]
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        print("Không có event nào để replay")
+        return 1
+
+    fingerprint = hashlib.sha1(
+        "\n".join(json.dumps(r["event"], sort_keys=True) for r in records).encode("utf-8")
+    ).hexdigest()[:12]
+    cfg = {
+        "events": len(records),
+        "events_sha": fingerprint,
+        "concurrency": args.concurrency,
+        "speedup": args.speedup,
+        "idle_timeout_s": args.idle_timeout_s,
+        "chunks": args.chunks,
+        "dim": args.dim,
+        "seed": args.seed,
+        "embed_latency_ms": args.embed_latency_ms,
+        "converse_latency_ms": args.converse_latency_ms,
+        "converse_ms_per_output_token": args.converse_ms_per_output_token,
+        "s3_latency_ms": args.s3_latency_ms,
+    }
+
+    stack = bench._stack(cfg)
+    load_lock = threading.Lock()
+    pools = {kind: ContainerPool(stack, kind, load_lock, args.idle_timeout_s, args.speedup) for kind in FUNCTIONS}
+    for kind, pool in pools.items():
+        name = stack.env["RAG_FUNCTION_NAME"] if kind == "ragsearch" else kind
+        stack.lambda_client.register(name, pool.dispatch)
+
+    print(f"Replay {len(records)} event (concurrency={args.concurrency}, speedup={args.speedup or 'max'})", flush=True)
+    samples, wall_s = replay(records, pools, args.concurrency, args.speedup)
+    results = build_results(samples, wall_s, pools)
+    for res in results:
+        print(format_row(res))
+    errors = [s["error"] for s in samples if s["error"]]
+    if errors:
+        print(f"{len(errors)} exception, ví dụ: {errors[0]}")
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "config": cfg,
+        "results": results,
+    }
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Saved report to {args.save}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        base_cfg = baseline.get("config") or {}
+        if any(base_cfg.get(k) != cfg.get(k) for k in ("events_sha", "concurrency", "speedup")):
+            print("[WARN] Lần chạy trước dùng bộ event / concurrency / speedup khác, so sánh chỉ mang tính tham khảo")
+        regressions = bench.compare_to_baseline(results, baseline, args.tolerance, cfg, metrics=COMPARED_METRICS)
+        regressions += compare_error_rates(results, baseline, args.error_tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) vượt ngưỡng")
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.exit(main())
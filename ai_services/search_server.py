@@ -0,0 +1,321 @@
+"""
+Chạy ragsearch như một server HTTP lâu dài (self-hosted) thay vì Lambda.
+
+  - Master load index pháp luật MỘT lần, ghi ma trận embedding ra file float32
+    (vector_matrix.py) rồi fork N worker. Các worker mmap chung file đó (chỉ đọc),
+    nên chỉ có một bản vector trong RAM dù chạy bao nhiêu process.
+  - Trong mỗi worker, các request đồng thời được gộp lô (micro-batching): một
+    lời gọi embed cho nhiều query, một phép nhân ma trận cho nhiều query.
+  - Request / response giống hệt lambda_handler: POST body JSON như event.body
+    của API Gateway, response là statusCode / headers / body của handler.
+    GET /health -> trạng thái worker.
+  - Index đổi trên S3 (base mới / segment mới): master load lại, ghi ma trận mới
+    rồi thay lần lượt các worker (cũng làm khi nhận SIGHUP).
+  - Index tenant, answer cache, rerank cache vẫn theo từng worker như Lambda.
+
+Ví dụ:
+
+    LEGAL_INDEX_BUCKET=... python search_server.py --port 8080 --workers 4
+    # chạy thử với stand-in local, không cần AWS
+    python search_server.py --local --chunks 20000 --port 8080
+    curl -s localhost:8080 -d '{"query": "mức phạt vi phạm hợp đồng", "top_k": 5}'
+"""
+
+import argparse
+import base64
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+import boto3
+
+import fast_json
+from vector_matrix import MicroBatcher, VectorMatrix
+
+logger = logging.getLogger("search_server")
+
+
+# -----------------------------------------------------------------------------
+# Index dùng chung
+# -----------------------------------------------------------------------------
+
+def load_ragsearch(local_cfg: Optional[Dict[str, Any]]):
+    if local_cfg:
+        import local_aws_stubs as stubs
+
+        stack = stubs.LocalAwsStack(dim=local_cfg["dim"], embed_latency_ms=local_cfg["embed_latency_ms"])
+        stack.seed_legal_index(stubs.make_synthetic_corpus(n_chunks=local_cfg["chunks"], dim=local_cfg["dim"]))
+        return stack.load("ragsearch")
+    import lambda_function_ragsearch
+    return lambda_function_ragsearch
+
+
+def share_legal_index(rag, matrix_dir: Optional[str]) -> VectorMatrix:
+    """
+    Load index pháp luật vào rag.INDEX_CACHE rồi thay list vectors bằng ma trận
+    mmap (ghi file trước khi fork). Worker không tự refresh index (ma trận chỉ
+    đọc): master lo việc đó.
+    """
+    rag.load_index_if_needed()
+    matrix = VectorMatrix.write(rag.INDEX_CACHE["vectors"], directory=matrix_dir)
+    rag.INDEX_CACHE["vectors"] = matrix
+    rag.LEGAL_SEGMENT_REFRESH_SECONDS = float("inf")
+    gc.collect()
+    logger.info("Shared %d vectors (dim %d) via %s", len(matrix), matrix.dim, matrix.path)
+    return matrix
+
+
+def current_index_version(rag) -> Optional[str]:
+    """Version index trên S3 (cùng cách tính với apply_legal_segments)."""
+    head = rag.s3.head_object(Bucket=rag.LEGAL_INDEX_BUCKET, Key=rag.LEGAL_INDEX_KEY)
+    etag = (head.get("ETag") or "").strip('"') or None
+    base_seq = (head.get("Metadata") or {}).get(rag.SEGMENT_SEQ_METADATA) or ""
+    seq = None
+    if rag.LEGAL_SEGMENT_PREFIX:
+        layout = rag.list_segment_layout(rag.LEGAL_INDEX_BUCKET, rag.LEGAL_SEGMENT_PREFIX)
+        live = [s for s, _ in layout["segments"] if s > base_seq]
+        seq = live[-1] if live else None
+    return f"{etag}+{seq}" if seq else etag
+
+
+# -----------------------------------------------------------------------------
+# Worker
+# -----------------------------------------------------------------------------
+
+def init_worker_process(rag, local: bool) -> None:
+    """
+    Chạy trong worker ngay sau fork: boto3 client (connection pool, credential
+    refresh) và ThreadPoolExecutor do master tạo không an toàn khi dùng tiếp sau
+    fork -> mỗi worker tạo bản riêng. Stand-in local (--local) giữ client giả.
+    """
+    if not local:
+        rag.s3 = boto3.client("s3", region_name=rag.AWS_REGION)
+        rag.bedrock = boto3.client("bedrock-runtime", region_name=rag.AWS_REGION)
+        rag.lambda_client = boto3.client("lambda", region_name=rag.AWS_REGION)
+    rag.RERANK_EXECUTOR = ThreadPoolExecutor(max_workers=rag.RERANK_EXECUTOR_WORKERS)
+    rag.SHARD_EXECUTOR = ThreadPoolExecutor(max_workers=rag.SHARD_FANOUT_WORKERS)
+
+
+def install_batchers(rag, batch_max: int, batch_wait_ms: float) -> Dict[str, MicroBatcher]:
+    """Gộp lô embed query + cosine giữa các request đồng thời của worker."""
+    embed = MicroBatcher(
+        lambda texts: rag.get_embeddings(texts, input_type="search_query"),
+        max_batch=min(batch_max, rag.EMBED_BATCH_SIZE),
+        max_wait_ms=batch_wait_ms,
+    )
+
+    def get_embedding(text: str) -> List[float]:
+        if not text or not text.strip():
+            raise ValueError("Query text is empty")
+        return embed.submit(text)
+
+    rag.get_embedding = get_embedding
+    matrix: VectorMatrix = rag.INDEX_CACHE["vectors"]
+    matrix.batcher = MicroBatcher(matrix.scores_batch, max_batch=batch_max, max_wait_ms=batch_wait_ms)
+    return {"embed": embed, "score": matrix.batcher}
+
+
+def make_handler(rag, batchers: Dict[str, MicroBatcher]):
+    class SearchHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status: int, headers: Dict[str, str], body: bytes) -> None:
+            self.send_response(status)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/health":
+                self._send(404, {"Content-Type": "application/json"}, b'{"error": "not found"}')
+                return
+            body = {
+                "status": "ok",
+                "pid": os.getpid(),
+                "index_version": rag.INDEX_CACHE.get("version"),
+                "chunks": len(rag.INDEX_CACHE["vectors"]),
+                "index_memory": {
+                    "vectors": rag.INDEX_CACHE["vectors"].describe(),
+                    "vector_bytes": rag.INDEX_CACHE["vectors"].memory_bytes(),
+                    "metadata_bytes": rag.INDEX_CACHE["chunks"].memory_bytes(),
+                },
+                "batching": {name: dict(b.stats) for name, b in batchers.items()},
+            }
+            self._send(200, {"Content-Type": "application/json"}, fast_json.dumps_bytes(body))
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            event = {
+                "httpMethod": "POST",
+                "path": self.path,
+                "headers": dict(self.headers),
+                "body": self.rfile.read(length).decode("utf-8"),
+                "isBase64Encoded": False,
+            }
+            resp = rag.lambda_handler(event, None)
+            body = resp.get("body") or ""
+            data = base64.b64decode(body) if resp.get("isBase64Encoded") else body.encode("utf-8")
+            self._send(resp["statusCode"], resp.get("headers") or {}, data)
+
+        def log_message(self, fmt, *args):
+            logger.debug("%s - %s", self.address_string(), fmt % args)
+
+    return SearchHandler
+
+
+def run_worker(sock: socket.socket, rag, batch_max: int, batch_wait_ms: float, local: bool = False) -> None:
+    init_worker_process(rag, local)
+    batchers = install_batchers(rag, batch_max, batch_wait_ms)
+    httpd = ThreadingHTTPServer(sock.getsockname()[:2], make_handler(rag, batchers), bind_and_activate=False)
+    httpd.socket = sock
+    httpd.daemon_threads = True
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=httpd.shutdown).start())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    httpd.serve_forever()
+
+
+# -----------------------------------------------------------------------------
+# Master (pre-fork + reload)
+# -----------------------------------------------------------------------------
+
+class Master:
+    def __init__(self, rag, sock: socket.socket, args: argparse.Namespace):
+        self.rag = rag
+        self.sock = sock
+        self.args = args
+        self.workers: Dict[int, int] = {}  # pid -> generation
+        self.generation = 0
+        self.matrix: Optional[VectorMatrix] = None
+        self.stopping = False
+        self.reload_requested = False
+
+    def spawn(self) -> int:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(self.sock, self.rag, self.args.batch_max, self.args.batch_wait_ms, local=self.args.local)
+            except Exception:
+                logger.exception("Worker crashed")
+                code = 1
+            finally:
+                os._exit(code)
+        self.workers[pid] = self.generation
+        return pid
+
+    def load(self) -> None:
+        old = self.matrix
+        if old is not None:
+            self.rag.INDEX_CACHE.update(self.rag.load_legal_index())
+        self.matrix = share_legal_index(self.rag, self.args.matrix_dir)
+        self.generation += 1
+        if old is not None:
+            # File cũ: worker thế hệ trước vẫn đang map, xoá tên file là đủ
+            os.unlink(old.path)
+            old.close()
+
+    def replace_workers(self) -> None:
+        old = [pid for pid, gen in self.workers.items() if gen != self.generation]
+        for pid in old:
+            self.spawn()
+            os.kill(pid, signal.SIGTERM)
+        logger.info("Replaced %d workers (index %s)", len(old), self.rag.INDEX_CACHE.get("version"))
+
+    def check_index(self) -> None:
+        try:
+            changed = current_index_version(self.rag) != self.rag.INDEX_CACHE.get("version")
+        except Exception as e:
+            logger.warning("Index version check failed, keeping current index: %s", e)
+            return
+        if changed or self.reload_requested:
+            self.reload_requested = False
+            self.load()
+            self.replace_workers()
+
+    def reap(self) -> None:
+        while self.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            gen = self.workers.pop(pid, None)
+            if gen == self.generation and not self.stopping:
+                logger.warning("Worker %d exited (status %d), restarting", pid, status)
+                self.spawn()
+
+    def run(self) -> None:
+        self.load()
+        for _ in range(self.args.workers):
+            self.spawn()
+        logger.info("Serving on %s:%d with %d workers", *self.sock.getsockname()[:2], self.args.workers)
+
+        def stop(*_):
+            self.stopping = True
+
+        def hup(*_):
+            self.reload_requested = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, hup)
+
+        next_check = time.monotonic() + self.args.refresh_seconds
+        while not self.stopping:
+            time.sleep(0.5)
+            self.reap()
+            if self.reload_requested or (self.args.refresh_seconds and time.monotonic() >= next_check):
+                self.check_index()
+                next_check = time.monotonic() + self.args.refresh_seconds
+
+        for pid in list(self.workers):
+            os.kill(pid, signal.SIGTERM)
+        for pid in list(self.workers):
+            os.waitpid(pid, 0)
+        if self.matrix is not None:
+            os.unlink(self.matrix.path)
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--batch-max", type=int, default=32, help="số query tối đa mỗi lô")
+    parser.add_argument("--batch-wait-ms", type=float, default=2.0, help="chờ gom lô sau query đầu tiên")
+    parser.add_argument("--matrix-dir", help="thư mục ghi file ma trận (mặc định: thư mục tạm)")
+    parser.add_argument("--refresh-seconds", type=float,
+                        default=float(os.getenv("LEGAL_SEGMENT_REFRESH_SECONDS", "60")),
+                        help="chu kỳ kiểm tra index mới trên S3 (0 = chỉ khi SIGHUP)")
+    local = parser.add_argument_group("local stand-in (không cần AWS)")
+    local.add_argument("--local", action="store_true")
+    local.add_argument("--chunks", type=int, default=5000)
+    local.add_argument("--dim", type=int, default=256)
+    local.add_argument("--embed-latency-ms", type=float, default=20.0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(process)d %(levelname)s %(message)s")
+    local_cfg = None
+    if args.local:
+        local_cfg = {"chunks": args.chunks, "dim": args.dim, "embed_latency_ms": args.embed_latency_ms}
+    rag = load_ragsearch(local_cfg)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(1024)
+    Master(rag, sock, args).run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
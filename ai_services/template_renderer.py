@@ -0,0 +1,206 @@
+"""
+Render hợp đồng từ template có slot, không cần model cho phần cố định.
+
+Template là text thuần (file raw trên TEMPLATE_BUCKET), chia thành block theo
+dòng trống. Trong block:
+  {{ten_slot}} / {{ten_slot|mặc định}}  thay bằng contract_info["ten_slot"]
+  "BÊN A: ............"                 dòng nhãn + chỗ trống: thay bằng
+                                        contract_info theo tên nhãn đã chuẩn hoá
+                                        ("ben_a"); không có thì giữ chỗ trống
+  {{ai}} / {{ai: hướng dẫn}}            block do model viết
+  "Điều 5. ...\n.........."             điều khoản chỉ có tiêu đề + chỗ trống:
+                                        model viết nội dung điều khoản
+
+Block cố định render giống hệt nhau giữa các bản nháp (byte-identical); chỉ các
+block "generate" được gửi cho model. Dùng bởi generator; file này phải được đóng
+gói cùng Lambda generate_contract.
+"""
+
+import hashlib
+import re
+import unicodedata
+from typing import Any, Dict, List, Optional
+
+_BLOCK_SPLIT_RE = re.compile(r"\n[ \t]*\n")
+_HEADING_RE = re.compile(r"^[ \t]*(?:Điều|ĐIỀU|Article|ARTICLE)[ \t]+(?:\d+|[IVXLC]+)\b")
+_SLOT_RE = re.compile(r"\{\{\s*([A-Za-z_][\w.]*)\s*(?:\|([^}]*))?\}\}")
+_AI_SLOT_RE = re.compile(r"\{\{\s*ai\s*(?::\s*([^}]*))?\}\}", re.IGNORECASE)
+_BLANK_RE = re.compile(r"[.…_]{6,}")
+_LABEL_LINE_RE = re.compile(r"^(?P<label>[^\n:]{2,60}?)\s*:\s*(?P<blank>[.…_]{6,})\s*$")
+_GAP_MARKER_RE = re.compile(r"^\[(B\d+)\]\s*$", re.MULTILINE)
+
+BLANK = ".............."
+
+
+def slot_key(label: str) -> str:
+    """"BÊN A" -> "ben_a", "Giá thuê" -> "gia_thue"."""
+    text = unicodedata.normalize("NFD", label.replace("đ", "d").replace("Đ", "D"))
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn").lower()
+    return re.sub(r"[^a-z0-9]+", "_", text).strip("_")
+
+
+def _is_blank_body(text: str) -> bool:
+    return bool(text.strip()) and not _BLANK_RE.sub("", text).strip(" \t\n:;,-")
+
+
+# -----------------------------------------------------------------------------
+# Parse
+# -----------------------------------------------------------------------------
+
+def _normalize(text: str) -> str:
+    return (text or "").replace("\r\n", "\n").strip()
+
+
+def template_version(text: str) -> str:
+    return hashlib.sha256(_normalize(text).encode("utf-8")).hexdigest()[:16]
+
+
+def parse_template(text: str) -> Dict[str, Any]:
+    """
+    Template text -> {"version", "blocks": [{"block_id", "kind", "heading", "text",
+    "instruction"}], "structured"}. kind: "fixed" | "generate".
+    structured = có ít nhất một tiêu đề "Điều N" (template dùng được để render).
+    """
+    text = _normalize(text)
+    blocks = []
+    structured = False
+    for raw in _BLOCK_SPLIT_RE.split(text):
+        raw = raw.strip("\n")
+        if not raw.strip():
+            continue
+        first, _, body = raw.partition("\n")
+        heading = first.strip() if _HEADING_RE.match(first) else ""
+        structured = structured or bool(heading)
+
+        kind, instruction = "fixed", ""
+        ai = _AI_SLOT_RE.search(raw)
+        if ai:
+            kind, instruction = "generate", (ai.group(1) or "").strip()
+        elif heading and (not body.strip() or _is_blank_body(body)):
+            kind = "generate"
+
+        blocks.append({
+            "block_id": f"B{len(blocks) + 1}",
+            "kind": kind,
+            "heading": heading,
+            "text": raw,
+            "instruction": instruction,
+        })
+    return {
+        "version": template_version(text),
+        "blocks": blocks,
+        "structured": structured,
+    }
+
+
+# -----------------------------------------------------------------------------
+# Render
+# -----------------------------------------------------------------------------
+
+def _format_value(value: Any) -> str:
+    if isinstance(value, (list, tuple)):
+        return ", ".join(_format_value(v) for v in value)
+    if isinstance(value, dict):
+        return "; ".join(f"{k}: {_format_value(v)}" for k, v in value.items())
+    return str(value).strip()
+
+
+def render_template(parsed: Dict[str, Any], contract_info: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Điền slot vào các block. Trả về {"blocks": [{"block_id", "kind", "heading",
+    "text", "instruction"}], "gaps": [block_id cần model viết], "used_fields",
+    "unused_fields", "unfilled_slots"}. Block "generate" giữ nguyên marker {{ai}}.
+    """
+    by_key = {slot_key(k): k for k in contract_info}
+    used: set = set()
+    unfilled: List[str] = []
+
+    def lookup(name: str) -> Optional[str]:
+        key = name if name in contract_info else by_key.get(slot_key(name))
+        if key is None:
+            return None
+        value = _format_value(contract_info[key])
+        if not value:
+            return None
+        used.add(key)
+        return value
+
+    def fill_slot(m: "re.Match") -> str:
+        if m.group(1).lower() == "ai":
+            return m.group(0)
+        value = lookup(m.group(1))
+        if value is not None:
+            return value
+        if m.group(2) is not None:
+            return m.group(2).strip()
+        unfilled.append(m.group(1))
+        return BLANK
+
+    def fill_line(line: str) -> str:
+        m = _LABEL_LINE_RE.match(line)
+        if not m:
+            return line
+        value = lookup(m.group("label").strip())
+        if value is None:
+            unfilled.append(slot_key(m.group("label")))
+            return line
+        return line[:m.start("blank")] + value
+
+    out = []
+    for b in parsed["blocks"]:
+        text = _SLOT_RE.sub(fill_slot, b["text"])
+        text = "\n".join(fill_line(line) for line in text.split("\n"))
+        out.append({**b, "text": text})
+
+    return {
+        "blocks": out,
+        "gaps": [b["block_id"] for b in out if b["kind"] == "generate"],
+        "used_fields": sorted(used),
+        "unused_fields": sorted(k for k in contract_info if k not in used),
+        "unfilled_slots": unfilled,
+    }
+
+
+# -----------------------------------------------------------------------------
+# Ghép output của model
+# -----------------------------------------------------------------------------
+
+def parse_gap_output(text: str, gap_ids: List[str]) -> Dict[str, str]:
+    """
+    Output model dạng "[B5]\\n<nội dung>\\n\\n[B7]\\n<nội dung>" -> {block_id: nội dung}.
+    Chỉ giữ block_id có trong gap_ids và nội dung không rỗng.
+    """
+    wanted = set(gap_ids)
+    matches = list(_GAP_MARKER_RE.finditer(text or ""))
+    out = {}
+    for i, m in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        body = text[m.end():end].strip()
+        if m.group(1) in wanted and body:
+            out[m.group(1)] = body
+    return out
+
+
+def assemble(rendered: Dict[str, Any], generated: Dict[str, str]) -> str:
+    """
+    Ghép block theo thứ tự template. Block generate: giữ tiêu đề của template +
+    nội dung model viết (bỏ tiêu đề nếu model lặp lại); block chưa có nội dung giữ
+    nguyên text template.
+    """
+    parts = []
+    for b in rendered["blocks"]:
+        body = generated.get(b["block_id"]) if b["kind"] == "generate" else None
+        if body is None:
+            parts.append(b["text"])
+            continue
+        first, _, rest = body.partition("\n")
+        if b["heading"] and _HEADING_RE.match(first):
+            body = rest.strip()
+        if _AI_SLOT_RE.search(b["text"]):
+            # {{ai}} nằm trong block: thay đúng vị trí marker, giữ phần còn lại
+            parts.append(_AI_SLOT_RE.sub(lambda _: body, b["text"], count=1))
+        elif b["heading"]:
+            parts.append(f"{b['heading']}\n{body}")
+        else:
+            parts.append(body)
+    return "\n\n".join(parts)
@@ -0,0 +1,41 @@
+"""
+Test hành vi cho ai_services, chạy trên local_aws_stubs (S3 / Bedrock / Lambda giả),
+không cần AWS thật:
+
+    cd ai_services && python -m pytest -q tests
+"""
+
+import os
+import sys
+
+import pytest
+
+AI_SERVICES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if AI_SERVICES_DIR not in sys.path:
+    sys.path.insert(0, AI_SERVICES_DIR)
+
+import local_aws_stubs as stubs  # noqa: E402
+
+TEST_DIM = 32
+
+
+@pytest.fixture(autouse=True)
+def restore_environ():
+    # LocalAwsStack.load ghi env của Lambda vào os.environ
+    saved = dict(os.environ)
+    yield
+    os.environ.clear()
+    os.environ.update(saved)
+
+
+@pytest.fixture(scope="session")
+def corpus():
+    return stubs.make_synthetic_corpus(n_chunks=300, dim=TEST_DIM)
+
+
+@pytest.fixture
+def stack(corpus):
+    stack = stubs.LocalAwsStack(dim=TEST_DIM)
+    stack.seed_legal_index(corpus)
+    return stack
+
@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+import local_aws_stubs as stubs
+
+QUESTION = "thời hạn thuê nhà tối đa là bao lâu"
+
+
+def invoke(rag, body):
+    resp = rag.lambda_handler(body, None)
+    return resp["statusCode"], json.loads(resp["body"])
+
+
+def store(rag, query, answer="Không giới hạn.", **extra):
+    status, body = invoke(rag, {"action": "answer_cache_store", "query": query, "answer": answer, **extra})
+    assert status == 200 and body["stored"], body
+
+
+def lookup(rag, query, **extra):
+    status, body = invoke(rag, {"query": query, "top_k": 3, "answer_cache": True, **extra})
+    assert status == 200, body
+    return body["answer_cache"]
+
+
+@pytest.fixture
+def rag(stack):
+    return stack.load("ragsearch", env={"LEGAL_SEGMENT_REFRESH_SECONDS": "0"})
+
+
+def test_hit_requires_similarity_above_threshold(rag):
+    store(rag, QUESTION)
+    hit = lookup(rag, QUESTION)
+    assert hit["hit"] and hit["answer"] == "Không giới hạn." and hit["similarity"] == pytest.approx(1.0, abs=1e-4)
+
+    paraphrase = "thời hạn thuê nhà tối đa bao lâu"
+    sim = sum(a * b for a, b in zip(rag.unit_vector(rag.get_embedding(QUESTION)), rag.unit_vector(rag.get_embedding(paraphrase))))
+    assert 0.5 < sim < 0.99
+    assert not lookup(rag, paraphrase, answer_cache={"threshold": sim + 0.01})["hit"]
+    hit = lookup(rag, paraphrase, answer_cache={"threshold": sim - 0.01})
+    assert hit["hit"] and hit["cached_query"] == QUESTION
+    assert not lookup(rag, "phạt vi phạm hợp đồng mua bán hàng hoá")["hit"]
+
+def test_expired_entries_are_dropped(rag, monkeypatch):
+    store(rag, QUESTION)
+    monkeypatch.setattr(rag, "ANSWER_CACHE_TTL_SECONDS", -1)
+    assert not lookup(rag, QUESTION)["hit"]
+    assert not rag.ANSWER_CACHE and rag.ANSWER_CACHE_STATS["expired"] == 1
+
+
+def test_lru_evicts_least_recently_used(rag, monkeypatch):
+    monkeypatch.setattr(rag, "ANSWER_CACHE_SIZE", 2)
+    store(rag, "câu hỏi một")
+    store(rag, "câu hỏi hai")
+    assert lookup(rag, "câu hỏi một")["hit"]  # "một" mới dùng -> "hai" bị đẩy ra trước
+    store(rag, "câu hỏi ba")
+
+    assert rag.ANSWER_CACHE_STATS["evictions"] == 1
+    assert sorted(e["query"] for e in rag.ANSWER_CACHE.values()) == ["câu hỏi ba", "câu hỏi một"]
+
+
+def test_new_legal_segment_invalidates_answers(rag, corpus):
+    store(rag, QUESTION)
+    assert lookup(rag, QUESTION)["hit"]
+
+    rag.write_segment(rag.LEGAL_INDEX_BUCKET, rag.LEGAL_SEGMENT_PREFIX, [dict(corpus[3], doc_id="nd-moi", chunk_id="nd-moi-c0")])
+    assert not lookup(rag, QUESTION)["hit"]
+    assert rag.ANSWER_CACHE_STATS["expired"] == 1
+
+
+def test_legal_scope_does_not_load_tenant_index(rag):
+    invoke(rag, {"action": "index_document", "tenant_id": "u1", "doc_id": "a", "text": "hợp đồng thuê kho"})
+    rag.TENANT_INDEXES.clear()
+    event = stubs.api_event({"query": QUESTION, "top_k": 3, "answer_cache": True})
+    event["requestContext"] = {"authorizer": {"jwt": {"claims": {"sub": "u1"}}}}
+
+    assert rag.lambda_handler(event, None)["statusCode"] == 200
+    assert not rag.TENANT_INDEXES
+
+    # câu trả lời scope "tenant" nằm riêng và mất hiệu lực khi tài liệu tenant đổi
+    store(rag, QUESTION, tenant_id="u1", scope="tenant")
+    assert not lookup(rag, QUESTION, tenant_id="u1")["hit"]
+    assert lookup(rag, QUESTION, tenant_id="u1", scope="tenant")["hit"]
+    invoke(rag, {"action": "index_document", "tenant_id": "u1", "doc_id": "b", "text": "hợp đồng mua xe"})
+    assert not lookup(rag, QUESTION, tenant_id="u1", scope="tenant")["hit"]
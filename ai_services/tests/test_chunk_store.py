@@ -0,0 +1,108 @@
+import json
+
+import pytest
+
+import local_aws_stubs as stubs
+
+
+@pytest.fixture
+def rag(stack):
+    return stack.load("ragsearch")
+
+
+def records():
+    return [
+        {"doc_id": "luat-1", "chunk_id": "luat-1-c0", "source_type": "legal", "doc_category": "luat",
+         "title": "Luật Nhà ở", "article_no": "Điều 1", "text": "Phạm vi điều chỉnh của luật."},
+        {"doc_id": "luat-1", "chunk_id": "luat-1-c1", "source_type": "legal", "doc_category": "luat",
+         "title": "Luật Nhà ở", "article_no": "Điều 2", "text": "Đối tượng áp dụng: tổ chức, cá nhân."},
+        # field mới gặp giữa chừng, giá trị không phải str, giá trị list (extras), không có text
+        {"doc_id": "nd-2", "chunk_id": "nd-2-c0", "source_type": "legal", "doc_category": "nghi_dinh",
+         "year": 2024, "active": True, "tags": ["thuê", "nhà"], "text": "Nghị định hướng dẫn chi tiết."},
+        {"doc_id": 7, "chunk_id": "num-c0", "source_type": "template", "year": 1, "active": 1, "text": None},
+    ]
+
+
+def test_interned_columns_round_trip(rag):
+    store = rag.ChunkStore()
+    for rec in records():
+        store.append(rec)
+    store.finalize()
+
+    assert len(store) == 4
+    for idx, rec in enumerate(records()):
+        assert store.materialize(idx) == {k: v for k, v in rec.items() if v is not None}
+    # giá trị lặp lại chỉ intern một lần; True và 1 không bị gộp thành một mã
+    assert store._values["title"].count("Luật Nhà ở") == 1
+    assert store.get(2, "active") is True and store.get(3, "active") == 1 and store.get(3, "active") is not True
+    assert store.get(2, "year") == 2024 and store.get(0, "year") is None
+    assert store.text(3) == ""
+    assert store.materialize(1, ["title", "text"]) == {"title": "Luật Nhà ở", "text": records()[1]["text"]}
+
+    # append sau finalize (segment mới) vẫn đọc đúng bản cũ lẫn bản mới
+    store.append({"doc_id": "nd-2", "chunk_id": "nd-2-c1", "text": "Điều khoản thi hành."})
+    assert store.materialize(4) == {"doc_id": "nd-2", "chunk_id": "nd-2-c1", "text": "Điều khoản thi hành."}
+    assert store.materialize(0)["text"] == records()[0]["text"]
+
+
+def test_compiled_filters_match_interned_codes(rag):
+    store = rag.ChunkStore()
+    for rec in records():
+        store.append(rec)
+    compiled = store.compile_filters({"source_type": ["legal"], "doc_category": ["luat", "khong_co"]})
+    assert [i for i in range(len(store)) if store.matches(i, compiled)] == [0, 1]
+    compiled = store.compile_filters({"doc_category": ["khong_co"]})
+    assert not [i for i in range(len(store)) if store.matches(i, compiled)]
+
+
+def test_find_uses_postings_and_respects_stop(rag):
+    store = rag.ChunkStore()
+    for rec in records():
+        store.append(rec)
+    assert store.find("doc_id", "luat-1") == [0, 1]
+    assert store.find("doc_id", 7) == [3]
+    assert store.find("doc_id", "7") == []
+    assert store.find("doc_id", "khong_co") == []
+    # postings đã build: append sau đó phải được cập nhật
+    store.append({"doc_id": "luat-1", "chunk_id": "luat-1-c2", "text": "x"})
+    assert store.find("doc_id", "luat-1") == [0, 1, 4]
+    assert store.find("doc_id", "luat-1", stop=4) == [0, 1]
+    assert store.find("chunk_id", "nd-2-c0") == [2]
+
+
+def test_delta_segment_tombstones_and_replaces_chunks(rag):
+    corpus = [dict(r, embedding=[1.0, float(i)]) for i, r in enumerate(records()[:3])]
+    index = {"chunks": rag.ChunkStore(), "vectors": []}
+    rag.read_index_records(stubs.FakeStreamingBody(stubs.records_to_jsonl(corpus)), index)
+
+    delta = [
+        {"op": "delete", "chunk_id": "luat-1-c1"},
+        dict(records()[2], chunk_id="nd-2-c9", text="Bản mới.", embedding=[0.0, 1.0]),
+    ]
+    rag.read_index_records(stubs.FakeStreamingBody(stubs.records_to_jsonl(delta)), index, delta=True)
+
+    assert index["deleted"] == {1, 2}  # chunk bị tombstone + bản cũ của doc được thay
+    live = [index["chunks"].get(i, "chunk_id") for i in range(len(index["chunks"])) if i not in index["deleted"]]
+    assert live == ["luat-1-c0", "nd-2-c9"]
+
+    tombstone = [{"op": "delete", "doc_id": "luat-1"}]
+    rag.read_index_records(stubs.FakeStreamingBody(stubs.records_to_jsonl(tombstone)), index, delta=True)
+    assert index["deleted"] == {0, 1, 2}
+
+
+def test_search_materializes_only_final_top_k(stack, rag, monkeypatch):
+    calls = []
+    original = rag.ChunkStore.materialize
+
+    def counting(self, idx, fields=None):
+        calls.append(idx)
+        return original(self, idx, fields)
+
+    monkeypatch.setattr(rag.ChunkStore, "materialize", counting)
+    resp = rag.lambda_handler({"query": "mức phạt vi phạm hợp đồng", "top_k": 3, "fields": ["chunk_id", "score"]}, None)
+    body = json.loads(resp["body"])
+
+    assert resp["statusCode"] == 200
+    assert len(body["results"]) == 3
+    assert len(calls) == 3
+    assert all(set(r) == {"chunk_id", "score"} for r in body["results"])
@@ -0,0 +1,29 @@
+import itertools
+
+
+def test_failed_save_marks_only_that_draft(stack, monkeypatch):
+    stack.seed_templates()
+    stack.load("ragsearch")
+    gen = stack.load("generate_contract")
+    gen.load_template_metadata_if_needed()
+    template_id = list(gen.TEMPLATE_CACHE["by_id"])[0]
+
+    calls = itertools.count()
+    save = gen.save_generated_to_s3
+
+    def save_once(*args):
+        if next(calls) == 0:
+            raise RuntimeError("s3 unavailable")
+        return save(*args)
+
+    monkeypatch.setattr(gen, "save_generated_to_s3", save_once)
+    drafts = [{"draft_id": "a", "contract_info": {}}, {"draft_id": "b", "contract_info": {}}]
+    status, body = gen.run_generation({"template_id": template_id, "drafts": drafts})
+
+    assert status == 200
+    rows = {r["draft_id"]: r for r in body["drafts"]}
+    failed = [r for r in rows.values() if r["status"] == "error"]
+    assert len(failed) == 1 and "s3 unavailable" in failed[0]["error"]
+    saved = [r for r in rows.values() if r["status"] == "ok"]
+    assert len(saved) == 1 and saved[0]["s3_paths"]
+    assert body["debug"]["drafts_ok"] == 1 and body["debug"]["drafts_failed"] == 1
@@ -0,0 +1,102 @@
+import json
+
+import pytest
+
+CLAUSES = [
+    "Điều 1. Đối tượng của hợp đồng\nBên A cho Bên B thuê kho tại Bình Dương.",
+    "Điều 2. Giá thuê\nGiá thuê là 50.000.000 đồng mỗi tháng.",
+    "Điều 3. Phạt vi phạm\nBên vi phạm chịu phạt 5% giá trị phần nghĩa vụ bị vi phạm.",
+    "Điều 4. Quyền và nghĩa vụ của Bên B\nBên B giữ gìn kho và trả lại khi hết hạn.",
+    "Điều 5. Thời hạn\nThời hạn thuê là 24 tháng.",
+    "Điều 6. Giải quyết tranh chấp\nTranh chấp được giải quyết tại tòa án có thẩm quyền.",
+]
+
+
+def item(title, clause_id="", severity="MEDIUM"):
+    return {
+        "title": title, "clause_id": clause_id, "clause_excerpt": "", "risk_types": ["Financial"],
+        "severity": severity, "description": title + ".", "recommendation": "Sửa lại.", "law_references": [],
+    }
+
+
+@pytest.fixture
+def callllm(stack):
+    stack.load("ragsearch")
+    return stack.load("callllm")
+
+
+@pytest.fixture
+def model(stack):
+    """Responder giả: trả lần lượt các risk_items đã xếp hàng, ghi lại prompt."""
+    state = {"prompts": [], "queue": []}
+
+    def responder(request):
+        state["prompts"].append(" ".join(c["text"] for m in request["messages"] for c in m["content"] if "text" in c))
+        return json.dumps({
+            "summary": "Hợp đồng thuê kho.", "overall_risk_level": "MEDIUM",
+            "risk_items": state["queue"].pop(0), "disclaimer": "Tham khảo.",
+        }, ensure_ascii=False)
+
+    stack.bedrock.converse_responder = responder
+    return state
+
+
+def analyze(callllm, clauses, **extra):
+    body = {"contract_text": "\n\n".join(clauses), "document_id": "hd-1", "tenant_id": "u1", "prescreen": False, **extra}
+    resp = callllm.lambda_handler(body, None)
+    out = json.loads(resp["body"])
+    assert resp["statusCode"] == 200, out
+    return out["analysis"], out["debug"]["incremental"]
+
+
+def assert_merged_schema(callllm, analysis):
+    assert callllm.validate_analysis(analysis) == []
+    assert [i["id"] for i in analysis["risk_items"]] == [f"R{n}" for n in range(1, len(analysis["risk_items"]) + 1)]
+    assert all("clause_id" in i for i in analysis["risk_items"])
+
+
+def test_unchanged_and_edited_clauses_reuse_stored_items(callllm, model):
+    model["queue"] = [[item("Giá thuê chưa gồm thuế", "C2"), item("Thiếu bảo hiểm kho")]]
+    analysis, stats = analyze(callllm, CLAUSES)
+    assert stats["mode"] == "full"
+    assert [(i["clause_id"], i["title"]) for i in analysis["risk_items"]] == [
+        ("C2", "Giá thuê chưa gồm thuế"), ("", "Thiếu bảo hiểm kho"),
+    ]
+    assert_merged_schema(callllm, analysis)
+
+    # không đổi gì -> không gọi model, kết quả y hệt
+    again, stats = analyze(callllm, CLAUSES)
+    assert stats["mode"] == "unchanged" and len(model["prompts"]) == 1
+    assert again["risk_items"] == analysis["risk_items"]
+
+    # sửa Điều 3: chỉ điều đó được gửi nguyên văn, item của Điều 2 dùng lại
+    edited = list(CLAUSES)
+    edited[2] = "Điều 3. Phạt vi phạm\nBên vi phạm chịu phạt 12% giá trị hợp đồng."
+    model["queue"] = [[item("Phạt vượt trần", "C3", "HIGH")]]
+    merged, stats = analyze(callllm, edited)
+
+    prompt = model["prompts"][-1]
+    assert "chịu phạt 12%" in prompt and "50.000.000 đồng" not in prompt
+    assert "không đổi so với lần phân tích trước" in prompt
+    assert stats["mode"] == "incremental"
+    assert stats["analyzed_clauses"] == 1 and stats["reused_clauses"] == 5 and stats["reused_risk_items"] == 1
+    assert [(i["clause_id"], i["title"]) for i in merged["risk_items"]] == [
+        ("C2", "Giá thuê chưa gồm thuế"), ("C3", "Phạt vượt trần"), ("", "Thiếu bảo hiểm kho"),
+    ]
+    assert merged["overall_risk_level"] == "HIGH" and merged["summary"] == "Hợp đồng thuê kho."
+    assert_merged_schema(callllm, merged)
+
+
+def test_many_edits_fall_back_to_full_analysis(callllm, model):
+    model["queue"] = [[], []]
+    analyze(callllm, CLAUSES)
+    rewritten = [c + " (sửa đổi)" for c in CLAUSES[:4]] + CLAUSES[4:]
+    _, stats = analyze(callllm, rewritten)
+    assert stats["mode"] == "full" and stats["analyzed_clauses"] == len(CLAUSES)
+
+
+def test_results_are_scoped_by_caller(callllm, model):
+    model["queue"] = [[item("Giá thuê chưa gồm thuế", "C2")], []]
+    analyze(callllm, CLAUSES)
+    _, stats = analyze(callllm, CLAUSES, tenant_id="u2")
+    assert stats["mode"] == "full"
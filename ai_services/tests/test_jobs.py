@@ -0,0 +1,107 @@
+import json
+import time
+
+import pytest
+
+import job_store
+import local_aws_stubs as stubs
+
+
+@pytest.fixture
+def store(monkeypatch):
+    monkeypatch.setenv("JOB_DISPATCH", "thread")
+    store = job_store.MemoryJobStore()
+    job_store.set_job_store(store)
+    yield store
+    job_store.set_job_store(None)
+
+
+def wait_done(store, job_id, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = store.get(job_id)
+        if job["status"] in (job_store.JOB_SUCCEEDED, job_store.JOB_FAILED):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def submit(work, request=None, owner=None):
+    return job_store.submit_job(
+        "test", dict(request or {}, **{"async": True}), None, None,
+        run_inline=lambda event: job_store.run_job(event, work), owner=owner,
+    )
+
+
+def test_submit_poll_and_progress(store):
+    def work(request, progress):
+        assert "async" not in request
+        progress("half", 50, first=request["n"])
+        return {"double": request["n"] * 2}
+
+    job = submit(work, {"n": 21}, owner="u1")
+    assert job["status"] == job_store.JOB_QUEUED
+    done = wait_done(store, job["job_id"])
+
+    assert done["status"] == job_store.JOB_SUCCEEDED
+    assert done["result"] == {"double": 42} and done["partial"] == {"first": 21}
+    assert done["progress"] == {"stage": "done", "percent": 100}
+    assert "owner" not in job_store.public_view(done)
+    assert job_store.job_visible_to(done, "u1") and not job_store.job_visible_to(done, "u2")
+    assert not job_store.job_visible_to(done, None)
+
+
+@pytest.mark.parametrize("exc, error_type", [(ValueError("bad input"), "bad_request"), (RuntimeError("boom"), "RuntimeError")])
+def test_failed_work_marks_job_failed(store, exc, error_type):
+    def work(request, progress):
+        raise exc
+
+    done = wait_done(store, submit(work)["job_id"])
+    assert done["status"] == job_store.JOB_FAILED
+    assert done["error"] == {"type": error_type, "message": str(exc)}
+
+
+def test_unstorable_result_marks_job_failed(store, monkeypatch):
+    update = store.update
+
+    def update_rejecting_result(job_id, **fields):
+        if fields.get("result") is not None:
+            raise RuntimeError("item too large")
+        update(job_id, **fields)
+
+    monkeypatch.setattr(store, "update", update_rejecting_result)
+    done = wait_done(store, submit(lambda request, progress: {"big": "x"})["job_id"])
+    assert done["status"] == job_store.JOB_FAILED
+    assert done["error"]["type"] == "result_store_failed"
+
+
+@pytest.mark.parametrize("kind, request_body", [
+    ("callllm", {"contract_text": "Điều 1. Bên A thuê nhà của Bên B.", "prescreen_only": True}),
+    ("generate_contract", None),
+])
+def test_only_submitting_caller_can_poll(stack, store, kind, request_body):
+    if kind == "generate_contract":
+        stack.seed_templates()
+        stack.load("ragsearch")
+    fn = stack.load(kind)
+    if request_body is None:
+        fn.load_template_metadata_if_needed()
+        request_body = {"template_id": list(fn.TEMPLATE_CACHE["by_id"])[0]}
+
+    def call(event):
+        resp = fn.lambda_handler(event, None)
+        return resp["statusCode"], json.loads(resp["body"])
+
+    status, body = call({**request_body, "async": True, "tenant_id": "u1"})
+    assert status == 202, body
+    job_id = body["job_id"]
+    wait_done(store, job_id)
+
+    assert call({"job_id": job_id, "tenant_id": "u1"})[0] == 200
+    assert call({"job_id": job_id, "tenant_id": "u2"})[0] == 404
+    event = stubs.api_event({"job_id": job_id})
+    event["requestContext"] = {"authorizer": {"jwt": {"claims": {"sub": "u2"}}}}
+    assert call(event)[0] == 404
+    event["requestContext"] = {"authorizer": {"jwt": {"claims": {"sub": "u1"}}}}
+    status, body = call(event)
+    assert status == 200 and body["status"] == job_store.JOB_SUCCEEDED
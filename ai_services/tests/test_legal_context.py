@@ -0,0 +1,40 @@
+from legal_context import estimate_tokens, pack_legal_context, trim_to_relevant_span
+
+FILLER = "Nội dung chung về quyền và nghĩa vụ của các bên trong giao dịch dân sự thông thường."
+
+
+def chunk(title, text, article_no=""):
+    return {"title": title, "article_no": article_no, "text": text}
+
+
+def test_chunks_within_budget_are_kept_verbatim():
+    chunks = [chunk("Bộ luật Dân sự", "Bên thuê phải trả tiền thuê đúng hạn.", "Điều 481")]
+    context, stats = pack_legal_context(chunks, "tiền thuê", budget_tokens=200, label="Luật")
+
+    assert "[Luật 1 – Bộ luật Dân sự, Điều 481]" in context
+    assert "Bên thuê phải trả tiền thuê đúng hạn." in context
+    assert stats["chunks_used"] == 1 and stats["chunks_trimmed"] == 0 and stats["tokens_dropped"] == 0
+
+
+def test_long_chunk_is_trimmed_around_matching_sentence():
+    key = "Tiền đặt cọc được hoàn trả trong vòng mười ngày khi chấm dứt hợp đồng."
+    text = " ".join([FILLER] * 6 + [key] + [FILLER] * 6)
+    trimmed = trim_to_relevant_span(text, {"đặt", "cọc", "hoàn", "trả"}, max_tokens=60)
+
+    assert key in trimmed
+    assert trimmed.startswith("… ") and trimmed.endswith(" …")
+    assert estimate_tokens(trimmed) <= 60 + 2
+
+
+def test_packer_respects_budget_and_reports_dropped_tokens():
+    long_text = " ".join([FILLER] * 20 + ["Tiền đặt cọc được hoàn trả khi chấm dứt hợp đồng."])
+    chunks = [chunk(f"Văn bản {i}", long_text) for i in range(4)]
+    budget = 250
+    context, stats = pack_legal_context(chunks, "hoàn trả tiền đặt cọc", budget_tokens=budget, label="Luật")
+
+    assert estimate_tokens(context) <= budget + stats["chunks_used"] * 3
+    assert stats["chunks_trimmed"] >= 1 and stats["chunks_dropped"] >= 1
+    assert stats["chunks_used"] + stats["chunks_dropped"] == stats["chunks_in"] == 4
+    assert stats["tokens_in"] == 4 * estimate_tokens(long_text)
+    assert stats["tokens_dropped"] == stats["tokens_in"] - stats["tokens_used"] > 0
+    assert "hoàn trả" in context
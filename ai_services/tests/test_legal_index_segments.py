@@ -0,0 +1,66 @@
+import json
+import time
+
+import local_aws_stubs as stubs
+
+SEGMENT_ENV = {"SEGMENT_COMPACT_GRACE_SECONDS": "0", "LEGAL_SEGMENT_REFRESH_SECONDS": "0"}
+
+
+def invoke(rag, body):
+    resp = rag.lambda_handler(body, None)
+    return resp["statusCode"], json.loads(resp["body"])
+
+
+def search_doc_ids(rag, query, **extra):
+    status, body = invoke(rag, {"query": query, "top_k": 5, **extra})
+    assert status == 200, body
+    return [r["doc_id"] for r in body["results"]]
+
+
+def base_records(stack, rag):
+    raw = stack.s3.objects[(rag.LEGAL_INDEX_BUCKET, rag.LEGAL_INDEX_KEY)]["Body"]
+    return [json.loads(line) for line in raw.decode("utf-8").splitlines() if line.strip()]
+
+
+def test_delete_then_search_hides_legal_document(stack, corpus):
+    rag = stack.load("ragsearch", env=SEGMENT_ENV)
+    query = corpus[5]["text"]
+    top_doc = search_doc_ids(rag, query)[0]
+
+    rag.write_segment(rag.LEGAL_INDEX_BUCKET, rag.LEGAL_SEGMENT_PREFIX, [{"op": "delete", "doc_id": top_doc}])
+
+    assert top_doc not in search_doc_ids(rag, query)
+    # container mới (cold start) đọc base + segment tombstone
+    assert top_doc not in search_doc_ids(stack.load("ragsearch", env=SEGMENT_ENV), query)
+
+
+def test_compaction_keeps_live_documents_and_drops_tombstoned(stack, corpus):
+    rag = stack.load("ragsearch", env=SEGMENT_ENV)
+    deleted_doc = corpus[0]["doc_id"]
+    added = dict(corpus[5], doc_id="nd-moi", chunk_id="nd-moi-c0")
+    rag.write_segment(rag.LEGAL_INDEX_BUCKET, rag.LEGAL_SEGMENT_PREFIX, [{"op": "delete", "doc_id": deleted_doc}])
+    rag.write_segment(rag.LEGAL_INDEX_BUCKET, rag.LEGAL_SEGMENT_PREFIX, [added])
+    time.sleep(0.01)  # segment phải cũ hơn cutoff (ms) của compaction
+
+    status, stats = invoke(rag, {"action": "compact_legal_index"})
+    assert status == 200, stats
+    assert stats["compacted_segments"] == 2
+
+    records = base_records(stack, rag)
+    doc_ids = {r["doc_id"] for r in records}
+    live = [r for r in corpus if r["doc_id"] != deleted_doc]
+    assert deleted_doc not in doc_ids
+    assert "nd-moi" in doc_ids
+    assert {r["chunk_id"] for r in records} == {r["chunk_id"] for r in live} | {"nd-moi-c0"}
+    assert not [k for (_, k) in stack.s3.objects if k.startswith(rag.LEGAL_SEGMENT_PREFIX)]
+
+    fresh = stack.load("ragsearch", env=SEGMENT_ENV)
+    ids = search_doc_ids(fresh, corpus[5]["text"])
+    assert "nd-moi" in ids
+    assert deleted_doc not in ids
+
+
+def test_compaction_is_not_reachable_through_api_gateway(stack):
+    rag = stack.load("ragsearch", env=SEGMENT_ENV)
+    status = rag.lambda_handler(stubs.api_event({"action": "compact_legal_index"}), None)["statusCode"]
+    assert status == 403
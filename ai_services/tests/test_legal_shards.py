@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+MANIFEST_KEY = "index/shards/manifest.json"
+UNSHARDED_ENV = {"LEGAL_SHARD_MANIFEST_KEY": "", "LEGAL_SHARD_NAME": "", "LEGAL_SHARD_FUNCTIONS": ""}
+SHARD_NAMES = ["shard-00", "shard-01", "shard-02"]
+
+
+def search(rag, body):
+    resp = rag.lambda_handler(body, None)
+    assert resp["statusCode"] == 200, resp["body"]
+    return json.loads(resp["body"])
+
+
+def chunk_ids(body):
+    return [r["chunk_id"] for r in body["results"]]
+
+
+def build_shards(stack, by):
+    builder = stack.load("ragsearch", env={**UNSHARDED_ENV, "LEGAL_SHARD_MANIFEST_KEY": MANIFEST_KEY})
+    resp = builder.lambda_handler({"action": "build_legal_shards", "by": by, "shards": len(SHARD_NAMES)}, None)
+    assert resp["statusCode"] == 200, resp["body"]
+    return json.loads(resp["body"])
+
+
+@pytest.mark.parametrize("by", ["doc_category", "hash"])
+@pytest.mark.parametrize("extra", [{}, {"diversity": True}, {"filters": {"doc_category": ["luat"]}}])
+def test_scatter_gather_matches_unsharded_top_k(stack, corpus, by, extra):
+    plain = stack.load("ragsearch", env=UNSHARDED_ENV)
+    manifest = build_shards(stack, by)
+    assert [sh["name"] for sh in manifest["shards"]] == SHARD_NAMES
+    coordinator = stack.load("ragsearch", env={**UNSHARDED_ENV, "LEGAL_SHARD_MANIFEST_KEY": MANIFEST_KEY})
+
+    for query in (corpus[5]["text"], "mức phạt vi phạm hợp đồng"):
+        body = {"query": query, "top_k": 5, **extra}
+        expected = search(plain, body)
+        gathered = search(coordinator, body)
+        assert chunk_ids(gathered) == chunk_ids(expected)
+        assert not gathered["shards"]["failed"]
+    # version gộp chỉ nằm trong response, không ghi đè version index của container
+    assert gathered["index_version"].startswith("shards-")
+    assert coordinator.INDEX_CACHE["version"] is None
+
+
+def test_remote_shards_match_unsharded_top_k(stack, corpus):
+    plain = stack.load("ragsearch", env=UNSHARDED_ENV)
+    build_shards(stack, "hash")
+    for name in SHARD_NAMES:
+        stack.load("ragsearch", env={"LEGAL_SHARD_MANIFEST_KEY": MANIFEST_KEY, "LEGAL_SHARD_NAME": name},
+                   register_as="rag-" + name)
+    coordinator = stack.load("ragsearch", env={
+        "LEGAL_SHARD_MANIFEST_KEY": MANIFEST_KEY,
+        "LEGAL_SHARD_NAME": "",
+        "LEGAL_SHARD_FUNCTIONS": json.dumps({name: "rag-" + name for name in SHARD_NAMES}),
+    })
+
+    body = {"query": corpus[5]["text"], "top_k": 5}
+    assert chunk_ids(search(coordinator, body)) == chunk_ids(search(plain, body))
+    assert all(stack.lambda_client.calls.get("rag-" + name) == 1 for name in SHARD_NAMES)
+
+
+@pytest.mark.parametrize("sharded", [False, True])
+def test_search_and_answer_cache_report_one_index_version(stack, corpus, sharded):
+    env = dict(UNSHARDED_ENV)
+    if sharded:
+        build_shards(stack, "hash")
+        env["LEGAL_SHARD_MANIFEST_KEY"] = MANIFEST_KEY
+    rag = stack.load("ragsearch", env=env)
+    body = {"query": corpus[5]["text"], "top_k": 3, "answer_cache": True}
+
+    miss = search(rag, body)
+    assert miss["answer_cache"] == {"hit": False}
+    rag.lambda_handler({"action": "answer_cache_store", "query": body["query"], "answer": "A", "answer_cache": True}, None)
+    hit = search(rag, body)
+
+    assert hit["answer_cache"]["hit"] is True
+    assert hit["index_version"] == miss["index_version"] == rag.legal_index_version()
@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+GOOD = {
+    "title": "Phạt vượt trần", "clause_excerpt": "", "risk_types": ["Financial"], "severity": "HIGH",
+    "description": "Mức phạt 15%.", "recommendation": "Giảm xuống 8%.", "law_references": [],
+}
+ANALYSIS = {"summary": "Tóm tắt.", "overall_risk_level": "HIGH", "risk_items": [GOOD], "disclaimer": "Tham khảo."}
+
+
+@pytest.fixture
+def callllm(stack):
+    return stack.load("callllm")
+
+
+@pytest.mark.parametrize("text", [
+    "```json\n" + json.dumps(ANALYSIS, ensure_ascii=False) + "\n```",
+    "Kết quả phân tích: " + json.dumps(ANALYSIS, ensure_ascii=False) + " Hết.",
+    json.dumps(ANALYSIS, ensure_ascii=False).replace("]", ",]"),
+    # bị cắt giữa chuỗi
+    json.dumps(ANALYSIS, ensure_ascii=False).split("15%")[0],
+])
+def test_lenient_parser_recovers_common_model_mistakes(callllm, text):
+    parsed = callllm.lenient_json_loads(text)
+    assert isinstance(parsed, dict)
+    assert parsed["risk_items"][0]["title"] == "Phạt vượt trần"
+
+
+def test_lenient_parser_keeps_vietnamese_quotes_and_rejects_prose(callllm):
+    quoted = dict(ANALYSIS, summary="Điều khoản “phạt cọc” chưa rõ.")
+    assert callllm.lenient_json_loads(json.dumps(quoted, ensure_ascii=False))["summary"] == quoted["summary"]
+    assert callllm.lenient_json_loads("Không có rủi ro đáng kể.") is None
+    analysis, raw = callllm.parse_model_json("{ không phải JSON")
+    assert raw is not None and analysis["overall_risk_level"] == "UNKNOWN"
+
+
+def test_local_fix_needs_no_repair_call(callllm, stack):
+    broken = dict(ANALYSIS, overall_risk_level="high", risk_items={**GOOD, "severity": "medium"})
+    analysis, raw, info = callllm.repair_model_output(broken, None, {})
+    assert raw is None and info["fixed"] == "local" and info["repair_calls"] == 0
+    assert analysis["risk_items"][0]["severity"] == "MEDIUM" and analysis["risk_items"][0]["id"] == "R1"
+    assert stack.bedrock.calls.get("converse", 0) == 0
+
+
+def test_repair_call_sends_only_broken_items(callllm, stack):
+    bad = {"title": "Thiếu thời hạn bàn giao", "severity": "MEDIUM", "description": "", "recommendation": ""}
+    prompts = []
+
+    def responder(request):
+        prompts.append(request["messages"][0]["content"][0]["text"])
+        return json.dumps({"risk_items": [dict(bad, description="Không nêu ngày bàn giao.", recommendation="Ghi rõ ngày.")]},
+                          ensure_ascii=False)
+
+    stack.bedrock.converse_responder = responder
+    before = callllm.output_repair_stats()
+    analysis, raw, info = callllm.repair_model_output(dict(ANALYSIS, risk_items=[GOOD, bad]), None, {})
+
+    assert raw is None and info["fixed"] == "repair_call" and info["repair_calls"] == 1
+    assert len(prompts) == 1
+    assert "Thiếu thời hạn bàn giao" in prompts[0] and "Phạt vượt trần" not in prompts[0]
+    assert [i["title"] for i in analysis["risk_items"]] == ["Phạt vượt trần", "Thiếu thời hạn bàn giao"]
+    assert callllm.validate_analysis(analysis) == []
+
+    after = callllm.output_repair_stats()
+    assert after["analyses"] - before["analyses"] == 1
+    assert after["repair_calls"] - before["repair_calls"] == 1
+    assert after["repaired"] - before["repaired"] == 1
+
+
+def test_unrepairable_output_is_counted(callllm, stack, monkeypatch):
+    monkeypatch.setattr(callllm.Config, "OUTPUT_REPAIR_MAX_CALLS", 0)
+    analysis, raw = callllm.parse_model_json('{"risk_items": [{"title": "x"')
+    _, raw, info = callllm.repair_model_output(analysis, "{\"risk_items\": [", {})
+    assert raw is not None and info["repair_calls"] == 0
+    stats = callllm.output_repair_stats()
+    assert stats["unrepaired"] == 1 and stats["repair_rate"] == 0.0
+    assert stack.bedrock.calls.get("converse", 0) == 0
@@ -0,0 +1,73 @@
+import json
+
+import contract_clauses
+
+FILLER = "Các bên cam kết thực hiện đúng nội dung đã thỏa thuận, phối hợp trao đổi thông tin kịp thời và thiện chí. "
+
+SKELETON = [
+    "Điều 1. Đối tượng của hợp đồng\nBên A cho Bên B thuê kho tại Bình Dương. " + FILLER * 4,
+    "Điều 2. Thời hạn hợp đồng\nThời hạn thuê là 24 tháng kể từ ngày ký. " + FILLER * 4,
+    "Điều 3. Bảo mật\nCác bên giữ bí mật thông tin của nhau. " + FILLER * 4,
+    "Điều 4. Bất khả kháng\nSự kiện bất khả kháng được xử lý theo pháp luật. " + FILLER * 4,
+    "Điều 5. Điều khoản chung\nHợp đồng lập thành hai bản có giá trị như nhau. " + FILLER * 4,
+]
+FLAGGED = [
+    "Điều 6. Phạt vi phạm\nBên vi phạm chịu phạt 15% giá trị hợp đồng.",
+    "Điều 7. Thanh toán\nChậm thanh toán chịu lãi 3%/tháng trên số tiền chậm trả.",
+    "Điều 8. Đặt cọc\nBên B đặt cọc 100.000.000 đồng khi ký hợp đồng.",
+    "Điều 9. Chấm dứt hợp đồng\nBên A được đơn phương chấm dứt hợp đồng bất cứ lúc nào.",
+]
+CONTRACT = "HỢP ĐỒNG THUÊ KHO\n\n" + "\n\n".join(SKELETON + FLAGGED)
+
+
+def test_rules_flag_risky_clauses_only():
+    clauses = contract_clauses.split_clauses(CONTRACT)
+    screen = contract_clauses.prescreen(clauses)
+
+    hits = {item["rule_id"]: item for item in screen["risk_items"]}
+    assert set(hits) == {
+        "missing_dispute_resolution", "penalty_above_cap", "interest_above_cap",
+        "deposit_refund_unclear", "unilateral_termination_no_notice",
+    }
+    assert "36%/năm" in hits["interest_above_cap"]["description"]
+    assert [item["id"] for item in screen["risk_items"]] == [f"P{i}" for i in range(1, 6)]
+    assert screen["overall_risk_level"] == "HIGH"
+
+    by_heading = {c["heading"]: c["clause_id"] for c in clauses}
+    assert set(screen["flagged_clause_ids"]) == {by_heading[text.split("\n")[0]] for text in FLAGGED}
+    assert not {by_heading[text.split("\n")[0]] for text in SKELETON} & set(screen["full_clause_ids"])
+
+
+def test_dispute_clause_clears_missing_dispute_rule():
+    text = CONTRACT + "\n\nĐiều 10. Giải quyết tranh chấp\nTranh chấp được giải quyết tại tòa án có thẩm quyền."
+    screen = contract_clauses.prescreen(contract_clauses.split_clauses(text))
+    assert "missing_dispute_resolution" not in {item["rule_id"] for item in screen["risk_items"]}
+
+
+def test_model_prompt_keeps_only_flagged_clauses(stack):
+    stack.load("ragsearch")
+    callllm = stack.load("callllm", env={"PRESCREEN_MIN_TOKENS": "100"})
+    prompts = []
+
+    def responder(request):
+        prompts.append(" ".join(c["text"] for m in request["messages"] for c in m["content"] if "text" in c))
+        return json.dumps({
+            "summary": "Hợp đồng thuê kho.", "overall_risk_level": "LOW", "risk_items": [],
+            "disclaimer": "Tham khảo.",
+        }, ensure_ascii=False)
+
+    stack.bedrock.converse_responder = responder
+    resp = callllm.lambda_handler({"contract_text": CONTRACT}, None)
+    body = json.loads(resp["body"])
+
+    assert resp["statusCode"] == 200, body
+    stats = body["debug"]["prescreen"]
+    assert stats["trimmed"] and stats["prompt_contract_tokens"] < stats["contract_tokens"]
+    prompt = prompts[0]
+    assert all(text in prompt for text in FLAGGED)
+    assert FILLER.strip() not in prompt and contract_clauses.OMITTED_PRESCREENED in prompt
+    assert "Điều 2. Thời hạn hợp đồng" in prompt
+    # rủi ro của rule được gộp vào kết quả, mức chung lấy mức cao hơn
+    analysis = body["analysis"]
+    assert [item["source"] for item in analysis["risk_items"]] == ["rule"] * 5
+    assert analysis["overall_risk_level"] == "HIGH"
@@ -0,0 +1,50 @@
+import base64
+import gzip
+import json
+
+import local_aws_stubs as stubs
+
+QUERY = {"query": "hợp đồng thuê nhà", "top_k": 3}
+
+
+def search(rag, **extra):
+    return rag.lambda_handler({**QUERY, **extra}, None)
+
+
+def test_fields_projection_and_text_truncation(stack):
+    rag = stack.load("ragsearch")
+    resp = search(rag, fields=["doc_id", "text"], max_text_chars=20)
+    assert resp["statusCode"] == 200
+    results = json.loads(resp["body"])["results"]
+    assert results
+    for r in results:
+        assert set(r) <= {"doc_id", "text", "text_truncated"}
+        if r.get("text_truncated"):
+            assert r["text"].endswith(" …") and len(r["text"]) <= 22
+
+
+def test_gzip_round_trip_matches_plain_response(stack):
+    rag = stack.load("ragsearch")
+    plain = json.loads(search(rag)["body"])
+
+    api = search(rag, compress="gzip")
+    assert api["isBase64Encoded"] and api["headers"]["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(base64.b64decode(api["body"])))["results"] == plain["results"]
+
+    raw = search(rag, compress="gzip", response_format="raw")
+    assert raw["encoding"] == "gzip"
+    assert json.loads(gzip.decompress(base64.b64decode(raw["data"])))["results"] == plain["results"]
+
+
+def test_auto_compress_keeps_small_bodies_plain(stack):
+    rag = stack.load("ragsearch", env={"GZIP_MIN_BYTES": "100000000"})
+    resp = search(rag, compress="auto")
+    assert "isBase64Encoded" not in resp and json.loads(resp["body"])["results"]
+
+
+def test_raw_format_is_rejected_through_api_gateway(stack):
+    rag = stack.load("ragsearch")
+    resp = rag.lambda_handler(stubs.api_event({**QUERY, "response_format": "raw"}), None)
+    assert resp["statusCode"] == 400
+    assert "direct invocation" in json.loads(resp["body"])["error"]
+    assert "results" in search(rag, response_format="raw")
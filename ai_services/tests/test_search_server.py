@@ -0,0 +1,23 @@
+import search_server
+
+
+def test_shared_matrix_reports_the_loaded_vector_store(stack, tmp_path):
+    rag = stack.load("ragsearch", env={"INDEX_VECTOR_PRECISION": "int8"})
+    matrix = search_server.share_legal_index(rag, str(tmp_path))
+
+    info = matrix.describe()
+    assert info["precision"] == "float32" and info["storage"] == "mmap"
+    assert info["rows"] == len(rag.INDEX_CACHE["chunks"])
+    assert info["source"]["precision"] == "int8"
+    matrix.close()
+
+
+def test_worker_init_replaces_executors_and_keeps_local_clients(stack):
+    rag = stack.load("ragsearch")
+    s3, rerank, shard = rag.s3, rag.RERANK_EXECUTOR, rag.SHARD_EXECUTOR
+
+    search_server.init_worker_process(rag, local=True)
+
+    assert rag.s3 is s3
+    assert rag.RERANK_EXECUTOR is not rerank and rag.SHARD_EXECUTOR is not shard
+    assert rag.SHARD_EXECUTOR.submit(lambda: 42).result() == 42
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+MANIFEST_KEY = "index/shards/manifest.json"
+
+
+@pytest.fixture
+def templated(stack):
+    stack.seed_templates()
+    return stack
+
+
+def load_pair(stack, sharded):
+    env = {"LEGAL_SHARD_MANIFEST_KEY": "", "LEGAL_SHARD_NAME": "", "LEGAL_SEGMENT_REFRESH_SECONDS": "3600"}
+    if sharded:
+        builder = stack.load("ragsearch", env={**env, "LEGAL_SHARD_MANIFEST_KEY": MANIFEST_KEY})
+        assert builder.lambda_handler({"action": "build_legal_shards", "by": "hash", "shards": 2}, None)["statusCode"] == 200
+        env["LEGAL_SHARD_MANIFEST_KEY"] = MANIFEST_KEY
+    rag = stack.load("ragsearch", env=env)
+    gen = stack.load("generate_contract", env={"INDEX_VERSION_CHECK_SECONDS": "0"})
+    gen.load_template_metadata_if_needed()
+    return rag, gen
+
+
+def cache_source(gen, template_id):
+    debug = {}
+    gen.retrieve_legal_context_for_template(gen.TEMPLATE_CACHE["by_id"][template_id], {}, "vi", debug=debug)
+    return debug["legal_context_cache"]["source"]
+
+
+@pytest.mark.parametrize("sharded", [False, True])
+def test_cache_hit_survives_new_segment_until_ragsearch_applies_it(templated, corpus, monkeypatch, sharded):
+    rag, gen = load_pair(templated, sharded)
+    template_id = list(gen.TEMPLATE_CACHE["by_id"])[0]
+
+    assert cache_source(gen, template_id) == "built"
+    assert cache_source(gen, template_id) == "memory"
+    version = gen.LEGAL_CONTEXT_CACHE[(template_id, "vi")]["index_version"]
+    assert version == rag.legal_index_version()
+
+    # segment mới đã ghi nhưng ragsearch chưa refresh -> vẫn hit
+    added = dict(corpus[5], doc_id="nd-moi", chunk_id="nd-moi-c0")
+    rag.write_segment(rag.LEGAL_INDEX_BUCKET, rag.LEGAL_SEGMENT_PREFIX, [added])
+    assert cache_source(gen, template_id) == "memory"
+
+    # ragsearch áp segment -> version đổi -> build lại một lần rồi hit tiếp
+    monkeypatch.setattr(rag, "LEGAL_SEGMENT_REFRESH_SECONDS", 0)
+    assert cache_source(gen, template_id) == "built"
+    assert gen.LEGAL_CONTEXT_CACHE[(template_id, "vi")]["index_version"] != version
+    monkeypatch.setattr(rag, "LEGAL_SEGMENT_REFRESH_SECONDS", 3600)
+    assert cache_source(gen, template_id) == "memory"
+
+
+def test_index_version_action_matches_search_response(templated):
+    rag, _ = load_pair(templated, sharded=False)
+    resp = rag.lambda_handler({"action": "index_version"}, None)
+    search = json.loads(rag.lambda_handler({"query": "hợp đồng thuê nhà", "top_k": 2}, None)["body"])
+    assert json.loads(resp["body"])["index_version"] == search["index_version"]
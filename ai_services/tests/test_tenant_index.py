@@ -0,0 +1,57 @@
+import json
+
+import local_aws_stubs as stubs
+
+SEGMENT_ENV = {"SEGMENT_COMPACT_GRACE_SECONDS": "0", "LEGAL_SEGMENT_REFRESH_SECONDS": "0"}
+
+
+def invoke(rag, body):
+    resp = rag.lambda_handler(body, None)
+    return resp["statusCode"], json.loads(resp["body"])
+
+
+def search_doc_ids(rag, query, **extra):
+    status, body = invoke(rag, {"query": query, "top_k": 5, **extra})
+    assert status == 200, body
+    return [r["doc_id"] for r in body["results"]]
+
+
+def test_delete_then_search_hides_tenant_document(stack):
+    rag = stack.load("ragsearch", env=SEGMENT_ENV)
+    for doc_id, text in (("a", "hợp đồng mua bán xe máy"), ("b", "hợp đồng thuê kho bãi")):
+        status, body = invoke(rag, {"action": "index_document", "tenant_id": "u1", "doc_id": doc_id, "text": text})
+        assert status == 200, body
+    assert set(search_doc_ids(rag, "hợp đồng", tenant_id="u1", scope="tenant")) == {"a", "b"}
+
+    status, _ = invoke(rag, {"action": "delete_document", "tenant_id": "u1", "doc_id": "a"})
+    assert status == 200
+
+    assert search_doc_ids(rag, "hợp đồng", tenant_id="u1", scope="tenant") == ["b"]
+    status, stats = invoke(rag, {"action": "compact_tenant_index", "tenant_id": "u1"})
+    assert status == 200, stats
+    fresh = stack.load("ragsearch", env=SEGMENT_ENV)
+    assert search_doc_ids(fresh, "hợp đồng", tenant_id="u1", scope="tenant") == ["b"]
+
+
+def test_api_gateway_cannot_pick_tenant(stack):
+    rag = stack.load("ragsearch", env=SEGMENT_ENV)
+    status = rag.lambda_handler(stubs.api_event({"query": "hợp đồng", "tenant_id": "u1"}), None)["statusCode"]
+    assert status == 403
+
+
+def test_authenticated_search_defaults_to_legal_scope(stack):
+    rag = stack.load("ragsearch", env=SEGMENT_ENV)
+    invoke(rag, {"action": "index_document", "tenant_id": "u1", "doc_id": "a", "text": "hợp đồng mua bán xe máy"})
+    rag.TENANT_INDEXES.clear()
+    event = stubs.api_event({"query": "hợp đồng", "top_k": 3})
+    event["requestContext"] = {"authorizer": {"jwt": {"claims": {"sub": "u1"}}}}
+
+    resp = rag.lambda_handler(event, None)
+    body = json.loads(resp["body"])
+    assert resp["statusCode"] == 200
+    assert "scope" not in body and all("index" not in r for r in body["results"])
+    assert not rag.TENANT_INDEXES
+
+    event["body"] = json.dumps({"query": "hợp đồng", "top_k": 3, "scope": "tenant"})
+    body = json.loads(rag.lambda_handler(event, None)["body"])
+    assert [r["doc_id"] for r in body["results"]] == ["a"]
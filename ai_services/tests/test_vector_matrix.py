@@ -0,0 +1,74 @@
+import random
+
+import pytest
+
+import vector_matrix
+
+DIM = 64
+ROWS = 3000
+
+# Sai số tối đa của cosine so với float32 (vector đã chuẩn hoá, dim 64)
+TOLERANCE = {"float16": 2e-3, "int8": 2e-2, "mmap": 1e-6}
+
+
+@pytest.fixture(scope="module")
+def vectors():
+    rnd = random.Random(7)
+    rows = [[rnd.gauss(0.0, 1.0) for _ in range(DIM)] for _ in range(ROWS)]
+    queries = [[rnd.gauss(0.0, 1.0) for _ in range(DIM)] for _ in range(5)]
+    return rows, queries
+
+
+def build(rows, precision, **kwargs):
+    store = vector_matrix.VectorStore(precision, block_rows=512, **kwargs)
+    for v in rows:
+        store.append(v)
+    return store
+
+
+def top_ids(scores, k=10):
+    return sorted(range(len(scores)), key=lambda i: -scores[i])[:k]
+
+
+@pytest.mark.parametrize("precision", ["float16", "int8", "mmap"])
+def test_downgraded_scores_stay_close_to_float32(vectors, precision):
+    rows, queries = vectors
+    exact = build(rows, "float32")
+    store = build(rows, precision)
+
+    assert len(store) == ROWS
+    for q, scores in zip(queries, store.scores_batch(queries)):
+        reference = exact.scores(q)
+        assert max(abs(a - b) for a, b in zip(scores, reference)) <= TOLERANCE[precision]
+        assert len(set(top_ids(scores)) & set(top_ids(reference))) >= 8
+    assert max(abs(a - b) for a, b in zip(store[1234], exact[1234])) <= TOLERANCE[precision]
+
+
+def test_budget_downgrade_keeps_scores_within_tolerance(vectors):
+    rows, queries = vectors
+    exact = build(rows, "float32")
+    float32_bytes = exact.memory_bytes()
+    store = build(rows, "auto", budget_bytes=float32_bytes // 3)
+
+    assert store.precision != "float32"
+    assert store.memory_bytes() <= float32_bytes // 3
+    tolerance = TOLERANCE[store.precision]
+    # mỗi lần hạ precision cộng dồn sai số của mức trước
+    for d in store.downgrades:
+        if d["from"] in TOLERANCE:
+            tolerance += TOLERANCE[d["from"]]
+    for q in queries:
+        assert max(abs(a - b) for a, b in zip(store.scores(q), exact.scores(q))) <= tolerance
+
+
+def test_mmap_remap_closes_previous_map(vectors):
+    rows, queries = vectors
+    store = build(rows[:10], "mmap")
+    assert store[3] == pytest.approx(vector_matrix._unit(rows[3]), abs=1e-6)
+    first = store._map
+
+    for v in rows[10:20]:
+        store.append(v)
+    assert store[15] == pytest.approx(vector_matrix._unit(rows[15]), abs=1e-6)
+    assert store._map is not first and first.closed
+    assert len(store.scores(queries[0])) == 20
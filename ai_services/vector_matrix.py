@@ -0,0 +1,475 @@
+"""
+Ma trận embedding float32 chỉ đọc, nằm trong một file (memory-mapped) thay vì
+list of list[float] trong từng process.
+
+  - Mỗi hàng đã chuẩn hoá L2 -> cosine = tích vô hướng.
+  - Nhiều process mmap cùng file dùng chung page cache (một bản trong RAM).
+  - scores_batch(): cosine của nhiều query với mọi hàng trong MỘT phép nhân ma
+    trận (numpy nếu có; không có thì vòng lặp Python, chậm hơn nhưng cùng kết quả).
+  - batcher (tuỳ chọn): scores() của các thread đồng thời được gộp lô qua
+    MicroBatcher (xem search_server.py).
+
+VectorStore: cùng giao diện nhưng thêm dần được (append khi đọc JSONL / segment
+delta) và giữ vector ở float32, float16, int8 (một scale / hàng) hoặc file mmap,
+tự hạ precision khi vượt ngân sách bộ nhớ (index pháp luật của ragsearch).
+
+ragsearch nhận VectorMatrix / VectorStore ở chỗ index["vectors"] (len, [i], scores).
+File này phải được đóng gói cùng Lambda ragsearch.
+"""
+
+import math
+import mmap
+import os
+import queue
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+try:
+    import numpy as np
+except ImportError:  # không có trong package / layer
+    np = None
+
+ITEM_BYTES = 4  # float32
+
+
+def _unit(v: Sequence[float]) -> List[float]:
+    norm = math.sqrt(sum(x * x for x in v))
+    return [x / norm for x in v] if norm else [0.0] * len(v)
+
+
+class VectorMatrix:
+    """n hàng x dim cột float32 (đã chuẩn hoá) trên một buffer chỉ đọc."""
+
+    def __init__(self, buf: Any, dim: int, path: Optional[str] = None):
+        self.dim = dim
+        self.path = path
+        self._buf = buf
+        self._view = memoryview(buf).cast("f")
+        self._rows = len(self._view) // dim if dim else 0
+        self._np = np.frombuffer(buf, dtype=np.float32).reshape(self._rows, dim) if np is not None else None
+        self.batcher: Optional["MicroBatcher"] = None
+        self.source: Optional[Dict[str, Any]] = None  # describe() của VectorStore đã ghi ra ma trận (nếu có)
+
+    @classmethod
+    def open(cls, path: str, dim: int) -> "VectorMatrix":
+        with open(path, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                return cls(b"", dim, path)
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buf, dim, path)
+
+    @classmethod
+    def write(cls, vectors: Sequence[Sequence[float]], path: Optional[str] = None, directory: Optional[str] = None) -> "VectorMatrix":
+        """
+        Ghi vectors (chuẩn hoá, float32) ra file rồi mmap lại. path None -> file tạm.
+        vectors là VectorStore: hàng được giải mã về float32, describe() của store giữ ở .source.
+        """
+        dim = len(vectors[0]) if len(vectors) else 0
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="vectors-", suffix=".f32", dir=directory)
+            os.close(fd)
+        with open(path, "wb") as f:
+            for v in vectors:
+                if len(v) != dim:
+                    raise ValueError("all vectors must have the same dimension")
+                array("f", _unit(v)).tofile(f)
+        matrix = cls.open(path, dim)
+        if isinstance(vectors, VectorStore):
+            matrix.source = vectors.describe()
+        return matrix
+
+    def __len__(self) -> int:
+        return self._rows
+
+    def __getitem__(self, idx: int) -> List[float]:
+        if idx < 0:
+            idx += self._rows
+        if not 0 <= idx < self._rows:
+            raise IndexError("vector index out of range")
+        return self._view[idx * self.dim:(idx + 1) * self.dim].tolist()
+
+    def __iter__(self):
+        for i in range(self._rows):
+            yield self[i]
+
+    def memory_bytes(self) -> int:
+        return self._rows * self.dim * ITEM_BYTES
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "precision": "float32",
+            "storage": "mmap" if isinstance(self._buf, mmap.mmap) else "memory",
+            "path": self.path,
+            "rows": self._rows,
+            "dim": self.dim,
+            "memory_bytes": self.memory_bytes(),
+            "numpy": self._np is not None,
+            "source": self.source,
+        }
+
+    def scores(self, q_emb: Sequence[float]) -> List[float]:
+        """Cosine của q_emb với mọi hàng (qua batcher nếu có)."""
+        if self.batcher is not None:
+            return self.batcher.submit(q_emb)
+        return self.scores_batch([q_emb])[0]
+
+    def scores_batch(self, q_embs: Sequence[Sequence[float]]) -> List[List[float]]:
+        if not self._rows:
+            return [[] for _ in q_embs]
+        queries = [_unit(q) if len(q) == self.dim else [0.0] * self.dim for q in q_embs]
+        if self._np is not None:
+            product = np.asarray(queries, dtype=np.float32) @ self._np.T
+            return product.tolist()
+
+        out = [[0.0] * self._rows for _ in queries]
+        view, dim = self._view, self.dim
+        for i in range(self._rows):
+            row = view[i * dim:(i + 1) * dim].tolist()
+            for qi, q in enumerate(queries):
+                out[qi][i] = sum(map(float.__mul__, q, row))
+        return out
+
+    def close(self) -> None:
+        self._np = None
+        self._view.release()
+        if isinstance(self._buf, mmap.mmap):
+            self._buf.close()
+
+
+# -----------------------------------------------------------------------------
+# VectorStore: append + precision theo ngân sách bộ nhớ
+# -----------------------------------------------------------------------------
+
+# Thứ tự hạ precision khi vượt ngân sách; "mmap" = float32 trong file tạm (page cache,
+# kernel thu hồi được) thay vì heap của process
+PRECISIONS = ("float32", "float16", "int8", "mmap")
+_NP_DTYPES = {"float32": "float32", "float16": "float16", "int8": "int8", "mmap": "float32"}
+
+
+def _row_bytes(precision: str, dim: int) -> int:
+    if precision == "float16":
+        return 2 * dim
+    if precision == "int8":
+        return dim + 4  # + scale float32
+    return 4 * dim
+
+
+class VectorStore:
+    """
+    Vector (chuẩn hoá L2) thêm dần theo block cố định block_rows hàng; block không
+    bao giờ đổi kích thước nên numpy view / memoryview trên block luôn hợp lệ.
+
+    precision "auto": bắt đầu float32; trước khi cấp block mới, nếu
+    memory_bytes() + block mới + reserved() (vd. metadata chunk) vượt budget_bytes
+    thì chuyển toàn bộ sang mức tiếp theo trong PRECISIONS (từng block một, đỉnh
+    bộ nhớ chỉ thêm một block). budget_bytes None = không giới hạn.
+    """
+
+    def __init__(
+        self,
+        precision: str = "auto",
+        budget_bytes: Optional[int] = None,
+        reserved: Optional[Callable[[], int]] = None,
+        directory: Optional[str] = None,
+        block_rows: int = 2048,
+    ):
+        if precision != "auto" and precision not in PRECISIONS:
+            raise ValueError(f"precision must be auto or one of {PRECISIONS}")
+        self.auto = precision == "auto"
+        self.precision = PRECISIONS[0] if self.auto else precision
+        self.budget_bytes = budget_bytes
+        self.reserved = reserved or (lambda: 0)
+        self.directory = directory
+        self.block_rows = max(1, block_rows)
+        self.dim = 0
+        self.downgrades: List[Dict[str, Any]] = []
+        self._rows = 0
+        self._blocks: List[bytearray] = []
+        self._scales: List[bytearray] = []   # int8: scale float32 của từng hàng
+        self._views: List[memoryview] = []   # float32 / int8: memoryview đã cast theo block
+        self._file = None                    # mmap: file tạm (đã unlink), float32
+        self._map: Any = None
+        self._map_view: Optional[memoryview] = None
+        self._mapped_rows = 0
+        self._lock = threading.Lock()
+
+    # ---- ghi ----
+
+    def append(self, v: Sequence[float]) -> None:
+        if not self.dim:
+            self.dim = len(v)
+            if self.budget_bytes is not None:
+                # Block nhỏ so với ngân sách để quyết định hạ precision không quá thô
+                self.block_rows = max(64, min(self.block_rows, self.budget_bytes // (16 * 4 * self.dim)))
+        elif len(v) != self.dim:
+            raise ValueError("all vectors must have the same dimension")
+        u = _unit(v)
+        slot = self._rows % self.block_rows
+        if self.precision != "mmap" and slot == 0:
+            self._new_block()
+        if self.precision == "mmap":
+            if self._file is None:
+                self._open_file()
+            self._file.write(array("f", u).tobytes())
+        else:
+            self._encode(len(self._blocks) - 1, slot, u)
+        self._rows += 1
+
+    def plan(self, expected_rows: int) -> str:
+        """
+        Chọn ngay precision cho tổng expected_rows hàng (metadata ước tính tăng theo
+        tỉ lệ số hàng), để không phải hạ qua từng mức (mỗi lần hạ cộng dồn sai số).
+        """
+        if not self.auto or self.budget_bytes is None or not self._rows or expected_rows <= self._rows:
+            return self.precision
+        blocks = -(-expected_rows // self.block_rows)
+        reserved = self.reserved() * expected_rows / self._rows
+        for precision in PRECISIONS[PRECISIONS.index(self.precision):]:
+            if precision == "mmap" or blocks * self._block_bytes(precision) + reserved <= self.budget_bytes:
+                break
+        if precision != self.precision:
+            self._downgrade(precision)
+        return self.precision
+
+    def _open_file(self) -> None:
+        # Đã unlink ngay khi tạo: không để lại file trong /tmp khi container load lại index
+        self._file = tempfile.TemporaryFile(prefix="vectors-", suffix=".f32", dir=self.directory)
+
+    def _block_bytes(self, precision: str) -> int:
+        return self.block_rows * _row_bytes(precision, self.dim)
+
+    def _over_budget(self, extra: int) -> bool:
+        if self.budget_bytes is None:
+            return False
+        return self.memory_bytes() + extra + self.reserved() > self.budget_bytes
+
+    def _new_block(self) -> None:
+        while self.auto and self.precision != "mmap" and self._over_budget(self._block_bytes(self.precision)):
+            self._downgrade(PRECISIONS[PRECISIONS.index(self.precision) + 1])
+        if self.precision != "mmap":
+            self._alloc_block()
+
+    def _alloc_block(self) -> None:
+        if self.precision == "int8":
+            self._blocks.append(bytearray(self.block_rows * self.dim))
+            self._scales.append(bytearray(4 * self.block_rows))
+        else:
+            self._blocks.append(bytearray(self._block_bytes(self.precision)))
+        self._views.append(self._cast(self._blocks[-1], self.precision))
+
+    @staticmethod
+    def _cast(block: bytearray, precision: str) -> Optional[memoryview]:
+        if precision == "float32":
+            return memoryview(block).cast("f")
+        if precision == "int8":
+            return memoryview(block).cast("b")
+        return None  # float16: struct (memoryview không cast được "e")
+
+    def _encode(self, b: int, slot: int, u: List[float]) -> None:
+        dim = self.dim
+        if np is not None and self.precision != "float32":
+            row = np.asarray(u, dtype=np.float32)
+            if self.precision == "float16":
+                self._blocks[b][slot * dim * 2:(slot + 1) * dim * 2] = row.astype(np.float16).tobytes()
+                return
+            peak = float(np.abs(row).max()) if dim else 0.0
+            scale = peak / 127.0 if peak else 1.0
+            self._blocks[b][slot * dim:(slot + 1) * dim] = np.rint(row / scale).astype(np.int8).tobytes()
+            struct.pack_into("<f", self._scales[b], slot * 4, scale)
+            return
+        if self.precision == "float32":
+            self._views[b][slot * dim:(slot + 1) * dim] = array("f", u)
+        elif self.precision == "float16":
+            struct.pack_into(f"<{dim}e", self._blocks[b], slot * dim * 2, *u)
+        else:
+            peak = max(abs(x) for x in u) if u else 0.0
+            scale = peak / 127.0 if peak else 1.0
+            self._views[b][slot * dim:(slot + 1) * dim] = array("b", (int(round(x / scale)) for x in u))
+            struct.pack_into("<f", self._scales[b], slot * 4, scale)
+
+    def _downgrade(self, target: str) -> None:
+        source = self.precision
+        before = self.memory_bytes()
+        old_blocks, old_scales = self._blocks, self._scales
+        rows = self._rows
+        self._blocks, self._scales, self._views = [], [], []
+        self.precision = target
+        if target == "mmap":
+            self._open_file()
+        for b in range(len(old_blocks)):
+            n = min(self.block_rows, rows - b * self.block_rows)
+            decoded = [self._decode(old_blocks[b], old_scales[b] if old_scales else None, slot, source) for slot in range(n)]
+            old_blocks[b] = None  # giải phóng block cũ ngay, đỉnh bộ nhớ chỉ thêm một block
+            if old_scales:
+                old_scales[b] = None
+            if target == "mmap":
+                for row in decoded:
+                    self._file.write(array("f", row).tobytes())
+                continue
+            self._alloc_block()
+            for slot, row in enumerate(decoded):
+                self._encode(b, slot, row)
+        self.downgrades.append({
+            "from": source,
+            "to": target,
+            "rows": rows,
+            "memory_bytes_before": before,
+            "memory_bytes_after": self.memory_bytes(),
+        })
+
+    # ---- đọc ----
+
+    def _decode(self, block: bytearray, scales: Optional[bytearray], slot: int, precision: str) -> List[float]:
+        dim = self.dim
+        if precision == "float16":
+            return list(struct.unpack_from(f"<{dim}e", block, slot * dim * 2))
+        if precision == "int8":
+            scale = struct.unpack_from("<f", scales, slot * 4)[0]
+            return [x * scale for x in memoryview(block).cast("b")[slot * dim:(slot + 1) * dim].tolist()]
+        return memoryview(block).cast("f")[slot * dim:(slot + 1) * dim].tolist()
+
+    def _mapped(self) -> memoryview:
+        """mmap: map lại file khi có hàng mới (segment delta) từ lần map trước."""
+        with self._lock:
+            if self._mapped_rows != self._rows:
+                self._file.flush()
+                if self._map is not None:
+                    try:
+                        self._map_view.release()
+                        self._map.close()
+                    except BufferError:
+                        # scan khác còn giữ buffer của lần map trước -> GC đóng khi hết tham chiếu
+                        pass
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._map_view = memoryview(self._map).cast("f")
+                self._mapped_rows = self._rows
+            return self._map_view
+
+    def __len__(self) -> int:
+        return self._rows
+
+    def __getitem__(self, idx: int) -> List[float]:
+        if idx < 0:
+            idx += self._rows
+        if not 0 <= idx < self._rows:
+            raise IndexError("vector index out of range")
+        if self.precision == "mmap":
+            return self._mapped()[idx * self.dim:(idx + 1) * self.dim].tolist()
+        b, slot = divmod(idx, self.block_rows)
+        return self._decode(self._blocks[b], self._scales[b] if self._scales else None, slot, self.precision)
+
+    def __iter__(self):
+        for i in range(self._rows):
+            yield self[i]
+
+    def _segments(self):
+        """(buffer, scales, số hàng) cho từng block (mmap: một segment là cả file)."""
+        if self.precision == "mmap":
+            if self._rows:
+                yield self._mapped().obj, None, self._rows
+            return
+        for b, block in enumerate(self._blocks):
+            n = min(self.block_rows, self._rows - b * self.block_rows)
+            if n > 0:
+                yield block, self._scales[b] if self._scales else None, n
+
+    def scores(self, q_emb: Sequence[float]) -> List[float]:
+        """Cosine của q_emb với mọi hàng."""
+        return self.scores_batch([q_emb])[0]
+
+    def scores_batch(self, q_embs: Sequence[Sequence[float]]) -> List[List[float]]:
+        if not self._rows:
+            return [[] for _ in q_embs]
+        queries = [_unit(q) if len(q) == self.dim else [0.0] * self.dim for q in q_embs]
+        out: List[List[float]] = [[] for _ in queries]
+        dim, precision = self.dim, self.precision
+
+        if np is not None:
+            qmat = np.asarray(queries, dtype=np.float32)
+            for buf, scales, n in self._segments():
+                rows = np.frombuffer(buf, dtype=_NP_DTYPES[precision], count=n * dim).reshape(n, dim)
+                if precision != "float32" and precision != "mmap":
+                    rows = rows.astype(np.float32)
+                product = rows @ qmat.T
+                if scales is not None:
+                    product *= np.frombuffer(scales, dtype=np.float32, count=n)[:, None]
+                for qi, col in enumerate(product.T.tolist()):
+                    out[qi].extend(col)
+            return out
+
+        for buf, scales, n in self._segments():
+            for slot in range(n):
+                row = self._decode(buf, scales, slot, "float32" if precision == "mmap" else precision)
+                for qi, q in enumerate(queries):
+                    out[qi].append(sum(map(float.__mul__, q, row)))
+        return out
+
+    # ---- kế toán bộ nhớ ----
+
+    def memory_bytes(self) -> int:
+        """Bộ nhớ heap đã cấp cho vector (kể cả phần trống của block cuối)."""
+        return sum(len(b) for b in self._blocks) + sum(len(s) for s in self._scales)
+
+    def disk_bytes(self) -> int:
+        return self._rows * self.dim * ITEM_BYTES if self.precision == "mmap" else 0
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "precision": self.precision,
+            "auto": self.auto,
+            "rows": self._rows,
+            "dim": self.dim,
+            "memory_bytes": self.memory_bytes(),
+            "disk_bytes": self.disk_bytes(),
+            "budget_bytes": self.budget_bytes,
+            "numpy": np is not None,
+            "downgrades": list(self.downgrades),
+        }
+
+
+class MicroBatcher:
+    """
+    Gộp các lời gọi đồng thời thành lô: thread gọi submit(item) và chờ; một thread
+    nền lấy tối đa max_batch item (chờ thêm tối đa max_wait_ms sau item đầu tiên)
+    rồi gọi fn(items) -> list kết quả cùng thứ tự.
+    """
+
+    def __init__(self, fn: Callable[[List[Any]], List[Any]], max_batch: int = 32, max_wait_ms: float = 2.0):
+        self.fn = fn
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000.0
+        self.stats = {"batches": 0, "items": 0, "max_batch": 0}
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, item: Any) -> Any:
+        future: Future = Future()
+        self._queue.put((item, future))
+        return future.result()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                results = self.fn([item for item, _ in batch])
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            self.stats["batches"] += 1
+            self.stats["items"] += len(batch)
+            self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))